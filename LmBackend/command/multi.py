@@ -69,7 +69,9 @@ class MultiSpeciesRunCommand(_LmCommand):
                  diversity_stats_filename=None, site_stats_filename=None,
                  species_stats_filename=None, site_covariance_filename=None,
                  species_covariance_filename=None, mcpa_output_filename=None,
-                 mcpa_f_matrix_filename=None, pam_success_filename=None):
+                 mcpa_f_matrix_filename=None, pam_success_filename=None,
+                 batched=False, random_seed=None, first_permutation=None,
+                 summarize=False, observed_filenames=None):
         """Constructor for command object
 
         Args:
@@ -106,6 +108,21 @@ class MultiSpeciesRunCommand(_LmCommand):
                 store MCPA observed outputs
             mcpa_f_matrix_filename (:obj: `str`, optional): The file location
                 to store MCPA F-values
+            pam_success_filename (:obj: `str`, optional): The file location
+                of a success file that must exist before this command runs
+            batched (:obj: `bool`, optional): A boolean value indicating if
+                the batched version of MCPA should be used
+            random_seed (:obj: `int`, optional): The base random seed for
+                permutations
+            first_permutation (:obj: `int`, optional): The index of the first
+                permutation performed by this command.  Groups of permutations
+                sharing a random seed need distinct first permutations.
+            summarize (:obj: `bool`, optional): If True, permuted runs write
+                summary matrices of permutation counts, means, variances and
+                exceedances instead of every permuted matrix
+            observed_filenames (:obj: `dict`, optional): A dictionary of
+                output option name (such as 'site_stats_filename') to the
+                observed matrix file that exceedances are counted against
         """
         _LmCommand.__init__(self)
         self.opt_args = ''
@@ -114,6 +131,20 @@ class MultiSpeciesRunCommand(_LmCommand):
         self.inputs.append(pam_filename)
         if parallel:
             self.opt_args += ' -p'
+        if batched:
+            self.opt_args += ' --batched'
+        if random_seed is not None:
+            self.opt_args += ' --random_seed={}'.format(random_seed)
+        if first_permutation is not None:
+            self.opt_args += ' --first_permutation={}'.format(
+                first_permutation)
+        if summarize:
+            self.opt_args += ' --summarize'
+        if observed_filenames is not None:
+            for option, observed_filename in observed_filenames.items():
+                self.inputs.append(observed_filename)
+                self.opt_args += ' --observed_{}={}'.format(
+                    option, observed_filename)
         # Inputs
         if grim_filename is not None:
             self.inputs.append(grim_filename)
@@ -205,6 +236,55 @@ class OccurrenceBucketeerCommand(_LmCommand):
             self.opt_args += ' -header'
 
 
+# .............................................................................
+class OccurrenceGrouperCommand(_LmCommand):
+    """This command will split CSV files into groups in a single pass
+    """
+    relative_directory = MULTI_SPECIES_SCRIPTS_DIR
+    script_name = 'occurrence_grouper.py'
+
+    # ................................
+    def __init__(self, group_position, in_file_name, out_dir, prefix=None,
+                 header_row=False, index_file_name=None, group_files=True,
+                 num_partitions=None):
+        """Construct the command object
+
+        Args:
+            group_position: The field to group on
+            in_file_name: A file location or list of file locations to use as
+                input
+            out_dir: A directory location to write the output files
+            prefix: A file name prefix to use for the output files
+            header_row: Do the input files have a header row?
+            index_file_name: If provided, write an index of the byte offsets
+                of each group in sorted partition files to this location
+            group_files: Write a file for each group
+            num_partitions: The number of partitions to hash groups into
+        """
+        _LmCommand.__init__(self)
+
+        if not isinstance(in_file_name, list):
+            in_file_name = [in_file_name]
+
+        self.inputs.extend(in_file_name)
+        # Group files are not deterministic from inputs
+        if index_file_name is not None:
+            self.outputs.append(index_file_name)
+
+        self.args = '{} {} {}'.format(
+            group_position, out_dir, ' '.join(in_file_name))
+        if prefix is not None:
+            self.opt_args += ' -p {}'.format(prefix)
+        if header_row:
+            self.opt_args += ' -header'
+        if index_file_name is not None:
+            self.opt_args += ' -i {}'.format(index_file_name)
+        if not group_files:
+            self.opt_args += ' --no_group_files'
+        if num_partitions is not None:
+            self.opt_args += ' -n {}'.format(num_partitions)
+
+
 # .............................................................................
 class OccurrenceSorterCommand(_LmCommand):
     """This command will sort a CSV file on a group field
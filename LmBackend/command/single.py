@@ -1,9 +1,26 @@
 """Module containing command objects for operations on single species
 """
+import json
 import os
 
 from LmBackend.command.base import _LmCommand
-from LmBackend.common.lmconstants import SINGLE_SPECIES_SCRIPTS_DIR
+from LmBackend.common.lmconstants import (
+    GrimEncodingMethod, RasterManifestKey, SINGLE_SPECIES_SCRIPTS_DIR)
+from LmCommon.common.lmconstants import ENCODING
+from LmCommon.common.ready_file import ready_filename
+
+
+# .............................................................................
+def _write_manifest(manifest_file_name, entries):
+    """Write a raster batch manifest
+
+    Args:
+        manifest_file_name: The file location to write the manifest
+        entries: A list of manifest entry dictionaries
+    """
+    ready_filename(manifest_file_name, overwrite=True)
+    with open(manifest_file_name, 'w', encoding=ENCODING) as out_file:
+        json.dump(entries, out_file)
 
 
 # .............................................................................
@@ -38,7 +55,150 @@ class GrimRasterCommand(_LmCommand):
         if minPercent:
             self.opt_args += ' -m largest_class'
         if ident is not None:
-            self.opt_args += '-i {}'.format(ident)
+            self.opt_args += ' -i {}'.format(ident)
+
+
+# .............................................................................
+class GrimRasterBatchCommand(_LmCommand):
+    """This command intersects a manifest of raster layers for GRIM columns
+
+    Add each raster with `add_raster` and write the manifest with
+    `write_manifest` before the makeflow runs.
+    """
+    relative_directory = SINGLE_SPECIES_SCRIPTS_DIR
+    script_name = 'grim_raster.py'
+
+    # ................................
+    def __init__(self, shapegrid_file_name, manifest_file_name,
+                 max_workers=None):
+        """Construct the command object
+
+        Args:
+            shapegrid_file_name: The file location of the shapegrid to
+                intersect
+            manifest_file_name: The file location of the JSON manifest listing
+                each raster and GRIM column file
+            max_workers: The number of rasters to process at once
+        """
+        _LmCommand.__init__(self)
+        self.manifest_file_name = manifest_file_name
+        self.entries = []
+        self.inputs.extend([shapegrid_file_name, manifest_file_name])
+
+        self.args = shapegrid_file_name
+        self.opt_args += ' --manifest={}'.format(manifest_file_name)
+        if max_workers is not None:
+            self.opt_args += ' -w {}'.format(max_workers)
+
+    # ................................
+    def add_raster(self, raster_file_name, grim_col_file_name,
+                   minPercent=None, ident=None):
+        """Add a raster to the manifest
+
+        Args:
+            raster_file_name: The file location of the raster file to intersect
+                with the shapegrid
+            grim_col_file_name: The file location to write the GRIM column
+            minPercent: If provided, use largest class method, otherwise use
+                weighted mean
+            ident: If included, use this for a label on the GRIM column
+        """
+        entry = {
+            RasterManifestKey.RASTER: raster_file_name,
+            RasterManifestKey.GRIM_COLUMN: grim_col_file_name
+        }
+        if minPercent:
+            entry[RasterManifestKey.METHOD] = GrimEncodingMethod.LARGEST_CLASS
+        else:
+            entry[RasterManifestKey.METHOD] = GrimEncodingMethod.MEAN
+        if ident is not None:
+            entry[RasterManifestKey.IDENT] = ident
+        self.entries.append(entry)
+        self.inputs.append(raster_file_name)
+        self.outputs.append(grim_col_file_name)
+
+    # ................................
+    def write_manifest(self):
+        """Write the manifest of added rasters
+        """
+        _write_manifest(self.manifest_file_name, self.entries)
+
+
+# .............................................................................
+class IntersectRasterBatchCommand(_LmCommand):
+    """This command intersects a manifest of raster layers and a shapegrid
+
+    Add each raster with `add_raster` and write the manifest with
+    `write_manifest` before the makeflow runs.
+    """
+    relative_directory = SINGLE_SPECIES_SCRIPTS_DIR
+    script_name = 'intersect_raster.py'
+
+    # ................................
+    def __init__(self, shapegrid_file_name, manifest_file_name,
+                 max_workers=None):
+        """Construct the command object
+
+        Args:
+            shapegrid_file_name: The file location of the shapegrid to
+                intersect
+            manifest_file_name: The file location of the JSON manifest listing
+                each raster, PAV, intersect parameters, and status files
+            max_workers: The number of rasters to process at once
+        """
+        _LmCommand.__init__(self)
+        self.manifest_file_name = manifest_file_name
+        self.entries = []
+        self.inputs.extend([shapegrid_file_name, manifest_file_name])
+
+        self.args = shapegrid_file_name
+        self.opt_args += ' --manifest={}'.format(manifest_file_name)
+        if max_workers is not None:
+            self.opt_args += ' -w {}'.format(max_workers)
+
+    # ................................
+    def add_raster(self, raster_file_name, pav_file_name, min_presence,
+                   max_presence, percent_presence, squid=None,
+                   layer_status_file_name=None, status_file_name=None):
+        """Add a raster to the manifest
+
+        Args:
+            raster_file_name: The file location of the raster file to intersect
+                with the shapegrid
+            pav_file_name: The file location to write the resulting PAV
+            min_presence: The minimum value to be considered present
+            max_presence: The maximum value to be considered present
+            percent_presence: The percent of a shapegrid feature that must be
+                present to be considered present
+            squid: If included, use this for a label on the PAV
+            layer_status_file_name: If provided, check this for the status of
+                the input layer object
+            status_file_name: If provided, write out status to this location
+        """
+        entry = {
+            RasterManifestKey.RASTER: raster_file_name,
+            RasterManifestKey.PAV: pav_file_name,
+            RasterManifestKey.MIN_PRESENCE: min_presence,
+            RasterManifestKey.MAX_PRESENCE: max_presence,
+            RasterManifestKey.MIN_COVERAGE: percent_presence
+        }
+        self.inputs.append(raster_file_name)
+        self.outputs.append(pav_file_name)
+        if squid is not None:
+            entry[RasterManifestKey.SQUID] = squid
+        if layer_status_file_name is not None:
+            entry[RasterManifestKey.LAYER_STATUS] = layer_status_file_name
+            self.inputs.append(layer_status_file_name)
+        if status_file_name is not None:
+            entry[RasterManifestKey.STATUS] = status_file_name
+            self.outputs.append(status_file_name)
+        self.entries.append(entry)
+
+    # ................................
+    def write_manifest(self):
+        """Write the manifest of added rasters
+        """
+        _write_manifest(self.manifest_file_name, self.entries)
 
 
 # .............................................................................
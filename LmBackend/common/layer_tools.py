@@ -15,6 +15,7 @@ import numpy
 from osgeo import gdal
 
 from LmCommon.common.lmconstants import (LMFormat, DEFAULT_NODATA, ENCODING)
+from LmCommon.common.raster_blocks import RasterBlockReader
 from LmCompute.common.lmconstants import (
     CONVERT_JAVA_CMD, CONVERT_TOOL, ME_CMD)
 
@@ -51,49 +52,50 @@ def convert_and_modify_ascii_to_tiff(asc_file_name, tiff_file_name, scale=None,
 
     in_nodata_value = band.GetNoDataValue()
 
-    data = src_ds.ReadAsArray(0, 0, src_ds.RasterXSize, src_ds.RasterYSize)
-
     # If scale
     if scale is not None:
         scale_min, scale_max = scale
         lyr_min = band.GetMinimum()
         lyr_max = band.GetMaximum()
 
-        def scale_func(cell_value):
+        def modify_func(data):
             """Function to scale layer values.
             """
-            if cell_value == in_nodata_value:
-                return nodata_value
-
             return (scale_max - scale_min) * (
-                (cell_value - lyr_min) / (lyr_max - lyr_min)) + scale_min
-
-        data = numpy.vectorize(scale_func)(data)
+                (data - lyr_min) / (lyr_max - lyr_min)) + scale_min
 
     # If multiply
     elif multiplier is not None:
 
-        def multiply_func(cell_value):
+        def modify_func(data):
             """Function to multiply layer values.
             """
-            if cell_value == in_nodata_value:
-                return nodata_value
-            return multiplier * cell_value
+            return multiplier * data
 
-        data = numpy.vectorize(multiply_func)(data)
+    else:
+        modify_func = None
 
-    data = data.astype(np_type)
     driver = gdal.GetDriverByName('GTiff')
     dst_ds = driver.Create(
         tiff_file_name, src_ds.RasterXSize, src_ds.RasterYSize, 1, gdal_type)
+    dst_band = dst_ds.GetRasterBand(1)
+
+    # Process the layer a block at a time so memory does not grow with the
+    #    size of the layer
+    with RasterBlockReader(src_ds) as reader:
+        for x_off, y_off, data in reader.iter_blocks():
+            if modify_func is not None:
+                data = numpy.where(
+                    data == in_nodata_value, nodata_value, modify_func(data))
+            dst_band.WriteArray(data.astype(np_type), x_off, y_off)
 
-    dst_ds.GetRasterBand(1).WriteArray(data)
-    dst_ds.GetRasterBand(1).SetNoDataValue(nodata_value)
-    dst_ds.GetRasterBand(1).ComputeStatistics(True)
+    dst_band.SetNoDataValue(nodata_value)
+    dst_band.ComputeStatistics(True)
 
     dst_ds.SetProjection(src_ds.GetProjection())
     dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
 
+    dst_band = None
     driver = None
     dst_ds = None
     src_ds = None
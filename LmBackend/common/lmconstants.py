@@ -23,6 +23,34 @@ class MaskMethod:
     BLANK_MASK = 'blank_mask'
 
 
+# .............................................................................
+class GrimEncodingMethod:
+    """Constants for the methods used to encode a raster as a GRIM column
+    """
+    LARGEST_CLASS = 'largest_class'
+    MEAN = 'mean'
+
+
+# .............................................................................
+class RasterManifestKey:
+    """Constants for the keys of raster intersect batch manifest entries
+
+    A manifest is a JSON list of objects with these keys, one for each raster
+    to intersect with the same shapegrid.
+    """
+    RASTER = 'raster_filename'
+    PAV = 'pav_filename'
+    MIN_PRESENCE = 'min_presence'
+    MAX_PRESENCE = 'max_presence'
+    MIN_COVERAGE = 'min_coverage'
+    SQUID = 'squid'
+    LAYER_STATUS = 'layer_status_file'
+    STATUS = 'status_file'
+    GRIM_COLUMN = 'grim_column_filename'
+    METHOD = 'method'
+    IDENT = 'ident'
+
+
 # .............................................................................
 class RegistryKey:
     """Constants for dictionary keys used when processing single species SDMs
@@ -0,0 +1,72 @@
+"""Tests for the block by block layer conversion in layer_tools.py
+"""
+import functools
+
+import numpy as np
+from osgeo import gdal
+import pytest
+
+from LmBackend.common import layer_tools
+from LmCommon.common.raster_blocks import (
+    DEFAULT_BLOCK_MEMORY, RasterBlockReader)
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+ASCII_NODATA = -9999
+# Values range from 0 to 10, so scaling to (0, 100) multiplies them by 10
+ASCII_DATA = np.array([
+    [0, 1, 2, 3, 4, 5, 6],
+    [7, 8, ASCII_NODATA, 9, 10, 1, 2],
+    [3, 4, 5, 6, 7, 8, ASCII_NODATA],
+    [9, 10, 0, 1, 2, 3, 4],
+    [ASCII_NODATA, 5, 6, 7, 8, 9, 10],
+])
+GEO_TRANSFORM = (-5.0, 2.0, 0.0, 10.0, 0.0, -2.0)
+TIFF_NODATA = 127
+
+
+# .............................................................................
+def _write_ascii(filename):
+    """Writes the data as an ASCII grid"""
+    num_rows, num_cols = ASCII_DATA.shape
+    with open(filename, 'w') as out_file:
+        out_file.write('ncols {}\n'.format(num_cols))
+        out_file.write('nrows {}\n'.format(num_rows))
+        out_file.write('xllcorner {}\n'.format(GEO_TRANSFORM[0]))
+        out_file.write('yllcorner {}\n'.format(
+            GEO_TRANSFORM[3] + num_rows * GEO_TRANSFORM[5]))
+        out_file.write('cellsize {}\n'.format(GEO_TRANSFORM[1]))
+        out_file.write('NODATA_value {}\n'.format(ASCII_NODATA))
+        for row in ASCII_DATA:
+            out_file.write('{}\n'.format(' '.join(str(val) for val in row)))
+
+
+# .............................................................................
+@pytest.mark.parametrize('memory_limit', [1, DEFAULT_BLOCK_MEMORY])
+@pytest.mark.parametrize(
+    'kwargs, multiplier', [
+        ({'multiplier': 3}, 3), ({'scale': (0, 100)}, 10)])
+def test_convert_and_modify_ascii_to_tiff(tmp_path, monkeypatch,
+                                          memory_limit, kwargs, multiplier):
+    """Converted blocks are modified and written where they were read"""
+    # Small memory limits read the layer a row at a time
+    monkeypatch.setattr(
+        layer_tools, 'RasterBlockReader',
+        functools.partial(RasterBlockReader, memory_limit=memory_limit))
+    asc_filename = str(tmp_path / 'layer.asc')
+    tiff_filename = str(tmp_path / 'layer.tif')
+    _write_ascii(asc_filename)
+
+    layer_tools.convert_and_modify_ascii_to_tiff(
+        asc_filename, tiff_filename, nodata_value=TIFF_NODATA, **kwargs)
+
+    dataset = gdal.Open(tiff_filename)
+    band = dataset.GetRasterBand(1)
+    assert band.GetNoDataValue() == TIFF_NODATA
+    assert tuple(dataset.GetGeoTransform()) == GEO_TRANSFORM
+    assert np.array_equal(
+        band.ReadAsArray(),
+        np.where(
+            ASCII_DATA == ASCII_NODATA, TIFF_NODATA, multiplier * ASCII_DATA))
+    band = dataset = None
@@ -7,6 +7,11 @@ observed values.  The values in this layer will indicate what proportion of the
 values, or absolute values, from the permuted matrices are larger than the
 observed.  Finally, the third layer will indicate which cells should be
 considered significant after undergoing p-value correction.
+
+Random matrix files may also be permutation summaries with permutation and
+exceedance count layers.  Their counts are merged rather than compared, and
+files are loaded one at a time so memory use does not depend on the number of
+permutations.
 """
 import argparse
 
@@ -177,6 +177,7 @@ class LMFormat:
     NEXUS = FileFormat('.nex', 'text/plain', all_extensions=['.nex', '.nxs'])
     NEWICK = FileFormat('.tre', 'text/plain', all_extensions=['.tre', '.nhx'])
     NUMPY = FileFormat('.npy', 'application/octet-stream')
+    PACKED_MATRIX = FileFormat('.lmp', 'application/octet-stream')
     PARAMS = FileFormat('.params', 'text/plain')
     PICKLE = FileFormat('.pkl', 'application/octet-stream')
     PROGRESS = FileFormat('.progress', 'application/progress+json')
@@ -187,6 +188,7 @@ class LMFormat:
                         '.fbx', '.ain', '.aih', '.ixs', '.mxs', '.atx',
                         '.shp.xml', '.cpg', '.qix'],
         driver='ESRI Shapefile', default=True, options={'MAX_STRLEN': 254})
+    SPARSE_MATRIX = FileFormat('.lms', 'application/octet-stream')
     TAR_GZ = FileFormat('.tar.gz', 'application/x-gzip')
     TMP = FileFormat('.tmp', 'application/octet-stream')
     TXT = FileFormat('.txt', 'text/plain')
@@ -1,10 +1,13 @@
 """Occurrence data parser
 """
+import bisect
 import csv
 import json
 import os
 import sys
 
+import numpy as np
+
 from LmBackend.common.lmobj import LMError, LMObject
 from LmCommon.common.lmconstants import (
     LMFormat, OFTInteger, OFTReal, OFTString, ENCODING)
@@ -20,6 +23,12 @@ except ImportError:
     except ImportError:
         raise Exception('Testing must be done on a Lifemapper instance')
 
+# Note: The number of CSV records OccDataBlockParser reads and validates at
+#    a time
+OCC_BLOCK_SIZE = 50000
+# Extension of the group index written alongside a CSV file
+GROUP_INDEX_EXT = '.gidx'
+
 
 # .............................................................................
 class OccDataParser(LMObject):
@@ -838,6 +847,576 @@ class OccDataParser(LMObject):
         self._csv_reader = None
 
 
+# .............................................................................
+def _is_float(val):
+    """Returns boolean indicating if the value can be converted to a float
+    """
+    try:
+        float(val)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+# .............................................................................
+def _get_float_mask(values):
+    """Returns a boolean array indicating which values convert to floats
+
+    Args:
+        values (numpy array): An array of strings, or of objects when the
+            values were parsed from geopoints.
+    """
+    if values.dtype.kind == 'U':
+        try:
+            values.astype(float)
+            return np.ones(values.shape, dtype=bool)
+        except ValueError:
+            pass
+    return np.fromiter(
+        (_is_float(val) for val in values), dtype=bool, count=len(values))
+
+
+# .............................................................................
+class OccGroupIndex(LMObject):
+    """Sidecar index of the groups in a sorted occurrence CSV file.
+
+    Each entry holds a group value, the byte offset and line number of the
+    first good record of the group, the number of good records and their
+    bounding box.  Entries are appended in file order as groups are read and
+    flushed with each block, so the index of a partly read file is valid up
+    to the last group read.  The index records the size and modification
+    time of the CSV file and is discarded if the file changes.  Group values
+    are written as JSON, so tabs and newlines in them are escaped.
+    """
+
+    # ......................................
+    def __init__(self, logger, csv_fname, index_fname=None):
+        """Constructor
+
+        Args:
+            logger: Logger to use
+            csv_fname: The CSV file that is indexed
+            index_fname: The index file, defaults to the CSV filename with
+                GROUP_INDEX_EXT appended
+        """
+        self.log = logger
+        self.csv_fname = csv_fname
+        if index_fname is None:
+            index_fname = csv_fname + GROUP_INDEX_EXT
+        self.index_fname = index_fname
+        stat = os.stat(csv_fname)
+        self._signature = '# {} {}\n'.format(stat.st_size, stat.st_mtime_ns)
+        self.group_vals = []
+        self.offsets = []
+        self.line_nums = []
+        self.counts = []
+        self.bboxes = []
+        self._group_entries = None
+        self._out_file = None
+        self._is_current = False
+        self.read()
+
+    # ......................................
+    def read(self):
+        """Read entries from an existing index file for the same CSV file
+        """
+        try:
+            with open(self.index_fname, 'r', encoding=ENCODING) as in_file:
+                if in_file.readline() != self._signature:
+                    return
+                self._is_current = True
+                for line in in_file:
+                    vals = line.rstrip('\n').split('\t')
+                    if len(vals) != 8:
+                        break
+                    try:
+                        entry = (
+                            json.loads(vals[0]), int(vals[1]), int(vals[2]),
+                            int(vals[3]),
+                            tuple(float(val) for val in vals[4:]))
+                    except ValueError:
+                        break
+                    self._add(*entry)
+        except IOError:
+            pass
+
+    # ......................................
+    def _add(self, group_val, offset, line_num, count, bbox):
+        self.group_vals.append(group_val)
+        self.offsets.append(offset)
+        self.line_nums.append(line_num)
+        self.counts.append(count)
+        self.bboxes.append(bbox)
+        self._group_entries = None
+
+    # ......................................
+    def append(self, group_val, offset, line_num, count, bbox):
+        """Append an entry for a group that follows the last indexed group
+
+        Returns:
+            bool: False if the entry was already indexed
+        """
+        if self.offsets and offset <= self.offsets[-1]:
+            return False
+        self._add(group_val, offset, line_num, count, bbox)
+        if self._out_file is None:
+            mode = 'a' if self._is_current else 'w'
+            try:
+                self._out_file = open(
+                    self.index_fname, mode, encoding=ENCODING)
+            except IOError as err:
+                self.log.warning('Unable to write group index {}: {}'.format(
+                    self.index_fname, err))
+                self._out_file = False
+            else:
+                if not self._is_current:
+                    self._out_file.write(self._signature)
+                    self._is_current = True
+        if self._out_file:
+            self._out_file.write('{}\t{}\t{}\t{}\t{}\n'.format(
+                json.dumps(group_val), offset, line_num, count,
+                '\t'.join(str(val) for val in bbox)))
+        return True
+
+    # ......................................
+    def flush(self):
+        """Flush appended entries to the index file
+        """
+        if self._out_file:
+            self._out_file.flush()
+
+    # ......................................
+    def close(self):
+        """Close the index file
+        """
+        if self._out_file:
+            self._out_file.close()
+        self._out_file = None
+
+    # ......................................
+    def __len__(self):
+        return len(self.offsets)
+
+    # ......................................
+    def get_entry(self, idx):
+        """Returns (group value, offset, line number, count, bbox) of an entry
+        """
+        return (self.group_vals[idx], self.offsets[idx], self.line_nums[idx],
+                self.counts[idx], self.bboxes[idx])
+
+    # ......................................
+    def find_group(self, group_val):
+        """Returns the index of the first entry for a group value, or None
+        """
+        if self._group_entries is None:
+            self._group_entries = {}
+            for idx, val in enumerate(self.group_vals):
+                self._group_entries.setdefault(val, idx)
+        return self._group_entries.get(group_val)
+
+    # ......................................
+    def find_line(self, line_num):
+        """Returns the index of the last entry starting at or before line_num
+        """
+        idx = bisect.bisect_right(self.line_nums, line_num) - 1
+        if idx < 0:
+            return None
+        return idx
+
+
+# .............................................................................
+class OccDataBlockParser(OccDataParser):
+    """Occurrence data parser that validates records in blocks.
+
+    OccDataBlockParser reads blocks of CSV records into column arrays and
+    tests IDs, coordinates and filter values for the whole block with numpy,
+    rather than testing one line at a time.  Chunks are split at the run
+    boundaries of the group column, so data must be sorted on the GroupBy
+    field, as it is for OccDataParser.  The chunk interface and the
+    statistics reported by print_stats are the same as OccDataParser.
+
+    The file is read in binary so the byte offset of each record is known.
+    Unless disabled, groups are recorded in an OccGroupIndex as they are read
+    and skip_to_record and seek_to_group seek directly to an indexed group
+    rather than reading every record before it.
+
+    Note:
+        * Each record is counted once in the statistics, where OccDataParser
+            tests the first record of each chunk twice.
+        * Seeking assumes records do not contain newlines in quoted fields,
+            so line numbers after a seek count records.
+        * Records skipped by seeking are not counted in the statistics.
+    """
+
+    # ......................................
+    def __init__(self, logger, csv_data_or_fname, metadata, delimiter='\t',
+                 pull_chunks=False, has_header=True,
+                 block_size=OCC_BLOCK_SIZE, use_index=True):
+        """Constructor
+
+        Args:
+            logger: Logger to use for the main thread
+            csv_data_or_fname: filename for CSV data
+            metadata: dictionary or filename containing metadata
+            delimiter: delimiter of values in csv records
+            pull_chunks: use the object to pull chunks of data based on the
+                groupBy column.
+            has_header: Does the CSV file have a header row
+            block_size: The number of CSV records to read into each block
+            use_index: Read and extend the group index of the CSV file
+        """
+        OccDataParser.__init__(
+            self, logger, csv_data_or_fname, metadata, delimiter=delimiter,
+            pull_chunks=pull_chunks, has_header=has_header)
+        self.block_size = block_size
+        self._rows = []
+        self._keys = np.zeros(0, dtype=object)
+        self._line_nums = np.zeros(0, dtype=np.int64)
+        self._run_starts = np.zeros(0, dtype=np.int64)
+        self._pos = 0
+
+        # Replace the text reader with one that tracks byte offsets
+        self._file.close()
+        self._file = open(csv_data_or_fname, 'rb')
+        self._offset = 0
+        self._line_base = 0
+        self._csv_reader = csv.reader(
+            self._iter_lines(), delimiter=self.delimiter)
+
+        self.group_index = None
+        if use_index:
+            self.group_index = OccGroupIndex(logger, csv_data_or_fname)
+        # Group run at the end of the last block, not yet indexed
+        self._index_run = None
+
+    # ......................................
+    def _iter_lines(self):
+        """Generator yielding decoded lines and counting bytes read
+        """
+        for line in self._file:
+            self._offset += len(line)
+            yield line.decode(ENCODING, errors='replace')
+
+    # ......................................
+    @property
+    def curr_rec_num(self):
+        """Get the line number of the current record
+        """
+        if self.curr_line is not None:
+            return int(self._line_nums[self._pos])
+        if self._csv_reader:
+            return self._line_base + self._csv_reader.line_num
+        if self.closed:
+            return -9999
+        return None
+
+    # ......................................
+    @property
+    def closed(self):
+        """Return boolean indicating if the file and buffer are exhausted
+        """
+        return self._file.closed and self._pos >= len(self._rows)
+
+    # ......................................
+    def close(self):
+        """Close the file and discard buffered records
+        """
+        OccDataParser.close(self)
+        self._rows = []
+        self._pos = 0
+        self.curr_line = self.group_val = None
+        if self.group_index is not None:
+            self.group_index.close()
+
+    # ......................................
+    def _read_rows(self):
+        """Reads the next block of rows, their line numbers and byte offsets
+        """
+        rows = []
+        line_nums = []
+        offsets = []
+        while self._csv_reader is not None and len(rows) < self.block_size:
+            offset = self._offset
+            try:
+                row = next(self._csv_reader)
+            except StopIteration:
+                self.log.debug('EOF after rec {}'.format(
+                    self._line_base + self._csv_reader.line_num))
+                OccDataParser.close(self)
+            except (csv.Error, OverflowError) as err:
+                self.log.warning('Bad record {}'.format(err))
+            else:
+                rows.append(row)
+                line_nums.append(self._line_base + self._csv_reader.line_num)
+                offsets.append(offset)
+        return (rows, np.array(line_nums, dtype=np.int64),
+                np.array(offsets, dtype=np.int64))
+
+    # ......................................
+    def _get_column(self, rows, idx):
+        """Returns the values of one field of the rows as a string array
+        """
+        return np.array([row[idx] for row in rows], dtype=str)
+
+    # ......................................
+    def _get_group_keys(self, values):
+        """Returns group values, as int where possible, for a string array
+        """
+        uniques, inverse = np.unique(values, return_inverse=True)
+        unique_keys = np.empty(len(uniques), dtype=object)
+        for i, val in enumerate(uniques):
+            try:
+                unique_keys[i] = int(val)
+            except ValueError:
+                unique_keys[i] = str(val)
+        self.group_vals.update(unique_keys)
+        return unique_keys[inverse]
+
+    # ......................................
+    def _test_block(self, rows):
+        """Tests a block of rows, updating statistics
+
+        Returns:
+            tuple: Indices of the good rows, their group values and x and y
+                coordinates
+        """
+        lengths = np.fromiter(
+            (len(row) for row in rows), dtype=np.int64, count=len(rows))
+        if np.any(lengths == 1):
+            self.log.info(
+                'Line has only one element - is delimiter set correctly?')
+        num_short = np.count_nonzero(
+            (lengths > 0) & (lengths < self.field_count))
+        if num_short > 0:
+            self.log.warning(
+                'Bad record: {} lines have fewer than {} fields'.format(
+                    num_short, self.field_count))
+        valid_idxs = np.flatnonzero(lengths >= self.field_count)
+        valid_rows = [rows[i] for i in valid_idxs]
+        self.rec_total += len(valid_rows)
+        good = np.ones(len(valid_rows), dtype=bool)
+
+        # Field filters, values compared lowercase
+        for filter_idx, accepted_vals in self.filters.items():
+            if accepted_vals is None:
+                continue
+            vals = np.char.lower(self._get_column(valid_rows, filter_idx))
+            bad = ~np.isin(
+                vals, [val for val in accepted_vals if isinstance(val, str)])
+            self.bad_filter_vals.update(np.unique(vals[bad]).tolist())
+            self.bad_filters += int(np.count_nonzero(bad))
+            good &= ~bad
+
+        # Sort/Group value; may be a string or integer
+        keys = self._get_group_keys(
+            self._get_column(valid_rows, self._group_by_idx))
+
+        # If present, unique ID value
+        if self._id_idx is not None:
+            bad = self._get_column(valid_rows, self._id_idx) == ''
+            self.bad_ids += int(np.count_nonzero(bad))
+            good &= ~bad
+
+        # Lat/long values, from x and y fields or parsed from a geopoint
+        if self._x_idx is not None and self._y_idx is not None:
+            x_vals = self._get_column(valid_rows, self._x_idx)
+            y_vals = self._get_column(valid_rows, self._y_idx)
+        else:
+            parse_point = np.frompyfunc(
+                lambda point: self.get_xy((point,), None, None, 0), 1, 2)
+            x_vals, y_vals = parse_point(
+                self._get_column(valid_rows, self._geo_idx))
+        has_xy = _get_float_mask(x_vals) & _get_float_mask(y_vals)
+        self.bad_geos += int(np.count_nonzero(~has_xy))
+        good &= has_xy
+
+        self.rec_total_good += int(np.count_nonzero(good))
+        return (valid_idxs[good], keys[good], x_vals[good].astype(float),
+                y_vals[good].astype(float))
+
+    # ......................................
+    def _index_block(self, keys, offsets, line_nums, x_vals, y_vals):
+        """Appends complete group runs of a block of good records to the index
+        """
+        if len(keys) > 0:
+            starts = np.concatenate(
+                ([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+            counts = np.diff(np.append(starts, len(keys)))
+            bboxes = np.column_stack((
+                np.fmin.reduceat(x_vals, starts),
+                np.fmin.reduceat(y_vals, starts),
+                np.fmax.reduceat(x_vals, starts),
+                np.fmax.reduceat(y_vals, starts)))
+            for start, count, bbox in zip(starts, counts, bboxes):
+                run = self._index_run
+                if run is not None and run[0] == keys[start]:
+                    # Group continues from the previous block
+                    run[3] += int(count)
+                    run[4] = (min(run[4][0], bbox[0]), min(run[4][1], bbox[1]),
+                              max(run[4][2], bbox[2]), max(run[4][3], bbox[3]))
+                else:
+                    if run is not None:
+                        self.group_index.append(*run)
+                    self._index_run = [
+                        keys[start], int(offsets[start]),
+                        int(line_nums[start]), int(count),
+                        tuple(float(val) for val in bbox)]
+        if self._csv_reader is None and self._index_run is not None:
+            self.group_index.append(*self._index_run)
+            self._index_run = None
+        self.group_index.flush()
+
+    # ......................................
+    def _read_block(self):
+        """Reads and tests a block, appending good records to the buffer
+
+        Returns:
+            bool: False if the file was already exhausted
+        """
+        if self._csv_reader is None:
+            return False
+        rows, line_nums, offsets = self._read_rows()
+        good_idxs, keys, x_vals, y_vals = self._test_block(rows)
+        if self.group_index is not None:
+            self._index_block(
+                keys, offsets[good_idxs], line_nums[good_idxs], x_vals,
+                y_vals)
+
+        # Keep unconsumed records from the previous block
+        self._rows = self._rows[self._pos:] + [rows[i] for i in good_idxs]
+        self._keys = np.concatenate((self._keys[self._pos:], keys))
+        self._line_nums = np.concatenate(
+            (self._line_nums[self._pos:], line_nums[good_idxs]))
+        self._pos = 0
+        self._run_starts = np.flatnonzero(
+            self._keys[1:] != self._keys[:-1]) + 1
+        return True
+
+    # ......................................
+    def _fill_buffer(self):
+        """Reads blocks until a record is available at the buffer position
+
+        Returns:
+            bool: True if there is a current record
+        """
+        while self._pos >= len(self._rows):
+            if not self._read_block():
+                return False
+        return True
+
+    # ......................................
+    def _set_current(self):
+        """Fills in self.group_val and self.curr_line from the buffer
+        """
+        if self._fill_buffer():
+            self.curr_line = self._rows[self._pos]
+            self.group_val = self._keys[self._pos]
+        else:
+            self.curr_line = self.group_val = None
+
+    # ......................................
+    def _seek(self, offset, line_num):
+        """Moves to the record at a byte offset and line number
+        """
+        if self._file.closed:
+            self._file = open(self.csv_fname, 'rb')
+        self._file.seek(offset)
+        self._offset = offset
+        self._line_base = line_num - 1
+        self._csv_reader = csv.reader(
+            self._iter_lines(), delimiter=self.delimiter)
+        self._rows = []
+        self._keys = np.zeros(0, dtype=object)
+        self._line_nums = np.zeros(0, dtype=np.int64)
+        self._run_starts = np.zeros(0, dtype=np.int64)
+        self._pos = 0
+        self._index_run = None
+        self._set_current()
+
+    # ......................................
+    def seek_to_group(self, group_val):
+        """Moves to the first record of an indexed group
+
+        Returns:
+            bool: False if the group is not in the index
+        """
+        idx = None
+        if self.group_index is not None:
+            idx = self.group_index.find_group(group_val)
+        if idx is None:
+            return False
+        _, offset, line_num, _, _ = self.group_index.get_entry(idx)
+        self._seek(offset, line_num)
+        return True
+
+    # ......................................
+    def skip_to_record(self, target_num):
+        """Skips records on lines before target_num.
+
+        Moves directly to the last indexed group starting before target_num,
+        then reads forward.
+        """
+        if self.group_index is not None:
+            idx = self.group_index.find_line(target_num)
+            curr_num = self.curr_rec_num or 0
+            if idx is not None:
+                _, offset, line_num, _, _ = self.group_index.get_entry(idx)
+                if line_num > curr_num:
+                    self.log.info('Seek to line {} at byte {}'.format(
+                        line_num, offset))
+                    self._seek(offset, line_num)
+        while self._fill_buffer():
+            idx = int(np.searchsorted(self._line_nums, target_num))
+            if idx < len(self._rows):
+                self._pos = max(self._pos, idx)
+                break
+            self._pos = len(self._rows)
+        self._set_current()
+
+    # ......................................
+    def read_all_recs(self):
+        """Read all records
+        """
+        while self._fill_buffer():
+            self._pos = len(self._rows)
+        self._set_current()
+
+    # ......................................
+    def pull_next_valid_rec(self):
+        """Fills in self.group_val and self.curr_line with the next record
+        """
+        if self.curr_line is not None:
+            self._pos += 1
+        self._set_current()
+
+    # ......................................
+    def pull_current_chunk(self):
+        """Returns chunk for self.group_val
+        """
+        chunk_group = self.group_by_value
+        chunk_name = self.name_value
+        chunk = []
+
+        if self.curr_line is not None:
+            chunk_group = self.group_val
+            while True:
+                run_idx = np.searchsorted(
+                    self._run_starts, self._pos, side='right')
+                if run_idx < len(self._run_starts):
+                    run_end = int(self._run_starts[run_idx])
+                else:
+                    run_end = len(self._rows)
+                chunk.extend(self._rows[self._pos:run_end])
+                self._pos = run_end
+                # Continue while the group runs into the next block
+                if (run_end < len(self._rows) or not self._fill_buffer()
+                        or self._keys[self._pos] != chunk_group):
+                    break
+            self._set_current()
+            self.group_first_rec = self.curr_rec_num
+        return chunk, chunk_group, chunk_name
+
+
 # .............................................................................
 def test_run():
     """Test the module
@@ -0,0 +1,221 @@
+"""Module containing a block reader for streaming GDAL raster bands
+
+Note:
+    Rasters are read in windows aligned to the native block size of the band
+        so that GDAL never decompresses a block more than once.  Windows span
+        as many blocks as fit in the memory limit, so peak memory is bounded
+        independently of the raster size.
+
+Note:
+    Uncompressed rasters that GDAL can memory map are read through the memory
+        map instead, windows are then views of the file and are not copied.
+"""
+import numpy as np
+from osgeo import gdal
+
+# Note: The default maximum number of bytes read from a band at a time
+DEFAULT_BLOCK_MEMORY = 64 * 1024 ** 2
+
+
+# .............................................................................
+class RasterBlockReader:
+    """Class for reading a raster band in memory-bounded windows
+    """
+
+    # ...........................
+    def __init__(self, raster, band_num=1, memory_limit=DEFAULT_BLOCK_MEMORY,
+                 use_mmap=True):
+        """Constructor
+
+        Args:
+            raster (str or gdal.Dataset): The file location of a raster or an
+                open GDAL dataset.
+            band_num (int): The band of the raster to read.
+            memory_limit (int): The maximum number of bytes to read at a time.
+                Windows are never smaller than one native block.
+            use_mmap (bool): If True, memory map uncompressed rasters when
+                GDAL supports it.
+        """
+        if isinstance(raster, str):
+            self.dataset = gdal.Open(raster)
+            if self.dataset is None:
+                raise IOError('Could not open raster {}'.format(raster))
+        else:
+            self.dataset = raster
+        self.band = self.dataset.GetRasterBand(band_num)
+        self.num_cols = self.dataset.RasterXSize
+        self.num_rows = self.dataset.RasterYSize
+        self.nodata = self.band.GetNoDataValue()
+        self.geo_transform = self.dataset.GetGeoTransform()
+
+        self._mmap = None
+        if use_mmap:
+            self._mmap = self._get_memory_map()
+        if self._mmap is not None:
+            self.dtype = self._mmap.dtype
+        else:
+            self.dtype = self.band.ReadAsArray(0, 0, 1, 1).dtype
+        self.window_cols, self.window_rows = self._get_window_size(
+            memory_limit)
+
+    # ...........................
+    def __enter__(self):
+        return self
+
+    # ...........................
+    def __exit__(self, *args):
+        self.close()
+
+    # ...........................
+    @property
+    def shape(self):
+        """Returns the (rows, columns) shape of the band
+        """
+        return (self.num_rows, self.num_cols)
+
+    # ...........................
+    @property
+    def bbox(self):
+        """Returns the (min x, min y, max x, max y) bounding box of the band
+        """
+        min_x, x_res, _, max_y, _, y_res = self.geo_transform
+        return (min_x, max_y + (y_res * self.num_rows),
+                min_x + (x_res * self.num_cols), max_y)
+
+    # ...........................
+    def _get_memory_map(self):
+        """Returns a memory mapped array of the band or None if unsupported
+        """
+        compression = self.dataset.GetMetadataItem(
+            'COMPRESSION', 'IMAGE_STRUCTURE')
+        if compression is not None:
+            return None
+        try:
+            return self.band.GetVirtualMemAutoArray(gdal.GF_Read)
+        except Exception:
+            return None
+
+    # ...........................
+    def _get_window_size(self, memory_limit):
+        """Returns the (columns, rows) size of the windows to read
+
+        Args:
+            memory_limit (int): The maximum number of bytes to read at a time.
+        """
+        block_cols, block_rows = self.band.GetBlockSize()
+        block_cols = min(max(block_cols, 1), self.num_cols)
+        block_rows = min(max(block_rows, 1), self.num_rows)
+        item_size = np.dtype(self.dtype).itemsize
+
+        window_cols = self.num_cols
+        if block_rows * window_cols * item_size > memory_limit:
+            window_cols = max(
+                block_cols, memory_limit // (block_rows * item_size)
+                // block_cols * block_cols)
+        window_rows = max(
+            block_rows, memory_limit // (window_cols * item_size)
+            // block_rows * block_rows)
+        return (min(window_cols, self.num_cols),
+                min(window_rows, self.num_rows))
+
+    # ...........................
+    def close(self):
+        """Releases the memory map and the dataset
+        """
+        self._mmap = None
+        self.band = None
+        self.dataset = None
+
+    # ...........................
+    def read_window(self, x_off, y_off, x_size, y_size):
+        """Reads a window of the band
+
+        Args:
+            x_off (int): The first column of the window.
+            y_off (int): The first row of the window.
+            x_size (int): The number of columns in the window.
+            y_size (int): The number of rows in the window.
+
+        Returns:
+            numpy array: The (y_size by x_size) values of the window.  This is
+                a read-only view when the band is memory mapped.
+        """
+        if self._mmap is not None:
+            return self._mmap[y_off:y_off + y_size, x_off:x_off + x_size]
+        return self.band.ReadAsArray(x_off, y_off, x_size, y_size)
+
+    # ...........................
+    def iter_windows(self):
+        """Iterates over the windows covering the band
+
+        Yields:
+            tuple: The (x offset, y offset, x size, y size) of each window.
+        """
+        for y_off in range(0, self.num_rows, self.window_rows):
+            y_size = min(self.window_rows, self.num_rows - y_off)
+            for x_off in range(0, self.num_cols, self.window_cols):
+                yield (x_off, y_off,
+                       min(self.window_cols, self.num_cols - x_off), y_size)
+
+    # ...........................
+    def iter_blocks(self):
+        """Iterates over the band in memory-bounded windows
+
+        Yields:
+            tuple: The x offset, y offset, and values of each window.
+        """
+        for x_off, y_off, x_size, y_size in self.iter_windows():
+            yield (x_off, y_off,
+                   self.read_window(x_off, y_off, x_size, y_size))
+
+    # ...........................
+    def gather(self, flat_idxs, order=None):
+        """Gets the values of the band at flat (row major) cell indices
+
+        Only the windows containing at least one index are read.
+
+        Args:
+            flat_idxs (numpy array): Flat indices of band cells.
+            order (numpy array): Optional indices that sort flat_idxs, these
+                can be computed once for indices used with many rasters.
+
+        Returns:
+            numpy array: The band value for each index.
+
+        Raises:
+            IndexError: If an index is outside of the band.
+        """
+        flat_idxs = np.asarray(flat_idxs, dtype=np.int64)
+        if order is None:
+            order = np.argsort(flat_idxs, kind='stable')
+        sorted_idxs = flat_idxs[order]
+        if sorted_idxs.size > 0 and (
+                sorted_idxs[0] < 0
+                or sorted_idxs[-1] >= self.num_rows * self.num_cols):
+            raise IndexError(
+                'Cell indices must be between 0 and {}'.format(
+                    self.num_rows * self.num_cols - 1))
+        values = np.empty(flat_idxs.shape, dtype=self.dtype)
+
+        for y_off in range(0, self.num_rows, self.window_rows):
+            y_size = min(self.window_rows, self.num_rows - y_off)
+            low, high = np.searchsorted(
+                sorted_idxs,
+                [y_off * self.num_cols, (y_off + y_size) * self.num_cols])
+            if low == high:
+                continue
+            rows = sorted_idxs[low:high] // self.num_cols - y_off
+            cols = sorted_idxs[low:high] % self.num_cols
+            for x_off in range(0, self.num_cols, self.window_cols):
+                x_size = min(self.window_cols, self.num_cols - x_off)
+                if x_size == self.num_cols:
+                    sel = slice(None)
+                else:
+                    sel = np.nonzero(
+                        (cols >= x_off) & (cols < x_off + x_size))[0]
+                    if sel.size == 0:
+                        continue
+                window = self.read_window(x_off, y_off, x_size, y_size)
+                values[order[low:high][sel]] = window[
+                    rows[sel], cols[sel] - x_off]
+        return values
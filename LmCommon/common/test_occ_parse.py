@@ -0,0 +1,174 @@
+"""Tests comparing OccDataBlockParser with OccDataParser on a fixture CSV
+"""
+import os
+
+import pytest
+
+from LmCommon.common.log import TestLogger
+from LmCommon.common.occ_parse import (
+    GROUP_INDEX_EXT, OccDataBlockParser, OccDataParser, OccGroupIndex)
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+# Sorted records, with bad IDs, coordinates and filter values, a short record
+#    and a blank line
+RECORDS = [
+    ['1', '100', 'Aa', '10.5', '20.5', 'observation'],
+    ['2', '100', 'Aa', '11.0', '21.0', 'SPECIMEN'],
+    ['', '100', 'Aa', '12.0', '22.0', 'observation'],
+    ['4', '100', 'Aa', 'x', '23.0', 'observation'],
+    ['5', '205', 'Bb', '-5.25', '4.75', 'observation'],
+    ['6', '205', 'Bb', '-6.0', '5.0', 'fossil'],
+    ['7', '205'],
+    [],
+    ['8', '205', 'Bb', '-7.0', '6.0', 'specimen'],
+    ['9', '310', 'Cc', '', '1.0', 'observation'],
+    ['10', '310', 'Cc', '1.5', '2.5', 'observation'],
+    ['11', '420', 'Dd', '3.0', '4.0', 'observation'],
+    ['12', '420', 'Dd', '3.5', '', 'observation'],
+    ['13', '420', 'Dd', '4.0', '5.0', 'observation'],
+    ['14', '420', 'Dd', '4.5', '5.5', 'observation'],
+    ['15', '530', 'Ee', '0.5', '0.5', 'observation'],
+    ['16', 'abc', 'Ff', '1.0', '1.0', 'observation'],
+    ['17', 'abc', 'Ff', '2.0', '2.0', 'specimen'],
+]
+# Statistics reported by print_stats
+STAT_ATTRIBUTES = [
+    'bad_ids', 'bad_geos', 'bad_groups', 'bad_names', 'bad_filters',
+    'bad_filter_vals', 'group_vals']
+
+
+# .............................................................................
+@pytest.fixture
+def occ_files(occ_data):
+    """Writes the fixture CSV and metadata files"""
+    return occ_data.write('occ.csv', RECORDS)
+
+
+# .............................................................................
+def _read_chunks(parser):
+    """Pulls every chunk from an initialized parser"""
+    chunks = []
+    while parser.curr_line is not None:
+        chunks.append(parser.pull_current_chunk())
+    return chunks
+
+
+# .............................................................................
+def _get_parser(parser_class, occ_files, **kwargs):
+    csv_fname, meta_fname = occ_files
+    parser = parser_class(
+        TestLogger('test_occ_parse'), csv_fname, meta_fname,
+        pull_chunks=True, **kwargs)
+    parser.initialize_me()
+    return parser
+
+
+# .............................................................................
+@pytest.mark.parametrize('block_size', [1, 3, 4, 100])
+def test_same_chunks_and_stats(occ_files, block_size):
+    """Block parsing gives the same chunks and statistics as line parsing"""
+    line_parser = _get_parser(OccDataParser, occ_files)
+    line_chunks = _read_chunks(line_parser)
+    block_parser = _get_parser(
+        OccDataBlockParser, occ_files, block_size=block_size, use_index=False)
+    block_chunks = _read_chunks(block_parser)
+
+    assert [group for _, group, _ in block_chunks] == [
+        100, 205, 310, 420, 530, 'abc']
+    assert [(chunk, group) for chunk, group, _ in block_chunks] == [
+        (chunk, group) for chunk, group, _ in line_chunks]
+    assert block_parser.closed and line_parser.closed
+
+    for attr in STAT_ATTRIBUTES:
+        assert getattr(block_parser, attr) == getattr(line_parser, attr), attr
+    # OccDataParser tests the first record of each chunk twice
+    assert block_parser.rec_total == len([rec for rec in RECORDS if rec]) - 1
+    assert block_parser.rec_total == (
+        line_parser.rec_total - len(line_chunks))
+    assert block_parser.rec_total_good == (
+        line_parser.rec_total_good - len(line_chunks))
+    assert block_parser.rec_total_good == sum(
+        len(chunk) for chunk, _, _ in block_chunks)
+
+    block_parser.print_stats()
+    line_parser.print_stats()
+
+
+# .............................................................................
+@pytest.mark.parametrize('block_size', [1, 3, 100])
+def test_skip_to_record(occ_files, block_size):
+    """Skipping to a line resumes at the first good record on or after it
+
+    Note:
+        * OccDataParser.skip_to_record leaves the prefetched first record
+            current, so the chunks are compared with a full read instead.
+    """
+    full_chunks = _read_chunks(_get_parser(
+        OccDataBlockParser, occ_files, block_size=block_size,
+        use_index=False))
+
+    # The CSV header is line 1, so records start on line 2
+    for line_num, expected_chunks in [
+            (13, full_chunks[3:]), (18, full_chunks[5:]),
+            (12, [(RECORDS[10:11], 310, 'Cc')] + full_chunks[3:])]:
+        block_parser = _get_parser(
+            OccDataBlockParser, occ_files, block_size=block_size,
+            use_index=False)
+        block_parser.skip_to_record(line_num)
+        assert block_parser.curr_rec_num == line_num
+        assert _read_chunks(block_parser) == expected_chunks
+
+
+# .............................................................................
+@pytest.mark.parametrize('block_size', [1, 3, 100])
+def test_group_index(occ_files, block_size):
+    """Groups indexed while reading are sought directly by a new parser"""
+    csv_fname, _ = occ_files
+    full_chunks = _read_chunks(_get_parser(
+        OccDataBlockParser, occ_files, block_size=block_size))
+
+    group_index = OccGroupIndex(TestLogger('test_occ_parse'), csv_fname)
+    assert os.path.exists(csv_fname + GROUP_INDEX_EXT)
+    assert group_index.group_vals == [group for _, group, _ in full_chunks]
+    assert group_index.counts == [len(chunk) for chunk, _, _ in full_chunks]
+    assert group_index.line_nums == [2, 6, 12, 13, 17, 18]
+
+    parser = _get_parser(
+        OccDataBlockParser, occ_files, block_size=block_size)
+    assert parser.seek_to_group(420)
+    assert parser.pull_current_chunk() == full_chunks[3]
+    assert not parser.seek_to_group('missing')
+    assert parser.seek_to_group(100)
+    assert _read_chunks(parser) == full_chunks
+
+    parser = _get_parser(
+        OccDataBlockParser, occ_files, block_size=block_size)
+    parser.skip_to_record(17)
+    assert _read_chunks(parser) == full_chunks[4:]
+
+
+# .............................................................................
+def test_group_index_values(occ_files):
+    """Escaped group values are read back and a changed file is reindexed"""
+    csv_fname, _ = occ_files
+    log = TestLogger('test_occ_parse')
+    group_vals = [7, 'tab\there', 'new\nline', 'back\\slash']
+    group_index = OccGroupIndex(log, csv_fname)
+    for i, group_val in enumerate(group_vals):
+        assert group_index.append(
+            group_val, 10 * (i + 1), i + 2, 1, (0.0, 0.0, 1.0, 1.0))
+    assert not group_index.append(7, 10, 2, 1, (0.0, 0.0, 1.0, 1.0))
+    group_index.close()
+
+    group_index = OccGroupIndex(log, csv_fname)
+    assert group_index.group_vals == group_vals
+    assert group_index.offsets == [10, 20, 30, 40]
+    assert group_index.find_group('new\nline') == 2
+    assert group_index.find_line(25) == 3
+    assert group_index.find_line(1) is None
+
+    with open(csv_fname, 'a') as out_file:
+        out_file.write('{}\n'.format('\t'.join(RECORDS[-1])))
+    assert len(OccGroupIndex(log, csv_fname)) == 0
@@ -0,0 +1,129 @@
+"""Tests for the memory-bounded block reader in raster_blocks.py
+"""
+import numpy as np
+from osgeo import gdal
+import pytest
+
+from LmCommon.common.raster_blocks import (
+    DEFAULT_BLOCK_MEMORY, RasterBlockReader)
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+NODATA = -9999
+# The shape is not a multiple of the tile size, so the last windows of each
+#    row and column are ragged
+NUM_ROWS = 37
+NUM_COLS = 23
+GEO_TRANSFORM = (-10.0, 0.5, 0, 20.0, 0, -0.5)
+# GeoTiff creation options for strips, tiles, and compressed strips
+RASTER_OPTIONS = {
+    'strips': [],
+    'tiles': ['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'],
+    'compressed': ['COMPRESS=DEFLATE'],
+}
+
+
+# .............................................................................
+def _get_data(seed=3):
+    """Gets random band values with some nodata cells"""
+    rand_state = np.random.RandomState(seed)
+    data = rand_state.randint(
+        0, 100, size=(NUM_ROWS, NUM_COLS)).astype(np.float32)
+    data[rand_state.uniform(size=data.shape) < 0.1] = NODATA
+    return data
+
+
+# .............................................................................
+def _write_raster(filename, data, options):
+    """Writes the data to a single band GeoTiff"""
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(
+        filename, data.shape[1], data.shape[0], 1, gdal.GDT_Float32,
+        options=options)
+    dataset.SetGeoTransform(GEO_TRANSFORM)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(data)
+    dataset.FlushCache()
+    band = dataset = None
+
+
+# .............................................................................
+@pytest.fixture(params=sorted(RASTER_OPTIONS.keys()))
+def raster_file(tmp_path, request):
+    """Writes a raster, returning the file name and the full band array"""
+    filename = str(tmp_path / 'raster_{}.tif'.format(request.param))
+    _write_raster(filename, _get_data(), RASTER_OPTIONS[request.param])
+    dataset = gdal.Open(filename)
+    full_data = dataset.GetRasterBand(1).ReadAsArray()
+    dataset = None
+    return filename, full_data
+
+
+# .............................................................................
+@pytest.mark.parametrize('use_mmap', [True, False])
+@pytest.mark.parametrize(
+    'memory_limit', [1, 16 * 16 * 4, 1000, DEFAULT_BLOCK_MEMORY])
+def test_iter_blocks(raster_file, memory_limit, use_mmap):
+    """Block aligned windows tile the band and match a full read"""
+    filename, full_data = raster_file
+    assert np.array_equal(full_data, _get_data())
+    with RasterBlockReader(
+            filename, memory_limit=memory_limit, use_mmap=use_mmap) as reader:
+        block_cols, block_rows = reader.band.GetBlockSize()
+        block_cols = min(block_cols, NUM_COLS)
+        block_rows = min(block_rows, NUM_ROWS)
+        item_size = np.dtype(reader.dtype).itemsize
+        assert reader.shape == (NUM_ROWS, NUM_COLS)
+        assert reader.nodata == NODATA
+        assert reader.bbox == (-10.0, 1.5, 1.5, 20.0)
+        assert reader.window_cols * reader.window_rows * item_size <= max(
+            memory_limit, block_cols * block_rows * item_size)
+
+        blocks_data = np.full(full_data.shape, np.nan)
+        for x_off, y_off, block in reader.iter_blocks():
+            # Windows start on block boundaries and only the last window of
+            #    each row and column is smaller
+            assert x_off % block_cols == 0 and y_off % block_rows == 0
+            y_size, x_size = block.shape
+            assert x_size == min(reader.window_cols, NUM_COLS - x_off)
+            assert y_size == min(reader.window_rows, NUM_ROWS - y_off)
+            window_data = blocks_data[y_off:y_off + y_size,
+                                      x_off:x_off + x_size]
+            assert np.all(np.isnan(window_data))
+            window_data[:] = block
+        assert np.array_equal(blocks_data, full_data)
+
+
+# .............................................................................
+@pytest.mark.parametrize('memory_limit', [1, 1000, DEFAULT_BLOCK_MEMORY])
+def test_gather(raster_file, memory_limit):
+    """Gathered values match a full read, including nodata cells"""
+    filename, full_data = raster_file
+    rand_state = np.random.RandomState(7)
+    flat_idxs = rand_state.randint(0, NUM_ROWS * NUM_COLS, size=200)
+    # Include the corners, repeated cells and nodata cells
+    nodata_idxs = np.flatnonzero(full_data == NODATA)
+    flat_idxs = np.concatenate([
+        flat_idxs, [0, NUM_COLS - 1, NUM_ROWS * NUM_COLS - 1, 0],
+        nodata_idxs[:5]])
+    expected = full_data.ravel()[flat_idxs]
+    assert np.sum(expected == NODATA) >= 5
+
+    with RasterBlockReader(filename, memory_limit=memory_limit) as reader:
+        assert np.array_equal(reader.gather(flat_idxs), expected)
+        order = np.argsort(flat_idxs, kind='stable')
+        assert np.array_equal(reader.gather(flat_idxs, order=order), expected)
+        assert reader.gather([]).size == 0
+
+
+# .............................................................................
+@pytest.mark.parametrize(
+    'flat_idxs', [[-1], [0, NUM_ROWS * NUM_COLS], [NUM_ROWS * NUM_COLS + 40]])
+def test_gather_out_of_range(raster_file, flat_idxs):
+    """Indices outside of the band are an error, not arbitrary values"""
+    filename, _ = raster_file
+    with RasterBlockReader(filename, memory_limit=1) as reader:
+        with pytest.raises(IndexError):
+            reader.gather(flat_idxs)
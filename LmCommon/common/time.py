@@ -168,7 +168,7 @@ class LmTime:
 def from_timestamp(ticks):
     """Return an aware LmTime object from timestamp ticks"""
     return LmTime(
-        dtime=DT.datetime.fromtimestamp(ticks, tzinfo=DT.timezone.utc))
+        dtime=DT.datetime.fromtimestamp(ticks, tz=DT.timezone.utc))
 
 
 # .............................................................................
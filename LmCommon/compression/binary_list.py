@@ -3,47 +3,175 @@
 Note:
     We are using this for compressing / decompressing matrix columns with the
         Lifemapper Global PAM solr index.  It only works with PAVs.
+
+Note:
+    Version 1 strings are 'v1s{start value} {run length} {run length} ...'
+        with decimal run lengths.  Version 2 strings are
+        'v2s{start value}n{list length} {runs}' where runs is the base64
+        encoding of the run lengths as LEB128 varints.  Both versions are
+        decoded so existing index entries remain readable.
 """
-VERSION = 1
+import base64
+
+import numpy as np
+
+VERSION = 2
+
+# Note: LEB128 varints store seven bits of a run length in each byte and set
+#    the high bit on every byte but the last
+_VARINT_BITS = 7
+_VARINT_MASK = 0x7F
+_VARINT_CONTINUE = 0x80
 
 
 # .............................................................................
-def compress(lst):
+def _encode_varints(values):
+    """Encodes non-negative integers as LEB128 varint bytes
+
+    Args:
+        values (numpy array): An array of non-negative integers.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    num_bytes = np.ones(values.size, dtype=np.int64)
+    remaining = values >> np.uint64(_VARINT_BITS)
+    while np.any(remaining):
+        num_bytes += remaining > 0
+        remaining >>= np.uint64(_VARINT_BITS)
+
+    buf = np.zeros(int(np.sum(num_bytes)), dtype=np.uint8)
+    offsets = np.cumsum(num_bytes) - num_bytes
+    for byte_num in range(int(np.max(num_bytes, initial=0))):
+        has_byte = num_bytes > byte_num
+        byte_vals = (values[has_byte] >> np.uint64(_VARINT_BITS * byte_num)
+                     ) & np.uint64(_VARINT_MASK)
+        byte_vals |= np.where(
+            num_bytes[has_byte] > byte_num + 1, _VARINT_CONTINUE, 0
+            ).astype(np.uint64)
+        buf[offsets[has_byte] + byte_num] = byte_vals
+    return buf.tobytes()
+
+
+# .............................................................................
+def _decode_varints(buf):
+    """Decodes LEB128 varint bytes into an array of integers
+
+    Args:
+        buf (bytes): The encoded varints.
+    """
+    byte_vals = np.frombuffer(buf, dtype=np.uint8)
+    if byte_vals.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    is_last = (byte_vals & _VARINT_CONTINUE) == 0
+    starts = np.concatenate(([0], np.flatnonzero(is_last)[:-1] + 1))
+    # The position of each byte within its varint
+    byte_num = np.arange(byte_vals.size) - np.repeat(
+        starts, np.diff(np.append(starts, byte_vals.size)))
+    return np.add.reduceat(
+        (byte_vals & _VARINT_MASK).astype(np.int64) << (
+            _VARINT_BITS * byte_num), starts)
+
+
+# .............................................................................
+def _get_runs(lst):
+    """Gets the start value and run lengths of a list of binary values
+    """
+    vals = np.asarray(lst).ravel() != 0
+    if vals.size == 0:
+        return 0, np.zeros(0, dtype=np.int64)
+    change_idxs = np.flatnonzero(vals[1:] != vals[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], change_idxs, [vals.size])))
+    return int(vals[0]), runs
+
+
+# .............................................................................
+def compress(lst, version=VERSION):
     """Compresses a list of zeros and ones into a string of run lengths
+
+    Args:
+        lst (list or numpy array): A list of binary values.
+        version (int): The version of the compressed format to write.
+    """
+    start_val, runs = _get_runs(lst)
+    if version == 1:
+        return 'v1s{} {}'.format(start_val, ' '.join(str(r) for r in runs))
+    return 'v2s{}n{} {}'.format(
+        start_val, int(np.sum(runs)),
+        base64.b64encode(_encode_varints(runs)).decode('ascii'))
+
+
+# .............................................................................
+def decompress_runs(compressed_list_str):
+    """Decodes a compressed string into its start value and run lengths
+
+    Args:
+        compressed_list_str (str): A version 1 or 2 compressed string.
+
+    Returns:
+        tuple: The value of the first run and an array of run lengths.
+    """
+    header, _, runs_str = compressed_list_str.partition(' ')
+    version_str, _, start_str = header.partition('s')
+    version = int(version_str.lstrip('v'))
+    if version == 1:
+        start_val = int(start_str)
+        runs = np.array(runs_str.split(), dtype=np.int64)
+    elif version == 2:
+        start_val = int(start_str.split('n')[0])
+        runs = _decode_varints(base64.b64decode(runs_str))
+    else:
+        raise ValueError(
+            'Unknown compressed list version: {}'.format(version))
+    return start_val, runs
+
+
+# .............................................................................
+def decompress(compressed_list_str, out=None):
+    """Decompress a string of run lengths into an array of binary values
+
+    Args:
+        compressed_list_str (str): A version 1 or 2 compressed string.
+        out (numpy array): An optional array, such as a column of a
+            preallocated PAM, to write the values into.
+
+    Returns:
+        numpy array: The binary values, this is `out` if it was provided.
     """
-    runs = []
-    start_val = int(lst[0])
-    val = start_val
-    run_length = 0
-
-    for i in lst:
-        # If we have the same value, extend the run
-        if i == val:
-            run_length += 1
-        else:
-            # Add the run length and switch to the other value
-            runs.append(str(run_length))
-            val = i
-            run_length = 1
-    runs.append(str(run_length))
-    return 'v{}s{} {}'.format(VERSION, start_val, ' '.join(runs))
+    start_val, runs = decompress_runs(compressed_list_str)
+    if out is None:
+        # Runs alternate between the start value and the other value
+        run_vals = (np.arange(runs.size) + start_val) % 2
+        return np.repeat(run_vals.astype(np.int8), runs)
+
+    run_ends = np.cumsum(runs)
+    list_length = int(run_ends[-1]) if runs.size else 0
+    if list_length != len(out):
+        raise ValueError(
+            'Compressed list has {} values, out has {}'.format(
+                list_length, len(out)))
+    # Write the runs of ones into the zeroed array, every other run starting
+    #    with the first run if the start value is one
+    out[:] = 0
+    for run_start, run_end in zip(
+            (run_ends - runs)[1 - start_val::2].tolist(),
+            run_ends[1 - start_val::2].tolist()):
+        out[run_start:run_end] = 1
+    return out
 
 
 # .............................................................................
-def decompress(compressed_list_str):
-    """Decompress a string of run lengths into a list of binary values
+def decompress_indices(compressed_list_str, indices):
+    """Get the binary values at selected positions of a compressed string
+
+    The runs are searched rather than expanded, so this is cheaper than
+    decompressing the whole list when only some positions are needed.
+
+    Args:
+        compressed_list_str (str): A version 1 or 2 compressed string.
+        indices (numpy array): The positions of the values to get.
+
+    Returns:
+        numpy array: The binary value at each index.
     """
-    vals = []
-    parts = compressed_list_str.split(' ')
-    header = parts[0]
-    # Uncomment if we end up using version information
-    # version = int(header.split('s')[0].split('v')[1])
-    start_val = int(header.split('s')[1])
-    val = start_val
-
-    for run_len in parts[1:]:
-        vals.extend(int(run_len) * [val])
-        # Will change 0 to 1 and 1 to 0
-        val = abs(val - 1)
-
-    return vals
+    start_val, runs = decompress_runs(compressed_list_str)
+    run_idxs = np.searchsorted(np.cumsum(runs), indices, side='right')
+    return ((run_idxs + start_val) % 2).astype(np.int8)
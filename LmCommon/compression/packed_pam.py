@@ -0,0 +1,358 @@
+"""Module containing a bit-packed Presence / Absence Matrix
+
+Note:
+    A PAM is a binary (sites by species) matrix, so each row is stored as bits
+        packed into bytes with numpy.packbits.  This uses one eighth of the
+        memory of an int8 matrix and one sixty-fourth of an int64 matrix.
+        Operations that need numbers unpack a block of rows at a time.
+"""
+import json
+
+import numpy as np
+
+from LmCommon.common.lmconstants import LMFormat
+from lmpy import Matrix
+
+# Note: The default number of rows unpacked at a time
+ROW_CHUNK_SIZE = 4096
+
+# Note: The number of bits set in each byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# .............................................................................
+class PackedPam:
+    """Class for a PAM with rows stored as packed bits
+
+    The interface follows the parts of lmpy.Matrix used by the multi-species
+    computations.  Headers are stored in the same dictionary format and are
+    shared, not copied, when converting to and from a Matrix.
+    """
+
+    # ...........................
+    def __init__(self, data, num_species, headers=None):
+        """Constructor
+
+        Args:
+            data (numpy array): A (sites by ceil(species / 8)) uint8 array of
+                rows packed with numpy.packbits.
+            num_species (int): The number of species (columns) in the PAM.
+            headers (dict): Optional Matrix style headers for the PAM.
+        """
+        self.data = data
+        self.num_species = num_species
+        if headers is None:
+            headers = {}
+        self.headers = headers
+
+    # ...........................
+    def __array__(self, dtype=None, copy=None):
+        """Returns the unpacked PAM as a numpy array
+
+        Args:
+            dtype (type): The data type of the array, defaults to int8.
+            copy (bool): Ignored, the array is always a new array.
+        """
+        if dtype is None:
+            dtype = np.int8
+        return self.get_rows(0, self.num_sites, dtype=dtype)
+
+    # ...........................
+    @property
+    def num_sites(self):
+        """Returns the number of sites (rows) in the PAM
+        """
+        return self.data.shape[0]
+
+    # ...........................
+    @property
+    def shape(self):
+        """Returns the (sites, species) shape of the PAM
+        """
+        return (self.num_sites, self.num_species)
+
+    # ...........................
+    @classmethod
+    def from_matrix(cls, mtx, chunk_size=ROW_CHUNK_SIZE):
+        """Packs a PAM Matrix
+
+        Args:
+            mtx (Matrix): A binary (sites by species) matrix.
+            chunk_size (int): The number of rows to pack at a time.
+        """
+        num_sites, num_species = mtx.shape
+        data = np.empty(
+            (num_sites, (num_species + 7) // 8), dtype=np.uint8)
+        for start in range(0, num_sites, chunk_size):
+            data[start:start + chunk_size] = np.packbits(
+                np.asarray(mtx[start:start + chunk_size]) != 0, axis=1)
+        return cls(
+            data, num_species, headers=getattr(mtx, 'headers', None))
+
+    # ...........................
+    @classmethod
+    def zeros(cls, num_sites, num_species, headers=None):
+        """Creates an empty PAM to be filled column by column
+
+        Args:
+            num_sites (int): The number of sites (rows) in the PAM.
+            num_species (int): The number of species (columns) in the PAM.
+            headers (dict): Optional Matrix style headers for the PAM.
+        """
+        return cls(
+            np.zeros((num_sites, (num_species + 7) // 8), dtype=np.uint8),
+            num_species, headers=headers)
+
+    # ...........................
+    @classmethod
+    def load(cls, filename):
+        """Loads a packed PAM written by `write`
+
+        Args:
+            filename (str): The file location of the packed PAM.
+        """
+        with open(filename, 'rb') as in_file:
+            packed = np.load(in_file, allow_pickle=False)
+            return cls(
+                packed['data'], int(packed['num_species']),
+                headers=json.loads(str(packed['headers'])))
+
+    # ...........................
+    def get_column_headers(self):
+        """Returns the column (species) headers
+        """
+        return self.headers.get('1', [])
+
+    # ...........................
+    def get_row_headers(self):
+        """Returns the row (site) headers
+        """
+        return self.headers.get('0', [])
+
+    # ...........................
+    def get_rows(self, start, stop, dtype=np.int8):
+        """Returns a block of rows unpacked into an array
+
+        Args:
+            start (int): The first row to unpack.
+            stop (int): The row after the last one to unpack.
+            dtype (type): The data type of the returned array.
+        """
+        return np.unpackbits(
+            self.data[start:stop], axis=1, count=self.num_species
+            ).astype(dtype, copy=False)
+
+    # ...........................
+    def iter_row_chunks(self, chunk_size=ROW_CHUNK_SIZE, dtype=np.int8):
+        """Iterates over blocks of unpacked rows
+
+        Args:
+            chunk_size (int): The number of rows in each block.
+            dtype (type): The data type of the unpacked blocks.
+
+        Yields:
+            tuple: The first row index of the block and the unpacked block.
+        """
+        for start in range(0, self.num_sites, chunk_size):
+            yield start, self.get_rows(start, start + chunk_size, dtype=dtype)
+
+    # ...........................
+    def get_column(self, col):
+        """Returns a column (species presence absence vector) as an array
+
+        Args:
+            col (int): The index of the column to return.
+        """
+        mask = np.uint8(1 << (7 - col % 8))
+        return ((self.data[:, col // 8] & mask) != 0).astype(np.int8)
+
+    # ...........................
+    def set_column(self, col, values):
+        """Sets the values of a column from a presence absence vector
+
+        Args:
+            col (int): The index of the column to set.
+            values (list): A binary value for each site.
+        """
+        byte_col = col // 8
+        mask = np.uint8(1 << (7 - col % 8))
+        present = np.asarray(values) != 0
+        self.data[:, byte_col] = np.where(
+            present, self.data[:, byte_col] | mask,
+            self.data[:, byte_col] & ~mask)
+
+    # ...........................
+    def sum_rows(self):
+        """Returns the number of species present at each site
+        """
+        return np.sum(_POPCOUNT[self.data], axis=1, dtype=np.int64)
+
+    # ...........................
+    def sum_columns(self, chunk_size=ROW_CHUNK_SIZE):
+        """Returns the number of sites where each species is present
+
+        Args:
+            chunk_size (int): The number of rows to unpack at a time.
+        """
+        col_sums = np.zeros(self.num_species, dtype=np.int64)
+        for _, rows in self.iter_row_chunks(chunk_size=chunk_size):
+            col_sums += np.sum(rows, axis=0, dtype=np.int64)
+        return col_sums
+
+    # ...........................
+    def dot(self, other, chunk_size=ROW_CHUNK_SIZE):
+        """Returns PAM . other
+
+        Args:
+            other (numpy array): A species vector or (species by k) array.
+            chunk_size (int): The number of rows to unpack at a time.
+        """
+        other = np.asarray(other)
+        return np.concatenate([
+            rows.dot(other) for _, rows in self.iter_row_chunks(
+                chunk_size=chunk_size, dtype=np.result_type(
+                    other.dtype, np.int8))])
+
+    # ...........................
+    def t_dot(self, other, chunk_size=ROW_CHUNK_SIZE):
+        """Returns PAM_T . other
+
+        Args:
+            other (numpy array): A site vector or (sites by k) array.
+            chunk_size (int): The number of rows to unpack at a time.
+        """
+        other = np.asarray(other)
+        dtype = np.result_type(other.dtype, np.int8)
+        total = np.zeros((self.num_species,) + other.shape[1:], dtype=dtype)
+        for start, rows in self.iter_row_chunks(
+                chunk_size=chunk_size, dtype=dtype):
+            total += rows.T.dot(other[start:start + rows.shape[0]])
+        return total
+
+    # ...........................
+    def get_columns(self, start, stop, dtype=np.int8,
+                    chunk_size=ROW_CHUNK_SIZE):
+        """Returns a block of columns for every site unpacked into an array
+
+        Only the bytes holding the requested columns are unpacked.
+
+        Args:
+            start (int): The first column to unpack.
+            stop (int): The column after the last one to unpack.
+            dtype (type): The data type of the returned array.
+            chunk_size (int): The number of rows to unpack at a time.
+        """
+        stop = min(stop, self.num_species)
+        byte_start = start // 8
+        bit_offset = start - 8 * byte_start
+        byte_stop = (stop + 7) // 8
+        block = np.empty((self.num_sites, stop - start), dtype=dtype)
+        for row in range(0, self.num_sites, chunk_size):
+            bits = np.unpackbits(
+                self.data[row:row + chunk_size, byte_start:byte_stop], axis=1)
+            block[row:row + chunk_size] = bits[
+                :, bit_offset:bit_offset + stop - start]
+        return block
+
+    # ...........................
+    def any_present(self, cols):
+        """Returns a binary site vector of where any of the columns are present
+
+        The bits of the columns stored in each byte are combined into one
+        mask, so each byte column of the PAM is read at most once.
+
+        Args:
+            cols (list): The indices of the columns to check.
+        """
+        byte_masks = {}
+        for col in cols:
+            byte_masks[col // 8] = byte_masks.get(col // 8, 0) | (
+                1 << (7 - col % 8))
+        present = np.zeros(self.num_sites, dtype=bool)
+        for byte_col, mask in byte_masks.items():
+            present |= (self.data[:, byte_col] & np.uint8(mask)) != 0
+        return present
+
+    # ...........................
+    def purge_empty_sites(self):
+        """Returns a new PAM without the sites that have no species present
+
+        Returns:
+            tuple: The purged PackedPam and the indices of the kept rows.
+        """
+        keep_rows = np.where(np.any(self.data, axis=1))[0]
+        return self.slice(keep_rows), keep_rows
+
+    # ...........................
+    def slice(self, rows=None, cols=None, chunk_size=ROW_CHUNK_SIZE):
+        """Returns a new PAM containing the specified rows and columns
+
+        Args:
+            rows (list): The indices of the rows to keep.  All if None.
+            cols (list): The indices of the columns to keep.  All if None.
+            chunk_size (int): The number of rows to unpack at a time.
+        """
+        headers = {key: val for key, val in self.headers.items()}
+        data = self.data
+        if rows is not None:
+            data = data[rows]
+            if '0' in headers:
+                headers['0'] = [headers['0'][i] for i in rows]
+        num_species = self.num_species
+        if cols is not None:
+            sliced = PackedPam(data, self.num_species)
+            num_species = len(cols)
+            data = np.empty(
+                (sliced.num_sites, (num_species + 7) // 8), dtype=np.uint8)
+            for start, block in sliced.iter_row_chunks(chunk_size=chunk_size):
+                data[start:start + block.shape[0]] = np.packbits(
+                    block[:, cols], axis=1)
+            if '1' in headers:
+                headers['1'] = [headers['1'][i] for i in cols]
+        elif rows is not None:
+            data = data.copy()
+        else:
+            data = self.data.copy()
+        return PackedPam(data, num_species, headers=headers)
+
+    # ...........................
+    def to_matrix(self, dtype=np.int8):
+        """Unpacks the PAM into a Matrix that shares this PAM's headers
+
+        Args:
+            dtype (type): The data type of the Matrix, defaults to int8.
+        """
+        return Matrix(np.asarray(self, dtype=dtype), headers=self.headers)
+
+    # ...........................
+    def write(self, filename):
+        """Writes the packed PAM to a file
+
+        Args:
+            filename (str): The file location to write the packed PAM.
+        """
+        with open(filename, 'wb') as out_file:
+            np.savez(
+                out_file, data=self.data,
+                num_species=np.array(self.num_species),
+                headers=np.array(json.dumps(self.headers)))
+
+
+# .............................................................................
+def load_pam(filename, pack=False):
+    """Loads a PAM from a Matrix or packed PAM file
+
+    Args:
+        filename (str): The file location of the PAM.  Files with the packed
+            matrix extension are loaded as a PackedPam.
+        pack (bool): If True, pack PAMs loaded from Matrix files.
+
+    Returns:
+        Matrix or PackedPam: The loaded PAM.
+    """
+    if filename.endswith(LMFormat.PACKED_MATRIX.ext):
+        return PackedPam.load(filename)
+    pam = Matrix.load(filename)
+    if pack:
+        return PackedPam.from_matrix(pam)
+    return pam
@@ -0,0 +1,110 @@
+"""Tests for the version 1 and 2 compressed binary lists in binary_list.py
+"""
+import numpy as np
+import pytest
+
+from LmCommon.compression.binary_list import (
+    compress, decompress, decompress_indices, decompress_runs)
+
+
+# .............................................................................
+def _compress_v1(lst):
+    """Compresses a list the way version 1 strings were always written"""
+    runs = []
+    val = int(lst[0])
+    run_length = 0
+    for i in lst:
+        if i == val:
+            run_length += 1
+        else:
+            runs.append(str(run_length))
+            val = i
+            run_length = 1
+    runs.append(str(run_length))
+    return 'v1s{} {}'.format(int(lst[0]), ' '.join(runs))
+
+
+# .............................................................................
+def _get_test_lists():
+    """Gets binary lists with short, long and multi-byte run lengths"""
+    rand_state = np.random.RandomState(3)
+    lists = [
+        [0], [1], [0] * 10, [1] * 10, [0, 1, 0, 1, 1, 0],
+        rand_state.randint(0, 2, size=1000).tolist(),
+        # Runs needing two and three varint bytes
+        [1] * 200 + [0] * 20000 + [1] * 5,
+        [0] * 128 + [1] * 16384 + [0] * 127]
+    # A sparse PAV
+    sparse = np.zeros(5000, dtype=int)
+    sparse[rand_state.choice(5000, size=40, replace=False)] = 1
+    lists.append(sparse.tolist())
+    return lists
+
+
+# .............................................................................
+def test_v1_strings_unchanged():
+    """Version 1 strings are written as before"""
+    for lst in _get_test_lists():
+        assert compress(lst, version=1) == _compress_v1(lst)
+
+
+# .............................................................................
+def test_round_trip():
+    """Version 1 and 2 strings decompress to the original list"""
+    for lst in _get_test_lists():
+        v1_str = compress(lst, version=1)
+        v2_str = compress(lst)
+        assert v2_str.startswith('v2s{}n{} '.format(lst[0], len(lst)))
+        assert decompress(v1_str).tolist() == lst
+        assert decompress(v2_str).tolist() == lst
+
+        v1_start, v1_runs = decompress_runs(v1_str)
+        v2_start, v2_runs = decompress_runs(v2_str)
+        assert v1_start == v2_start == lst[0]
+        assert v1_runs.tolist() == v2_runs.tolist()
+        assert int(v2_runs.sum()) == len(lst)
+
+
+# .............................................................................
+def test_compress_arrays():
+    """Numpy arrays, including booleans, compress like lists"""
+    lst = [0, 0, 1, 1, 1, 0, 1]
+    for arr in [np.array(lst), np.array(lst, dtype=np.int8),
+                np.array(lst, dtype=bool)]:
+        assert compress(arr) == compress(lst)
+        assert compress(arr, version=1) == _compress_v1(lst)
+
+
+# .............................................................................
+def test_decompress_into_out():
+    """Values are written into a provided array, such as a PAM column"""
+    lists = _get_test_lists()
+    for lst in lists:
+        pam = np.full((len(lst), 3), 7, dtype=np.int8)
+        for version in [1, 2]:
+            col = decompress(compress(lst, version=version), out=pam[:, 1])
+            assert col.base is pam
+            assert pam[:, 1].tolist() == lst
+            assert np.all(pam[:, [0, 2]] == 7)
+
+    with pytest.raises(ValueError):
+        decompress(compress([0, 1, 1]), out=np.zeros(4, dtype=np.int8))
+
+
+# .............................................................................
+def test_decompress_indices():
+    """Values at selected positions match the decompressed list"""
+    for lst in _get_test_lists():
+        indices = np.arange(0, len(lst), 3)
+        for version in [1, 2]:
+            assert decompress_indices(
+                compress(lst, version=version), indices
+                ).tolist() == np.asarray(lst)[indices].tolist()
+
+
+# .............................................................................
+def test_empty_and_unknown():
+    """Empty lists round trip and unknown versions are rejected"""
+    assert decompress(compress([])).size == 0
+    with pytest.raises(ValueError):
+        decompress('v9s0 1 2')
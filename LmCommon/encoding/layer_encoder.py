@@ -4,17 +4,27 @@ The 'LayerEncoder' class uses a shapegrid to generate a base matrix structure
 and then each layer is encoded as a new column (or columns) for the resulting
 encoded matrix.
 
-Todo:
-    Consider if we want to support hexagonal cells, if so, we will need to
-        mask the resulting data windows and possibly change the minimum
-        coverage calculation.
+Each shapegrid cell is mapped to the window of data array cells it covers.
+These cell windows only depend on the shapegrid and the geometry of the data
+array, so they are computed once and kept for later layers.  Layers are read
+one block window at a time, the data cells of each block that are covered by
+shapegrid cells are found from the cell windows, and the encoding methods
+accumulate per cell sums, counts, and class counts with np.bincount style
+operations.  Memory use is bounded by the block size, not the layer size.
 
 Note:
     Data array is oriented at top left (min x, max y)
+
+Note:
+    Square shapegrid cells use the window of data cells they cover.  Hexagonal
+        shapegrid cells use the data cells in their bounding window whose
+        centers fall inside the hexagon.
 """
+import copy
 import json
 import os
 from random import shuffle
+import threading
 
 import numpy as np
 from osgeo import gdal, ogr
@@ -22,20 +32,212 @@ from osgeo import gdal, ogr
 from lmpy import Matrix
 
 from LmCommon.common.lmconstants import DEFAULT_NODATA, LMFormat
+from LmCommon.common.raster_blocks import (
+    DEFAULT_BLOCK_MEMORY, RasterBlockReader)
 
 # DEFAULT_SCALE is the scale of the layer data array to the shapegrid cellsize
 #     The number of data array cells in a (square) shapegrid cell is::
 #         1.0 / DEFAULT_SCALE^2
 DEFAULT_SCALE = 0.1  # Default scale for data array versus shapegrid cells
 
+
+# .............................................................................
+# Helper functions
+def _get_nodata_mask(values, nodata):
+    """Gets a mask of the values that are nodata or NaN
+
+    Args:
+        values: A numpy array of data values
+        nodata: This value is assumed to be nodata, may be None
+    """
+    mask = np.isnan(values)
+    if nodata is not None:
+        mask |= np.isclose(values, nodata)
+    return mask
+
+
+# .............................................................................
+def _get_class_counts(values, cell_ids, counts=None):
+    """Counts the data cells of each distinct value in each shapegrid cell
+
+    Args:
+        values: A numpy array of data values
+        cell_ids: A numpy array with the shapegrid cell index of each value
+        counts: An optional numpy array with the number of data cells of each
+            value, used to merge class counts.  Each value counts once if this
+            is not provided.
+
+    Returns:
+        A tuple of arrays with the shapegrid cell, value, and count of each
+        distinct (shapegrid cell, value) pair, ordered by cell and then value
+    """
+    order = np.lexsort((values, cell_ids))
+    cells = cell_ids[order]
+    vals = values[order]
+    if cells.size == 0:
+        return cells, vals, np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(
+        np.concatenate(
+            [[True], (cells[1:] != cells[:-1]) | (vals[1:] != vals[:-1])]))
+    if counts is None:
+        counts = np.diff(np.append(starts, cells.size))
+    else:
+        counts = np.add.reduceat(counts[order], starts)
+    return cells[starts], vals[starts], counts
+
+
+# .............................................................................
+def _in_convex_polygon(x_vals, y_vals, vertices):
+    """Tests which points are inside of a convex polygon
+
+    Args:
+        x_vals: A numpy array of point x coordinates
+        y_vals: A numpy array of point y coordinates
+        vertices: A (vertices by 2) array of the polygon ring, in either
+            direction and without repeating the first vertex
+    """
+    all_left = np.ones(x_vals.shape, dtype=bool)
+    all_right = np.ones(x_vals.shape, dtype=bool)
+    for (x_1, y_1), (x_2, y_2) in zip(
+            vertices, np.roll(vertices, -1, axis=0)):
+        cross = (x_2 - x_1) * (y_vals - y_1) - (y_2 - y_1) * (x_vals - x_1)
+        all_left &= cross >= 0
+        all_right &= cross <= 0
+    return all_left | all_right
+
+
+# .............................................................................
+def _get_cell_bounds(centroids, vertex_offsets, data_shape, layer_bbox):
+    """Gets the window of data array cells covered by each shapegrid cell
+
+    Args:
+        centroids: A (shapegrid cells by 2) array of cell centroids
+        vertex_offsets: A (vertices by 2) array of the offsets of the cell
+            vertices from the cell centroid
+        data_shape: The (rows, columns) shape of the data array
+        layer_bbox: The bounding box of the data array in the map units of the
+            layer
+
+    Returns:
+        A (shapegrid cells by 4) array of the first row, first column, end
+        row, and end column of the data window of each shapegrid cell, clipped
+        to the data array
+
+    Note:
+        The origin (0, 0) of the data array should represent (min x, max y)
+            for the layer.
+    """
+    y_size, x_size = data_shape
+    min_x, min_y, max_x, max_y = layer_bbox
+    x_size_2, y_size_2 = np.max(np.abs(vertex_offsets), axis=0)
+
+    # ...............................
+    def get_rc(x_coords, y_coords, round_x=np.trunc, round_y=np.trunc):
+        x_prop = (x_coords - min_x) / (max_x - min_x)
+        y_prop = (y_coords - min_y) / (max_y - min_y)
+
+        cols = round_x(x_size * x_prop).astype(np.int64)
+        rows = y_size - round_y(y_size * y_prop).astype(np.int64)
+        return rows, cols
+
+    x_coords = centroids[:, 0]
+    y_coords = centroids[:, 1]
+    # Note: Again, 0 row corresponds to top of map, so bigger y
+    #     corresponds to lower row number
+    if vertex_offsets.shape[0] == 4:
+        # Upper left corner
+        ul_rows, ul_cols = get_rc(x_coords - x_size_2, y_coords + y_size_2)
+        # Lower right corner
+        lr_rows, lr_cols = get_rc(x_coords + x_size_2, y_coords - y_size_2)
+    else:
+        # Hexagons keep the data cells with centers inside, so the window
+        #    includes the data cells partly covered on each edge
+        ul_rows, ul_cols = get_rc(
+            x_coords - x_size_2, y_coords + y_size_2, round_x=np.floor,
+            round_y=np.ceil)
+        lr_rows, lr_cols = get_rc(
+            x_coords + x_size_2, y_coords - y_size_2, round_x=np.ceil,
+            round_y=np.floor)
+    ul_rows = np.maximum(ul_rows, 0)
+    ul_cols = np.maximum(ul_cols, 0)
+    lr_rows = np.maximum(np.minimum(lr_rows, y_size), ul_rows)
+    lr_cols = np.maximum(np.minimum(lr_cols, x_size), ul_cols)
+    return np.column_stack([ul_rows, ul_cols, lr_rows, lr_cols])
+
+
+# .............................................................................
+def _get_window_cells(cell_bounds, window, centroids, vertex_offsets,
+                      data_shape, layer_bbox, num_cell_sides=4):
+    """Gets the data cells of a block window covered by each shapegrid cell
+
+    Args:
+        cell_bounds: The shapegrid cell data windows from _get_cell_bounds
+        window: The (x offset, y offset, x size, y size) of the block window
+        centroids: A (shapegrid cells by 2) array of cell centroids
+        vertex_offsets: A (vertices by 2) array of the offsets of the cell
+            vertices from the cell centroid
+        data_shape: The (rows, columns) shape of the data array
+        layer_bbox: The bounding box of the data array in the map units of the
+            layer
+        num_cell_sides: The number of sides each shapegrid cell has::
+            4 -- square
+            6 -- hexagon
+
+    Returns:
+        A tuple of arrays with the shapegrid cell, and the row and column
+        within the block window, of each covered data cell
+    """
+    x_off, y_off, x_size, y_size = window
+    ul_rows = np.maximum(cell_bounds[:, 0], y_off)
+    ul_cols = np.maximum(cell_bounds[:, 1], x_off)
+    heights = np.minimum(cell_bounds[:, 2], y_off + y_size) - ul_rows
+    widths = np.minimum(cell_bounds[:, 3], x_off + x_size) - ul_cols
+    cells = np.flatnonzero((heights > 0) & (widths > 0))
+    ul_rows = ul_rows[cells]
+    ul_cols = ul_cols[cells]
+    heights = heights[cells]
+    widths = widths[cells]
+
+    # Expand the part of each cell window inside the block into its rows and
+    #    columns
+    window_sizes = heights * widths
+    cell_idxs = np.repeat(np.arange(cells.size), window_sizes)
+    window_starts = np.cumsum(window_sizes) - window_sizes
+    positions = np.arange(cell_idxs.size) - window_starts[cell_idxs]
+    rows = ul_rows[cell_idxs] + positions // widths[cell_idxs]
+    cols = ul_cols[cell_idxs] + positions % widths[cell_idxs]
+
+    if num_cell_sides != 4:
+        # Only keep the data cells with centers inside of the cell
+        min_x, min_y, max_x, max_y = layer_bbox
+        inside = _in_convex_polygon(
+            min_x + (cols + 0.5) * (max_x - min_x) / data_shape[1]
+            - centroids[cells[cell_idxs], 0],
+            max_y - (rows + 0.5) * (max_y - min_y) / data_shape[0]
+            - centroids[cells[cell_idxs], 1],
+            vertex_offsets)
+        cell_idxs = cell_idxs[inside]
+        rows = rows[inside]
+        cols = cols[inside]
+
+    return cells[cell_idxs], rows - y_off, cols - x_off
+
+
 # .............................................................................
 # Encoding methods
+#
+# Each encoding method gets a pair of functions.  The accumulate function gets
+#    the data values of a block window covered by shapegrid cells and the
+#    shapegrid cell index of each value, and adds them to per cell totals.
+#    Once every block is accumulated, the encode function gets the number of
+#    data cells in each shapegrid cell (the window size) and returns the
+#    encoded value (or values) of every shapegrid cell.
 
 
 # .............................................................................
 def _get_presence_absence_method(min_presence, max_presence, min_coverage,
-                                 nodata):
-    """Gets the function for determining presence for a data window
+                                 nodata, num_cells):
+    """Gets the functions for determining presence for each data window
 
     Args:
         min_presence: Data cells must have a value greater than or equal to
@@ -45,87 +247,116 @@ def _get_presence_absence_method(min_presence, max_presence, min_coverage,
         min_coverage: At least the percentage of the window must be classified
             as present to consider the window present
         nodata: This values should be considered nodata
+        num_cells: The number of shapegrid cells
     """
     if min_coverage > 1.0:
         min_coverage = min_coverage / 100.0
+    num_valid = np.zeros(num_cells)
 
     # ...............................
-    def get_presence_absence(window):
-        min_num = max(min_coverage * window.size, 1)
+    def accumulate(values, cell_ids):
         valid_cells = np.logical_and(
-            np.logical_and(window >= min_presence, window <= max_presence),
-            window != nodata)
-        return np.sum(valid_cells) >= min_num
+            values >= min_presence, values <= max_presence)
+        if nodata is not None:
+            valid_cells &= values != nodata
+        num_valid[:] += np.bincount(
+            cell_ids, weights=valid_cells, minlength=num_cells)
+
+    # ...............................
+    def get_presence_absence(cell_sizes):
+        min_num = np.maximum(min_coverage * cell_sizes, 1)
+        return num_valid >= min_num
 
-    return get_presence_absence
+    return accumulate, get_presence_absence
 
 
 # .............................................................................
-def _get_mean_value_method(nodata):
-    """Gets the function to use for determining the mean value of a data window
+def _get_mean_value_method(nodata, num_cells):
+    """Gets the functions to use for determining the mean value of each window
 
     Args:
         nodata: This value is assumed to be nodata in the array
+        num_cells: The number of shapegrid cells
     """
+    num_valid = np.zeros(num_cells, dtype=np.int64)
+    totals = np.zeros(num_cells)
 
     # ...............................
-    def get_mean(window):
-        window_mean = np.nanmean(window)
-        if np.isnan(window_mean):
-            return nodata
+    def accumulate(values, cell_ids):
+        valid = np.logical_not(_get_nodata_mask(values, nodata))
+        num_valid[:] += np.bincount(cell_ids[valid], minlength=num_cells)
+        totals[:] += np.bincount(
+            cell_ids[valid], weights=values[valid], minlength=num_cells)
 
-        return window_mean
+    # ...............................
+    def get_mean(cell_sizes):
+        means = np.full(
+            cell_sizes.size, np.nan if nodata is None else nodata, dtype=float)
+        has_data = num_valid > 0
+        means[has_data] = totals[has_data] / num_valid[has_data]
+        return means
 
-    return get_mean
+    return accumulate, get_mean
 
 
 # .............................................................................
-def _get_largest_class_method(min_coverage, nodata):
-    """Gets the function to use for determining the largest class
+def _get_largest_class_method(min_coverage, nodata, num_cells):
+    """Gets the functions to use for determining the largest class
 
     Args:
         min_coverage: The minimum percentage of the data window that must be
             covered by the largest class.
         nodata: This value is assumed to be nodata in the array
+        num_cells: The number of shapegrid cells
     """
     if min_coverage > 1.0:
         min_coverage = min_coverage / 100.0
+    # The (shapegrid cell, class, count) arrays of the blocks read so far
+    class_counts = []
 
     # ...............................
-    def get_largest_class(window):
-        """Get largest class for numpy > 1.8
-        """
-        min_num = min_coverage * window.size
-        largest_count = 0
-        largest_class = nodata
-        unique_values = np.column_stack(np.unique(window, return_counts=True))
-        for class_, num in unique_values:
-            if not np.isclose(class_, nodata) and num > largest_count \
-                    and num > min_num:
-                largest_class = class_
-        return largest_class
+    def accumulate(values, cell_ids):
+        valid = np.logical_not(_get_nodata_mask(values, nodata))
+        block_counts = _get_class_counts(values[valid], cell_ids[valid])
+        if class_counts:
+            # Merge with the counts of earlier blocks
+            block_counts = _get_class_counts(
+                np.concatenate([class_counts[1], block_counts[1]]),
+                np.concatenate([class_counts[0], block_counts[0]]),
+                counts=np.concatenate([class_counts[2], block_counts[2]]))
+        class_counts[:] = block_counts
 
     # ...............................
-    def get_largest_class_1_8(window):
-        """Get largest class for numpy 1.8
-        """
-        min_num = min_coverage * window.size
-        largest_count = 0
-        largest_class = nodata
-        unique_values = np.unique(window)
-        for class_ in unique_values:
-            num = np.where(window == class_)[0].size
-            if not np.isclose(class_, nodata) and num > largest_count \
-                    and num > min_num:
-                largest_class = class_
-        return largest_class
-
-    return get_largest_class_1_8
+    def get_largest_class(cell_sizes):
+        largest_classes = np.full(
+            cell_sizes.size, np.nan if nodata is None else nodata, dtype=float)
+        if not class_counts:
+            return largest_classes
+        class_cells, classes, counts = class_counts
+
+        # Drop classes that do not cover enough of the window
+        covered = counts > min_coverage * cell_sizes[class_cells]
+        class_cells = class_cells[covered]
+        classes = classes[covered]
+        counts = counts[covered]
+
+        # Order by cell and then decreasing count, so the first class for each
+        #    cell is the largest
+        order = np.lexsort((-counts, class_cells))
+        class_cells = class_cells[order]
+        classes = classes[order]
+        first = np.concatenate(
+            [[True], class_cells[1:] != class_cells[:-1]])[:class_cells.size]
+        largest_classes[class_cells[first]] = classes[first]
+        return largest_classes
+
+    return accumulate, get_largest_class
 
 
 # .............................................................................
-def _get_encode_hypothesis_method(hypothesis_values, min_coverage, nodata):
-    """Gets the function to determine the hypothesis value for each data window
+def _get_encode_hypothesis_method(hypothesis_values, min_coverage, nodata,
+                                  num_cells):
+    """Gets the functions to determine the hypothesis value for each window
 
     Args:
         hypothesis_values: A list of possible hypothesis values to look for.
@@ -133,6 +364,7 @@ def _get_encode_hypothesis_method(hypothesis_values, min_coverage, nodata):
         min_coverage: The minimum percentage of each data window that must be
             covered by the returned hypothesis value.
         nodata: This value is assumed to be nodata
+        num_cells: The number of shapegrid cells
     """
     # Build the map
     val_map = {}
@@ -162,50 +394,40 @@ def _get_encode_hypothesis_method(hypothesis_values, min_coverage, nodata):
     if min_coverage > 1.0:
         min_coverage = min_coverage / 100.0
 
+    # Hypothesis values are never nodata
+    hypothesis_keys = sorted(
+        val for val in val_map if nodata is None or not np.isclose(
+            val, nodata))
+    # The number of data cells of each hypothesis value in each window
+    value_counts = np.zeros((num_cells, len(hypothesis_keys)))
+
     # ...............................
-    def encode_method(window):
-        """Encode method for numpy > 1.8
-        """
-        min_vals = int(min_coverage * window.size)
-        # Set default min count to min_vals
-        # Note: This will cause last one to win if they are equal, change to
-        #     '>' below and set this to * (min_vals - 1) to have first one win
-        counts = np.zeros((i), dtype=int) * min_vals
-        ret = np.zeros((i))
-
-        unique_values = np.column_stack(np.unique(window, return_counts=True))
-
-        # Check unique values in window
-        for val, num in unique_values:
-            if not np.isclose(val, nodata) and val in list(val_map.keys()) and\
-                    num >= counts[val_map[val]['index']]:
-                counts[val_map[val]['index']] = num
-                ret[val_map[val]['index']] = val_map[val]['val']
-        return ret
+    def accumulate(values, cell_ids):
+        for k, val in enumerate(hypothesis_keys):
+            value_counts[:, k] += np.bincount(
+                cell_ids, weights=values == val, minlength=num_cells)
 
     # ...............................
-    def encode_method_1_8(window):
-        """Encode method for Numpy 1.8
+    def encode_method(cell_sizes):
+        """Encode the hypothesis columns for every window
         """
-        min_vals = int(min_coverage * window.size)
         # Set default min count to min_vals
         # Note: This will cause last one to win if they are equal, change to
-        #     '>' below and set this to * (min_vals - 1) to have first one win
-        counts = np.zeros((i), dtype=int) * min_vals
-        ret = np.zeros((i))
-
-        unique_values = np.unique(window)
-
-        # Check unique values in window
-        for val in unique_values:
-            num = np.where(window == val)[0].size
-            if not np.isclose(val, nodata) and val in list(val_map.keys()) and\
-                    num >= counts[val_map[val]['index']]:
-                counts[val_map[val]['index']] = num
-                ret[val_map[val]['index']] = val_map[val]['val']
+        #     '>' below and set this to (min_vals - 1) to have first one win
+        counts = np.repeat(
+            np.floor(min_coverage * cell_sizes)[:, np.newaxis], i, axis=1)
+        ret = np.zeros((cell_sizes.size, i))
+
+        # Check each hypothesis value, in increasing order, in every window
+        for k, val in enumerate(hypothesis_keys):
+            idx = val_map[val]['index']
+            num = value_counts[:, k]
+            update = np.logical_and(num > 0, num >= counts[:, idx])
+            counts[update, idx] = num[update]
+            ret[update, idx] = val_map[val]['val']
         return ret
 
-    return encode_method_1_8
+    return accumulate, encode_method
 
 
 # .............................................................................
@@ -217,60 +439,90 @@ class LayerEncoder:
     """
 
     # ...............................
-    def __init__(self, shapegrid_filename):
+    def __init__(self, shapegrid_filename,
+                 block_memory=DEFAULT_BLOCK_MEMORY):
+        """Constructor
+
+        Args:
+            shapegrid_filename: The file location of the shapegrid
+            block_memory: The maximum number of bytes of a layer to read at a
+                time.
+        """
         # Process shapegrid
         self.shapegrid_filename = shapegrid_filename
+        self.block_memory = block_memory
+        self._cell_indexes = {}
+        # Copies of the encoder share cell indexes and may run in threads
+        self._cell_index_lock = threading.Lock()
         self._read_shapegrid(shapegrid_filename)
 
         self.encoded_matrix = None
 
     # ...............................
-    def _encode_layer(self, window_func, encode_func, column_name,
-                      num_columns=1):
-        """Encodes the layer using the provided encoding function
+    def _accumulate_layer(self, reader, layer_bbox, accumulate):
+        """Accumulates the data values covered by each shapegrid cell
+
+        Only the block windows of the layer covered by shapegrid cells are
+        read, one at a time.
+
+        Args:
+            reader: A RasterBlockReader for the layer data.
+            layer_bbox: The bounding box of the layer in the map units of the
+                layer.
+            accumulate: The accumulate function of an encoding method.
+
+        Returns:
+            The number of data cells in each shapegrid cell
+        """
+        cell_bounds = self._get_cell_index(reader.shape, layer_bbox)
+        cell_sizes = np.zeros(self.num_cells, dtype=np.int64)
+        for window in reader.iter_windows():
+            cell_ids, rows, cols = _get_window_cells(
+                cell_bounds, window, self._centroids, self._vertex_offsets,
+                reader.shape, layer_bbox, num_cell_sides=self.shapegrid_sides)
+            if cell_ids.size == 0:
+                continue
+            cell_sizes += np.bincount(cell_ids, minlength=self.num_cells)
+            accumulate(reader.read_window(*window)[rows, cols], cell_ids)
+        return cell_sizes
+
+    # ...............................
+    def _encode_layer(self, layer, encode_method, column_name):
+        """Encodes the layer using the provided encoding method
 
         Args:
-            window_func: A function that returns a window of array data for a
-                provided x, y pair.
-            encode_func: A function that encodes a window of array data.
+            layer: A tuple of a RasterBlockReader for the layer data and the
+                bounding box of the layer, as returned by '_read_layer'.  The
+                reader is closed once the layer is encoded.
+            encode_method: A tuple of the accumulate and encode functions of an
+                encoding method.  The encode function returns one value, or a
+                row of values, for each shapegrid cell.  More than one column
+                is encoded if we are testing for multiple biogeographic
+                hypotheses in a single vector layer for example.
             column_name: The header name to use for the column in the encoded
                 matrix.
-            num_columns: The number of columns that will be encoded by
-                'encode_func'.  This can be non-zero if we are testing for
-                multiple biogeographic hypotheses in a single vector layer for
-                example.
 
         Returns:
             A list of column headers for the newly encoded columns
         """
-        shapegrid_dataset = ogr.Open(self.shapegrid_filename)
-        shapegrid_layer = shapegrid_dataset.GetLayer()
-
-        encoded_column = np.zeros((self.num_cells, num_columns))
+        reader, layer_bbox = layer
+        accumulate, encode_func = encode_method
+        with reader:
+            cell_sizes = self._accumulate_layer(reader, layer_bbox, accumulate)
+
+        encoded_column = np.asarray(encode_func(cell_sizes), dtype=float)
+        if encoded_column.ndim == 1:
+            num_columns = 1
+        else:
+            num_columns = encoded_column.shape[1]
         if num_columns == 1:
             column_headers = [column_name]
         else:
             column_headers = [
                 '{}-{}'.format(column_name, val) for val in range(num_columns)]
 
-        row_headers = []
-
-        i = 0
-
-        feat = shapegrid_layer.GetNextFeature()
-        while feat is not None:
-            geom = feat.GetGeometryRef()
-            cent = geom.Centroid()
-            x_coord = cent.GetX()
-            y_coord = cent.GetY()
-            val = encode_func(window_func(x_coord, y_coord))
-            encoded_column[i] = val
-            row_headers.append((feat.GetFID(), x_coord, y_coord))
-            i += 1
-            feat = shapegrid_layer.GetNextFeature()
-
-        col = Matrix(encoded_column,
-                     headers={'0': row_headers,
+        col = Matrix(encoded_column.reshape((self.num_cells, num_columns)),
+                     headers={'0': list(self.row_headers),
                               '1': column_headers})
 
         if self.encoded_matrix is None:
@@ -282,72 +534,27 @@ class LayerEncoder:
         return column_headers
 
     # ...............................
-    @staticmethod
-    def _get_window_function(data, layer_bbox, cell_size, num_cell_sides=4):
-        """Gets a windowing function for the data.
+    def _get_cell_index(self, data_shape, layer_bbox):
+        """Gets the shapegrid cell data windows for a data array geometry
 
-        This function generates a function that will return a "window" of array
-        data for a given (x, y) pair.
+        The cell windows are computed once for each data array geometry and
+        kept for later layers.
 
         Args:
-            data: A numpy array with data for a layer
-            layer_bbox: The bounding box of the layer in the map units of the
-                layer.
-            cell_size: Either a single value or a tuple with two values. If it
-                is a single value, it will be used for both x and y cell sizes.
-                If a tuple is provided, the first value will be used for the
-                size of each cell in the x dimension and the second will be
-                used for the size of the cell in the y dimension.
-            num_cell_sides: The number of sides each shapegrid cell has::
-                4 -- square
-                6 -- hexagon
-
-        Note:
-            The origin (0, 0) of the data array should represent (min x, max y)
-                for the layer.
-
-        TODO(CJ): Enable hexagonal windows by masking data
-        """
-        # Compute bounds here to save compute time
-        y_size, x_size = data.shape
-        min_x, min_y, max_x, max_y = layer_bbox
-
-        # x_res = float(max_x - min_x) / x_size
+            data_shape: The (rows, columns) shape of the data array
+            layer_bbox: The bounding box of the data array
 
-        y_range = max_y - min_y
-        x_range = max_x - min_x
-
-        try:
-            # Tuple or list
-            x_size_2 = cell_size[0] / 2.0
-            y_size_2 = cell_size[1] / 2.0
-        except TypeError:
-            # Single value
-            x_size_2 = y_size_2 = cell_size / 2.0
-
-        # ...............................
-        def get_rc(x_coord, y_coord):
-            x_prop = (1.0 * x_coord - min_x) / x_range
-            y_prop = (1.0 * y_coord - min_y) / y_range
-
-            col = int(x_size * x_prop)
-            row = y_size - int(y_size * y_prop)
-            return row, col
-
-        # ...............................
-        def window_function(x_coord, y_coord):
-            """Get the array window from the centroid coordinates"""
-            # Note: Again, 0 row corresponds to top of map, so bigger y
-            #     corresponds to lower row number
-            # Upper left coorner
-            uly, ulx = get_rc(x_coord - x_size_2, y_coord + y_size_2)
-            # Lower right corner
-            lry, lrx = get_rc(x_coord + x_size_2, y_coord - y_size_2)
-
-            return data[max(0, uly):min(y_size, lry),
-                        max(0, ulx):min(x_size, lrx)]
-
-        return window_function
+        Returns:
+            The shapegrid cell data windows, see '_get_cell_bounds'
+        """
+        key = (tuple(int(i) for i in data_shape),
+               tuple(float(i) for i in layer_bbox))
+        with self._cell_index_lock:
+            if key not in self._cell_indexes:
+                self._cell_indexes[key] = _get_cell_bounds(
+                    self._centroids, self._vertex_offsets, data_shape,
+                    layer_bbox)
+        return self._cell_indexes[key]
 
     # ...............................
     def _read_layer(self, layer_filename, resolution=None, bbox=None,
@@ -367,22 +574,22 @@ class LayerEncoder:
                 vector layer.
 
         Returns:
-            A tuple containing a window function for returning a portion of the
-            numpy array generated by the layer and the NODATA value to use with
-            this layer.
+            A tuple containing a RasterBlockReader for the layer data and the
+            bounding box of the layer (see _encode_layer), the NODATA value to
+            use with this layer, and the distinct events of a vector layer.
         """
         # Get the file extension for the layer file name
         ext = os.path.splitext(layer_filename)[1]
 
         if ext == LMFormat.SHAPE.ext:
-            window_func, nodata_value, events = self._read_vector_layer(
+            layer, nodata_value, events = self._read_vector_layer(
                 layer_filename, resolution=resolution, bbox=bbox,
                 nodata=nodata, event_field=event_field)
         else:
-            window_func, nodata_value = self._read_raster_layer(layer_filename)
+            layer, nodata_value = self._read_raster_layer(layer_filename)
             events = set([])
 
-        return (window_func, nodata_value, events)
+        return (layer, nodata_value, events)
 
     # ...............................
     def _read_raster_layer(self, raster_filename):
@@ -392,62 +599,54 @@ class LayerEncoder:
             raster_filename: The file path for the raster layer.
 
         Returns:
-            A tuple containing a window function for returning a portion of the
-            numpy array generated by the layer and the NODATA value to use with
-            this layer.
+            A tuple containing a RasterBlockReader for the layer and its
+            bounding box, and the NODATA value to use with this layer.
         """
-        dataset = gdal.Open(raster_filename)
-        band = dataset.GetRasterBand(1)
-        layer_array = band.ReadAsArray()
-        nodata = band.GetNoDataValue()
-
-        num_y, num_x = layer_array.shape
-        min_x, x_res, _, max_y, _, y_res = dataset.GetGeoTransform()
-        max_x = min_x + (num_x * x_res)
-        min_y = max_y + (y_res * num_y)
-        layer_bbox = (min_x, min_y, max_x, max_y)
-        window_func = self._get_window_function(
-            layer_array, layer_bbox, self.shapegrid_resolution,
-            num_cell_sides=self.shapegrid_sides)
-
-        return (window_func, nodata)
+        reader = RasterBlockReader(
+            raster_filename, memory_limit=self.block_memory)
+        return ((reader, reader.bbox), reader.nodata)
 
     # ...............................
     def _read_shapegrid(self, shapegrid_filename):
         """Read the shapegrid
 
+        The cell centroids and row headers are read once here and shared by
+        every encoded layer.
+
         Args:
             shapegrid_filename: The file location of the shapegrid
         """
         shapegrid_dataset = ogr.Open(shapegrid_filename)
-        self.shapegrid_layer = shapegrid_dataset.GetLayer()
-        tmp = self.shapegrid_layer.GetExtent()
+        shapegrid_layer = shapegrid_dataset.GetLayer()
+        tmp = shapegrid_layer.GetExtent()
         self.shapegrid_bbox = (tmp[0], tmp[2], tmp[1], tmp[3])
 
-        self.num_cells = self.shapegrid_layer.GetFeatureCount()
-
-        feature_0 = self.shapegrid_layer.GetFeature(0)
-        geom = feature_0.GetGeometryRef()
+        self.row_headers = []
+        vertices = None
+        feat = shapegrid_layer.GetNextFeature()
+        while feat is not None:
+            geom = feat.GetGeometryRef()
+            cent = geom.Centroid()
+            x_coord = cent.GetX()
+            y_coord = cent.GetY()
+            if vertices is None:
+                # Cells are regular, so the first one gives the cell shape
+                envelope = geom.GetEnvelope()
+                self.shapegrid_resolution = (envelope[1] - envelope[0],
+                                             envelope[3] - envelope[2])
+                # Drop the closing point of the ring
+                vertices = np.array(
+                    geom.GetGeometryRef(0).GetPoints())[:-1, :2]
+                self._vertex_offsets = vertices - [x_coord, y_coord]
+            self.row_headers.append((feat.GetFID(), x_coord, y_coord))
+            feat = shapegrid_layer.GetNextFeature()
 
-        # Get resolution and number of sides
-        geom_wkt = geom.ExportToWkt()
-        boundary_points = geom_wkt.split(',')
-        if len(boundary_points) == 5:
-            # Square
-            envelope = geom.GetEnvelope()
-            self.shapegrid_resolution = (envelope[1] - envelope[0],
-                                         envelope[3] - envelope[2])
-        else:
-            # Hexagon
-            center = geom.Centroid()
-            x_cent = center.GetX()
-            y_cent = center.GetY()
-            x_1, y_1 = boundary_points[1].split(' ')
-            self.shapegrid_resolution = np.sqrt(
-                (x_cent - x_1) ** 2 + (y_cent - y_1) ** 2)
-        self.shapegrid_sides = len(boundary_points) - 1
-        # self.shapegrid_layer.ResetReading()
-        self.shapegrid_layer = None
+        self.num_cells = len(self.row_headers)
+        self._centroids = np.array(
+            [(x_coord, y_coord) for _, x_coord, y_coord in self.row_headers],
+            dtype=float).reshape((self.num_cells, 2))
+        self.shapegrid_sides = 0 if vertices is None else vertices.shape[0]
+        shapegrid_dataset = shapegrid_layer = None
 
     # ...............................
     def _read_vector_layer(self, vector_filename, resolution=None, bbox=None,
@@ -467,9 +666,9 @@ class LayerEncoder:
                 value for each cell.  This should be numeric.
 
         Returns:
-            A tuple containing a window function for returning a portion of the
-            numpy array generated by the layer, the NODATA value to use with
-            this layer, and a set of distinct events to be used for processing.
+            A tuple containing a RasterBlockReader for the rasterized layer and
+            its bounding box, the NODATA value to use with this layer, and a
+            set of distinct events to be used for processing.
         """
         options = ['ALL_TOUCHED=TRUE']
         if event_field is not None:
@@ -501,21 +700,14 @@ class LayerEncoder:
         raster_ds.SetGeoTransform((min_x, x_res, 0, max_y, 0, -1.0 * y_res))
         band = raster_ds.GetRasterBand(1)
         band.SetNoDataValue(nodata)
-        band.FlushCache()
-        init_ary = np.empty((y_size, x_size))
-        init_ary.fill(nodata)
-        band.WriteArray(init_ary)
+        band.Fill(nodata)
         gdal.RasterizeLayer(raster_ds, [1], vector_layer, options=options)
+        vector_ds = vector_layer = None
 
-        layer_array = raster_ds.ReadAsArray()
-        raster_ds = None
+        reader = RasterBlockReader(raster_ds, memory_limit=self.block_memory)
+        distinct_events = list(np.unique(np.concatenate([
+            np.unique(block) for _, _, block in reader.iter_blocks()])))
 
-        layer_bbox = (min_x, min_y, max_x, max_y)
-        window_func = self._get_window_function(
-            layer_array, layer_bbox, self.shapegrid_resolution,
-            num_cell_sides=self.shapegrid_sides)
-
-        distinct_events = list(np.unique(layer_array))
         try:
             # Go through list backwards to safely pop if needed
             for i in range(len(distinct_events) - 1, -1, -1):
@@ -527,7 +719,8 @@ class LayerEncoder:
                 distinct_events = []
             else:
                 distinct_events = [distinct_events]
-        return (window_func, nodata, distinct_events)
+        return ((reader, (min_x, min_y, max_x, max_y)), nodata,
+                distinct_events)
 
     # ...............................
     def encode_biogeographic_hypothesis(self, layer_filename, column_name,
@@ -556,17 +749,15 @@ class LayerEncoder:
         Returns:
             A list of column headers for the newly encoded columns
         """
-        window_func, nodata, distinct_events = self._read_layer(
+        layer, nodata, distinct_events = self._read_layer(
             layer_filename, resolution=resolution, bbox=bbox, nodata=nodata,
             event_field=event_field)
         if len(distinct_events) == 2:
             # Set the events to be opposite sides of same hypothesis
             distinct_events = [tuple(distinct_events)]
-        encode_func = _get_encode_hypothesis_method(
-            distinct_events, min_coverage, nodata)
-        return self._encode_layer(
-            window_func, encode_func, column_name,
-            num_columns=len(distinct_events))
+        encode_method = _get_encode_hypothesis_method(
+            distinct_events, min_coverage, nodata, self.num_cells)
+        return self._encode_layer(layer, encode_method, column_name)
 
     # ...............................
     def encode_presence_absence(self, layer_filename, column_name,
@@ -594,12 +785,12 @@ class LayerEncoder:
         Returns:
             A list of column headers for the newly encoded columns
         """
-        window_func, nodata, _ = self._read_layer(
+        layer, nodata, _ = self._read_layer(
             layer_filename, resolution=resolution, bbox=bbox, nodata=nodata,
             event_field=attribute_name)
-        encode_func = _get_presence_absence_method(
-            min_presence, max_presence, min_coverage, nodata)
-        return self._encode_layer(window_func, encode_func, column_name)
+        encode_method = _get_presence_absence_method(
+            min_presence, max_presence, min_coverage, nodata, self.num_cells)
+        return self._encode_layer(layer, encode_method, column_name)
 
     # ...............................
     def encode_mean_value(self, layer_filename, column_name, resolution=None,
@@ -622,11 +813,11 @@ class LayerEncoder:
         Returns:
             A list of column headers for the newly encoded columns
         """
-        window_func, nodata, _ = self._read_layer(
+        layer, nodata, _ = self._read_layer(
             layer_filename, resolution=resolution, bbox=bbox, nodata=nodata,
             event_field=attribute_name)
-        encode_func = _get_mean_value_method(nodata)
-        return self._encode_layer(window_func, encode_func, column_name)
+        encode_method = _get_mean_value_method(nodata, self.num_cells)
+        return self._encode_layer(layer, encode_method, column_name)
 
     # ...............................
     def encode_largest_class(self, layer_filename, column_name, min_coverage,
@@ -651,11 +842,27 @@ class LayerEncoder:
         Returns:
             A list of column headers for the newly encoded columns
         """
-        window_func, nodata, _ = self._read_layer(
+        layer, nodata, _ = self._read_layer(
             layer_filename, resolution=resolution, bbox=bbox, nodata=nodata,
             event_field=attribute_name)
-        encode_func = _get_largest_class_method(min_coverage, nodata)
-        return self._encode_layer(window_func, encode_func, column_name)
+        encode_method = _get_largest_class_method(
+            min_coverage, nodata, self.num_cells)
+        return self._encode_layer(layer, encode_method, column_name)
+
+    # ...............................
+    def get_empty_copy(self):
+        """Returns a new encoder that shares this encoder's shapegrid
+
+        The copy shares the shapegrid information and cell indexes, so they
+        are not read again, but encodes layers into its own matrix.  Copies
+        can be used to encode layers in separate threads.
+
+        Returns:
+            A LayerEncoder without any encoded layers
+        """
+        encoder = copy.copy(self)
+        encoder.encoded_matrix = None
+        return encoder
 
     # ...............................
     def get_encoded_matrix(self):
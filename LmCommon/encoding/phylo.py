@@ -1,5 +1,11 @@
 """Module containing a class for encoding a Phylogenetic tree into a matrix.
 
+The P matrix is built without recursion from a postorder and a preorder pass
+over the tree.  The tips descending from each internal node are a contiguous
+range of the tips in postorder, so each column is computed with a few array
+operations over that range and the matrix is assembled in sparse column (CSC)
+form.  The work and memory are proportional to the total length of the paths
+from the tips to the root rather than to tips times internal nodes.
 
 See:
     Leibold, m.A., E.P. Economo and P.R. Peres-Neto. 2010. Metacommunity
@@ -9,14 +15,133 @@ See:
 Todo:
     Use method to get labels by matrix index when available from tree
 """
+import json
 from random import shuffle
 
 import numpy as np
+from scipy import sparse
 from lmpy import Matrix, PhyloTreeKeys, TreeWrapper
 
+from LmCommon.common.lmconstants import LMFormat
 from LmCommon.encoding.encoding_exception import EncodingException
 
 
+# .............................................................................
+class SparsePhyloMatrix:
+    """Class for a P matrix stored in compressed sparse column form
+
+    The interface follows the parts of lmpy.Matrix used by MCPA.  Headers are
+    stored in the same dictionary format as a Matrix.
+    """
+
+    # ..............................
+    def __init__(self, data, headers=None):
+        """Constructor
+
+        Args:
+            data (scipy.sparse.csc_matrix): A (tips by internal nodes) sparse
+                matrix.
+            headers (dict): Optional Matrix style headers for the matrix.
+        """
+        self.data = data
+        if headers is None:
+            headers = {}
+        self.headers = headers
+
+    # ..............................
+    def __array__(self, dtype=None, copy=None):
+        """Returns the dense P matrix as a numpy array
+
+        Args:
+            dtype (type): The data type of the array, defaults to float.
+            copy (bool): Ignored, the array is always a new array.
+        """
+        if dtype is None:
+            dtype = float
+        return self.data.toarray().astype(dtype, copy=False)
+
+    # ..............................
+    @property
+    def shape(self):
+        """Returns the (tips, internal nodes) shape of the matrix
+        """
+        return self.data.shape
+
+    # ..............................
+    @classmethod
+    def load(cls, filename):
+        """Loads a sparse P matrix written by `write`
+
+        Args:
+            filename (str): The file location of the sparse P matrix.
+        """
+        with open(filename, 'rb') as in_file:
+            loaded = np.load(in_file, allow_pickle=False)
+            return cls(
+                sparse.csc_matrix(
+                    (loaded['data'], loaded['indices'], loaded['indptr']),
+                    shape=tuple(loaded['shape'])),
+                headers=json.loads(str(loaded['headers'])))
+
+    # ..............................
+    def get_column_headers(self):
+        """Returns the column (internal node) headers
+        """
+        return self.headers.get('1', [])
+
+    # ..............................
+    def get_row_headers(self):
+        """Returns the row (tip) headers
+        """
+        return self.headers.get('0', [])
+
+    # ..............................
+    def get_columns(self, start, stop, dtype=float):
+        """Returns a block of columns as a dense array
+
+        Args:
+            start (int): The first column to return.
+            stop (int): The column after the last one to return.
+            dtype (type): The data type of the returned array.
+        """
+        return self.data[:, start:stop].toarray().astype(dtype, copy=False)
+
+    # ..............................
+    def to_matrix(self):
+        """Returns the P matrix as a dense Matrix with the same headers
+        """
+        return Matrix(np.asarray(self), headers=self.headers)
+
+    # ..............................
+    def write(self, filename):
+        """Writes the sparse P matrix to a file
+
+        Args:
+            filename (str): The file location to write the sparse P matrix.
+        """
+        with open(filename, 'wb') as out_file:
+            np.savez(
+                out_file, data=self.data.data, indices=self.data.indices,
+                indptr=self.data.indptr, shape=np.array(self.data.shape),
+                headers=np.array(json.dumps(self.headers)))
+
+
+# .............................................................................
+def load_phylo_matrix(filename):
+    """Loads a P matrix from a Matrix or sparse P matrix file
+
+    Args:
+        filename (str): The file location of the P matrix.  Files with the
+            sparse matrix extension are loaded as a SparsePhyloMatrix.
+
+    Returns:
+        Matrix or SparsePhyloMatrix: The loaded P matrix.
+    """
+    if filename.endswith(LMFormat.SPARSE_MATRIX.ext):
+        return SparsePhyloMatrix.load(filename)
+    return Matrix.load(filename)
+
+
 # .............................................................................
 class PhyloEncoding:
     """
@@ -56,9 +181,13 @@ class PhyloEncoding:
         return cls(tree, pam)
 
     # ..............................
-    def encode_phylogeny(self):
+    def encode_phylogeny(self, sparse_matrix=False):
         """Encode the phylogenetic tree into a matrix.
 
+        Args:
+            sparse_matrix (bool): If True, return the P matrix as a
+                SparsePhyloMatrix instead of a dense Matrix.
+
         Note:
             P in the literature, a tip (row) by internal node (column) matrix
                 that needs to match the provided PAM.
@@ -75,7 +204,9 @@ class PhyloEncoding:
             raise EncodingException(
                 "PAM and Tree do not match, fix before encoding")
 
-        return p_mtx
+        if sparse_matrix:
+            return p_mtx
+        return p_mtx.to_matrix()
 
     # ..............................
     def validate(self):
@@ -105,77 +236,59 @@ class PhyloEncoding:
         return False
 
     # ..............................
-    def _build_p_branch_length_values(self, node):
-        """Recurse through the tree to get P matrix values for node / tips.
+    def _get_tip_ranges(self):
+        """Gets the range of postorder tip positions descending from each node
+
+        Returns:
+            * A numpy array of the PAM matrix index of each tip in postorder.
+            * A dictionary of node to the (start, stop) range of the postorder
+                positions of the tips descending from it.
+        """
+        tip_rows = []
+        tip_ranges = {}
+        for node in self.tree.postorder_node_iter():
+            if node.is_leaf():
+                tip_ranges[node] = (len(tip_rows), len(tip_rows) + 1)
+                tip_rows.append(int(
+                    node.taxon.annotations.get_value(PhyloTreeKeys.MTX_IDX)))
+            else:
+                child_ranges = [
+                    tip_ranges[child] for child in node.child_nodes()]
+                tip_ranges[node] = (
+                    child_ranges[0][0], child_ranges[-1][1])
+        return np.array(tip_rows, dtype=np.int64), tip_ranges
+
+    # ..............................
+    def _assemble_p_matrix(self, tip_rows, columns, column_labels):
+        """Assembles the sparse P matrix from column values
 
         Args:
-            node (dendropy.Node): The current clade.
+            tip_rows (numpy array): The PAM matrix index of each tip in
+                postorder.
+            columns (list): A list of (tip position array, value array) tuples
+                for each column.
+            column_labels (list): The label of each column.
+
+        Returns:
+            SparsePhyloMatrix: The P matrix with PAM species headers for the
+                rows and internal node labels for the columns.
         """
-        # Dictionary of branch length lists, bottom-up from tip to current node
-        bl_dict = {}
-
-        clade_bl = node.edge_length  # To avoid lookups
-
-        # This is the sum of all branch lengths in the clade and will be used
-        #    as the denominator for the p value for each tip to this node.  See
-        #    the literature for more information.  We will initialize with the
-        #    branch length of this clade because it will always be added
-        #    whether we are at a tip or an internal node.
-        bl_sum = clade_bl
-
-        # Dictionary of dictionaries of p values, first key is node path id,
-        #    sub-keys are tip matrix indices for that node
-        p_vals_dict = {}
-
-        if node.num_child_nodes() > 0:  # Assume this is two since binary
-            clade_p_vals = {}
-            multipliers = [-1.0, 1.0]  # One positive, one negative
-            shuffle(multipliers)
-
-            for child in node.child_nodes():
-                (child_bl_dict, child_bl_sum, child_p_val_dict
-                 ) = self._build_p_branch_length_values(child)
-                multiplier = multipliers.pop(0)
-
-                # Extend the p values dictionary
-                p_vals_dict.update(child_p_val_dict)
-
-                # Add this child's branch length sum to the clade's branch
-                #    length sum
-                bl_sum += child_bl_sum
-                child_bl = child.edge_length
-
-                # We will add this value to the branch length list for all of
-                #    the tips in this clade.  It is the branch length of this
-                #    clade divided by the number of tips in the clade.
-                add_val = 1.0 * child_bl / len(child_bl_dict)
-
-                # Process eac of the tips in the child_bl_dict
-                for k, child_bl_k in child_bl_dict.items():
-                    # The formula for calculating the p value is:
-                    #    P(tip)(node) = (l1 + l2/2 + l3/3 + ... ln/n) / sum of
-                    #        branch lengths to node
-                    #    The value is arbitrarily set to be positive for one
-                    #        child and negative for the other
-                    #    The 'l' term is the length of a branch  and it is
-                    #        divided by the number of tips that share that
-                    #        branch.
-                    tip_bls = child_bl_k + [add_val]
-
-                    # Add the p value to p_vals_dict
-                    clade_p_vals[k] = multiplier * sum(tip_bls) / child_bl_sum
-
-                    # Add to bl_dict with this branch length
-                    bl_dict[k] = tip_bls
-
-            p_vals_dict[node.label] = clade_p_vals
-
-        else:  # We are at a tip
-            bl_dict = {
-                node.taxon.annotations.get_value(PhyloTreeKeys.MTX_IDX): []
-            }
-
-        return bl_dict, bl_sum, p_vals_dict
+        labels = self.pam.get_column_headers()
+        indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([col_vals.size for _, col_vals in columns])
+        if columns:
+            indices = tip_rows[
+                np.concatenate([tip_pos for tip_pos, _ in columns])]
+            data = np.concatenate([col_vals for _, col_vals in columns])
+        else:
+            indices = np.zeros(0, dtype=np.int64)
+            data = np.zeros(0)
+
+        p_mtx = sparse.csc_matrix(
+            (data, indices, indptr), shape=(len(labels), len(columns)))
+        p_mtx.sort_indices()
+        return SparsePhyloMatrix(
+            p_mtx, headers={'0': labels, '1': column_labels})
 
     # ..............................
     def _build_p_matrix_no_branch_lengths(self):
@@ -185,10 +298,9 @@ class PhyloEncoding:
             For this method, we assume that there is a total weight of -1 to
                 the left and +1 to the right for each node.  As we go down
                 (towards the tips) of the tree, we divide the proportion of
-                each previously visited node by 2.  We then recurse with this
-                new visited list down the tree.  Once we reach a tip, we can
-                return that list of proportions because it will match for that
-                tip for each of its ancestors.
+                each previously visited node by 2.  So the value for a tip and
+                an ancestor is +/-1 divided by 2 for each internal node between
+                them, which is computed from the node depths.
 
         Example:
             3
@@ -206,27 +318,9 @@ class PhyloEncoding:
                +-- E
                +-- F
 
-            Step 1: (Node 3) []
-                - recurse left with [(3,-1)]
-                - recurse right with [(3,1)]
-            Step 2: (Node 2) [(3,-1)]
-                - recurse left with [(3,-.5),(2,-1)]
-                - recurse right with [(3,-.5),(2,1)]
-            Step 3: (Node 1)[(3,-.5),(2,-1)]
-                - recurse left with [(3,-.25),(2,-.5),(1,-1)]
-                - recurse right with [3,-.25),(2,-.5),(1,1)]
-            Step 4: (Node 0)[(3,-.25),(2,-.5),(1,-1)]
-                - recurse left with [(3,-.125),(2,-.25),(1,-.5),(0,-1)]
-                - recurse right with [(3,-.125),(2,-.25),(1,-.5),(0,1)]
-            Step 5: (Tip A) - Return [(3,-.125),(2,-.25),(1,-.5),(0,-1)]
-            Step 6: (Tip B) - Return [(3,-.125),(2,-.25),(1,-.5),(0,1)]
-            Step 7: (Tip C) - Return [(3,-.25),(2,-.5),(1,1)]
-            Step 8: (Tip D) - Return [(3,-.5),(2,1)]
-            Step 9: (Node 4) [(3,1)]
-                - recurse left with [(3,.5),(4,-1)]
-                - recurse right with [(3,.5),(4,1)]
-            Step 10: (Tip E) - Return [(3,.5),(4,-1)]
-            Step 11: (Tip F) - Return [(3,.5),(4,1)]
+            Depths: 3 -> 0, 2 -> 1, 4 -> 1, 1 -> 2, 0 -> 3, A -> 4, E -> 2
+            P(A)(3) = -1 / 2^(4 - 0 - 1) = -0.125
+            P(E)(4) = -1 / 2^(2 - 1 - 1) = -1.0
 
             Creates matrix:
                      0     1     2      3       4
@@ -240,83 +334,46 @@ class PhyloEncoding:
         See:
             Page 1293 of the literature
         """
-        # .......................
-        # Initialize the matrix
-        internal_node_labels = [
-            n.label for n in self.tree.nodes() if not n.is_leaf()]
-        labels = self.pam.get_column_headers()
-
-        # We need a mapping of node path id to matrix column.  I don't think
-        #     order matters
-        node_col_idx = dict(
-            zip(internal_node_labels, range(len(internal_node_labels))))
-
-        mtx = Matrix(
-            np.zeros((len(labels), len(internal_node_labels)), dtype=np.float),
-            headers={'0': labels, '1': internal_node_labels})
-
-        # Get the list of tip proportion lists
-        # Note: Which tip each of the lists belongs to doesn't really matter
-        #    but recursion will start at the top and go to the bottom of the
-        #    tree tips.
-        self.tree.seed_node._set_edge_length(0.0)
-        tip_props = self._build_p_matrix_tip_proportion_list(
-            self.tree.seed_node, visited=[])
-
-        # The matrix index of the tip in the PAM maps to the row index of P
-        for row_idx, tip_prop in tip_props:
-            for node_clade_id, val in tip_prop:
-                mtx[row_idx][node_col_idx[node_clade_id]] = val
-
-        return mtx
-
-    # ..............................
-    def _build_p_matrix_tip_proportion_list(self, node, visited=None):
-        """Builds a list of tip proportions for the p matrix w/o branch lengths
-
-        Args:
-            node (dendropy.Node): The current clade.
-            visited (:obj:`None` or :obj:`list` of :obj:`tuple`): A list of
-                (node path id, proportion) tuples.
+        tip_rows, tip_ranges = self._get_tip_ranges()
+
+        # Depth is the number of internal nodes above a node
+        depths = {}
+        tip_depths = np.zeros(tip_rows.size)
+        internal_nodes = []
+        for node in self.tree.preorder_node_iter():
+            if node.parent_node is None:
+                depths[node] = 0
+            else:
+                depths[node] = depths[node.parent_node] + 1
+            if node.is_leaf():
+                tip_depths[tip_ranges[node][0]] = depths[node]
+            else:
+                internal_nodes.append(node)
 
-        Note:
-            Proportion for each visited node is divided by two as we go
-                towards the tips at each hop.
-        """
-        if visited is None:
-            visited = []
-
-        tip_props = []
-        if node.num_child_nodes() > 0:  # Assume this is two since binary
-            # First divide all existing visited by two
-            new_visited = [(idx, val / 2) for idx, val in visited]
-            # Recurse.  Left is negative, right is positive
-            left_child, right_child = node.child_nodes()
-            tip_props.extend(
-                self._build_p_matrix_tip_proportion_list(
-                    left_child, visited=new_visited + [(node.label, -1.0)]))
-            tip_props.extend(
-                self._build_p_matrix_tip_proportion_list(
-                    right_child, visited=new_visited + [(node.label, 1.0)]))
-        else:
-            tip_props.append(
-                (node.taxon.annotations.get_value(PhyloTreeKeys.MTX_IDX),
-                 visited))
+        # Columns are in preorder, left is negative and right is positive
+        columns = []
+        for node in internal_nodes:
+            tip_pos = np.arange(*tip_ranges[node])
+            left_child = node.child_nodes()[0]
+            signs = np.where(tip_pos < tip_ranges[left_child][1], -1.0, 1.0)
+            columns.append((tip_pos, signs * 0.5 ** (
+                tip_depths[tip_pos] - depths[node] - 1)))
 
-        return tip_props
+        return self._assemble_p_matrix(
+            tip_rows, columns, [node.label for node in internal_nodes])
 
     # ..............................
     def _build_p_matrix_with_branch_lengths(self):
         """Creates a P matrix when branch lengths are present
 
         Note:
-            For this method, we assume that there is a total weight of -1 to
-                the left and +1 to the right for each node.  As we go down
-                (towards the tips) of the tree, we divide the proportion of
-                each previously visited node by 2.  We then recurse with this
-                new visited list down the tree.  Once we reach a tip, we can
-                return that list of proportions because it will match for that
-                tip for each of its ancestors.
+            For this method, the value for a tip and an internal node is the
+                sum of the length of each branch on the path from the tip to
+                the node's child divided by the number of tips sharing that
+                branch, divided by the sum of the branch lengths in the
+                child's clade.  The sum along the path is the difference of the
+                sums from the root, which are computed once in preorder.  One
+                child of each node is randomly chosen to be negative.
 
         Example:
             3
@@ -361,25 +418,54 @@ class PhyloEncoding:
         See:
             Literature supplemental material
         """
-        # We only need the P-values dictionary
-        # TODO: Is there a better way to do this so the length of the r?
-        self.tree.seed_node._set_edge_length(0.0)
-        _, _, p_val_dict = self._build_p_branch_length_values(
-            self.tree.seed_node)
-
-        # Initialize the matrix
-        labels = self.pam.get_column_headers()
-        mtx = Matrix(
-            np.zeros((len(labels), len(p_val_dict)), dtype=np.float),
-            headers={'0': labels, '1': list(p_val_dict.keys())})
-
-        # We need a mapping of node path id to matrix column.  I don't think
-        #     order matters
-        node_col_idx = dict(
-            zip(p_val_dict.keys(), range(len(p_val_dict.keys()))))
-
-        for node_clade_id, p_val_node_val in p_val_dict.items():
-            for tip_mtx_idx, tip_p_vals in p_val_node_val.items():
-                mtx[int(tip_mtx_idx)][node_col_idx[node_clade_id]] = tip_p_vals
-
-        return mtx
+        tip_rows, tip_ranges = self._get_tip_ranges()
+
+        # The root branch is not part of the encoding
+        seed_node = self.tree.seed_node
+
+        def edge_length(node):
+            if node is seed_node:
+                return 0.0
+            return node.edge_length
+
+        # Sum of all branch lengths in each clade, including its own branch
+        clade_sums = {}
+        internal_nodes = []
+        for node in self.tree.postorder_node_iter():
+            clade_sums[node] = edge_length(node) + sum(
+                clade_sums[child] for child in node.child_nodes())
+            if not node.is_leaf():
+                internal_nodes.append(node)
+
+        # Sum of branch length / number of tips sharing it from the root.
+        #    Multipliers are shuffled in preorder, like the tree is visited
+        path_sums = {}
+        multipliers = {}
+        tip_path_sums = np.zeros(tip_rows.size)
+        for node in self.tree.preorder_node_iter():
+            start, stop = tip_ranges[node]
+            path_sums[node] = edge_length(node) / (stop - start)
+            if node.parent_node is not None:
+                path_sums[node] += path_sums[node.parent_node]
+            if node.is_leaf():
+                tip_path_sums[start] = path_sums[node]
+            else:
+                multipliers[node] = [-1.0, 1.0]  # One positive, one negative
+                shuffle(multipliers[node])
+
+        # Columns are in postorder
+        columns = []
+        for node in internal_nodes:
+            tip_pos = []
+            values = []
+            for child, multiplier in zip(
+                    node.child_nodes(), multipliers[node]):
+                child_pos = np.arange(*tip_ranges[child])
+                tip_pos.append(child_pos)
+                values.append(multiplier * (
+                    tip_path_sums[child_pos] - path_sums[node]
+                    ) / clade_sums[child])
+            columns.append((np.concatenate(tip_pos), np.concatenate(values)))
+
+        return self._assemble_p_matrix(
+            tip_rows, columns, [node.label for node in internal_nodes])
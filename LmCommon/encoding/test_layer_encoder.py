@@ -0,0 +1,197 @@
+"""Tests for encoding raster layers over shapegrids in layer_encoder.py
+
+Note:
+    * Expected values are computed by hand from the data cells covered by
+        each shapegrid cell.  Square cells cover a 3 by 3 data window.
+        Hexagonal cells cover the data cells with centers inside of them.
+"""
+import math
+
+import numpy as np
+from osgeo import gdal, ogr
+import pytest
+
+from LmCommon.common.raster_blocks import DEFAULT_BLOCK_MEMORY
+from LmCommon.encoding.layer_encoder import LayerEncoder
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+NODATA = -9999
+N = NODATA
+# Four 3 by 3 square cells over a 6 by 6 layer with 1 by 1 data cells, in
+#    the order top left, top right, bottom left, bottom right
+SQUARE_CELLS = [(0, 3), (3, 3), (0, 0), (3, 0)]
+SQUARE_DATA = [
+    [1, 2, 3, 4, 4, 4],
+    [4, 5, N, 4, 2, 2],
+    [6, N, N, 2, 2, 2],
+    [1, 1, 1, N, N, N],
+    [1, 3, 3, N, N, N],
+    [3, 3, 3, N, N, 5],
+]
+# Two hexagons with a radius of 3 centered at (3, 3) and (9, 3) over a 12 by
+#    6 layer.  The top and bottom edges of each hexagon are 0.4 inside of the
+#    layer, so the first and last rows are partly covered, but their centers
+#    are inside.  The centers of the corner data cells with value 100 are
+#    outside, so each hexagon covers 28 data cells.
+HEX_CENTERS = [(3, 3), (9, 3)]
+HEX_DATA = [
+    [100, 8, 8, 8, 8, 100, 100, 7, 7, 7, 7, 100],
+    [100, 2, 2, 2, 2, 100, 100, 7, 7, 7, 7, 100],
+    [2, 2, 2, 2, 2, 2, 5, 5, 5, 7, 7, 9],
+    [2, 2, 2, 2, N, 2, 5, 5, 5, 5, 5, 9],
+    [100, 2, 2, 2, 2, 100, 100, 5, 5, 5, 5, 100],
+    [100, 2, 2, 2, 2, 100, 100, 5, 5, 5, 5, 100],
+]
+
+
+# .............................................................................
+def _write_shapegrid(filename, cell_rings):
+    """Writes a shapegrid with a polygon for each ring of (x, y) vertices"""
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    dataset = driver.CreateDataSource(filename)
+    layer = dataset.CreateLayer('shapegrid', geom_type=ogr.wkbPolygon)
+    for ring in cell_rings:
+        feat = ogr.Feature(layer.GetLayerDefn())
+        feat.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON(({}))'.format(
+            ','.join('{} {}'.format(x, y) for x, y in ring + ring[:1]))))
+        layer.CreateFeature(feat)
+        feat = None
+    dataset = layer = None
+
+
+# .............................................................................
+def _write_raster(filename, data):
+    """Writes the data as a layer with 1 by 1 cells and a corner at (0, 0)
+
+    Each row of the layer is a block.
+    """
+    data = np.array(data, dtype=np.float32)
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(
+        filename, data.shape[1], data.shape[0], 1, gdal.GDT_Float32,
+        options=['BLOCKYSIZE=1'])
+    dataset.SetGeoTransform((0.0, 1.0, 0.0, float(data.shape[0]), 0.0, -1.0))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(data)
+    dataset.FlushCache()
+    band = dataset = None
+
+
+# .............................................................................
+@pytest.fixture(params=[4, DEFAULT_BLOCK_MEMORY], ids=['rows', 'layer'])
+def square_encoder(tmp_path, request):
+    """Gets an encoder of the square shapegrid and the layer file name
+
+    The small block memory reads the layer one row at a time.
+    """
+    shapegrid_filename = str(tmp_path / 'squares.shp')
+    _write_shapegrid(shapegrid_filename, [
+        [(x, y), (x + 3, y), (x + 3, y + 3), (x, y + 3)]
+        for x, y in SQUARE_CELLS])
+    layer_filename = str(tmp_path / 'squares.tif')
+    _write_raster(layer_filename, SQUARE_DATA)
+    return (LayerEncoder(shapegrid_filename, block_memory=request.param),
+            layer_filename)
+
+
+# .............................................................................
+@pytest.fixture(params=[4, DEFAULT_BLOCK_MEMORY], ids=['rows', 'layer'])
+def hexagon_encoder(tmp_path, request):
+    """Gets an encoder of the hexagon shapegrid and the layer file name"""
+    shapegrid_filename = str(tmp_path / 'hexagons.shp')
+    half_height = 3 * math.sqrt(3) / 2
+    _write_shapegrid(shapegrid_filename, [
+        [(x + 3, y), (x + 1.5, y + half_height), (x - 1.5, y + half_height),
+         (x - 3, y), (x - 1.5, y - half_height), (x + 1.5, y - half_height)]
+        for x, y in HEX_CENTERS])
+    layer_filename = str(tmp_path / 'hexagons.tif')
+    _write_raster(layer_filename, HEX_DATA)
+    return (LayerEncoder(shapegrid_filename, block_memory=request.param),
+            layer_filename)
+
+
+# .............................................................................
+def _get_column(encoder):
+    """Gets the values of the only encoded column"""
+    return np.asarray(encoder.get_encoded_matrix())[:, 0]
+
+
+# .............................................................................
+def test_read_shapegrid(square_encoder, hexagon_encoder):
+    """Cell resolution is the envelope of the first cell"""
+    encoder, _ = square_encoder
+    assert encoder.num_cells == 4
+    assert encoder.shapegrid_sides == 4
+    assert encoder.shapegrid_resolution == pytest.approx((3.0, 3.0))
+    assert np.allclose(
+        [row[1:] for row in encoder.row_headers],
+        [(x + 1.5, y + 1.5) for x, y in SQUARE_CELLS])
+
+    encoder, _ = hexagon_encoder
+    assert encoder.num_cells == 2
+    assert encoder.shapegrid_sides == 6
+    assert encoder.shapegrid_resolution == pytest.approx(
+        (6.0, 3 * math.sqrt(3)))
+    assert np.allclose(
+        [row[1:] for row in encoder.row_headers], HEX_CENTERS)
+
+
+# .............................................................................
+def test_mean_value(square_encoder, hexagon_encoder):
+    """Means skip nodata cells"""
+    encoder, layer_filename = square_encoder
+    assert encoder.encode_mean_value(layer_filename, 'mean') == ['mean']
+    assert _get_column(encoder) == pytest.approx(
+        [21 / 6, 26 / 9, 19 / 9, 5.0])
+
+    encoder, layer_filename = hexagon_encoder
+    encoder.encode_mean_value(layer_filename, 'mean')
+    # 8 * 4 + 2 * 23 over 27 data cells, and 7 * 10 + 5 * 16 + 9 * 2
+    assert _get_column(encoder) == pytest.approx([78 / 27, 6.0])
+
+
+# .............................................................................
+def test_largest_class(square_encoder, hexagon_encoder):
+    """The most common class covering more than min_coverage is encoded"""
+    encoder, layer_filename = square_encoder
+    # Classes must cover more than 1.8 of 9 data cells.  The top right cell
+    #    has 5 cells of 2 and 4 cells of 4, the bottom left 4 cells of 1 and
+    #    5 cells of 3.
+    encoder.encode_largest_class(layer_filename, 'class', 0.2)
+    encoder.encode_largest_class(layer_filename, 'class_percent', 20)
+    encoded = np.asarray(encoder.get_encoded_matrix())
+    assert encoder.get_encoded_matrix().get_column_headers() == [
+        'class', 'class_percent']
+    assert encoded[:, 0].tolist() == [NODATA, 2, 3, NODATA]
+    assert encoded[:, 1].tolist() == [NODATA, 2, 3, NODATA]
+
+    encoder, layer_filename = hexagon_encoder
+    # The second hexagon has 16 cells of 5, 10 cells of 7, and 2 cells of 9
+    encoder.encode_largest_class(layer_filename, 'class', 0.25)
+    assert _get_column(encoder).tolist() == [2, 5]
+
+
+# .............................................................................
+@pytest.mark.parametrize(
+    'min_coverage, square_presence, hexagon_presence', [
+        # At least one present data cell is always needed
+        (0.0, [1, 1, 1, 0], [1, 1]),
+        (0.5, [0, 1, 1, 0], [1, 1]),
+        (60, [0, 1, 0, 0], [1, 0]),
+        (100, [0, 1, 0, 0], [0, 0]),
+    ])
+def test_presence_absence(square_encoder, hexagon_encoder, min_coverage,
+                          square_presence, hexagon_presence):
+    """Cells are present when enough of the window is in the value range"""
+    encoder, layer_filename = square_encoder
+    # Data cells from 2 to 4 in each cell: 3, 9, 5, and 0 of 9
+    encoder.encode_presence_absence(layer_filename, 'pa', 2, 4, min_coverage)
+    assert _get_column(encoder).tolist() == square_presence
+
+    encoder, layer_filename = hexagon_encoder
+    # Data cells from 2 to 5 in each hexagon: 23 and 16 of 28
+    encoder.encode_presence_absence(layer_filename, 'pa', 2, 5, min_coverage)
+    assert _get_column(encoder).tolist() == hexagon_presence
@@ -6,6 +6,144 @@ import numpy as np
 
 from lmpy import Matrix
 
+# Depth headers used for serialized permutation counts
+PERMUTATIONS_HEADER = 'Permutations'
+EXCEEDANCES_HEADER = 'Exceedances'
+P_VALUES_HEADER = 'P-Values'
+
+
+# .............................................................................
+class PValueAccumulator:
+    """Incrementally counts how often permuted values exceed observed values
+
+    Randomized matrices, or stacks of them, are added one at a time and only
+    an array of exceedance counts and the number of permutations are kept, so
+    memory use does not depend on the number of permutations.  Accumulators
+    from separate workers or nodes can be serialized to a Matrix and merged.
+    """
+
+    # ...........................
+    def __init__(self, observed_matrix, compare_func=None):
+        """Constructor
+
+        Args:
+            observed_matrix (:obj: `Matrix`): A Matrix object with observed
+                values.
+            compare_func (:obj: `function`): A function that, when given the
+                observed and random values, returns True where the random
+                value meets the condition.  Defaults to comparing absolute
+                values.
+        """
+        if compare_func is None:
+            compare_func = compare_absolute_values
+        self.observed = observed_matrix
+        self.compare_func = compare_func
+        self.exceedances = np.zeros(observed_matrix.shape)
+        self.num_permutations = 0
+
+    # ...........................
+    def add(self, rand):
+        """Adds a randomized matrix, a stack of them, or a serialized count
+
+        Args:
+            rand (:obj: `Matrix`): A Matrix of values from one permutation, a
+                stack of permutations along an extra (or the last) dimension,
+                or a Matrix produced by `get_count_matrix` which is merged.
+        """
+        if is_count_matrix(rand):
+            self.add_count_matrix(rand)
+            return
+
+        ndim = self.observed.ndim
+        if rand.ndim > ndim:
+            # Each layer of the extra dimension is a permutation
+            cmp = self.compare_func(
+                np.expand_dims(np.asarray(self.observed), axis=-1),
+                np.asarray(rand))
+            self.exceedances += np.sum(cmp, axis=-1)
+            self.num_permutations += rand.shape[-1]
+        elif rand.shape[-1] > self.observed.shape[-1]:
+            # Permutations are stacked along the last (size one) dimension
+            cmp = self.compare_func(
+                np.asarray(self.observed), np.asarray(rand))
+            self.exceedances += np.sum(cmp, axis=-1, keepdims=True)
+            self.num_permutations += rand.shape[-1]
+        else:
+            self.exceedances += self.compare_func(
+                np.asarray(self.observed), np.asarray(rand))
+            self.num_permutations += 1
+
+    # ...........................
+    def add_count_matrix(self, count_mtx):
+        """Merges serialized counts from another accumulator
+
+        Args:
+            count_mtx (:obj: `Matrix`): A Matrix with depth layers for the
+                number of permutations and the exceedance counts, such as one
+                produced by `get_count_matrix` or a permutation summary.
+        """
+        layer_headers = count_mtx.headers[str(count_mtx.ndim - 1)]
+        data = np.asarray(count_mtx)
+        exceedances = data[..., layer_headers.index(EXCEEDANCES_HEADER)]
+        self.exceedances += exceedances.reshape(self.exceedances.shape)
+        self.num_permutations += int(
+            data[..., layer_headers.index(PERMUTATIONS_HEADER)].flat[0])
+
+    # ...........................
+    def get_count_matrix(self):
+        """Serializes the counts as a Matrix
+
+        Returns:
+            Matrix: A matrix with the observed rows and columns and depth
+                layers for the number of permutations and exceedance counts.
+        """
+        counts = self._as_p_value_shape(self.exceedances)
+        data = np.concatenate(
+            [np.full(counts.shape, float(self.num_permutations)), counts],
+            axis=-1)
+        headers = deepcopy(self.observed.headers)
+        headers[str(data.ndim - 1)] = [PERMUTATIONS_HEADER, EXCEEDANCES_HEADER]
+        return Matrix(data, headers=headers)
+
+    # ...........................
+    def get_p_values(self):
+        """Gets the p-values for the permutations added so far
+
+        Returns:
+            Matrix: A matrix of p-values, with a depth dimension added if the
+                last dimension of the observed matrix has more than one value.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p_values = np.clip(
+                np.nan_to_num(self.exceedances / self.num_permutations),
+                0.0, 1.0)
+        p_values = self._as_p_value_shape(p_values)
+        headers = deepcopy(self.observed.headers)
+        headers[str(p_values.ndim - 1)] = [P_VALUES_HEADER]
+        return Matrix(p_values, headers=headers)
+
+    # ...........................
+    def merge(self, other):
+        """Merges the counts from another accumulator into this one
+
+        Args:
+            other (:obj: `PValueAccumulator`): An accumulator for the same
+                observed matrix.
+        """
+        self.exceedances += other.exceedances
+        self.num_permutations += other.num_permutations
+
+    # ...........................
+    def _as_p_value_shape(self, data):
+        """Reshapes an observed-shaped array to add a size-one depth dimension
+
+        Args:
+            data (:obj: `Numpy array`): An array shaped like the observed data.
+        """
+        if self.observed.shape[-1] == 1:
+            return data
+        return data.reshape(list(self.observed.shape) + [1])
+
 
 # .............................................................................
 def compare_absolute_values(obs, rand):
@@ -80,8 +218,9 @@ def get_p_values(observed_matrix, test_matrices,
 
     Args:
         observed_matrix (:obj: `Matrix`): A Matrix object with observed values
-        test_matrices (:obj: `list`): A list of Matrix objects with values
-            obtained through permutations
+        test_matrices (:obj: `list`): A list, or generator, of Matrix objects
+            with values obtained through permutations.  These may also be
+            serialized counts from a `PValueAccumulator`.
         compare_func (:obj: `function`): A function that, when given two
             values, returns True if the second meets the condition
 
@@ -89,41 +228,21 @@ def get_p_values(observed_matrix, test_matrices,
         * Take optional clip values
         * Take optional number of permutations
     """
-    p_val_headers = deepcopy(observed_matrix.headers)
-    ndim = observed_matrix.ndim
-    p_val_headers[str(ndim - 1)] = ['P-Values']
-
-    # Create the P-values matrix.  The shape should be the same as the observed
-    #    data with one extra dimension if the last dimension has size > 1
-    if observed_matrix.shape[-1] == 1:
-        p_vals_shape = observed_matrix.shape
-    else:
-        p_vals_shape = list(observed_matrix.shape) + [1]
-    p_values = Matrix(np.zeros(p_vals_shape), headers=observed_matrix.headers)
-
-    num_permutations = 0
+    accumulator = PValueAccumulator(observed_matrix, compare_func=compare_func)
     for rand in test_matrices:
-        # If the random matrices are a stack with more dimensions or more
-        #    layers, compare each layer to observed
-        if rand.ndim > ndim or \
-                rand.shape[-1] > observed_matrix.shape[-1]:
-            # Determine shape of test matrix
-            if rand.ndim > ndim:
-                test_shape = list(rand.shape)[:-1]
-            else:
-                test_shape = observed_matrix.shape
-            # Loop through each
-            for i in range(rand.shape[-1]):
-                p_values += compare_func(
-                    observed_matrix,
-                    # Slice off one test layer
-                    rand[..., i].reshape(test_shape))
-                num_permutations += 1
-        else:
-            p_values += compare_func(observed_matrix, rand)
-            num_permutations += 1
+        accumulator.add(rand)
+    return accumulator.get_p_values()
 
-    # Divide by number of permutations and clip just in case
-    p_values = np.clip(
-        np.nan_to_num(p_values / num_permutations), 0.0, 1.0)
-    return p_values
+
+# .............................................................................
+def is_count_matrix(mtx):
+    """Returns True if the Matrix holds serialized permutation counts
+
+    Args:
+        mtx (:obj: `Matrix`): A Matrix that may have depth layers for the
+            number of permutations and the exceedance counts.
+    """
+    headers = getattr(mtx, 'headers', None) or {}
+    layer_headers = headers.get(str(mtx.ndim - 1), [])
+    return (PERMUTATIONS_HEADER in layer_headers
+            and EXCEEDANCES_HEADER in layer_headers)
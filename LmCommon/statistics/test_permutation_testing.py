@@ -0,0 +1,140 @@
+"""Tests for the streaming p-value accumulator in permutation_testing.py
+"""
+import numpy as np
+
+from lmpy import Matrix
+
+from LmCommon.statistics.permutation_testing import (
+    compare_absolute_values, compare_signed_values, EXCEEDANCES_HEADER,
+    get_p_values, is_count_matrix, P_VALUES_HEADER, PERMUTATIONS_HEADER,
+    PValueAccumulator)
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+NUM_ROWS = 5
+NUM_COLS = 3
+NUM_PERMUTATIONS = 20
+HEADERS = {
+    '0': ['row_{}'.format(i) for i in range(NUM_ROWS)],
+    '1': ['col_{}'.format(j) for j in range(NUM_COLS)]}
+
+
+# .............................................................................
+def _get_test_data(num_cols=NUM_COLS, seed=13):
+    """Gets an observed matrix and a stack of permuted values"""
+    rand_state = np.random.RandomState(seed)
+    headers = {
+        '0': HEADERS['0'],
+        '1': ['col_{}'.format(j) for j in range(num_cols)]}
+    observed = Matrix(
+        rand_state.normal(size=(NUM_ROWS, num_cols)), headers=headers)
+    stack = rand_state.normal(size=(NUM_ROWS, num_cols, NUM_PERMUTATIONS))
+    return observed, stack
+
+
+# .............................................................................
+def _get_exceedances(observed, stack, compare_func=compare_absolute_values):
+    """Counts exceedances directly from a stack of permuted values"""
+    return compare_func(
+        np.asarray(observed)[..., np.newaxis], stack).sum(axis=-1)
+
+
+# .............................................................................
+def test_add_counts():
+    """Single matrices and stacks are counted the same way"""
+    observed, stack = _get_test_data()
+    expected = _get_exceedances(observed, stack)
+
+    single = PValueAccumulator(observed)
+    for i in range(NUM_PERMUTATIONS):
+        single.add(Matrix(stack[:, :, i], headers=HEADERS))
+    assert single.num_permutations == NUM_PERMUTATIONS
+    assert np.array_equal(single.exceedances, expected)
+
+    stacked = PValueAccumulator(observed)
+    stacked.add(Matrix(stack))
+    assert stacked.num_permutations == NUM_PERMUTATIONS
+    assert np.array_equal(stacked.exceedances, expected)
+
+
+# .............................................................................
+def test_add_counts_last_dimension():
+    """Permutations stacked along a size one last dimension are counted"""
+    observed, stack = _get_test_data(num_cols=1)
+    accumulator = PValueAccumulator(observed)
+    accumulator.add(Matrix(stack[:, 0, :]))
+    assert accumulator.num_permutations == NUM_PERMUTATIONS
+    assert np.array_equal(
+        accumulator.exceedances, _get_exceedances(observed, stack))
+    assert accumulator.get_p_values().shape == (NUM_ROWS, 1)
+
+
+# .............................................................................
+def test_signed_comparison():
+    """A comparison function can be provided"""
+    observed, stack = _get_test_data()
+    accumulator = PValueAccumulator(
+        observed, compare_func=compare_signed_values)
+    accumulator.add(Matrix(stack))
+    assert np.array_equal(
+        accumulator.exceedances,
+        _get_exceedances(observed, stack, compare_signed_values))
+
+
+# .............................................................................
+def test_merge():
+    """Merging accumulators of split permutations gives the whole counts"""
+    observed, stack = _get_test_data()
+    whole = PValueAccumulator(observed)
+    whole.add(Matrix(stack))
+
+    first = PValueAccumulator(observed)
+    first.add(Matrix(stack[..., :7]))
+    second = PValueAccumulator(observed)
+    second.add(Matrix(stack[..., 7:]))
+    first.merge(second)
+
+    assert first.num_permutations == whole.num_permutations
+    assert np.array_equal(first.exceedances, whole.exceedances)
+    assert np.allclose(first.get_p_values(), whole.get_p_values())
+
+
+# .............................................................................
+def test_count_matrix_round_trip():
+    """Serialized counts are recognized and merged when added"""
+    observed, stack = _get_test_data()
+    accumulator = PValueAccumulator(observed)
+    accumulator.add(Matrix(stack))
+    count_mtx = accumulator.get_count_matrix()
+
+    assert is_count_matrix(count_mtx)
+    assert not is_count_matrix(observed)
+    assert count_mtx.headers['0'] == HEADERS['0']
+    assert count_mtx.headers['2'] == [PERMUTATIONS_HEADER, EXCEEDANCES_HEADER]
+    assert count_mtx.shape == (NUM_ROWS, NUM_COLS, 2)
+
+    merged = PValueAccumulator(observed)
+    merged.add(count_mtx)
+    merged.add(count_mtx)
+    assert merged.num_permutations == 2 * NUM_PERMUTATIONS
+    assert np.array_equal(merged.exceedances, 2 * accumulator.exceedances)
+    assert np.allclose(merged.get_p_values(), accumulator.get_p_values())
+
+
+# .............................................................................
+def test_get_p_values():
+    """P-values are the fraction of exceedances with a depth header"""
+    observed, stack = _get_test_data()
+    p_values = get_p_values(
+        observed, [Matrix(stack[..., :10]), Matrix(stack[..., 10:])])
+    assert p_values.shape == (NUM_ROWS, NUM_COLS, 1)
+    assert p_values.headers['1'] == HEADERS['1']
+    assert p_values.headers['2'] == [P_VALUES_HEADER]
+    assert np.allclose(
+        p_values[:, :, 0],
+        _get_exceedances(observed, stack) / float(NUM_PERMUTATIONS))
+
+    # No permutations gives zero p-values rather than NaN
+    empty = PValueAccumulator(observed).get_p_values()
+    assert np.array_equal(empty, np.zeros((NUM_ROWS, NUM_COLS, 1)))
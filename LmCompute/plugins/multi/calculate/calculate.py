@@ -6,9 +6,14 @@ Todo:
 import numpy as np
 
 from LmCommon.common.lmconstants import PamStatKeys, PhyloTreeKeys
+from LmCommon.compression.packed_pam import PackedPam
 from LmCompute.plugins.multi.calculate import ot_phylo
 from lmpy import Matrix
 
+# Note: The default number of bytes that may be used for temporary matrices
+#    when computing the C-score from species co-occurrence tiles
+COOCCURRENCE_MEMORY_LIMIT = 512 * 1024 ** 2
+
 
 # .............................................................................
 class PamStats:
@@ -16,21 +21,28 @@ class PamStats:
     """
 
     # ...........................
-    def __init__(self, pam, tree=None):
+    def __init__(self, pam, tree=None,
+                 memory_limit=COOCCURRENCE_MEMORY_LIMIT):
         """Constructor
 
         Args:
-            pam: A Present / Absence Matrix to compute statistics for
+            pam: A Present / Absence Matrix to compute statistics for.  A
+                PackedPam is used without unpacking it as a whole
             tree: An optional TreeWrapper object to use for additional
                 statistics
+            memory_limit: The approximate number of bytes that may be used
+                for temporary matrices when computing the C-score without the
+                full species co-occurrence matrix, or the covariance matrices
+                of a PackedPam
         """
         # Ensure PAM is a Matrix object.  PAM data will be shortcut to data
-        if isinstance(pam, Matrix):
+        if isinstance(pam, (Matrix, PackedPam)):
             self.pam = pam
         else:
             self.pam = Matrix(pam)
 
         self.tree = tree
+        self.memory_limit = memory_limit
         self.alpha = None
         self.alpha_prop = None
         self.c_score = None
@@ -47,6 +59,9 @@ class PamStats:
         self.sigma_sites = None
         self.sigma_species = None
         self.whittaker = None
+        # Species by species co-occurrence counts (PAM_T . PAM), only kept if
+        #    the covariance matrices are calculated
+        self._species_cooccurrence = None
 
         self._calculate_core_stats()
         self._calculate_diversity_statistics()
@@ -58,17 +73,17 @@ class PamStats:
         Todo:
             Add headers
         """
-        try:
-            return self.sigma_sites, self.sigma_species
-        except Exception:
+        if self.sigma_sites is None or self.sigma_species is None:
             # We haven't calculated them yet
             self._calculate_covariance_matrices()
-            return self.sigma_sites, self.sigma_species
+        return self.sigma_sites, self.sigma_species
 
     # ...........................
     def get_diversity_statistics(self):
         """Get the (beta) diversity statistics
         """
+        if self.c_score is None:
+            self._calculate_c_score()
         return Matrix.concatenate(
             [self.whittaker, self.lande, self.legendre, self.c_score], axis=1)
 
@@ -99,8 +114,12 @@ class PamStats:
                       PamStatKeys.SITES_VARIANCE_RATIO]})
 
     # ...........................
-    def get_site_statistics(self):
+    def get_site_statistics(self, max_workers=1):
         """Retrieves the site statistics as a Matrix of site statistic columns
+
+        Args:
+            max_workers: The number of processes to use for the phylogenetic
+                site statistics.  None will use all CPUs
         """
         num_rows = self.alpha.shape[0]
         stat_columns = [
@@ -114,29 +133,23 @@ class PamStats:
 
         # Check if we have tree stats too
         if self.tree is not None:
-            # Get phylogenetic distance matrix
-            phylo_dist_mtx = self.tree.get_distance_matrix()
-
             squid_annotations = self.tree.get_annotations(PhyloTreeKeys.SQUID)
             squid_dict = {squid: label for label, squid in squid_annotations}
             taxon_labels = []
             keep_columns = []
             squids = self.pam.get_column_headers()
             for i, squid in enumerate(squids):
-                if squid in list(squid_dict.keys()):
+                if squid in squid_dict:
                     keep_columns.append(i)
                     taxon_labels.append(squid_dict[squid])
             # Slice the PAM to remove missing squid columns
             sl_pam = self.pam.slice(
                 list(range(self.pam.shape[0])), keep_columns)
 
-            stat_columns.extend([
-                ot_phylo.mean_nearest_taxon_distance(sl_pam, phylo_dist_mtx),
-                ot_phylo.mean_pairwise_distance(sl_pam, phylo_dist_mtx),
-                ot_phylo.pearson_correlation(sl_pam, phylo_dist_mtx),
-                ot_phylo.phylogenetic_diversity(
-                    sl_pam, self.tree, taxon_labels),
-                ot_phylo.sum_pairwise_distance(sl_pam, phylo_dist_mtx)])
+            stat_columns.append(
+                ot_phylo.get_phylo_site_statistics(
+                    sl_pam, self.tree, taxon_labels,
+                    max_workers=max_workers))
 
             sites_headers.extend(
                 [PamStatKeys.MNTD, PamStatKeys.MPD, PamStatKeys.PEARSON,
@@ -168,18 +181,22 @@ class PamStats:
     def _calculate_core_stats(self):
         """This function calculates the standard PAM statistics
         """
-        # Number of species at each site
-        self.alpha = Matrix(np.sum(self.pam, axis=1))
+        if isinstance(self.pam, PackedPam):
+            self.alpha = Matrix(self.pam.sum_rows())
+            self.omega = Matrix(self.pam.sum_columns())
+        else:
+            # Number of species at each site
+            self.alpha = Matrix(np.sum(self.pam, axis=1))
 
-        # Number of sites for each species
-        self.omega = Matrix(np.sum(self.pam, axis=0))
+            # Number of sites for each species
+            self.omega = Matrix(np.sum(self.pam, axis=0))
 
         # Calculate the number of species by looking for columns that have any
         #     presences.  This will let the stats ignore empty columns
-        self.num_species = np.sum(np.any(self.pam, axis=0))
+        self.num_species = np.count_nonzero(self.omega)
 
         # Calculate the number of sites that have at least one species present
-        self.num_sites = np.sum(np.any(self.pam, axis=1))
+        self.num_sites = np.count_nonzero(self.alpha)
 
         # Site statistics
         self.alpha_prop = self.alpha.astype(float) / self.num_species
@@ -191,24 +208,97 @@ class PamStats:
 
         # Species statistics
         self.omega_prop = self.omega.astype(float) / self.num_sites
-        self.psi = self.alpha.dot(self.pam)
+        if isinstance(self.pam, PackedPam):
+            self.psi = Matrix(self.pam.t_dot(self.alpha))
+        else:
+            self.psi = self.alpha.dot(self.pam)
         # psi_avg_prop can produce np.nan for empty row and columns, set to
         #    zero
         self.psi_avg_prop = np.nan_to_num(
             self.psi.astype(float) / (self.num_species * self.omega))
 
+    # ...........................
+    def _calculate_c_score(self):
+        """Calculates the C-score from species co-occurrence sums
+
+        Note:
+            * The C-score sums (O_i - S_ij)(O_j - S_ij) over species pairs,
+                where O is the number of sites for each species and S is the
+                number of sites shared by a pair.  Expanding the product, the
+                pair sums only need O, psi (the row sums of S) and the sum of
+                the squared entries of S, so S is never needed as a whole.
+        """
+        omega = np.asarray(self.omega, dtype=float).ravel()
+        psi = np.asarray(self.psi, dtype=float).ravel()
+        sum_omega_sq = np.sum(omega ** 2)
+        pair_omega = np.sum(omega) ** 2 - sum_omega_sq
+        pair_shared_omega = 2.0 * np.sum(omega * (psi - omega))
+        pair_shared_sq = self._sum_squared_cooccurrence() - sum_omega_sq
+        temp = (pair_omega - pair_shared_omega + pair_shared_sq) / 2.0
+        self.c_score = Matrix(
+            np.array([
+                [2 * temp / (self.num_species * (self.num_species - 1))]]),
+            headers={'0': ['value'], '1': [PamStatKeys.C_SCORE]})
+
     # ...........................
     def _calculate_covariance_matrices(self):
         """Calculates the sigmaSpecies and sigmaSites covariance matrices
         """
-        alpha = self.pam.dot(self.pam.T).astype(float)  # Site by site
-        omega = self.pam.T.dot(self.pam).astype(float)  # Species by sites
+        if isinstance(self.pam, PackedPam):
+            alpha, omega = self._calculate_packed_cooccurrence()
+        else:
+            pam = np.asarray(self.pam, dtype=float)
+            alpha = pam.dot(pam.T)  # Site by site
+            omega = pam.T.dot(pam)  # Species by species
+        self._species_cooccurrence = omega
 
         self.sigma_sites = (alpha / self.num_species) - np.outer(
             self.alpha_prop, self.alpha_prop)
         self.sigma_species = (omega / self.num_sites) - np.outer(
             self.omega_prop, self.omega_prop)
 
+    # ...........................
+    def _calculate_packed_cooccurrence(self):
+        """Returns the site and species co-occurrence matrices of a PackedPam
+
+        Blocks of rows sized by the memory limit are unpacked one or two at a
+        time.  The species matrix (PAM_T . PAM) is the sum of each block's
+        product with itself and each tile of the site matrix (PAM . PAM_T) is
+        the product of a pair of blocks, so the PAM is never unpacked as a
+        whole.
+
+        Returns:
+            tuple - The (sites by sites) and (species by species) matrices
+        """
+        num_sites, num_species = self.pam.shape
+        # float32 holds integer counts exactly up to 2^24
+        if max(num_sites, num_species) < 2 ** 24:
+            dtype = np.float32
+        else:
+            dtype = np.float64
+        # Two blocks of rows are unpacked at a time
+        chunk_size = int(
+            self.memory_limit // (2 * num_species * np.dtype(dtype).itemsize))
+        chunk_size = max(1, min(chunk_size, num_sites))
+
+        site_cooccurrence = np.empty((num_sites, num_sites))
+        species_cooccurrence = np.zeros((num_species, num_species))
+        for i, block_1 in self.pam.iter_row_chunks(
+                chunk_size=chunk_size, dtype=dtype):
+            stop_1 = i + block_1.shape[0]
+            species_cooccurrence += block_1.T.dot(block_1)
+            for j in range(i, num_sites, chunk_size):
+                if i == j:
+                    block_2 = block_1
+                else:
+                    block_2 = self.pam.get_rows(j, j + chunk_size, dtype=dtype)
+                stop_2 = j + block_2.shape[0]
+                # Fill the tile and its mirror in the symmetric matrix
+                shared = block_1.dot(block_2.T)
+                site_cooccurrence[i:stop_1, j:stop_2] = shared
+                site_cooccurrence[j:stop_2, i:stop_1] = shared.T
+        return site_cooccurrence, species_cooccurrence
+
     # ...........................
     def _calculate_diversity_statistics(self):
         """Calculate the (beta) diversity statistics for this PAM
@@ -226,16 +316,70 @@ class PamStats:
                 float((self.omega ** 2).sum()) / self.num_sites)]]),
             headers={'0': ['value'], '1': [PamStatKeys.LEGENDRES_BETA]})
 
-        temp = 0.0
-        for i in range(self.num_species):
-            for j in range(i, self.num_species):
-                # Get the number shared (where both are == 1, so sum == 2)
-                num_shared = len(
-                    np.where(np.sum(self.pam[:, [i, j]], axis=1) == 2)[0])
-                p_1 = self.omega[i] - num_shared
-                p_2 = self.omega[j] - num_shared
-                temp += p_1 * p_2
-        self.c_score = Matrix(
-            np.array([
-                [2 * temp / (self.num_species * (self.num_species - 1))]]),
-            headers={'0': ['value'], '1': [PamStatKeys.C_SCORE]})
+        # The C-score is calculated when requested so that it can reuse the
+        #    co-occurrence matrix if the covariance matrices are calculated
+
+    # ...........................
+    def _sum_squared_cooccurrence(self):
+        """Returns the sum of the squared entries of the co-occurrence matrix
+
+        The species co-occurrence matrix (PAM_T . PAM) is computed in tiles
+        sized by the memory limit, and only the sum of squares of each tile is
+        kept.  The sum of squares is the same for the site co-occurrence
+        matrix (PAM . PAM_T), so the smaller of the two is tiled.  Packed PAMs
+        always tile the species matrix, unpacking only the bytes that hold
+        each block of columns.
+
+        Note:
+            * Tiles are multiplied as floats so that BLAS can be used, but the
+                counts are exact integers and are summed as integers.
+        """
+        if self._species_cooccurrence is not None:
+            return float(np.sum(self._species_cooccurrence ** 2))
+
+        if isinstance(self.pam, PackedPam):
+            num_rows, num_cols = self.pam.shape
+            dtype = np.float32 if num_rows < 2 ** 24 else np.float64
+
+            def _get_block(cols):
+                return self.pam.get_columns(*cols, dtype=dtype)
+        else:
+            mtx = np.asarray(self.pam)
+            if mtx.shape[0] < mtx.shape[1]:
+                mtx = mtx.T
+            num_rows, num_cols = mtx.shape
+            # float32 holds integer counts exactly up to 2^24
+            if num_rows < 2 ** 24:
+                mtx = mtx.astype(np.float32)
+            else:
+                mtx = mtx.astype(np.float64)
+            dtype = mtx.dtype
+
+            def _get_block(cols):
+                return mtx[:, slice(*cols)]
+
+        # Solve tile ** 2 * 16 + tile * 2 * rows * itemsize <= memory limit
+        #    for the product tile, its integer copy, and two column blocks
+        block_bytes = 2.0 * num_rows * np.dtype(dtype).itemsize
+        tile = int(
+            (-block_bytes + np.sqrt(
+                block_bytes ** 2 + 64.0 * self.memory_limit)) / 32.0)
+        tile = max(1, min(tile, num_cols))
+
+        total = 0
+        for i in range(0, num_cols, tile):
+            # The first block is reused for every tile in this row of tiles
+            block_1 = _get_block((i, min(i + tile, num_cols)))
+            for j in range(i, num_cols, tile):
+                if i == j:
+                    block_2 = block_1
+                else:
+                    block_2 = _get_block((j, min(j + tile, num_cols)))
+                shared = block_1.T.dot(block_2).astype(np.int64)
+                tile_sum = int(np.sum(shared * shared))
+                # Off-diagonal tiles appear twice in the symmetric matrix
+                if i == j:
+                    total += tile_sum
+                else:
+                    total += 2 * tile_sum
+        return float(total)
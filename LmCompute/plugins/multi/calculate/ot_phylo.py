@@ -3,158 +3,433 @@
 Note:
     The code is originally from Stephen Smith and has been written to work with
         Lifemapper by CJ Grady
+
+Note:
+    All of the site statistics are computed together by
+        `get_phylo_site_statistics`.  Pair sums over the species present at a
+        site are computed as p . M . p_T for a site presence vector p, so a
+        block of sites is handled with two matrix products.  Phylogenetic
+        diversity uses a (branch by tip) incidence matrix, a branch is part of
+        the minimum spanning path of a site if it subtends at least one, but
+        not all, of the species present.
 """
+from concurrent.futures import ProcessPoolExecutor
+import os
+
 import numpy as np
 
+from LmCompute.plugins.multi.shared_matrices import (
+    attach_shared_matrices, release_shared_matrices, share_matrices)
+
+# Note: The distance used for a species without a present neighbor at a
+#    positive distance when computing MNTD
+NO_NEIGHBOR_DISTANCE = 99999
+
+# Note: The approximate number of bytes that may be used for the temporary
+#    (sites by species by species) matrix used to find nearest neighbors
+PHYLO_STATS_MEMORY = 256 * 1024 ** 2
+
+# Note: The number of sites processed together when computing site statistics
+SITE_CHUNK_SIZE = 1000
+
+# Note: Worker processes keep the shared statistic inputs here
+_WORKER_INPUTS = {}
+
 
 # .............................................................................
-def mean_nearest_taxon_distance(pam, phylo_dist_mtx):
-    """Calculates the nearest neighbor distance for each site in a PAM
+def _get_pair_matrices(pam, phylo_dist_mtx):
+    """Gets the species pair matrices used for site pair sums
+
+    Args:
+        pam (numpy array): A (sites by species) presence absence array.
+        phylo_dist_mtx (numpy array): A (species by species) phylogenetic
+            distance array aligned with the PAM columns.
+
+    Returns:
+        dict: Pair matrix key to (species by species) array.
     """
-    mntd = []
-    for site in pam:
-        sp_idxs = np.where(site == 1)[0]
-
-        if len(sp_idxs) > 1:
-            nearest_total = 0.0
-            for i in sp_idxs:
-                nearest = 99999
-                for j in sp_idxs:
-                    cmp_val = phylo_dist_mtx[i, j]
-                    if 0.0 < cmp_val < nearest:
-                        nearest = cmp_val
-                nearest_total += nearest
-            mntd.append(float(nearest_total) / len(sp_idxs))
-        else:
-            mntd.append(0.0)
-    return np.array(mntd).reshape((len(mntd), 1))
+    pam = pam.astype(float)
+    dist = np.asarray(phylo_dist_mtx, dtype=float)
+    # Number of sites shared by each pair of species
+    shared = pam.T.dot(pam)
+    return {
+        'dist': dist,
+        'pos_dist': _get_positive_distances(dist),
+        'dist_sq': dist ** 2,
+        'dist_shared': dist * shared,
+        'shared': shared,
+        'shared_sq': shared ** 2
+    }
 
 
 # .............................................................................
-def mean_pairwise_distance(pam, phylo_dist_mtx):
-    """Calculates mean pairwise distance
+def _get_positive_distances(dist):
+    """Gets a distance array with zero distances set to infinity for MNTD
+    """
+    return np.where(dist > 0.0, dist, np.inf)
 
-    Calculates mean pairwise distance between the species present at each site
+
+# .............................................................................
+def _get_tip_branch_matrix(branch_tip_mtx):
+    """Gets the (species by branches) float array used for PD
+
+    Args:
+        branch_tip_mtx (numpy array): A (branches by species) array where a
+            branch row is one for each tip it subtends.
     """
-    num_sites = pam.shape[0]
-    mpd = np.zeros((num_sites, 1), dtype=float)
-    for idx in range(num_sites):
-        sp_idxs = np.where(pam[idx] == 1)[0]
-        num_sp = len(sp_idxs)
-        if num_sp > 1:
-            num_pairs = num_sp * (num_sp - 1) / 2
-            total_distance = 0.0
+    return np.ascontiguousarray(branch_tip_mtx.T, dtype=np.float32)
+
 
-            for i in range(num_sp - 1):
-                for j in range(i + 1, num_sp):
-                    total_distance += phylo_dist_mtx[i, j]
+# .............................................................................
+def _pair_sums(pam, pair_mtx):
+    """Sums a pair matrix over the pairs of species present at each site
 
-            mpd[idx, 0] = total_distance / num_pairs
+    Args:
+        pam (numpy array): A (sites by species) presence absence array.
+        pair_mtx (numpy array): A symmetric (species by species) array.
 
-    return mpd
+    Returns:
+        numpy array: The sum of pair_mtx[i, j] for i < j present at each site.
+    """
+    pam = pam.astype(float)
+    return 0.5 * (
+        np.sum(pam.dot(pair_mtx) * pam, axis=1) - pam.dot(np.diag(pair_mtx)))
 
 
 # .............................................................................
-def sum_pairwise_distance(pam, phylo_dist_mtx):
-    """Calculates the sum pairwise distance for all species present at a site
+def _mean_nearest_taxon_distance(pam, pos_dist,
+                                 memory_limit=PHYLO_STATS_MEMORY):
+    """Calculates the mean nearest taxon distance for a block of sites
 
-    TODO:
-        * Consider combining with MPD / Pearson / etc
+    Args:
+        pam (numpy array): A (sites by species) presence absence array.
+        pos_dist (numpy array): A (species by species) distance array with
+            zero distances set to infinity, from `_get_positive_distances`.
+        memory_limit (int): The approximate number of bytes to use for the
+            temporary (sites by species by species) array.
+
+    Returns:
+        numpy array: The mean nearest taxon distance of each site.
+    """
+    present = np.asarray(pam) == 1
+    num_sites = present.shape[0]
+    num_sp = np.sum(present, axis=1)
+    mntd = np.zeros(num_sites, dtype=float)
+
+    # Only the species present somewhere in the block are needed
+    num_present_sp = max(1, np.sum(np.any(present, axis=0)))
+    block_size = max(1, int(memory_limit // (8 * num_present_sp ** 2)))
+    for start in range(0, num_sites, block_size):
+        block = present[start:start + block_size]
+        cols = np.any(block, axis=0)
+        block = block[:, cols]
+        block_dist = pos_dist[np.ix_(cols, cols)]
+        nearest = np.min(
+            np.where(
+                block[:, np.newaxis, :], block_dist[np.newaxis], np.inf),
+            axis=2, initial=np.inf)
+        nearest[np.isinf(nearest)] = NO_NEIGHBOR_DISTANCE
+        totals = np.sum(np.where(block, nearest, 0.0), axis=1)
+        block_num_sp = num_sp[start:start + block_size]
+        mntd[start:start + block_size] = np.where(
+            block_num_sp > 1, totals / np.maximum(block_num_sp, 1), 0.0)
+    return mntd
+
+
+# .............................................................................
+def _phylogenetic_diversity(pam, tip_branch_mtx, branch_lengths):
+    """Calculates phylogenetic diversity for a block of sites
+
+    Args:
+        pam (numpy array): A (sites by species) presence absence array.
+        tip_branch_mtx (numpy array): A (species by branches) float array from
+            `_get_tip_branch_matrix`.
+        branch_lengths (numpy array): The length of each branch.
+
+    Returns:
+        numpy array: The phylogenetic diversity of each site.
+    """
+    pam = pam.astype(np.float32)
+    num_sp = np.sum(pam, axis=1)
+    tip_counts = pam.dot(tip_branch_mtx)
+    in_path = (tip_counts >= 1) & (tip_counts < num_sp[:, np.newaxis])
+    return in_path.astype(float).dot(branch_lengths)
+
+
+# .............................................................................
+def _pair_statistics(pam, pair_mtxs):
+    """Calculates the species pair statistics for a block of sites
+
+    Args:
+        pam (numpy array): A (sites by species) presence absence array.
+        pair_mtxs (dict): Pair matrices from `_get_pair_matrices`.
+
+    Returns:
+        tuple: Arrays of the mean pairwise distance, Pearson correlation, and
+            sum pairwise distance of each site.
+    """
+    num_sp = np.sum(pam, axis=1).astype(float)
+    num_pairs = num_sp * (num_sp - 1) / 2.0
+
+    # X : Pair distance
+    # Y : Pair sites shared
+    sum_x = _pair_sums(pam, pair_mtxs['dist'])
+    sum_x_sq = _pair_sums(pam, pair_mtxs['dist_sq'])
+    sum_xy = _pair_sums(pam, pair_mtxs['dist_shared'])
+    sum_y = _pair_sums(pam, pair_mtxs['shared'])
+    sum_y_sq = _pair_sums(pam, pair_mtxs['shared_sq'])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mpd = np.where(num_pairs > 0, sum_x / num_pairs, 0.0)
+        p_num = sum_xy - sum_x * sum_y / num_pairs
+        p_denom = np.sqrt(
+            (sum_x_sq - (sum_x ** 2 / num_pairs)) * (
+                sum_y_sq - (sum_y ** 2 / num_pairs)))
+        # Need at least 2 pairs
+        pearson = np.where(num_pairs >= 2, p_num / p_denom, 0.0)
+    return mpd, pearson, sum_x
+
+
+# .............................................................................
+def _site_statistics(pam, pair_mtxs, tip_branch_mtx, branch_lengths,
+                     memory_limit=PHYLO_STATS_MEMORY):
+    """Computes all phylogenetic site statistics for a block of sites
+
+    Args:
+        pam (numpy array): A (sites by species) presence absence array.
+        pair_mtxs (dict): Pair matrices from `_get_pair_matrices`.
+        tip_branch_mtx (numpy array): A (species by branches) float array.
+        branch_lengths (numpy array): The length of each branch.
+        memory_limit (int): The memory limit used for nearest neighbors.
+
+    Returns:
+        numpy array: A (sites by 5) array of MNTD, MPD, Pearson, PD, and SPD.
+    """
+    mpd, pearson, spd = _pair_statistics(pam, pair_mtxs)
+    return np.column_stack([
+        _mean_nearest_taxon_distance(
+            pam, pair_mtxs['pos_dist'], memory_limit),
+        mpd,
+        pearson,
+        _phylogenetic_diversity(pam, tip_branch_mtx, branch_lengths),
+        spd])
+
+
+# .............................................................................
+def _init_worker(matrix_specs, memory_limit):
+    """Attaches the inputs shared by all site chunks in a worker process
+
+    Args:
+        matrix_specs (dict): Shared memory specifications for the PAM, pair
+            matrices, tip to branch matrix and branch lengths.
+        memory_limit (int): The memory limit used for nearest neighbors.
+    """
+    attach_shared_matrices(matrix_specs, _WORKER_INPUTS)
+    _WORKER_INPUTS['memory_limit'] = memory_limit
+
+
+# .............................................................................
+def _site_statistics_worker(start, stop):
+    """Computes the site statistics for a chunk of sites in a worker process
+
+    Args:
+        start (int): The first site row of the chunk.
+        stop (int): The site row after the last one in the chunk.
+
+    Returns:
+        tuple: The start row and the (sites by 5) statistics array.
+    """
+    return start, _site_statistics(
+        _WORKER_INPUTS['pam'][start:stop], _WORKER_INPUTS,
+        _WORKER_INPUTS['tip_branch_mtx'], _WORKER_INPUTS['branch_lengths'],
+        memory_limit=_WORKER_INPUTS['memory_limit'])
+
+
+# .............................................................................
+def align_distance_matrix(phylo_dist_mtx, taxon_labels):
+    """Reorders a phylogenetic distance matrix to match a list of taxa
+
+    Args:
+        phylo_dist_mtx (Matrix): A (taxa by taxa) distance matrix.  If it has
+            row headers, they are the taxon labels of the rows and columns.
+        taxon_labels (list): The taxon labels of the PAM columns.
+
+    Returns:
+        numpy array: A distance array with rows and columns in the order of the
+            taxon labels.
+
+    Raises:
+        ValueError: If the matrix does not have row headers or is missing
+            labels for some of the taxa.
     """
+    headers = getattr(phylo_dist_mtx, 'headers', None) or {}
+    dist_labels = headers.get('0')
+    if not dist_labels:
+        raise ValueError(
+            'Phylogenetic distance matrix has no taxon labels to align with '
+            'the PAM')
+    label_idx = {label: i for i, label in enumerate(dist_labels)}
+    missing = [label for label in taxon_labels if label not in label_idx]
+    if missing:
+        raise ValueError(
+            'Phylogenetic distance matrix is missing {} PAM taxa: {}'.format(
+                len(missing), ', '.join(str(lbl) for lbl in missing[:10])))
+    idxs = [label_idx[label] for label in taxon_labels]
+    return np.asarray(phylo_dist_mtx, dtype=float)[np.ix_(idxs, idxs)]
+
+
+# .............................................................................
+def get_branch_tip_matrix(tree, taxon_labels):
+    """Gets a branch to tip incidence matrix for a tree
+
+    Args:
+        tree (TreeWrapper): The tree to get branches from.
+        taxon_labels (list): The taxon labels of the PAM columns.
+
+    Returns:
+        tuple: A (branches by taxa) boolean array where each branch row is True
+            for the taxa it subtends, and an array of branch lengths.
+    """
+    label_idx = {label: i for i, label in enumerate(taxon_labels)}
+    node_tips = {}
+    branch_rows = []
+    branch_lengths = []
+    for node in tree.postorder_node_iter():
+        if node.is_leaf():
+            tips = np.zeros(len(taxon_labels), dtype=bool)
+            if node.taxon is not None and node.taxon.label in label_idx:
+                tips[label_idx[node.taxon.label]] = True
+        else:
+            tips = np.any(
+                [node_tips.pop(child) for child in node.child_node_iter()],
+                axis=0)
+        node_tips[node] = tips
+        if node.edge.length is not None and np.any(tips):
+            branch_rows.append(tips)
+            branch_lengths.append(node.edge.length)
+    if not branch_rows:
+        return (np.zeros((0, len(taxon_labels)), dtype=bool),
+                np.zeros(0, dtype=float))
+    return np.array(branch_rows), np.array(branch_lengths, dtype=float)
+
+
+# .............................................................................
+def get_phylo_site_statistics(pam, tree, taxon_labels, phylo_dist_mtx=None,
+                              chunk_size=SITE_CHUNK_SIZE, max_workers=1,
+                              memory_limit=PHYLO_STATS_MEMORY):
+    """Computes all phylogenetic site statistics for a PAM
+
+    Args:
+        pam (Matrix): A (sites by species) PAM with columns for the taxa.
+        tree (TreeWrapper): The tree containing the PAM taxa.
+        taxon_labels (list): The taxon labels of the PAM columns.
+        phylo_dist_mtx (Matrix): An optional phylogenetic distance matrix.  It
+            is computed from the tree if not provided.
+        chunk_size (int): The number of sites to process at a time.
+        max_workers (int): The number of worker processes to use.  Chunks are
+            processed in this process if this is 1.  None uses all CPUs.
+        memory_limit (int): The approximate number of bytes to use for the
+            temporary nearest neighbor array of each chunk.
+
+    Returns:
+        numpy array: A (sites by 5) array of MNTD, MPD, Pearson correlation,
+            phylogenetic diversity, and sum pairwise distance.
+    """
+    if phylo_dist_mtx is None:
+        phylo_dist_mtx = tree.get_distance_matrix()
+    pam = np.asarray(pam)
+    branch_tip_mtx, branch_lengths = get_branch_tip_matrix(tree, taxon_labels)
+    inputs = _get_pair_matrices(
+        pam, align_distance_matrix(phylo_dist_mtx, taxon_labels))
+    inputs.update({
+        'pam': pam,
+        'tip_branch_mtx': _get_tip_branch_matrix(branch_tip_mtx),
+        'branch_lengths': branch_lengths
+    })
+
     num_sites = pam.shape[0]
-    spd = np.zeros((num_sites, 1), dtype=float)
-    for idx in range(num_sites):
-        sp_idxs = np.where(pam[idx] == 1)[0]
-        num_sp = len(sp_idxs)
-        if num_sp > 1:
-            total_distance = 0.0
+    starts = list(range(0, num_sites, chunk_size))
+    stops = [min(start + chunk_size, num_sites) for start in starts]
+    stats = np.zeros((num_sites, 5), dtype=float)
 
-            for i in range(num_sp - 1):
-                for j in range(i + 1, num_sp):
-                    total_distance += phylo_dist_mtx[i, j]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(starts))
+    if max_workers <= 1:
+        for start, stop in zip(starts, stops):
+            stats[start:stop] = _site_statistics(
+                pam[start:stop], inputs, inputs['tip_branch_mtx'],
+                branch_lengths, memory_limit=memory_limit)
+    else:
+        # The (species by species) matrices are shared, not pickled for
+        #    each worker
+        shared_blocks, matrix_specs = share_matrices(inputs)
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=max_workers, initializer=_init_worker,
+                    initargs=(matrix_specs, memory_limit)) as executor:
+                for start, chunk_stats in executor.map(
+                        _site_statistics_worker, starts, stops):
+                    stats[start:start + chunk_stats.shape[0]] = chunk_stats
+        finally:
+            release_shared_matrices(shared_blocks)
+    return stats
 
-            spd[idx, 0] = total_distance
 
-    return spd
+# .............................................................................
+def mean_nearest_taxon_distance(pam, phylo_dist_mtx):
+    """Calculates the nearest neighbor distance for each site in a PAM
+    """
+    mntd = _mean_nearest_taxon_distance(
+        np.asarray(pam),
+        _get_positive_distances(np.asarray(phylo_dist_mtx, dtype=float)))
+    return mntd.reshape((len(mntd), 1))
+
+
+# .............................................................................
+def mean_pairwise_distance(pam, phylo_dist_mtx):
+    """Calculates mean pairwise distance
+
+    Calculates mean pairwise distance between the species present at each site
+    """
+    pam = np.asarray(pam)
+    num_sp = np.sum(pam, axis=1).astype(float)
+    num_pairs = num_sp * (num_sp - 1) / 2.0
+    spd = _pair_sums(pam, np.asarray(phylo_dist_mtx, dtype=float))
+    mpd = np.where(num_pairs > 0, spd / np.maximum(num_pairs, 1), 0.0)
+    return mpd.reshape((len(mpd), 1))
+
+
+# .............................................................................
+def sum_pairwise_distance(pam, phylo_dist_mtx):
+    """Calculates the sum pairwise distance for all species present at a site
+    """
+    spd = _pair_sums(np.asarray(pam), np.asarray(phylo_dist_mtx, dtype=float))
+    return spd.reshape((len(spd), 1))
 
 
 # .............................................................................
 def pearson_correlation(pam, phylo_dist_mtx):
     """Calculates the Pearson correlation coef. for each site
 
+    The correlation is between the distance and the number of sites shared for
+    each pair of species present at a site.
+
     TODO:
-        * Consider combining with MPD
         * Check for NaNs
     """
-    num_sites = pam.shape[0]
-    pearson = np.zeros((num_sites, 1), dtype=float)
-
-    for site_idx in range(num_sites):
-        sp_idxs = np.where(pam[site_idx] == 1)[0]
-        num_sp = len(sp_idxs)
-        num_pairs = num_sp * (num_sp - 1) / 2
-        if num_pairs >= 2:
-            # Need at least 2 pairs
-            pair_dist = []
-            pair_sites_shared = []
-            for i in range(num_sp - 1):
-                for j in range(i + 1, num_sp):
-                    pair_dist.append(phylo_dist_mtx[i, j])
-                    pair_sites_shared.append(
-                        pam[:, i].dot(pam[:, j]))
-            # X : Pair distance
-            # Y : Pair sites shared
-            x_val = np.array(pair_dist)
-            y_val = np.array(pair_sites_shared)
-            sum_xy = np.sum(x_val * y_val)
-            sum_x = np.sum(x_val)
-            sum_y = np.sum(y_val)
-            sum_x_sq = np.sum(x_val ** 2)
-            sum_y_sq = np.sum(y_val ** 2)
-
-            # Pearson
-            p_num = sum_xy - sum_x * sum_y / num_pairs
-            p_denom = np.sqrt(
-                (sum_x_sq - (sum_x ** 2 / num_pairs)
-                 ) * (sum_y_sq - (sum_y ** 2 / num_pairs)))
-            pearson[site_idx, 0] = p_num / p_denom
-    return pearson
-
-
-# .............................................................................
-def _get_node_filter(present_taxa):
-    """Return a node filter for present taxa
-    """
-
-    def _node_filter(node):
-        """Return a boolean indication if the node is in present taxa
-        """
-        return node.taxon is not None and node.taxon.label in present_taxa
-
-    return _node_filter
+    pam = np.asarray(pam)
+    pearson = _pair_statistics(
+        pam, _get_pair_matrices(pam, phylo_dist_mtx))[1]
+    return pearson.reshape((len(pearson), 1))
 
 
 # .............................................................................
 def phylogenetic_diversity(pam, tree, taxon_labels):
     """Calculate phylogenetic diversity
     """
-    num_sites = pam.shape[0]
-    pd_mtx = np.zeros((num_sites, 1), dtype=float)
-    for idx in range(num_sites):
-        sp_idxs = np.where(pam[idx] == 1)[0]
-        if len(sp_idxs) > 1:
-            present_taxa = [taxon_labels[i] for i in sp_idxs]
-            mrca = tree.mrca(taxon_labels=present_taxa)
-            visited = set([mrca])
-            total_distance = 0.0
-            flt = _get_node_filter(present_taxa)
-            for node in tree.find_nodes(filter_fn=flt):
-                check_node = node
-                # n = tree.find_node_with_taxon_label(tax_label)
-                while check_node not in visited:
-                    total_distance += check_node.edge.length
-                    visited.add(check_node)
-                    check_node = check_node.parent_node
-            pd_mtx[idx, 0] = total_distance
-
-    return pd_mtx
+    branch_tip_mtx, branch_lengths = get_branch_tip_matrix(tree, taxon_labels)
+    pd_vals = _phylogenetic_diversity(
+        np.asarray(pam), _get_tip_branch_matrix(branch_tip_mtx),
+        branch_lengths)
+    return pd_vals.reshape((len(pd_vals), 1))
@@ -0,0 +1,50 @@
+"""Tests for the PAM statistics of packed and unpacked PAMs in calculate.py
+"""
+import numpy as np
+import pytest
+
+from LmCommon.compression.packed_pam import PackedPam
+from LmCompute.plugins.multi.calculate.calculate import PamStats
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+NUM_SITES = 23
+NUM_SPECIES = 19
+
+
+# .............................................................................
+def _get_pam(seed=3):
+    """Gets a random PAM with every site and species present"""
+    rand_state = np.random.RandomState(seed)
+    pam = (rand_state.uniform(size=(NUM_SITES, NUM_SPECIES)) < 0.4).astype(
+        np.int8)
+    np.fill_diagonal(pam, 1)
+    pam[NUM_SPECIES:, 0] = 1
+    return pam
+
+
+# .............................................................................
+@pytest.mark.parametrize('memory_limit', [1, 300, 2000, 10 ** 9])
+def test_packed_covariance_matrices(monkeypatch, memory_limit):
+    """Row blocks of a PackedPam give the covariance matrices of the PAM"""
+    pam = _get_pam()
+    stats = PamStats(pam)
+
+    def _unpack_all(*args, **kwargs):
+        raise AssertionError('The PackedPam was unpacked as a whole')
+
+    monkeypatch.setattr(PackedPam, '__array__', _unpack_all)
+    packed_stats = PamStats(
+        PackedPam.from_matrix(pam), memory_limit=memory_limit)
+
+    sigma_sites, sigma_species = packed_stats.get_covariance_matrices()
+    assert np.allclose(sigma_sites, stats.get_covariance_matrices()[0])
+    assert np.allclose(sigma_species, stats.get_covariance_matrices()[1])
+    assert np.allclose(
+        packed_stats.get_schluter_covariances(),
+        stats.get_schluter_covariances())
+    # The C-score reuses the species co-occurrence matrix
+    assert np.allclose(
+        packed_stats.get_diversity_statistics(),
+        stats.get_diversity_statistics())
@@ -5,20 +5,47 @@ See:
          phylogenetics: separating the roles of environmental filters and
          historical biogeography. Ecology letters 13: 1290-1299.
 """
-from concurrent.futures import ThreadPoolExecutor as ExecutorClass
-from functools import partial
-import threading
+from concurrent.futures import ProcessPoolExecutor
+import os
 
 import numpy as np
+from scipy import sparse
 
+from LmCommon.encoding.phylo import SparsePhyloMatrix
+from LmCommon.statistics.permutation_testing import PValueAccumulator
+from LmCompute.plugins.multi.shared_matrices import (
+    attach_shared_matrices, release_shared_matrices, share_matrices)
 from lmpy import Matrix
 
-# Note: This lock is used when calculating beta to keep memory usage down
-lock = threading.Lock()
+# Note: The default memory budget, in bytes, for each parallel MCPA worker.
+#    This determines how many nodes a worker solves at once.
+WORKER_MEMORY = 1024 ** 3
 
-# Note: This will depend on the executor class used and is subject to tuning.
-#    Threads should have a higher level of concurrency than processes.
-CONCURRENCY_FACTOR = 5
+# Note: The approximate number of (sites x nodes) float matrices held at once
+#    while solving a batch of nodes.  Used to size batches from memory budgets.
+NODE_BATCH_MATRICES = 8
+
+# Note: Worker processes keep their attached shared input matrices here
+_WORKER_MATRICES = {}
+
+# Note: The number of tree nodes solved together by the batched engine.  Memory
+#    use grows with (sites x nodes) so this bounds the temporary matrices.
+NODE_BATCH_SIZE = 256
+
+# Note: Weighted variances at or below this value are treated as zero by the
+#    batched engine.  Predictors are pre-scaled so this is relative to one.
+VARIANCE_TOLERANCE = 1e-10
+
+
+# .............................................................................
+def _attach_shared_matrices(matrix_specs):
+    """Attaches the shared MCPA input matrices in a worker process
+
+    Args:
+        matrix_specs (dict): A dictionary of matrix key to a tuple of shared
+            memory block name, array shape, and dtype string.
+    """
+    attach_shared_matrices(matrix_specs, _WORKER_MATRICES)
 
 
 # .............................................................................
@@ -34,13 +61,13 @@ def _beta_helper(mtx1, mtx2, weights):
     _, num_k = mtx2.shape
     out_mtx = np.empty((num_predictors, num_k))
     for i in range(num_predictors):
-        for j in range(i, num_k):
+        for j in range(num_k):
             out_mtx[i, j] = np.sum(mtx1[:, i] * weights * mtx2[:, j])
     return out_mtx
 
 
 # .............................................................................
-def _calculate_beta(pred_std, weights, phylo_std, use_lock=True):
+def _calculate_beta(pred_std, weights, phylo_std):
     """Calculates the regression model (beta) for the provided inputs
 
     Args:
@@ -48,10 +75,6 @@ def _calculate_beta(pred_std, weights, phylo_std, use_lock=True):
             (n [sites] by i [predictors]).
         weights (numpy array): A matrix of site weights (n by n).
         phylo_std (numpy array): A standardized phylo matrix (n by k [nodes]).
-        use_lock (boolean): If true, use a lock when performing the computation
-            to save on overall memory usage.  This is useful for large, or
-            full, predictor matrices but can be skipped for single columns to
-            improve performance.
 
     Note:
         * The computation is::
@@ -61,9 +84,6 @@ def _calculate_beta(pred_std, weights, phylo_std, use_lock=True):
         * W is the weights column
         * P is the phylo matrix
         * "^-1" is the inverse of the matrix
-        * Locking is available to prevent many threads / subprocesses from
-            performing memory intensive computations concurrently and
-            overwhelming the system.
 
     Todo:
         * Update documentation so that note shows symbols in equation
@@ -72,16 +92,12 @@ def _calculate_beta(pred_std, weights, phylo_std, use_lock=True):
         * An (i by k) numpy ndarray, where i is the number of predictors in
             pred_std and k is the number of nodes in phylo_std.
     """
-    if use_lock:
-        lock.acquire()
     temp1 = _beta_helper(pred_std, pred_std, weights)
     tmp1_inv = np.linalg.inv(temp1)
     temp2 = _beta_helper(pred_std, phylo_std, weights)
     beta = tmp1_inv.dot(temp2)
     if len(beta.shape) == 1:
         beta = beta.reshape((beta.shape[0], 1))
-    if use_lock:
-        lock.release()
     return beta
 
 
@@ -126,7 +142,21 @@ def _calculate_y_hat(pred_std, beta):
 
 
 # .............................................................................
-def _mcpa_for_node(incidence_mtx, env_mtx, bg_mtx, phylo_col, use_locks=False):
+def _get_phylo_columns(phylo_mtx, start, stop):
+    """Gets a block of phylo matrix columns as a dense float array
+
+    Args:
+        phylo_mtx (Matrix or SparsePhyloMatrix): The phylo matrix.
+        start (int): The first column to return.
+        stop (int): The column after the last one to return.
+    """
+    if isinstance(phylo_mtx, SparsePhyloMatrix):
+        return phylo_mtx.get_columns(start, stop)
+    return np.asarray(phylo_mtx[:, start:stop], dtype=float)
+
+
+# .............................................................................
+def _mcpa_for_node(incidence_mtx, env_mtx, bg_mtx, phylo_col):
     """Runs MCPA computations for a single tree node.
 
     Args:
@@ -135,8 +165,6 @@ def _mcpa_for_node(incidence_mtx, env_mtx, bg_mtx, phylo_col, use_locks=False):
         bg_mtx (numpy array): A matrix of encoded Biogeographic hypotheses.
         phylo_col (numpy array): A column from the phylo matrix for a
             single node.
-        use_locks (boolean): Indicator if locks are needed for larger
-            computations.  This is probably only true for parallel runs.
     """
     species_present_at_node = np.where(phylo_col != 0)[0]
     phylo_col = phylo_col[species_present_at_node, :]
@@ -170,11 +198,10 @@ def _mcpa_for_node(incidence_mtx, env_mtx, bg_mtx, phylo_col, use_locks=False):
             p_std = _standardize_matrix(phylo_col, species_weights)
             p_sigma_std = np.dot(incidence, p_std)
             # Get Beta, Y(hat), Rho, R-squared, F-pseudo
-            beta_env_all = _calculate_beta(e_std, site_weights, p_sigma_std,
-                                           use_lock=use_locks)
+            beta_env_all = _calculate_beta(e_std, site_weights, p_sigma_std)
             y_hat_env_all = _calculate_y_hat(e_std, beta_env_all)
-            beta_bg_all = _calculate_beta(all_std, site_weights, p_sigma_std,
-                                          use_lock=use_locks)
+            beta_bg_all = _calculate_beta(
+                all_std, site_weights, p_sigma_std)
             y_hat_bg_all = _calculate_y_hat(all_std, beta_bg_all)
             env_r2 = _calculate_r_squared(y_hat_env_all, p_sigma_std)
             bg_r2 = _calculate_r_squared(y_hat_bg_all, p_sigma_std)
@@ -218,11 +245,10 @@ def _mcpa_for_node(incidence_mtx, env_mtx, bg_mtx, phylo_col, use_locks=False):
 
                 # Semi-partial correlation
                 beta_wo_pred = _calculate_beta(
-                    wo_predictor, site_weights, p_sigma_std,
-                    use_lock=use_locks)
+                    wo_predictor, site_weights, p_sigma_std)
                 y_hat_wo_pred = _calculate_y_hat(wo_predictor, beta_wo_pred)
                 beta_j_i = _calculate_beta(
-                    predictor, site_weights, p_sigma_std, use_lock=False)
+                    predictor, site_weights, p_sigma_std)
                 r2_j_i = _calculate_r_squared(y_hat_wo_pred, p_sigma_std)
                 semi_partial = beta_j_i * np.sqrt(
                     env_r2 - r2_j_i) / np.abs(beta_j_i)
@@ -243,11 +269,10 @@ def _mcpa_for_node(incidence_mtx, env_mtx, bg_mtx, phylo_col, use_locks=False):
 
                 # Semi-partial correlation
                 beta_wo_pred = _calculate_beta(
-                    wo_predictor, site_weights, p_sigma_std,
-                    use_lock=use_locks)
+                    wo_predictor, site_weights, p_sigma_std)
                 y_hat_wo_pred = _calculate_y_hat(wo_predictor, beta_wo_pred)
                 beta_j_i = _calculate_beta(
-                    predictor, site_weights, p_sigma_std, use_lock=False)
+                    predictor, site_weights, p_sigma_std)
                 r2_j_i = _calculate_r_squared(y_hat_wo_pred, p_sigma_std)
                 semi_partial = beta_j_i * np.sqrt(
                     bg_r2 - r2_j_i) / np.abs(beta_j_i)
@@ -265,6 +290,316 @@ def _mcpa_for_node(incidence_mtx, env_mtx, bg_mtx, phylo_col, use_locks=False):
     return (obs_values, f_values)
 
 
+# .............................................................................
+def _compare_rounded_absolute_values(obs_abs, rand):
+    """Compares rounded absolute random values to pre-rounded observed values
+
+    Args:
+        obs_abs (numpy array): The absolute value of the observed values,
+            rounded to 5 decimal places.
+        rand (numpy array): Random values to compare.
+    """
+    return np.abs(np.round(rand, 5)) >= obs_abs
+
+
+# .............................................................................
+def _factor_inverse(gram):
+    """Inverts a stack of Gram matrices using Cholesky factorizations
+
+    Args:
+        gram (numpy array): A (k [nodes] by i by i) stack of symmetric Gram
+            matrices.
+
+    Note:
+        * Factorization is attempted for the whole stack at once and only
+            falls back to node by node factorization if one of the matrices is
+            singular so that those nodes can be flagged.
+
+    Returns:
+        * A (k by i by i) numpy ndarray of inverse matrices.
+        * A (k) boolean numpy ndarray that is True for singular matrices.
+    """
+    num_nodes, size, _ = gram.shape
+    singular = np.zeros(num_nodes, dtype=bool)
+    try:
+        chol = np.linalg.cholesky(gram)
+    except np.linalg.LinAlgError:
+        chol = np.empty(gram.shape)
+        for i in range(num_nodes):
+            try:
+                chol[i] = np.linalg.cholesky(gram[i])
+            except np.linalg.LinAlgError:
+                # Singular matrix, substitute identity and flag the node
+                singular[i] = True
+                chol[i] = np.eye(size)
+    chol_inv = np.linalg.solve(chol, np.broadcast_to(np.eye(size), gram.shape))
+    return np.matmul(chol_inv.transpose((0, 2, 1)), chol_inv), singular
+
+
+# .............................................................................
+def _fit_node_batch(gram, unweighted_gram, weighted_cross, unweighted_cross,
+                    sum_squares):
+    """Fits the regression for a batch of nodes from their Gram matrices
+
+    Args:
+        gram (numpy array): A (k [nodes] by i by i) stack of weighted Gram
+            matrices of the standardized predictors (M_T.W.M).
+        unweighted_gram (numpy array): A (k by i by i) stack of unweighted Gram
+            matrices of the standardized predictors over each node's sites.
+        weighted_cross (numpy array): A (k by i) matrix of weighted products of
+            the standardized predictors and the node's phylo column (M_T.W.P).
+        unweighted_cross (numpy array): A (k by i) matrix of unweighted
+            products of the standardized predictors and the phylo column.
+        sum_squares (numpy array): A (k) array of trace(P . P_T) for each
+            node.
+
+    Note:
+        * The fit without predictor i is derived from the full fit by the
+            rank-one downdate beta_wo = beta - beta[i] / C[i, i] * C[:, i],
+            where C is the inverse Gram matrix, so no further inversions are
+            needed for the semi-partial correlations.
+        * trace(Y_hat . Y_hat_T) is computed as beta_T.(M_T.M).beta
+
+    Returns:
+        * A (k) array of R-squared values for the full model.
+        * A (k by i) array of R-squared values for the models without each
+            predictor.
+        * A (k) array of F-pseudo numerators.
+        * A (k) array of F-pseudo denominators.
+        * A (k) boolean array that is True where the Gram matrix is singular.
+    """
+    gram_inv, singular = _factor_inverse(gram)
+    beta = np.einsum('kij,kj->ki', gram_inv, weighted_cross)
+    fit_sum_squares = np.einsum(
+        'ki,kij,kj->k', beta, unweighted_gram, beta)
+    residual_sum_squares = sum_squares - 2.0 * np.sum(
+        beta * unweighted_cross, axis=1) + fit_sum_squares
+
+    inv_diagonal = np.einsum('kii->ki', gram_inv)
+    beta_wo = beta[:, np.newaxis, :] - (
+        beta / inv_diagonal)[:, :, np.newaxis] * gram_inv
+    wo_sum_squares = np.einsum(
+        'kij,kjl,kil->ki', beta_wo, unweighted_gram, beta_wo)
+
+    r_2 = fit_sum_squares / sum_squares
+    r_2_wo = wo_sum_squares / sum_squares[:, np.newaxis]
+    return (r_2, r_2_wo, fit_sum_squares, residual_sum_squares, singular)
+
+
+# .............................................................................
+def _mcpa_for_node_batch(incidence_mtx, predictors, predictor_products,
+                         species_weights, phylo_batch, num_bg_predictors):
+    """Runs MCPA computations for a batch of tree nodes at once.
+
+    Rather than purging the matrices for each node, sites that are not present
+    for a node are given a weight of zero.  This way the weighted sums needed
+    for standardization and for the regressions of every node in the batch
+    are computed with a handful of matrix products.
+
+    Args:
+        incidence_mtx (numpy array): An incidence matrix (PAM) purged of empty
+            sites (n [sites] by k+1 [species]).
+        predictors (numpy array): The pre-scaled biogeographic and
+            environmental predictors, in that order (n by i [predictors]).
+        predictor_products (numpy array): The products of each pair of
+            predictor columns for each site (n by i * i).
+        species_weights (numpy array): The column sums of the incidence matrix.
+        phylo_batch (numpy array): The phylo matrix columns for this batch of
+            nodes (k+1 [species] by k [nodes]).
+        num_bg_predictors (int): The number of biogeographic predictors at the
+            start of the predictor matrix.
+
+    Returns:
+        * A (k by i + 2) numpy ndarray of observed values.
+        * A (k by i + 2) numpy ndarray of F-pseudo values.
+    """
+    num_nodes = phylo_batch.shape[1]
+    num_predictors = predictors.shape[1]
+    num_env_predictors = num_predictors - num_bg_predictors
+    env_idx = np.arange(num_bg_predictors, num_predictors)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Standardize the phylo columns (see _standardize_matrix)
+        node_mask = phylo_batch != 0
+        node_species_weights = node_mask * species_weights[:, np.newaxis]
+        total_species_weights = np.sum(node_species_weights, axis=0)
+        s_1 = np.sum(node_species_weights * phylo_batch, axis=0)
+        s_2 = np.sum(node_species_weights * phylo_batch ** 2, axis=0)
+        phylo_var = (
+            s_2 - s_1 ** 2.0 / total_species_weights) / total_species_weights
+        phylo_inv_std = np.where(
+            phylo_var > VARIANCE_TOLERANCE, phylo_var ** -0.5, 0.0)
+        phylo_std = np.where(
+            node_mask,
+            (phylo_batch - s_1 / total_species_weights) * phylo_inv_std,
+            0.0)
+
+        site_weights = incidence_mtx.dot(node_mask)
+        site_present = (site_weights > 0).astype(float)
+        p_sigma_std = incidence_mtx.dot(phylo_std)
+        weighted_p_sigma = site_weights * p_sigma_std
+
+        # Raw moments of the predictors for every node in the batch
+        weight_sums = np.sum(site_weights, axis=0)
+        num_sites = np.sum(site_present, axis=0)
+        weighted_first = site_weights.T.dot(predictors)
+        unweighted_first = site_present.T.dot(predictors)
+        weighted_second = site_weights.T.dot(predictor_products).reshape(
+            (num_nodes, num_predictors, num_predictors))
+        unweighted_second = site_present.T.dot(predictor_products).reshape(
+            (num_nodes, num_predictors, num_predictors))
+        weighted_cross = weighted_p_sigma.T.dot(predictors)
+        unweighted_cross = p_sigma_std.T.dot(predictors)
+        weighted_p_sum = np.sum(weighted_p_sigma, axis=0)
+        unweighted_p_sum = np.sum(p_sigma_std, axis=0)
+        sum_squares = np.sum(p_sigma_std ** 2, axis=0)
+
+        # Center and scale the moments as if the predictors were standardized
+        #    with each node's site weights
+        mean = weighted_first / weight_sums[:, np.newaxis]
+        var = np.einsum('kii->ki', weighted_second) / weight_sums[
+            :, np.newaxis] - mean ** 2
+        inv_std = np.where(var > VARIANCE_TOLERANCE, var ** -0.5, 0.0)
+        scale = inv_std[:, :, np.newaxis] * inv_std[:, np.newaxis, :]
+        outer_mean = mean[:, :, np.newaxis] * mean[:, np.newaxis, :]
+
+        gram = scale * (
+            weighted_second
+            - weight_sums[:, np.newaxis, np.newaxis] * outer_mean)
+        unweighted_gram = scale * (
+            unweighted_second
+            - mean[:, :, np.newaxis] * unweighted_first[:, np.newaxis, :]
+            - unweighted_first[:, :, np.newaxis] * mean[:, np.newaxis, :]
+            + num_sites[:, np.newaxis, np.newaxis] * outer_mean)
+        weighted_cross = inv_std * (
+            weighted_cross - mean * weighted_p_sum[:, np.newaxis])
+        unweighted_cross = inv_std * (
+            unweighted_cross - mean * unweighted_p_sum[:, np.newaxis])
+
+        # Nodes without sites have nothing to fit
+        gram[weight_sums == 0] = np.eye(num_predictors)
+
+        env_grid = np.ix_(np.arange(num_nodes), env_idx, env_idx)
+        (env_r2, env_r2_wo, env_f_num, env_f_denom, env_singular
+         ) = _fit_node_batch(
+             gram[env_grid], unweighted_gram[env_grid],
+             weighted_cross[:, env_idx], unweighted_cross[:, env_idx],
+             sum_squares)
+        (bg_r2, bg_r2_wo, bg_f_num, bg_f_denom, bg_singular
+         ) = _fit_node_batch(
+             gram, unweighted_gram, weighted_cross, unweighted_cross,
+             sum_squares)
+
+        env_adj_denom = num_sites - num_env_predictors - 1.0
+        env_adj_r2 = np.where(
+            env_adj_denom != 0,
+            1.0 - ((num_sites - 1.0) / env_adj_denom) * (1.0 - env_r2), 0.0)
+        bg_adj_denom = num_sites - num_bg_predictors - 1.0
+        bg_adj_r2 = np.where(
+            bg_adj_denom != 0,
+            1.0 - ((num_sites - 1.0) / bg_adj_denom) * (1.0 - bg_r2), 0.0)
+
+        # The sign of the single predictor regression coefficient is the sign
+        #    of the weighted cross product since the Gram diagonal is positive
+        env_sign = np.sign(weighted_cross[:, env_idx])
+        bg_sign = np.sign(weighted_cross[:, :num_bg_predictors])
+        env_diff = env_r2[:, np.newaxis] - env_r2_wo
+        bg_diff = bg_r2[:, np.newaxis] - bg_r2_wo[:, :num_bg_predictors]
+
+        obs_values = np.column_stack([
+            env_sign * np.sqrt(env_diff), env_adj_r2,
+            bg_sign * np.sqrt(bg_diff), bg_adj_r2])
+        f_values = np.column_stack([
+            env_diff / env_f_denom[:, np.newaxis], env_f_num / env_f_denom,
+            bg_diff / bg_f_denom[:, np.newaxis], bg_f_num / bg_f_denom])
+
+    # Singular nodes produce zeros, as in _mcpa_for_node
+    failed = (weight_sums == 0) | env_singular | bg_singular
+    obs_values[failed] = 0.0
+    f_values[failed] = 0.0
+    return (obs_values, f_values)
+
+
+# .............................................................................
+def _mcpa_worker(start, stop, num_bg_predictors):
+    """Runs MCPA for a range of tree nodes in a worker process
+
+    Args:
+        start (int): The index of the first node to compute.
+        stop (int): The index after the last node to compute.
+        num_bg_predictors (int): The number of biogeographic predictors.
+
+    Returns:
+        * The start index so results can be placed in the correct rows.
+        * A numpy ndarray of observed values for the nodes.
+        * A numpy ndarray of F-pseudo values for the nodes.
+    """
+    mtx = _WORKER_MATRICES
+    if 'phylo' in mtx:
+        phylo_batch = mtx['phylo'][:, start:stop]
+    else:
+        phylo_batch = sparse.csc_matrix(
+            (mtx['phylo_data'], mtx['phylo_indices'], mtx['phylo_indptr']),
+            shape=(mtx['incidence'].shape[1], mtx['phylo_indptr'].size - 1)
+            )[:, start:stop].toarray()
+    obs_values, f_values = _mcpa_for_node_batch(
+        mtx['incidence'], mtx['predictors'], mtx['predictor_products'],
+        mtx['species_weights'], phylo_batch, num_bg_predictors)
+    return (start, obs_values, f_values)
+
+
+# .............................................................................
+def _prepare_batch_inputs(incidence_matrix, env_mtx, bg_mtx):
+    """Purges empty sites and builds the predictor inputs for batched MCPA
+
+    Args:
+        incidence_matrix (Matrix): A binary PAM (n [sites] by k+1 [species]).
+        env_mtx (Matrix): An environmental matrix (n by ei).
+        bg_mtx (Matrix): A biogeographic hypotheses matrix (n by bi).
+
+    Returns:
+        * The incidence matrix purged of empty sites as a float array.
+        * The pre-scaled biogeographic and environmental predictors, in that
+            order, for the remaining sites (n by i [predictors]).
+        * The products of each pair of predictor columns for each site
+            (n by i * i).
+    """
+    site_present = np.any(incidence_matrix, axis=1)
+
+    # Initial purge of empty sites
+    init_incidence = np.asarray(incidence_matrix, dtype=float)[site_present]
+    env_predictors = np.asarray(env_mtx, dtype=float)[site_present]
+    bg_predictors = np.asarray(bg_mtx, dtype=float)[site_present]
+
+    num_sites = init_incidence.shape[0]
+    predictors = _prescale_predictors(
+        np.concatenate([bg_predictors, env_predictors], axis=1))
+    num_predictors = predictors.shape[1]
+    predictor_products = (
+        predictors[:, :, np.newaxis] * predictors[:, np.newaxis, :]).reshape(
+            (num_sites, num_predictors * num_predictors))
+    return (init_incidence, predictors, predictor_products)
+
+
+# .............................................................................
+def _prescale_predictors(predictors):
+    """Centers and scales predictor columns over all sites
+
+    Args:
+        predictors (numpy array): A (n [sites] by i [predictors]) matrix.
+
+    Note:
+        * Standardization is invariant to a positive affine transformation of
+            a column, so this does not change MCPA results.  It keeps the
+            values near one so that the raw moments used by the batched engine
+            do not lose precision when they are centered.
+    """
+    centered = predictors - np.mean(predictors, axis=0)
+    std_dev = np.std(centered, axis=0)
+    std_dev[std_dev == 0] = 1.0
+    return centered / std_dev
+
+
 # .............................................................................
 def _standardize_matrix(mtx, weights):
     """Standardizes a phylogenetic or predictor matrix
@@ -344,34 +679,28 @@ def get_p_values(observed_value, test_values, num_permutations=None):
     Args:
         observed_value (Matrix): An array of observed values to use as a
             reference.
-        test_values (Matrix): A list of arrays generated from randomizations
-            that will be compared to the observed
+        test_values (Matrix): A list, or generator, of arrays generated from
+            randomizations that will be compared to the observed
         num_permutations: (optional) The total number of randomizations
-            performed.  Divide the P-values by this if provided.
+            performed.  Divide the P-values by this if provided, otherwise
+            divide by the number of randomizations in test_values.
 
     Todo:
         Deprecate this in favor of new method that is more flexible
     """
-    if num_permutations is None:
-        num_permutations = 1.0
-
-    # Create the P-Values matrix
-    p_vals = np.zeros(observed_value.shape, dtype=float)
-    # For each matrix in test values
+    # Round the observed values once rather than for every test matrix
+    accumulator = PValueAccumulator(
+        Matrix(np.abs(np.round(observed_value, 5)),
+               headers=observed_value.headers),
+        compare_func=_compare_rounded_absolute_values)
+    # Add 1 where every value in the test matrix is greater than or equal to
+    #    the value in the observed value.  Each layer of a stack counts as a
+    #    permutation.
     for test_mtx in test_values:
-        # Add 1 where every value in the test matrix is greater than or equal
-        #    to the value in the observed value.  Numpy comparisons will create
-        #    a matrix of boolean values for each cell, which when added to the
-        #    p_vals matrix will be treated as 1 for True and 0 for False
-
-        # If this is a stack
-        if test_mtx.ndim == 3:
-            for i in range(test_mtx.shape[2]):
-                p_vals += np.abs(np.round(test_mtx[:, :, [i]], 5)
-                                 ) >= np.abs(np.round(observed_value, 5))
-        else:
-            p_vals += np.abs(np.round(test_mtx, 5)
-                             ) >= np.abs(np.round(observed_value, 5))
+        accumulator.add(test_mtx)
+    p_vals = accumulator.exceedances
+    if num_permutations is None:
+        num_permutations = max(accumulator.num_permutations, 1)
     # Reshape and adding depth header
     if len(p_vals.shape) == 2:
         p_vals = np.expand_dims(p_vals, axis=2)
@@ -391,9 +720,10 @@ def mcpa(incidence_matrix, phylo_mtx, env_mtx, bg_mtx):
             representing the incidence of each species for each site by coding
             them as ones.  This is the same thing as a Lifemapper Presence
             Absence Matrix, or PAM (n [sites] by k+1 [species]).
-        phylo_mtx (Matrix): A matrix encoding of a phylogenetic tree where each
-            cell represents the relative contribution of each tip to each
-            inner tree node (k+1 [species] by k [nodes]).
+        phylo_mtx (Matrix or SparsePhyloMatrix): A matrix encoding of a
+            phylogenetic tree where each cell represents the relative
+            contribution of each tip to each inner tree node (k+1 [species]
+            by k [nodes]).
         env_mtx (Matrix): A matrix encoding of the environment for each site
             (n [sites] by ei [environmental predictors]).
         bg_mtx (Matirx): A matrix of Helmert contrasts (-1, 0, 1) for
@@ -423,7 +753,7 @@ def mcpa(incidence_matrix, phylo_mtx, env_mtx, bg_mtx):
         # print('Node {} of {}'.format(i+1, num_nodes))
         obs, f_vals = _mcpa_for_node(
             init_incidence, env_predictors, bg_predictors,
-            phylo_mtx[:, [i]])
+            _get_phylo_columns(phylo_mtx, i, i + 1))
         obs_results[i] = obs
         f_results[i] = f_vals
 
@@ -455,24 +785,32 @@ def mcpa(incidence_matrix, phylo_mtx, env_mtx, bg_mtx):
 
 
 # .............................................................................
-def mcpa_parallel(incidence_matrix, phylo_mtx, env_mtx, bg_mtx):
-    """Run MCPA for a set of matrices using parallelism.
+def mcpa_batched(incidence_matrix, phylo_mtx, env_mtx, bg_mtx,
+                 node_batch_size=NODE_BATCH_SIZE):
+    """Runs MCPA for a set of matrices, solving batches of nodes together.
 
-    Performs MCPA across each of the tree nodes in parallel.
+    Produces the same outputs as `mcpa` but, instead of purging and
+    standardizing the matrices for each node, computes the weighted Gram
+    matrices for a batch of nodes with a few matrix products and solves each
+    node's regressions from a single Cholesky factorization.
 
     Args:
         incidence_matrix (Matrix): A binary Lifemapper Matrix object
             representing the incidence of each species for each site by coding
             them as ones.  This is the same thing as a Lifemapper Presence
             Absence Matrix, or PAM (n [sites] by k+1 [species]).
-        phylo_mtx (Matrix): A matrix encoding of a phylogenetic tree where each
-            cell represents the relative contribution of each tip to each
-            inner tree node (k+1 [species] by k [nodes]).
+        phylo_mtx (Matrix or SparsePhyloMatrix): A matrix encoding of a
+            phylogenetic tree where each cell represents the relative
+            contribution of each tip to each inner tree node (k+1 [species]
+            by k [nodes]).
         env_mtx (Matrix): A matrix encoding of the environment for each site
             (n [sites] by ei [environmental predictors]).
         bg_mtx (Matirx): A matrix of Helmert contrasts (-1, 0, 1) for
             Biogeographic hypotheses (n [sites] by bi [biogeographic
             predictors]).
+        node_batch_size (int): The number of tree nodes to solve at once.
+            Larger batches are faster but use (n by node_batch_size) temporary
+            matrices.
 
     Returns:
         * A Matrix object representing the observed values from the
@@ -480,38 +818,138 @@ def mcpa_parallel(incidence_matrix, phylo_mtx, env_mtx, bg_mtx):
         * A Matrix object representing the F-pseudo values from the
             calculation.
     """
-    site_present = np.any(incidence_matrix, axis=1)
-    empty_sites = np.where(site_present == False)[0]
+    init_incidence, predictors, predictor_products = _prepare_batch_inputs(
+        incidence_matrix, env_mtx, bg_mtx)
+    species_weights = np.sum(init_incidence, axis=0)
 
-    # Initial purge of empty sites
-    init_incidence = np.delete(incidence_matrix, empty_sites, axis=0)
-    env_predictors = np.delete(env_mtx, empty_sites, axis=0)
-    bg_predictors = np.delete(bg_mtx, empty_sites, axis=0)
+    num_nodes = phylo_mtx.shape[1]
+    num_bg_predictors = bg_mtx.shape[1]
+    num_predictors = predictors.shape[1]
+
+    obs_results = np.empty((num_nodes, num_predictors + 2))
+    f_results = np.empty((num_nodes, num_predictors + 2))
+    for start in range(0, num_nodes, node_batch_size):
+        stop = min(start + node_batch_size, num_nodes)
+        obs_results[start:stop], f_results[start:stop] = _mcpa_for_node_batch(
+            init_incidence, predictors, predictor_products, species_weights,
+            _get_phylo_columns(phylo_mtx, start, stop), num_bg_predictors)
+
+    # Correct any nans and add depth
+    obs_results = np.clip(
+        np.expand_dims(np.nan_to_num(obs_results), axis=2), -1.0, 1.0)
+    f_results = np.clip(
+        np.expand_dims(np.nan_to_num(f_results), axis=2), -1.0, 1.0)
+
+    column_headers = env_mtx.get_column_headers()
+    column_headers.append('Env - Adjusted R-squared')
+    column_headers.extend(bg_mtx.get_column_headers())
+    column_headers.append('BG - Adjusted R-squared')
+    obs_headers = {
+        '0': phylo_mtx.get_column_headers(),
+        '1': column_headers,
+        '2': ['Observed']
+    }
+    f_headers = {
+        '0': phylo_mtx.get_column_headers(),
+        '1': column_headers,
+        '2': ['F-values']
+    }
+    obs_mtx = Matrix(obs_results, headers=obs_headers)
+    f_mtx = Matrix(f_results, headers=f_headers)
+    return (obs_mtx, f_mtx)
+
+
+# .............................................................................
+def mcpa_parallel(incidence_matrix, phylo_mtx, env_mtx, bg_mtx,
+                  max_workers=None, worker_memory=WORKER_MEMORY):
+    """Run MCPA for a set of matrices using parallelism.
+
+    Performs MCPA across batches of tree nodes in a pool of processes.  The
+    purged input matrices are placed in shared memory once and attached by
+    each worker so that tasks only pass node ranges and small result arrays.
+
+    Args:
+        incidence_matrix (Matrix): A binary Lifemapper Matrix object
+            representing the incidence of each species for each site by coding
+            them as ones.  This is the same thing as a Lifemapper Presence
+            Absence Matrix, or PAM (n [sites] by k+1 [species]).
+        phylo_mtx (Matrix or SparsePhyloMatrix): A matrix encoding of a
+            phylogenetic tree where each cell represents the relative
+            contribution of each tip to each inner tree node (k+1 [species]
+            by k [nodes]).
+        env_mtx (Matrix): A matrix encoding of the environment for each site
+            (n [sites] by ei [environmental predictors]).
+        bg_mtx (Matirx): A matrix of Helmert contrasts (-1, 0, 1) for
+            Biogeographic hypotheses (n [sites] by bi [biogeographic
+            predictors]).
+        max_workers (int): The number of worker processes to use.  Defaults
+            to the number of CPUs.
+        worker_memory (int): The approximate number of bytes each worker may
+            use for temporary matrices.  This determines how many nodes a
+            worker solves at once.
 
+    Returns:
+        * A Matrix object representing the observed values from the
+            calculation.
+        * A Matrix object representing the F-pseudo values from the
+            calculation.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count()
+
+    init_incidence, predictors, predictor_products = _prepare_batch_inputs(
+        incidence_matrix, env_mtx, bg_mtx)
+    species_weights = np.sum(init_incidence, axis=0)
+
+    # Sparse phylo matrices are shared in sparse form
+    if isinstance(phylo_mtx, SparsePhyloMatrix):
+        phylo_csc = phylo_mtx.data
+        phylo_inputs = [('phylo_data', phylo_csc.data),
+                        ('phylo_indices', phylo_csc.indices),
+                        ('phylo_indptr', phylo_csc.indptr)]
+    else:
+        phylo_inputs = [('phylo', np.asarray(phylo_mtx, dtype=float))]
+
+    num_sites = init_incidence.shape[0]
     num_nodes = phylo_mtx.shape[1]
-    num_predictors = env_predictors.shape[1] + bg_predictors.shape[1]
+    num_bg_predictors = bg_mtx.shape[1]
+    num_predictors = predictors.shape[1]
+
+    # Size batches from the memory budget, but make sure that every worker
+    #    gets at least one batch
+    node_batch_size = max(
+        1, min(worker_memory // (NODE_BATCH_MATRICES * 8 * max(num_sites, 1)),
+               -(-num_nodes // max_workers)))
 
     obs_results = np.empty((num_nodes, num_predictors + 2))
     f_results = np.empty((num_nodes, num_predictors + 2))
 
-    func = partial(
-        _mcpa_for_node, init_incidence, env_predictors, bg_predictors,
-        use_locks=True)
-
-    # Use an Executor to parallelize the computations over each tree node
-    # Note: The executor class is determined at the module level, so see top of
-    #    module for more information about executor class and concurrency
-    with ExecutorClass(CONCURRENCY_FACTOR) as executor:
-        comp_run = executor.map(
-            func, [phylo_mtx[:, [i]] for i in range(num_nodes)])
-        i = 0
-        for obs, f_val in comp_run:
-            obs_results[i] = obs
-            f_results[i] = f_val
-
-    # Correct any nans
-    obs_results = np.clip(np.nan_to_num(obs_results), -1.0, 1.0)
-    f_results = np.clip(np.nan_to_num(f_results), -1.0, 1.0)
+    shared_blocks, matrix_specs = share_matrices(dict([
+        ('incidence', init_incidence),
+        ('predictors', predictors),
+        ('predictor_products', predictor_products),
+        ('species_weights', species_weights)] + phylo_inputs))
+    try:
+        with ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_attach_shared_matrices,
+                initargs=(matrix_specs,)) as executor:
+            futures = [
+                executor.submit(
+                    _mcpa_worker, start,
+                    min(start + node_batch_size, num_nodes), num_bg_predictors)
+                for start in range(0, num_nodes, node_batch_size)]
+            for future in futures:
+                start, obs, f_vals = future.result()
+                obs_results[start:start + obs.shape[0]] = obs
+                f_results[start:start + f_vals.shape[0]] = f_vals
+    finally:
+        release_shared_matrices(shared_blocks)
+
+    # Correct any nans and add depth
+    obs_results = np.clip(
+        np.expand_dims(np.nan_to_num(obs_results), axis=2), -1.0, 1.0)
+    f_results = np.clip(
+        np.expand_dims(np.nan_to_num(f_results), axis=2), -1.0, 1.0)
 
     column_headers = env_mtx.get_column_headers()
     column_headers.append('Env - Adjusted R-squared')
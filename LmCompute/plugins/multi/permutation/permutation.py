@@ -0,0 +1,405 @@
+"""Module for running multi-species permutations in a pool of processes
+
+Randomized PAMs are generated by worker processes and the statistics computed
+for each one can be streamed into running accumulators so that only a summary
+of the permutations is kept in memory.
+
+Note:
+    * The random seed for each permutation is derived from a base seed and the
+        permutation index.  A set of permutations can be split across jobs by
+        giving each a different first permutation index and the summaries can
+        then be merged to get the same result as a single run.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import random
+
+import numpy as np
+
+from LmCommon.compression.packed_pam import PackedPam
+from LmCommon.statistics.permutation_testing import (
+    compare_absolute_values, EXCEEDANCES_HEADER, PERMUTATIONS_HEADER,
+    PValueAccumulator)
+from LmCompute.plugins.multi.calculate.calculate import PamStats
+from LmCompute.plugins.multi.mcpa.mcpa import mcpa
+from lmpy import Matrix, TreeWrapper
+from lmpy.randomize.grady import grady_randomize
+
+# Statistic keys
+DIVERSITY_STATS = 'diversity_stats'
+SITE_COVARIANCE = 'site_covariance'
+SITE_STATS = 'site_stats'
+SPECIES_COVARIANCE = 'species_covariance'
+SPECIES_STATS = 'species_stats'
+MCPA_OBSERVED = 'mcpa_observed'
+MCPA_F_VALUES = 'mcpa_f_values'
+
+STAT_KEYS = [
+    DIVERSITY_STATS, SITE_COVARIANCE, SITE_STATS, SPECIES_COVARIANCE,
+    SPECIES_STATS, MCPA_OBSERVED, MCPA_F_VALUES]
+
+# Depth headers for summary matrices.  The permutation and exceedance layers
+#    let a PValueAccumulator merge summaries directly.
+SUMMARY_PERMUTATIONS = PERMUTATIONS_HEADER
+SUMMARY_MEAN = 'Mean'
+SUMMARY_VARIANCE = 'Variance'
+SUMMARY_EXCEEDANCES = EXCEEDANCES_HEADER
+
+# Note: Worker processes keep the inputs shared by all permutations here
+_WORKER_INPUTS = {}
+
+
+# .............................................................................
+class RunningStatistics(PValueAccumulator):
+    """Accumulates the mean, variance and exceedance counts of permuted values
+
+    Values are added one permutation at a time using Welford's algorithm so
+    that the individual permuted matrices do not need to be retained.
+    Exceedances and the number of permutations are counted by
+    PValueAccumulator.
+    """
+
+    # ...........................
+    def __init__(self, observed=None, compare_func=compare_absolute_values):
+        """Constructor
+
+        Args:
+            observed (:obj: `Matrix`): If provided, count the number of
+                permutations where a cell value exceeds the observed value.
+            compare_func (:obj: `function`): A function that, when given the
+                observed and permuted values, returns True where the permuted
+                value exceeds the observed.
+        """
+        if observed is not None:
+            super(RunningStatistics, self).__init__(
+                _as_layer(observed), compare_func=compare_func)
+        else:
+            # Only the mean and variance are accumulated
+            self.observed = None
+            self.compare_func = compare_func
+            self.exceedances = None
+            self.num_permutations = 0
+        self.headers = None
+        self.mean = None
+        self.m_2 = None
+
+    # ...........................
+    @classmethod
+    def from_summary_matrix(cls, summary_mtx):
+        """Creates an accumulator from a summary matrix
+
+        Args:
+            summary_mtx (:obj: `Matrix`): A summary matrix produced by
+                `get_summary_matrix`.
+        """
+        layer_headers = summary_mtx.headers['2']
+        stats = cls()
+        stats.headers = {
+            key: summary_mtx.headers[key] for key in ['0', '1']
+            if key in summary_mtx.headers}
+        data = np.asarray(summary_mtx)
+        stats.num_permutations = int(
+            data[..., layer_headers.index(SUMMARY_PERMUTATIONS)].flat[0])
+        stats.mean = data[..., layer_headers.index(SUMMARY_MEAN)].copy()
+        stats.m_2 = data[..., layer_headers.index(SUMMARY_VARIANCE)] * max(
+            stats.num_permutations - 1, 0)
+        if SUMMARY_EXCEEDANCES in layer_headers:
+            stats.exceedances = data[
+                ..., layer_headers.index(SUMMARY_EXCEEDANCES)].copy()
+        return stats
+
+    # ...........................
+    def add(self, values, headers=None):
+        """Adds the values from one permutation
+
+        Args:
+            values (:obj: `Matrix`): The statistic values for a permutation.
+            headers (:obj: `dict`): Optional headers for the values, used if
+                values is a plain numpy array.
+        """
+        if headers is None:
+            headers = getattr(values, 'headers', None)
+        values = _as_layer(values)
+        if self.mean is None:
+            self.headers = headers
+            self.mean = np.zeros(values.shape)
+            self.m_2 = np.zeros(values.shape)
+        if self.observed is not None:
+            super(RunningStatistics, self).add(values)
+        else:
+            self.num_permutations += 1
+        delta = values - self.mean
+        self.mean += delta / self.num_permutations
+        self.m_2 += delta * (values - self.mean)
+
+    # ...........................
+    def get_summary_matrix(self):
+        """Gets a Matrix summarizing the permutations
+
+        Returns:
+            Matrix: A matrix with the same rows and columns as the statistic
+                and depth layers for the number of permutations, the mean, the
+                variance, and (if observed values were provided) the number of
+                exceedances.
+        """
+        layers = [
+            np.full(self.mean.shape, float(self.num_permutations)), self.mean,
+            self.get_variance()]
+        layer_headers = [
+            SUMMARY_PERMUTATIONS, SUMMARY_MEAN, SUMMARY_VARIANCE]
+        if self.exceedances is not None:
+            layers.append(self.exceedances)
+            layer_headers.append(SUMMARY_EXCEEDANCES)
+        headers = {}
+        if self.headers is not None:
+            headers = {
+                key: self.headers[key] for key in ['0', '1']
+                if key in self.headers}
+        headers['2'] = layer_headers
+        return Matrix(np.stack(layers, axis=2), headers=headers)
+
+    # ...........................
+    def get_variance(self):
+        """Gets the sample variance of the permuted values
+        """
+        if self.num_permutations < 2:
+            return np.zeros(self.mean.shape)
+        return self.m_2 / (self.num_permutations - 1)
+
+    # ...........................
+    def merge(self, other):
+        """Merges the permutations from another accumulator into this one
+
+        Args:
+            other (:obj: `RunningStatistics`): Another accumulator for the same
+                statistic.
+        """
+        if other.num_permutations == 0:
+            return
+        if self.num_permutations == 0:
+            self.headers = other.headers
+            self.num_permutations = other.num_permutations
+            self.mean = other.mean.copy()
+            self.m_2 = other.m_2.copy()
+            if other.exceedances is not None:
+                self.exceedances = other.exceedances.copy()
+            return
+        total = self.num_permutations + other.num_permutations
+        delta = other.mean - self.mean
+        self.m_2 = self.m_2 + other.m_2 + delta ** 2 * (
+            self.num_permutations * other.num_permutations / total)
+        self.mean = self.mean + delta * (other.num_permutations / total)
+        if self.exceedances is not None and other.exceedances is not None:
+            super(RunningStatistics, self).merge(other)
+        else:
+            self.exceedances = None
+            self.num_permutations = total
+
+
+# .............................................................................
+def _as_layer(mtx):
+    """Gets a statistic matrix as a two-dimensional float array
+
+    Args:
+        mtx (:obj: `Matrix`): A statistic matrix.  MCPA outputs have a single
+            depth layer that is removed.
+    """
+    data = np.asarray(mtx, dtype=float)
+    if data.ndim == 3 and data.shape[2] == 1:
+        data = data[:, :, 0]
+    return data
+
+
+# .............................................................................
+def _init_worker(inputs):
+    """Stores the inputs shared by all permutations in a worker process
+
+    Args:
+        inputs (:obj: `dict`): The PAM, statistic keys, and optional tree and
+            MCPA inputs.  The tree is passed as a NEXUS string.
+    """
+    _WORKER_INPUTS.update(inputs)
+    if inputs.get('tree') is not None:
+        _WORKER_INPUTS['tree'] = TreeWrapper.get(
+            data=inputs['tree'], schema='nexus')
+
+
+# .............................................................................
+def _run_permutation(seed):
+    """Randomizes the PAM using the seed and computes the statistics
+
+    Args:
+        seed (:obj: `int`): The random seed for this permutation.
+
+    Note:
+        * Matrix headers are returned separately from the data so that they
+            survive being sent back to the parent process.
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+    pam = _WORKER_INPUTS['pam']
+    # Randomization needs a Matrix, the PAM is kept packed between permutations
+    if isinstance(pam, PackedPam):
+        pam = pam.to_matrix()
+    i_pam = grady_randomize(pam)
+    stats = compute_statistics(
+        i_pam, _WORKER_INPUTS['stat_keys'], tree=_WORKER_INPUTS.get('tree'),
+        tree_mtx=_WORKER_INPUTS.get('tree_mtx'),
+        grim=_WORKER_INPUTS.get('grim'),
+        biogeo=_WORKER_INPUTS.get('biogeo'),
+        mcpa_method=_WORKER_INPUTS.get('mcpa_method', mcpa))
+    return {
+        key: (np.asarray(mtx), getattr(mtx, 'headers', None))
+        for key, mtx in stats.items()}
+
+
+# .............................................................................
+def compute_statistics(pam, stat_keys, tree=None, tree_mtx=None, grim=None,
+                       biogeo=None, mcpa_method=mcpa):
+    """Computes the requested multi-species statistics for a PAM
+
+    Args:
+        pam (:obj: `Matrix` or `PackedPam`): The PAM to compute statistics
+            for.
+        stat_keys (:obj: `list`): A list of statistic keys to compute.
+        tree (:obj: `TreeWrapper`): A tree to use for PAM stats.
+        tree_mtx (:obj: `Matrix` or `SparsePhyloMatrix`): An encoded
+            phylogenetic tree for MCPA.
+        grim (:obj: `Matrix`): A matrix of environment values for MCPA.
+        biogeo (:obj: `Matrix`): A matrix of biogeographic hypotheses for MCPA.
+        mcpa_method (:obj: `function`): The MCPA function to use.
+
+    Returns:
+        dict: A dictionary of statistic key to Matrix.
+    """
+    stats = {}
+    if set(stat_keys) & set(STAT_KEYS[:5]):
+        multi_stats = PamStats(pam, tree=tree)
+        # If we want either covariance matrix, calculate them both.  Do this
+        #    before the diversity statistics so the C-score can reuse the
+        #    species co-occurrence matrix
+        if SITE_COVARIANCE in stat_keys or SPECIES_COVARIANCE in stat_keys:
+            site_c, species_c = multi_stats.get_covariance_matrices()
+            if SITE_COVARIANCE in stat_keys:
+                stats[SITE_COVARIANCE] = site_c
+            if SPECIES_COVARIANCE in stat_keys:
+                stats[SPECIES_COVARIANCE] = species_c
+        if DIVERSITY_STATS in stat_keys:
+            stats[DIVERSITY_STATS] = multi_stats.get_diversity_statistics()
+        if SITE_STATS in stat_keys:
+            stats[SITE_STATS] = multi_stats.get_site_statistics()
+        if SPECIES_STATS in stat_keys:
+            stats[SPECIES_STATS] = multi_stats.get_species_statistics()
+    if MCPA_OBSERVED in stat_keys or MCPA_F_VALUES in stat_keys:
+        if isinstance(pam, PackedPam):
+            pam = pam.to_matrix()
+        mcpa_out, f_mtx = mcpa_method(pam, tree_mtx, grim, biogeo)
+        if MCPA_OBSERVED in stat_keys:
+            stats[MCPA_OBSERVED] = mcpa_out
+        if MCPA_F_VALUES in stat_keys:
+            stats[MCPA_F_VALUES] = f_mtx
+    return stats
+
+
+# .............................................................................
+def get_permutation_seed(base_seed, permutation_index):
+    """Gets the random seed for a permutation
+
+    Args:
+        base_seed (:obj: `int`): The base seed for a set of permutations.
+        permutation_index (:obj: `int`): The index of the permutation.
+
+    Returns:
+        int: A 32-bit seed that only depends on the two inputs.
+    """
+    return int(np.random.SeedSequence(
+        [base_seed, permutation_index]).generate_state(1)[0])
+
+
+# .............................................................................
+def iterate_permutations(pam, stat_keys, num_permutations, base_seed,
+                         first_permutation=0, max_workers=None, tree=None,
+                         tree_mtx=None, grim=None, biogeo=None,
+                         mcpa_method=mcpa):
+    """Generates the statistics of permuted PAMs computed in a process pool
+
+    Args:
+        pam (:obj: `Matrix` or `PackedPam`): The PAM to randomize.
+        stat_keys (:obj: `list`): A list of statistic keys to compute.
+        num_permutations (:obj: `int`): The number of permutations to perform.
+        base_seed (:obj: `int`): The base random seed for the permutations.
+        first_permutation (:obj: `int`): The index of the first permutation.
+        max_workers (:obj: `int`): The number of worker processes, defaults to
+            the number of CPUs.  If 1, permutations are run in this process.
+        tree (:obj: `TreeWrapper`): A tree to use for PAM stats.
+        tree_mtx (:obj: `Matrix` or `SparsePhyloMatrix`): An encoded
+            phylogenetic tree for MCPA.
+        grim (:obj: `Matrix`): A matrix of environment values for MCPA.
+        biogeo (:obj: `Matrix`): A matrix of biogeographic hypotheses for MCPA.
+        mcpa_method (:obj: `function`): The MCPA function to use.  This should
+            not be one that creates its own process pool.
+
+    Yields:
+        dict: A dictionary of statistic key to Matrix for each permutation, in
+            permutation order.
+    """
+    inputs = {
+        'pam': pam,
+        'stat_keys': stat_keys,
+        'tree': None,
+        'tree_mtx': tree_mtx,
+        'grim': grim,
+        'biogeo': biogeo,
+        'mcpa_method': mcpa_method
+    }
+    if tree is not None:
+        inputs['tree'] = tree.as_string(schema='nexus')
+    seeds = [
+        get_permutation_seed(base_seed, i) for i in range(
+            first_permutation, first_permutation + num_permutations)]
+
+    if max_workers == 1:
+        _init_worker(inputs)
+        results = map(_run_permutation, seeds)
+        for stats in results:
+            yield {key: Matrix(data, headers=headers)
+                   for key, (data, headers) in stats.items()}
+    else:
+        with ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker,
+                initargs=(inputs,)) as executor:
+            for stats in executor.map(_run_permutation, seeds):
+                yield {key: Matrix(data, headers=headers)
+                       for key, (data, headers) in stats.items()}
+
+
+# .............................................................................
+def run_permutations(pam, stat_keys, num_permutations, base_seed,
+                     observed=None, compare_func=compare_absolute_values,
+                     **kwargs):
+    """Runs permutations, streaming their statistics into accumulators
+
+    Args:
+        pam (:obj: `Matrix` or `PackedPam`): The PAM to randomize.
+        stat_keys (:obj: `list`): A list of statistic keys to compute.
+        num_permutations (:obj: `int`): The number of permutations to perform.
+        base_seed (:obj: `int`): The base random seed for the permutations.
+        observed (:obj: `dict`): An optional dictionary of statistic key to
+            observed Matrix.  Exceedances are counted for these statistics.
+        compare_func (:obj: `function`): A function that returns True where
+            the permuted value exceeds the observed.
+        **kwargs: Additional keyword arguments for `iterate_permutations`.
+
+    Returns:
+        dict: A dictionary of statistic key to RunningStatistics.
+    """
+    if observed is None:
+        observed = {}
+    accumulators = {
+        key: RunningStatistics(
+            observed=observed.get(key), compare_func=compare_func)
+        for key in stat_keys}
+    for stats in iterate_permutations(
+            pam, stat_keys, num_permutations, base_seed, **kwargs):
+        for key, mtx in stats.items():
+            accumulators[key].add(mtx)
+    return accumulators
@@ -0,0 +1,129 @@
+"""Tests for the running permutation accumulators in permutation.py
+"""
+import numpy as np
+
+from lmpy import Matrix
+
+from LmCommon.statistics.permutation_testing import (
+    compare_absolute_values, PValueAccumulator)
+from LmCompute.plugins.multi.permutation.permutation import (
+    get_permutation_seed, RunningStatistics, SUMMARY_EXCEEDANCES,
+    SUMMARY_MEAN, SUMMARY_PERMUTATIONS, SUMMARY_VARIANCE)
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+NUM_ROWS = 6
+NUM_COLS = 4
+NUM_PERMUTATIONS = 25
+ROW_HEADERS = ['site_{}'.format(i) for i in range(NUM_ROWS)]
+COL_HEADERS = ['stat_{}'.format(j) for j in range(NUM_COLS)]
+
+
+# .............................................................................
+def _get_permuted_values(seed=42):
+    """Gets an observed matrix and a list of permuted value matrices"""
+    rand_state = np.random.RandomState(seed)
+    headers = {'0': ROW_HEADERS, '1': COL_HEADERS}
+    observed = Matrix(
+        rand_state.normal(size=(NUM_ROWS, NUM_COLS)), headers=headers)
+    permuted = [
+        Matrix(rand_state.normal(size=(NUM_ROWS, NUM_COLS)), headers=headers)
+        for _ in range(NUM_PERMUTATIONS)]
+    return observed, permuted
+
+
+# .............................................................................
+def _accumulate(permuted, observed=None):
+    """Adds permuted values to a new RunningStatistics"""
+    stats = RunningStatistics(observed=observed)
+    for values in permuted:
+        stats.add(values)
+    return stats
+
+
+# .............................................................................
+def test_running_statistics_counts():
+    """Mean, variance and exceedance counts match the retained values"""
+    observed, permuted = _get_permuted_values()
+    stats = _accumulate(permuted, observed=observed)
+    stack = np.stack([np.asarray(values) for values in permuted], axis=2)
+
+    assert stats.num_permutations == NUM_PERMUTATIONS
+    assert np.allclose(stats.mean, stack.mean(axis=2))
+    assert np.allclose(stats.get_variance(), stack.var(axis=2, ddof=1))
+    assert np.array_equal(
+        stats.exceedances,
+        compare_absolute_values(
+            np.asarray(observed)[:, :, np.newaxis], stack).sum(axis=2))
+
+
+# .............................................................................
+def test_running_statistics_merge():
+    """Merging split runs gives the same summary as one run"""
+    observed, permuted = _get_permuted_values()
+    whole = _accumulate(permuted, observed=observed)
+
+    merged = _accumulate(permuted[:10], observed=observed)
+    merged.merge(_accumulate(permuted[10:], observed=observed))
+    assert merged.num_permutations == NUM_PERMUTATIONS
+    assert np.allclose(merged.mean, whole.mean)
+    assert np.allclose(merged.get_variance(), whole.get_variance())
+    assert np.array_equal(merged.exceedances, whole.exceedances)
+
+    # Merging into, or from, an empty accumulator copies the other one
+    empty = RunningStatistics(observed=observed)
+    empty.merge(whole)
+    assert empty.num_permutations == NUM_PERMUTATIONS
+    assert np.allclose(empty.mean, whole.mean)
+    whole.merge(RunningStatistics(observed=observed))
+    assert whole.num_permutations == NUM_PERMUTATIONS
+
+
+# .............................................................................
+def test_running_statistics_without_observed():
+    """Without observed values only the mean and variance are kept"""
+    _, permuted = _get_permuted_values()
+    stats = _accumulate(permuted[:10])
+    stats.merge(_accumulate(permuted[10:]))
+    summary = stats.get_summary_matrix()
+    assert summary.headers['2'] == [
+        SUMMARY_PERMUTATIONS, SUMMARY_MEAN, SUMMARY_VARIANCE]
+    assert stats.exceedances is None
+    assert stats.num_permutations == NUM_PERMUTATIONS
+
+
+# .............................................................................
+def test_summary_matrix_round_trip():
+    """A summary matrix can be read back and merged by p-value counting"""
+    observed, permuted = _get_permuted_values()
+    stats = _accumulate(permuted, observed=observed)
+    summary = stats.get_summary_matrix()
+    assert summary.headers['0'] == ROW_HEADERS
+    assert summary.headers['1'] == COL_HEADERS
+    assert summary.headers['2'] == [
+        SUMMARY_PERMUTATIONS, SUMMARY_MEAN, SUMMARY_VARIANCE,
+        SUMMARY_EXCEEDANCES]
+
+    read_stats = RunningStatistics.from_summary_matrix(summary)
+    assert read_stats.num_permutations == NUM_PERMUTATIONS
+    assert np.allclose(read_stats.mean, stats.mean)
+    assert np.allclose(read_stats.get_variance(), stats.get_variance())
+    assert np.array_equal(read_stats.exceedances, stats.exceedances)
+
+    # Summaries carry the counts a p-value accumulator needs
+    accumulator = PValueAccumulator(observed)
+    accumulator.add(summary)
+    accumulator.add(summary)
+    assert accumulator.num_permutations == 2 * NUM_PERMUTATIONS
+    assert np.array_equal(accumulator.exceedances, 2 * stats.exceedances)
+
+
+# .............................................................................
+def test_permutation_seeds():
+    """Seeds only depend on the base seed and the permutation index"""
+    seeds = [get_permutation_seed(7, i) for i in range(100)]
+    assert seeds == [get_permutation_seed(7, i) for i in range(100)]
+    assert len(set(seeds)) == len(seeds)
+    assert seeds != [get_permutation_seed(8, i) for i in range(100)]
+    assert all(0 <= seed < 2 ** 32 for seed in seeds)
@@ -0,0 +1,88 @@
+"""Module for sharing input matrices with pools of worker processes
+
+Input arrays are copied into shared memory blocks once by the parent process
+and attached by each worker in its pool initializer, so that tasks only pass
+small arguments and results instead of pickling the inputs for every worker.
+"""
+from multiprocessing import shared_memory, util
+
+import numpy as np
+
+
+# .............................................................................
+def _detach_shared_matrices(worker_mtxs, shared_blocks):
+    """Closes the shared memory blocks attached in a worker process
+
+    Args:
+        worker_mtxs (dict): The dictionary holding the attached arrays.
+        shared_blocks (list): The attached SharedMemory blocks.
+    """
+    # Drop the array views first, a block cannot close while they exist
+    worker_mtxs.clear()
+    for shm in shared_blocks:
+        shm.close()
+
+
+# .............................................................................
+def attach_shared_matrices(matrix_specs, worker_mtxs):
+    """Attaches shared matrices in a worker process
+
+    The blocks are closed when the worker exits.  This uses a multiprocessing
+    finalizer because forked workers exit without running atexit hooks.
+
+    Args:
+        matrix_specs (dict): A dictionary of matrix key to a tuple of shared
+            memory block name, array shape, and dtype string, as returned by
+            `share_matrices`.
+        worker_mtxs (dict): A dictionary that the attached arrays are added
+            to.  It is cleared when the worker exits.
+    """
+    shared_blocks = []
+    for key, (shm_name, shape, dtype) in matrix_specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shared_blocks.append(shm)
+        worker_mtxs[key] = np.ndarray(
+            shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    util.Finalize(
+        None, _detach_shared_matrices, args=(worker_mtxs, shared_blocks),
+        exitpriority=10)
+
+
+# .............................................................................
+def release_shared_matrices(shared_blocks):
+    """Closes and removes shared memory blocks created by `share_matrices`
+
+    Args:
+        shared_blocks (list): A list of SharedMemory blocks.
+    """
+    for shm in shared_blocks:
+        shm.close()
+        shm.unlink()
+
+
+# .............................................................................
+def share_matrices(mtxs):
+    """Copies numpy arrays into new shared memory blocks
+
+    Args:
+        mtxs (dict): A dictionary of matrix key to numpy array.
+
+    Returns:
+        tuple: A list of the SharedMemory blocks, which the caller must release
+            with `release_shared_matrices`, and a dictionary of matrix key to
+            (block name, shape, dtype string) for `attach_shared_matrices`.
+    """
+    shared_blocks = []
+    matrix_specs = {}
+    try:
+        for key, mtx in mtxs.items():
+            mtx = np.asarray(mtx)
+            shm = shared_memory.SharedMemory(
+                create=True, size=max(mtx.nbytes, 1))
+            shared_blocks.append(shm)
+            np.ndarray(mtx.shape, dtype=mtx.dtype, buffer=shm.buf)[...] = mtx
+            matrix_specs[key] = (shm.name, mtx.shape, mtx.dtype.str)
+    except Exception:
+        release_shared_matrices(shared_blocks)
+        raise
+    return shared_blocks, matrix_specs
@@ -1,5 +1,6 @@
 """Tools for creating masks
 """
+from collections import OrderedDict
 import math
 import os
 
@@ -13,6 +14,102 @@ from LmCommon.common.ready_file import ready_filename
 # TODO: Move to constants probably
 NUM_QUAD_SEGS = 30
 
+# Note: The number of decoded region layers each worker process keeps so that
+#    masks for a batch of species reuse the same region layer
+REGION_CACHE_SIZE = 4
+
+# Note: Decoded region layers, keyed by file path, modification time, and size
+_REGION_LAYERS = OrderedDict()
+
+
+# .............................................................................
+def _get_window(geometry, bbox, cell_size, num_cols, num_rows):
+    """Gets the raster window covering the envelope of a geometry
+
+    Args:
+        geometry: An OGR geometry in the map units of the raster
+        bbox: (minx, miny, maxx, maxy) tuple of raster coordinates
+        cell_size: The cell size, in map units, of each cell in the raster
+        num_cols: The number of columns in the raster
+        num_rows: The number of rows in the raster
+
+    Returns:
+        A (first column, first row, last column + 1, last row + 1) tuple
+    """
+    min_x, _, _, max_y = bbox
+    env_min_x, env_max_x, env_min_y, env_max_y = geometry.GetEnvelope()
+    col_start = max(0, int(math.floor((env_min_x - min_x) / cell_size)))
+    col_stop = min(num_cols, int(math.ceil((env_max_x - min_x) / cell_size)))
+    row_start = max(0, int(math.floor((max_y - env_max_y) / cell_size)))
+    row_stop = min(num_rows, int(math.ceil((max_y - env_min_y) / cell_size)))
+    return (col_start, row_start, max(col_start, col_stop),
+            max(row_start, row_stop))
+
+
+# .............................................................................
+def _rasterize_geometry(geometry, min_x, max_y, cell_size, num_cols,
+                        num_rows):
+    """Rasterizes a polygon in memory
+
+    Args:
+        geometry: An OGR polygon geometry
+        min_x: The x coordinate of the left edge of the raster
+        max_y: The y coordinate of the top edge of the raster
+        cell_size: The cell size, in map units, of each cell in the raster
+        num_cols: The number of columns in the raster
+        num_rows: The number of rows in the raster
+
+    Returns:
+        A numpy array with ones in the cells whose centers are in the polygon
+    """
+    if num_cols == 0 or num_rows == 0:
+        return np.zeros((num_rows, num_cols), dtype=np.int16)
+
+    vector_ds = ogr.GetDriverByName('Memory').CreateDataSource('convex_hull')
+    vector_lyr = vector_ds.CreateLayer('convex_hull', geom_type=ogr.wkbPolygon)
+    feat = ogr.Feature(vector_lyr.GetLayerDefn())
+    feat.SetGeometry(geometry)
+    vector_lyr.CreateFeature(feat)
+    feat = None
+
+    raster_ds = gdal.GetDriverByName('MEM').Create(
+        '', num_cols, num_rows, 1, gdalconst.GDT_Int16)
+    raster_ds.SetGeoTransform([min_x, cell_size, 0, max_y, 0, -cell_size])
+    gdal.RasterizeLayer(raster_ds, [1], vector_lyr, burn_values=[1])
+
+    data = raster_ds.GetRasterBand(1).ReadAsArray()
+    raster_ds = vector_lyr = vector_ds = None
+    return data
+
+
+# .............................................................................
+def get_region_layer(region_layer_filename):
+    """Gets a decoded region layer, reading it only if it is not cached
+
+    Args:
+        region_layer_filename: File location of the region raster file
+
+    Returns:
+        A tuple of the (read only) region data array, bounding box, cell size,
+        and EPSG code of the region layer
+    """
+    file_stat = os.stat(region_layer_filename)
+    key = (os.path.abspath(region_layer_filename), file_stat.st_mtime,
+           file_stat.st_size)
+    if key in _REGION_LAYERS:
+        _REGION_LAYERS.move_to_end(key)
+    else:
+        bbox, cell_size, epsg = get_layer_dimensions(region_layer_filename)
+        region_ds = gdal.Open(region_layer_filename)
+        data = region_ds.GetRasterBand(1).ReadAsArray()
+        region_ds = None
+        data.flags.writeable = False
+
+        _REGION_LAYERS[key] = (data, bbox, cell_size, epsg)
+        while len(_REGION_LAYERS) > REGION_CACHE_SIZE:
+            _REGION_LAYERS.popitem(last=False)
+    return _REGION_LAYERS[key]
+
 
 # .............................................................................
 def create_convex_hull_region_intersect_mask(
@@ -22,7 +119,10 @@ def create_convex_hull_region_intersect_mask(
 
     Args:
         occ_shp_filename: File location of occurrence set shapefile
+        mask_path: Unused, kept for compatibility, no temporary files are
+            written
         region_layer_filename: File location of ecoregions raster file
+        buffer_distance: The distance to buffer the convex hull
         nodata: A value to use for NODATA
         ascii_filename: If provided, write the mask raster as ASCII to this
             location
@@ -45,45 +145,43 @@ def create_convex_hull_region_intersect_mask(
 
     pts_lyr = points_ds = None
 
-    bbox, cell_size, epsg = get_layer_dimensions(region_layer_filename)
+    data, bbox, cell_size, epsg = get_region_layer(region_layer_filename)
     min_x, _, _, max_y = bbox
-
-    region_ds = gdal.Open(region_layer_filename)
-    band = region_ds.GetRasterBand(1)
-
-    cols = region_ds.RasterXSize
-    rows = region_ds.RasterYSize
-
-    data = band.ReadAsArray(0, 0, cols, rows)
+    rows, cols = data.shape
 
     # Get layer values for the points
-    vals = set([])
-    for x_coord, y_coord in pts:
-        col = int((x_coord - min_x) / cell_size)
-        row = int((max_y - y_coord) / cell_size)
-        try:
-            vals.add(data[row][col])
-        except Exception:
-            pass
-
-    list_vals = list(vals)
-    if len(list_vals) == 0:
+    pts = np.array(pts, dtype=float).reshape((-1, 2))
+    pt_cols = ((pts[:, 0] - min_x) / cell_size).astype(np.int64)
+    pt_rows = ((max_y - pts[:, 1]) / cell_size).astype(np.int64)
+    in_layer = (pt_cols >= 0) & (pt_cols < cols) & (pt_rows >= 0) & (
+        pt_rows < rows)
+    vals = np.unique(data[pt_rows[in_layer], pt_cols[in_layer]])
+
+    if vals.size == 0:
         raise Exception('No intersection between points and raster')
-    new_data = nodata * np.ones(data.shape, dtype=np.int8)
+    # Note: The mask type is the smallest integer type holding NODATA
+    new_data = np.full(
+        data.shape, nodata,
+        dtype=np.promote_types(np.int8, np.min_scalar_type(nodata)))
 
     convex_hull_raw = geom_coll.ConvexHull()
     buffered_convex_hull = convex_hull_raw.Buffer(
         buffer_distance, NUM_QUAD_SEGS)
 
-    # Get convex hull array
-    con_hull_data = create_convex_hull_array(
-        mask_path, buffered_convex_hull, bbox, cell_size, epsg, nodata=nodata)
+    # Only the window of the region layer covered by the hull can be in the
+    #    mask, so rasterize and test region values in that window
+    col_start, row_start, col_stop, row_stop = _get_window(
+        buffered_convex_hull, bbox, cell_size, cols, rows)
+    con_hull_data = _rasterize_geometry(
+        buffered_convex_hull, min_x + col_start * cell_size,
+        max_y - row_start * cell_size, cell_size, col_stop - col_start,
+        row_stop - row_start)
 
     # Mask the layer to only regions that points fall within
-    for i in range(data.shape[0]):
-        for j in range(data.shape[1]):
-            if data[i, j] in list_vals and con_hull_data[i, j] == 1:
-                new_data[i, j] = 1
+    new_window = new_data[row_start:row_stop, col_start:col_stop]
+    new_window[np.isin(
+        data[row_start:row_stop, col_start:col_stop], vals) & (
+            con_hull_data == 1)] = 1
 
     if ascii_filename is not None:
         write_ascii(
@@ -100,73 +198,20 @@ def create_convex_hull_array(base_path, convex_hull, bbox, cell_size, epsg,
     """Create a numpy array containing the convex hull mask
 
     Args:
-        base_path: A base file path (w/o extension) to use for temp files
+        base_path: Unused, kept for compatibility, the convex hull is
+            rasterized in memory
         convex_hull: Convex hull geometry
         bbox: (minx, miny, maxx, maxy) tuple of raster coordinates
         cell_size: The cell size, in map units, of each cell in the raster
-        epsg: The epsg code of the map projection to use for this raster
-        nodata: A value to use for NODATA
+        epsg: Unused, the raster is in the map units of the convex hull
+        nodata: Unused, cells outside of the convex hull are zero
     """
-    # Create a shapefile for the convex hull
-    # --------------------------------------
-    # Note: Must encode or gdal will fail
-    lyr_name = os.path.basename(base_path).encode(ENCODING)
-
-    tmp_shp_filename = '{}_convex_hull.shp'.format(base_path)
-    tmp_raster_filename = '{}_convex_hull.tif'.format(base_path)
-
-    print(tmp_raster_filename, tmp_shp_filename)
-
-    shp_drv = ogr.GetDriverByName(LMFormat.SHAPE.driver)
-
-    assert ready_filename(tmp_shp_filename, overwrite=True)
-
-    # Create the convex hull shapefile
-    out_ds = shp_drv.CreateDataSource(tmp_shp_filename)
-    out_lyr = out_ds.CreateLayer(
-        lyr_name.decode(ENCODING), geom_type=ogr.wkbPolygon)
-
-    # Add an ID field
-    id_field = ogr.FieldDefn('id', ogr.OFTInteger)
-    out_lyr.CreateField(id_field)
-
-    # Create the feature
-    feat_defn = out_lyr.GetLayerDefn()
-    feat = ogr.Feature(feat_defn)
-    feat.SetGeometry(convex_hull)
-    feat.SetField('id', 1)
-    out_lyr.CreateFeature(feat)
-    feat = None
-
-    # Rasterize the shapefile
-    # --------------------------------------
     minx, miny, maxx, maxy = bbox
     num_cols = int(math.ceil(float(maxx - minx) / cell_size))
     num_rows = int(math.ceil(float(maxy - miny) / cell_size))
 
-    tiff_drv = gdal.GetDriverByName(LMFormat.GTIFF.driver)
-    rst_ds = tiff_drv.Create(
-        tmp_raster_filename, num_cols, num_rows, 1, gdalconst.GDT_Int16)
-    rst_ds.SetGeoTransform([minx, cell_size, 0, maxy, 0, -cell_size])
-
-    srs = osr.SpatialReference()
-    srs.ImportFromEPSG(int(epsg))
-    rst_ds.SetProjection(srs.ExportToWkt())
-
-    gdal.RasterizeLayer(rst_ds, [1], out_lyr, burn_values=[1])
-
-    rst_ds.FlushCache()
-
-    out_ds = None
-    rst_ds = None
-
-    # Get the data array
-    # --------------------------------------
-    rst_ds = gdal.Open(tmp_raster_filename)
-    band = rst_ds.GetRasterBand(1)
-    data = np.array(band.ReadAsArray())
-
-    return data
+    return _rasterize_geometry(
+        convex_hull, minx, maxy, cell_size, num_cols, num_rows)
 
 
 # .............................................................................
@@ -0,0 +1,120 @@
+"""This script benchmarks the batched MCPA engine against the node by node one
+
+Random matrices are generated for the requested dimensions, both engines are
+run on them, and the run times and the largest difference between the outputs
+are reported.
+
+Note:
+    * The encoded tree is a random binary tree where each node has -1 / l for
+        the l tips in the left clade and 1 / r for the r tips in the right.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from LmCompute.plugins.multi.mcpa.mcpa import mcpa, mcpa_batched
+from lmpy import Matrix
+
+
+# .............................................................................
+def _random_phylo_matrix(num_species, rng):
+    """Generate a random encoded binary tree
+
+    Args:
+        num_species (int): The number of tips in the tree.
+        rng (numpy.random.Generator): The random number generator to use.
+
+    Returns:
+        Matrix: A (num_species by num_species - 1) encoded tree.
+    """
+    clades = [[i] for i in range(num_species)]
+    node_cols = []
+    while len(clades) > 1:
+        left_idx, right_idx = rng.choice(len(clades), 2, replace=False)
+        left, right = clades[left_idx], clades[right_idx]
+        col = np.zeros(num_species)
+        col[left] = -1.0 / len(left)
+        col[right] = 1.0 / len(right)
+        node_cols.append(col)
+        clades = [
+            clade for i, clade in enumerate(clades)
+            if i not in (left_idx, right_idx)]
+        clades.append(left + right)
+    return Matrix(
+        np.array(node_cols).T,
+        headers={
+            '0': ['Species {}'.format(i) for i in range(num_species)],
+            '1': ['Node {}'.format(i) for i in range(len(node_cols))]})
+
+
+# .............................................................................
+def main():
+    """Main method for script
+    """
+    parser = argparse.ArgumentParser(
+        description='Compare run times of the MCPA engines on random data')
+    parser.add_argument(
+        '-s', '--num_sites', type=int, default=1000,
+        help='The number of sites (rows) in the random PAM')
+    parser.add_argument(
+        '-k', '--num_species', type=int, default=100,
+        help='The number of species (columns) in the random PAM')
+    parser.add_argument(
+        '-e', '--num_env', type=int, default=5,
+        help='The number of environmental predictors')
+    parser.add_argument(
+        '-b', '--num_bg', type=int, default=3,
+        help='The number of biogeographic hypotheses')
+    parser.add_argument(
+        '-f', '--fill', type=float, default=0.2,
+        help='The proportion of the PAM that is filled with presences')
+    parser.add_argument(
+        '--node_batch_size', type=int, default=256,
+        help='The number of nodes solved together by the batched engine')
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help='A seed for the random number generator')
+    parser.add_argument(
+        '--skip_node_by_node', action='store_true',
+        help='Only time the batched engine (for inputs too big for the other)')
+
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    pam = Matrix(
+        (rng.random((args.num_sites, args.num_species)) < args.fill).astype(
+            int),
+        headers={
+            '0': ['Site {}'.format(i) for i in range(args.num_sites)],
+            '1': ['Species {}'.format(i) for i in range(args.num_species)]})
+    phylo_mtx = _random_phylo_matrix(args.num_species, rng)
+    env_mtx = Matrix(
+        rng.random((args.num_sites, args.num_env)),
+        headers={'1': ['Env {}'.format(i) for i in range(args.num_env)]})
+    bg_mtx = Matrix(
+        rng.choice([-1.0, 0.0, 1.0], (args.num_sites, args.num_bg)),
+        headers={'1': ['BG {}'.format(i) for i in range(args.num_bg)]})
+
+    start_time = time.time()
+    batched_obs, batched_f = mcpa_batched(
+        pam, phylo_mtx, env_mtx, bg_mtx,
+        node_batch_size=args.node_batch_size)
+    batched_time = time.time() - start_time
+    print('Batched MCPA: {:.3f} seconds'.format(batched_time))
+
+    if not args.skip_node_by_node:
+        start_time = time.time()
+        obs, f_vals = mcpa(pam, phylo_mtx, env_mtx, bg_mtx)
+        node_time = time.time() - start_time
+        print('Node by node MCPA: {:.3f} seconds'.format(node_time))
+        print('Speed up: {:.1f}x'.format(node_time / batched_time))
+        print('Max observed difference: {}'.format(
+            np.max(np.abs(obs - batched_obs))))
+        print('Max F-value difference: {}'.format(
+            np.max(np.abs(f_vals - batched_f))))
+
+
+# .............................................................................
+if __name__ == '__main__':
+    main()
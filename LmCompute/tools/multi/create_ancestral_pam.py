@@ -12,6 +12,7 @@ import argparse
 
 import numpy as np
 
+from LmCommon.compression.packed_pam import load_pam, PackedPam
 from lmpy import Matrix, PhyloTreeKeys, TreeWrapper
 
 # Local constants for this module
@@ -67,6 +68,19 @@ def _get_squids_in_clade(node):
     return clade_dict, all_squids
 
 
+# .............................................................................
+def _any_present(pam, col_idxs):
+    """Returns a binary site vector of where any of the columns are present
+
+    Args:
+        pam: A Matrix or PackedPam to check
+        col_idxs: A list of column indices to check
+    """
+    if isinstance(pam, PackedPam):
+        return pam.any_present(col_idxs).astype(int)
+    return np.any(pam[:, col_idxs], axis=1).astype(int)
+
+
 # .............................................................................
 def build_ancestral_pam(pam, tree):
     """Builds an ancestral PAM
@@ -76,7 +90,7 @@ def build_ancestral_pam(pam, tree):
     present (-1), both clades are present (2), or neither clade is present (0).
 
     Args:
-        pam: A PAM to use to build the ancestral PAM
+        pam: A PAM (Matrix or PackedPam) to use to build the ancestral PAM
         tree: An TreeWrapper object to use for phylogenetic information
 
     Note:
@@ -114,13 +128,13 @@ def build_ancestral_pam(pam, tree):
                          ] for squid in right_squids if squid in squid_lookup]
 
         # Get the left and right side (clades) binary column of presences
-        left_side = np.any(pam[:, left_idxs], axis=1).astype(int)
-        right_side = np.any(pam[:, right_idxs], axis=1).astype(int)
+        left_side = _any_present(pam, left_idxs)
+        right_side = _any_present(pam, right_idxs)
 
         # Build the column of quaternary values indicating which clade is
         #    present; a1 - a2 + 2*((a1+a2)/2)
         node_data[:, col] = left_side - right_side + 2 * (
-            (left_side + right_side) / 2).astype(np.int)
+            (left_side + right_side) / 2).astype(int)
 
         col += 1
 
@@ -149,7 +163,7 @@ def main():
     args = parser.parse_args()
 
     # Read in inputs
-    pam = Matrix.load(args.pam_fn)
+    pam = load_pam(args.pam_fn)
     tree = TreeWrapper.from_filename(args.tree_fn)
 
     # Build the Ancestral PAM
@@ -3,12 +3,15 @@
 Note:
     * If no indices mapping file is provided, assume that the tree already has
         matrix indices in it
+    * If the output file has the sparse matrix extension, the P matrix is
+        written in sparse form and is never built as a dense matrix
 
 Todo:
     * Remove or reinstate mashed potato parameter
 """
 import argparse
 
+from LmCommon.common.lmconstants import LMFormat
 from LmCommon.encoding.phylo import PhyloEncoding
 from lmpy import Matrix, TreeWrapper
 
@@ -46,7 +49,9 @@ def main():
 
     encoder = PhyloEncoding(tree, pam)
 
-    p_mtx = encoder.encode_phylogeny()
+    p_mtx = encoder.encode_phylogeny(
+        sparse_matrix=args.out_file_name.endswith(
+            LMFormat.SPARSE_MATRIX.ext))
 
     p_mtx.write(args.out_file_name)
 
@@ -29,25 +29,13 @@ def main():
 
     args = parser.parse_args()
 
-    # Load the matrices
-    test_values = []
-    num_values = 0
-
-    for f_val in args.f_value_filename:
-        test_mtx = Matrix.load(f_val)
-
-        # Add the values to the test values list
-        test_values.append(test_mtx)
-
-        # Add to the number of values
-        if test_mtx.ndim == 3:  # Stack of values
-            num_values += test_mtx.shape[2]
-        else:
-            num_values += 1
+    # Load the F-value matrices one at a time so that memory use does not
+    #    depend on the number of permutations
+    test_values = (
+        Matrix.load(f_val) for f_val in args.f_value_filename)
 
     obs_vals = Matrix.load(args.observed_filename)
-    p_values = get_p_values(obs_vals, test_values,
-                            num_permutations=num_values)
+    p_values = get_p_values(obs_vals, test_values)
 
     p_values.write(args.p_values_filename)
 
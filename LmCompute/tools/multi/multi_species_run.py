@@ -7,31 +7,63 @@ Todo:
         determine if they should be done
 """
 import argparse
+from functools import partial
 
-from LmCompute.plugins.multi.calculate.calculate import PamStats
-from LmCompute.plugins.multi.mcpa.mcpa import mcpa, mcpa_parallel
+import numpy as np
+
+from LmCommon.compression.packed_pam import load_pam
+from LmCommon.encoding.phylo import load_phylo_matrix
+from LmCommon.statistics.permutation_testing import (
+    compare_absolute_values, compare_signed_values)
+from LmCompute.plugins.multi.mcpa.mcpa import (
+    mcpa, mcpa_batched, mcpa_parallel, WORKER_MEMORY)
+from LmCompute.plugins.multi.permutation import permutation
 from lmpy import Matrix, TreeWrapper
-from lmpy.randomize.grady import grady_randomize
 from LmBackend.common.lmobj import LMError
 
+# Statistic keys in the order that do_runs returns them, with the script
+#    option for the output file of each.  Observed files use an 'observed_'
+#    prefix on the option.
+RUN_STATS = [
+    (permutation.DIVERSITY_STATS, 'diversity_stats_filename'),
+    (permutation.SITE_COVARIANCE, 'site_covariance_filename'),
+    (permutation.SITE_STATS, 'site_stats_filename'),
+    (permutation.SPECIES_COVARIANCE, 'species_covariance_filename'),
+    (permutation.SPECIES_STATS, 'species_stats_filename'),
+    (permutation.MCPA_OBSERVED, 'mcpa_output_matrix_filename'),
+    (permutation.MCPA_F_VALUES, 'mcpa_f_matrix_filename')]
+
 
 # .............................................................................
 def do_runs(pam, num_permutations, do_mcpa=False, tree=None, biogeo=None,
-            grim=None, tree_mtx=None, parallel=False, do_diversity_stats=False,
-            do_site_cov_stats=False, do_site_stats=True,
-            do_species_cov_stats=False, do_species_stats=True):
+            grim=None, tree_mtx=None, parallel=False, batched=False,
+            max_workers=None, worker_memory=WORKER_MEMORY,
+            do_diversity_stats=False, do_site_cov_stats=False,
+            do_site_stats=True, do_species_cov_stats=False,
+            do_species_stats=True, random_seed=None, first_permutation=0,
+            summarize=False, observed=None, use_abs=True):
     """Run multi-species analyses
 
     Args:
-        pam (:obj: `Matrix`): The PAM or incidence matrix to use for analysis
+        pam (:obj: `Matrix` or `PackedPam`): The PAM or incidence matrix to
+            use for analysis
         num_permutations (:obj: `int`): The number of permutations to perform,
             setting to zero performs an observed run
         do_mcpa (:obj: `bool`): Should MCPA be calculated
         tree (:obj: `Dendropy.Tree`): A tree instance to use for PAM stats
         biogeo (:obj: `Matrix`): A matrix of biogeographic hypotheses for MCPA
         grim (:obj: `Matrix`): A matrix of environment values for MCPA
-        tree_mtx (:obj: `Matrix`): An encoded phylogenetic tree for MCPA
-        parallel (:obj: `bool`): If true, use the parallel version of MCPA
+        tree_mtx (:obj: `Matrix` or `SparsePhyloMatrix`): An encoded
+            phylogenetic tree for MCPA
+        parallel (:obj: `bool`): If true, use the parallel version of MCPA.
+            This is only available for observed runs, permutations already
+            run in a process pool.
+        batched (:obj: `bool`): If true, use the batched version of MCPA that
+            solves many tree nodes at once
+        max_workers (:obj: `int`): The number of processes to use for
+            parallel MCPA and for permutations, defaults to the number of CPUs
+        worker_memory (:obj: `int`): The approximate number of bytes each
+            parallel MCPA process may use for temporary matrices
         do_diversity_stats (:obj: `bool`) : Should diversity stats be
             calculated
         do_site_cov_stats (:obj: `bool`) : Should site covariance stats be
@@ -40,84 +72,74 @@ def do_runs(pam, num_permutations, do_mcpa=False, tree=None, biogeo=None,
         do_species_cov_stats (:obj: `bool`) : Should species covariance stats
             be calculated
         do_species_stats (:obj: `bool`) : Should species stats be calculated
+        random_seed (:obj: `int`): The base random seed for permutations.  A
+            seed is chosen, and printed, if one is not provided.
+        first_permutation (:obj: `int`): The index of the first permutation,
+            used to give each group of permutations distinct seeds
+        summarize (:obj: `bool`): If true, stream permutations into running
+            accumulators and return one summary matrix for each statistic
+            instead of every permuted matrix
+        observed (:obj: `dict`): An optional dictionary of statistic key to
+            observed Matrix.  Summaries for these statistics include the number
+            of permutations exceeding the observed values.
+        use_abs (:obj: `bool`): If true, compare absolute values when counting
+            exceedances
     """
-    diversity_stats = []
-    site_cov_stats = []
-    site_stats = []
-    species_cov_stats = []
-    species_stats = []
-    mcpa_outs = []
-    mcpa_fs = []
-
-    # If any of the pam stats are True, this will evaluate to true
-    do_pam_stats = bool(
-        sum([
-            do_diversity_stats, do_site_cov_stats, do_site_stats,
-            do_species_cov_stats, do_species_stats]))
-
-    if parallel:
-        mcpa_method = mcpa_parallel
+    run_flags = [
+        do_diversity_stats, do_site_cov_stats, do_site_stats,
+        do_species_cov_stats, do_species_stats, do_mcpa, do_mcpa]
+    stat_keys = [
+        key for (key, _), flag in zip(RUN_STATS, run_flags) if flag]
+    outputs = {key: [] for key, _ in RUN_STATS}
+
+    if batched:
+        mcpa_method = mcpa_batched
+    elif parallel:
+        mcpa_method = partial(
+            mcpa_parallel, max_workers=max_workers,
+            worker_memory=worker_memory)
     else:
         mcpa_method = mcpa
 
+    mcpa_inputs = {
+        'tree': tree, 'tree_mtx': tree_mtx, 'grim': grim, 'biogeo': biogeo}
+
     if num_permutations >= 1:
-        for i in range(num_permutations):
-            print(('Iteration {}'.format(i)))
-            i_pam = grady_randomize(pam)
-            if do_pam_stats:
-                multi_stats = PamStats(i_pam, tree=tree)
-                # Append to diversity stats if we want them
-                if do_diversity_stats:
-                    diversity_stats.append(
-                        multi_stats.get_diversity_statistics())
-                # If we want either covariance matrix, calculate them both
-                if do_site_cov_stats or do_species_cov_stats:
-                    site_c, species_c = multi_stats.get_covariance_matrices()
-                    if do_site_cov_stats:
-                        site_cov_stats.append(site_c)
-                    if do_species_cov_stats:
-                        species_cov_stats.append(species_c)
-                # Site stats
-                if do_site_stats:
-                    site_stats.append(multi_stats.get_site_statistics())
-                # Species stats
-                if do_species_stats:
-                    species_stats.append(multi_stats.get_species_statistics())
-
-                multi_stats = None
-
-            if do_mcpa:
-                mcpa_out, f_mtx = mcpa_method(i_pam, tree_mtx, grim, biogeo)
-                mcpa_outs.append(mcpa_out)
-                mcpa_fs.append(f_mtx)
-            i_pam = None
+        if mcpa_method not in (mcpa, mcpa_batched):
+            raise LMError(
+                'Parallel MCPA cannot run in the permutation process pool, '
+                'use batched or serial MCPA for permuted runs')
+        if random_seed is None:
+            random_seed = int(np.random.SeedSequence().generate_state(1)[0])
+            print('Using random seed {}'.format(random_seed))
+
+        run_args = dict(
+            first_permutation=first_permutation, max_workers=max_workers,
+            mcpa_method=mcpa_method, **mcpa_inputs)
+        if summarize:
+            if use_abs:
+                compare_func = compare_absolute_values
+            else:
+                compare_func = compare_signed_values
+            accumulators = permutation.run_permutations(
+                pam, stat_keys, num_permutations, random_seed,
+                observed=observed, compare_func=compare_func, **run_args)
+            for key, stats in accumulators.items():
+                outputs[key].append(stats.get_summary_matrix())
+        else:
+            for i, stats in enumerate(permutation.iterate_permutations(
+                    pam, stat_keys, num_permutations, random_seed,
+                    **run_args)):
+                print(('Iteration {}'.format(first_permutation + i)))
+                for key, mtx in stats.items():
+                    outputs[key].append(mtx)
     else:
-        if do_pam_stats:
-            multi_stats = PamStats(pam, tree=tree)
-            # Append to diversity stats if we want them
-            if do_diversity_stats:
-                diversity_stats.append(multi_stats.get_diversity_statistics())
-            # If we want either covariance matrix, calculate them both
-            if do_site_cov_stats or do_species_cov_stats:
-                site_c, species_c = multi_stats.get_covariance_matrices()
-                if do_site_cov_stats:
-                    site_cov_stats.append(site_c)
-                if do_species_cov_stats:
-                    species_cov_stats.append(species_c)
-            # Site stats
-            if do_site_stats:
-                site_stats.append(multi_stats.get_site_statistics())
-            # Species stats
-            if do_species_stats:
-                species_stats.append(multi_stats.get_species_statistics())
-        if do_mcpa:
-            mcpa_out, f_mtx = mcpa_method(pam, tree_mtx, grim, biogeo)
-            mcpa_outs.append(mcpa_out)
-            mcpa_fs.append(f_mtx)
-
-    return (
-        diversity_stats, site_cov_stats, site_stats, species_cov_stats,
-        species_stats, mcpa_outs, mcpa_fs)
+        stats = permutation.compute_statistics(
+            pam, stat_keys, mcpa_method=mcpa_method, **mcpa_inputs)
+        for key, mtx in stats.items():
+            outputs[key].append(mtx)
+
+    return tuple(outputs[key] for key, _ in RUN_STATS)
 
 
 # .............................................................................
@@ -138,7 +160,21 @@ def main():
         help=('1 to perform MCPA, 0 to skip. '
               ' Must provide GRIM, BIOGEO, and TREE matrix to perform'))
     parser.add_argument(
-        '-p', '--parallel', action='store_true', help='Use parallelism')
+        '-p', '--parallel', action='store_true',
+        help='Use parallel MCPA, only available for observed runs')
+    parser.add_argument(
+        '--batched', action='store_true',
+        help='Use the batched MCPA engine that solves many nodes at once')
+    parser.add_argument(
+        '-w', '--max_workers', type=int,
+        help='The number of processes for parallel MCPA and permutations')
+    parser.add_argument(
+        '--worker_memory_mb', type=int,
+        help='The memory budget, in megabytes, for each parallel MCPA process')
+    parser.add_argument(
+        '--packed', action='store_true',
+        help=('Keep the PAM bit-packed in memory.  PAMs in packed matrix'
+              ' files are always loaded packed'))
     parser.add_argument(
         '-g', '--grim', type=str,
         help='The file location of the GRIM to use for MCPA')
@@ -177,9 +213,29 @@ def main():
         '--mcpa_f_matrix_filename', type=str,
         help='File location to store MCPA F-matrix')
 
+    # Permutation options
+    parser.add_argument(
+        '--random_seed', type=int,
+        help='The base random seed for permutations')
+    parser.add_argument(
+        '--first_permutation', type=int, default=0,
+        help='The index of the first permutation in this group')
+    parser.add_argument(
+        '--summarize', action='store_true',
+        help=('Write a summary matrix of permutation counts, means, variances'
+              ' and exceedances instead of every permuted matrix'))
+    parser.add_argument(
+        '--signed', action='store_true',
+        help='Compare signed, rather than absolute, values for exceedances')
+    for _, option in RUN_STATS:
+        parser.add_argument(
+            '--observed_{}'.format(option), type=str,
+            help=('Observed matrix to count exceedances against for'
+                  ' --{}'.format(option)))
+
     args = parser.parse_args()
 
-    pam = Matrix.load(args.pam_filename)
+    pam = load_pam(args.pam_filename, pack=args.packed)
     tree = None
     biogeo = None
     grim = None
@@ -191,7 +247,7 @@ def main():
         try:
             biogeo = Matrix.load(args.biogeo)
             grim = Matrix.load(args.grim)
-            tree_mtx = Matrix.load(args.tree_matrix)
+            tree_mtx = load_phylo_matrix(args.tree_matrix)
         except Exception as err:
             print((str(err)))
             msg = ('Cannot perform MCPA without PAM, Grim, Biogeo, '
@@ -199,16 +255,31 @@ def main():
             print(msg)
             raise LMError(msg, err)
 
+    worker_memory = WORKER_MEMORY
+    if args.worker_memory_mb is not None:
+        worker_memory = args.worker_memory_mb * 1024 ** 2
+
+    observed = {}
+    for key, option in RUN_STATS:
+        observed_filename = getattr(args, 'observed_{}'.format(option))
+        if observed_filename is not None:
+            observed[key] = Matrix.load(observed_filename)
+
     (diversity_stats, site_cov_stats, site_stats, species_cov_stats,
         species_stats, mcpa_outs, mcpa_fs) = do_runs(
             pam, args.num_permutations, do_mcpa=args.do_mcpa, tree=tree,
             biogeo=biogeo, grim=grim, tree_mtx=tree_mtx,
-            parallel=args.parallel,
+            parallel=args.parallel, batched=args.batched,
+            max_workers=args.max_workers, worker_memory=worker_memory,
             do_diversity_stats=args.diversity_stats_filename is not None,
             do_site_cov_stats=args.site_covariance_filename is not None,
             do_site_stats=args.site_stats_filename is not None,
             do_species_cov_stats=args.species_covariance_filename is not None,
-            do_species_stats=args.species_stats_filename is not None)
+            do_species_stats=args.species_stats_filename is not None,
+            random_seed=args.random_seed,
+            first_permutation=args.first_permutation,
+            summarize=args.summarize, observed=observed,
+            use_abs=not args.signed)
 
     # Write outputs if they are not empty lists
     # PAM stats - diversity
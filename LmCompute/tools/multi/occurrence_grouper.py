@@ -0,0 +1,374 @@
+"""Split CSV files of occurrence records into groups in a single pass
+
+This script replaces the bucketeer, sorter and splitter pipeline, which
+rewrites the data three times.  Records are streamed once from the input files
+into partition files chosen by a hash of the group field.  Each partition is
+then sorted on the group field and written as one file per group and / or as
+a sorted partition file with an index of the byte offset of each group, so
+that the records of a group can be read without per-group files.
+
+Note:
+    * Records for each partition are buffered and written in blocks, and at
+        most `max_open_files` partition files are open at a time.
+    * A partition is sorted in memory if it is smaller than `memory_limit`
+        bytes, otherwise it is sorted in runs that are merged.
+"""
+import argparse
+from collections import OrderedDict
+import contextlib
+import csv
+import heapq
+import io
+import itertools
+from operator import itemgetter
+import os
+import zlib
+
+from LmCommon.common.lmconstants import ENCODING
+
+DEFAULT_NUM_PARTITIONS = 256
+DEFAULT_MAX_OPEN_FILES = 64
+# Note: Partition records are buffered until this many characters, so the
+#    buffers hold up to num_partitions times this in memory
+PARTITION_BUFFER_SIZE = 256 * 1024
+DEFAULT_MEMORY_LIMIT = 512 * 1024 * 1024
+INDEX_HEADER = ['group', 'filename', 'offset', 'length', 'count']
+
+
+# .............................................................................
+class PartitionWriter:
+    """Buffered CSV writer for a set of partition files
+    """
+    # ................................
+    def __init__(self, filenames, max_open_files=DEFAULT_MAX_OPEN_FILES,
+                 buffer_size=PARTITION_BUFFER_SIZE):
+        """Constructor
+
+        Args:
+            filenames: A list of partition file names, files are truncated
+                when they are first written
+            max_open_files: The maximum number of files open at a time
+            buffer_size: Flush a partition buffer when it reaches this many
+                characters
+        """
+        self.filenames = filenames
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self._buffers = [io.StringIO() for _ in filenames]
+        self._writers = [csv.writer(buf) for buf in self._buffers]
+        # LRU cache of open files, keyed by partition index
+        self._files = OrderedDict()
+        self._started = set()
+
+    # ................................
+    def writerow(self, idx, row):
+        """Write a row to a partition
+        """
+        self._writers[idx].writerow(row)
+        if self._buffers[idx].tell() >= self.buffer_size:
+            self._flush(idx)
+
+    # ................................
+    def _flush(self, idx):
+        buf = self._buffers[idx]
+        out_file = self._files.pop(idx, None)
+        if out_file is None:
+            if len(self._files) >= self.max_open_files:
+                _, old_file = self._files.popitem(last=False)
+                old_file.close()
+            mode = 'a' if idx in self._started else 'w'
+            out_file = open(
+                self.filenames[idx], mode, encoding=ENCODING, newline='')
+            self._started.add(idx)
+        self._files[idx] = out_file
+        out_file.write(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+
+    # ................................
+    def close(self):
+        """Flush all buffers and close files, creating empty partitions
+        """
+        for idx in range(len(self.filenames)):
+            if idx not in self._started or self._buffers[idx].tell() > 0:
+                self._flush(idx)
+        for out_file in self._files.values():
+            out_file.close()
+        self._files.clear()
+
+
+# .............................................................................
+def _get_row_size(row):
+    """Estimate the memory size of a row from its number of characters
+    """
+    return sum(len(val) for val in row) + len(row)
+
+
+# .............................................................................
+def iterate_sorted_partition(partition_filename, group_position,
+                             memory_limit=DEFAULT_MEMORY_LIMIT):
+    """Generator yielding the rows of a partition file sorted on the group
+
+    Args:
+        partition_filename: The partition CSV file
+        group_position: The field to sort on
+        memory_limit: Partitions larger than this many bytes are sorted in
+            runs of about this size that are written to temporary files and
+            merged
+    """
+    key = itemgetter(group_position)
+    with open(partition_filename, 'r', encoding=ENCODING,
+              newline='') as in_file:
+        reader = csv.reader(in_file)
+        if os.path.getsize(partition_filename) <= memory_limit:
+            yield from sorted(reader, key=key)
+            return
+
+        # Spill sorted runs
+        run_filenames = []
+        rows = []
+        run_size = 0
+        for row in itertools.chain(reader, [None]):
+            if row is not None:
+                rows.append(row)
+                run_size += _get_row_size(row)
+            if rows and (row is None or run_size >= memory_limit):
+                run_filename = '{}.run{}'.format(
+                    partition_filename, len(run_filenames))
+                with open(run_filename, 'w', encoding=ENCODING,
+                          newline='') as run_file:
+                    csv.writer(run_file).writerows(sorted(rows, key=key))
+                run_filenames.append(run_filename)
+                rows = []
+                run_size = 0
+
+    try:
+        with contextlib.ExitStack() as stack:
+            readers = [
+                csv.reader(stack.enter_context(
+                    open(fn, 'r', encoding=ENCODING, newline='')))
+                for fn in run_filenames]
+            yield from heapq.merge(*readers, key=key)
+    finally:
+        for run_filename in run_filenames:
+            os.remove(run_filename)
+
+
+# .............................................................................
+def partition_records(input_filenames, partition_filenames, group_position,
+                      headers=False, max_open_files=DEFAULT_MAX_OPEN_FILES):
+    """Stream input records into partition files by a hash of the group
+
+    Args:
+        input_filenames: A list of CSV filenames of input data
+        partition_filenames: A list of partition filenames to write
+        group_position: The column in the CSV file to group on
+        headers: Do the input files have a header row
+        max_open_files: The maximum number of partition files open at a time
+
+    Returns:
+        int - The number of records skipped for missing a group value
+    """
+    num_partitions = len(partition_filenames)
+    partitions = {}
+    skipped = 0
+    writer = PartitionWriter(
+        partition_filenames, max_open_files=max_open_files)
+    try:
+        for filename in input_filenames:
+            with open(filename, 'r', encoding=ENCODING,
+                      newline='') as in_file:
+                reader = csv.reader(in_file)
+                if headers:
+                    next(reader, None)
+                for row in reader:
+                    try:
+                        group = row[group_position]
+                    except IndexError:
+                        skipped += 1
+                        continue
+                    idx = partitions.get(group)
+                    if idx is None:
+                        idx = zlib.crc32(
+                            group.encode(ENCODING)) % num_partitions
+                        partitions[group] = idx
+                    writer.writerow(idx, row)
+    finally:
+        writer.close()
+    return skipped
+
+
+# .............................................................................
+def group_records(input_filenames, out_dir, group_position,
+                  file_prefix='taxon_', headers=False, write_groups=True,
+                  index_filename=None, num_partitions=DEFAULT_NUM_PARTITIONS,
+                  max_open_files=DEFAULT_MAX_OPEN_FILES,
+                  memory_limit=DEFAULT_MEMORY_LIMIT):
+    """Split input files into groups on the specified field
+
+    Args:
+        input_filenames: A list of CSV filenames of input data
+        out_dir: The directory to store the output files
+        group_position: The field in the CSV to group / split on
+        file_prefix: The prefix of the output file names
+        headers: Do the input files have a header row
+        write_groups: Write a CSV file for each group
+        index_filename: If provided, keep the sorted partition files and
+            write an index of the file, byte offset, byte length and record
+            count of each group to this CSV file
+        num_partitions: The number of partitions to hash groups into
+        max_open_files: The maximum number of partition files open at a time
+        memory_limit: The size, in bytes, of the largest partition to sort
+            in memory
+
+    Returns:
+        int - The number of groups
+    """
+    partition_filenames = [
+        os.path.join(out_dir, '{}partition_{}.csv'.format(file_prefix, i))
+        for i in range(num_partitions)]
+    skipped = partition_records(
+        input_filenames, partition_filenames, group_position,
+        headers=headers, max_open_files=max_open_files)
+    if skipped:
+        print('Skipped {} records without a group value'.format(skipped))
+
+    num_groups = 0
+    with contextlib.ExitStack() as stack:
+        index_writer = None
+        if index_filename is not None:
+            index_writer = csv.writer(stack.enter_context(
+                open(index_filename, 'w', encoding=ENCODING, newline='')))
+            index_writer.writerow(INDEX_HEADER)
+
+        for partition_filename in partition_filenames:
+            sorted_filename = '{}.sorted'.format(partition_filename)
+            sorted_file = None
+            if index_writer is not None:
+                sorted_file = open(sorted_filename, 'wb')
+            try:
+                for group, rows in itertools.groupby(
+                        iterate_sorted_partition(
+                            partition_filename, group_position,
+                            memory_limit=memory_limit),
+                        key=itemgetter(group_position)):
+                    buf = io.StringIO()
+                    writer = csv.writer(buf)
+                    count = 0
+                    for row in rows:
+                        writer.writerow(row)
+                        count += 1
+                    data = buf.getvalue().encode(ENCODING)
+                    num_groups += 1
+
+                    if write_groups:
+                        with open(os.path.join(out_dir, '{}{}.csv'.format(
+                                file_prefix, group)), 'wb') as out_file:
+                            out_file.write(data)
+                    if sorted_file is not None:
+                        index_writer.writerow([
+                            group, os.path.basename(partition_filename),
+                            sorted_file.tell(), len(data), count])
+                        sorted_file.write(data)
+            finally:
+                if sorted_file is not None:
+                    sorted_file.close()
+            if sorted_file is not None:
+                os.replace(sorted_filename, partition_filename)
+            else:
+                os.remove(partition_filename)
+    return num_groups
+
+
+# .............................................................................
+def read_group_index(index_filename):
+    """Read a group index file
+
+    Returns:
+        dict - Group value keys with (data filename, offset, length, count)
+            values, data filenames are relative to the index file directory
+    """
+    index_dir = os.path.dirname(index_filename)
+    group_index = {}
+    with open(index_filename, 'r', encoding=ENCODING, newline='') as in_file:
+        reader = csv.reader(in_file)
+        next(reader, None)
+        for group, filename, offset, length, count in reader:
+            group_index[group] = (
+                os.path.join(index_dir, filename), int(offset), int(length),
+                int(count))
+    return group_index
+
+
+# .............................................................................
+def read_group_rows(index_entry):
+    """Read the rows of a group by seeking to its offset in the data file
+
+    Args:
+        index_entry: A (data filename, offset, length, count) tuple from
+            read_group_index
+    """
+    filename, offset, length, _ = index_entry
+    with open(filename, 'rb') as in_file:
+        in_file.seek(offset)
+        data = in_file.read(length).decode(ENCODING)
+    return list(csv.reader(io.StringIO(data, newline='')))
+
+
+# .............................................................................
+def main():
+    """Script main method
+    """
+    parser = argparse.ArgumentParser(
+        description=('This script takes in CSV input files and groups them '
+                     'in a single pass'))
+
+    parser.add_argument(
+        'group_position', type=int,
+        help='The position of the field to group on')
+    parser.add_argument(
+        'out_dir', type=str, help='Output directory to write files')
+    parser.add_argument(
+        'input_filename', type=str, nargs='+', help='Input CSV file')
+    parser.add_argument(
+        '-p', '--prefix', type=str, default='taxon_',
+        help='Prefix for output files')
+    parser.add_argument(
+        '-header', dest='header', action='store_true',
+        help='Do the input files have a header row')
+    parser.add_argument(
+        '-i', '--index_filename', type=str,
+        help=('Keep sorted partition files and write an index of the byte '
+              'offsets of each group to this file'))
+    parser.add_argument(
+        '--no_group_files', action='store_true',
+        help='Do not write a file for each group, requires an index file')
+    parser.add_argument(
+        '-n', '--num_partitions', type=int, default=DEFAULT_NUM_PARTITIONS,
+        help='The number of partitions to hash groups into')
+    parser.add_argument(
+        '--max_open_files', type=int, default=DEFAULT_MAX_OPEN_FILES,
+        help='The maximum number of partition files open at a time')
+    parser.add_argument(
+        '--memory_limit', type=int,
+        default=DEFAULT_MEMORY_LIMIT // (1024 * 1024),
+        help='Sort partitions up to this many megabytes in memory')
+
+    args = parser.parse_args()
+    if args.no_group_files and args.index_filename is None:
+        parser.error('--no_group_files requires an index file')
+
+    num_groups = group_records(
+        args.input_filename, args.out_dir, args.group_position,
+        file_prefix=args.prefix, headers=args.header,
+        write_groups=not args.no_group_files,
+        index_filename=args.index_filename,
+        num_partitions=args.num_partitions,
+        max_open_files=args.max_open_files,
+        memory_limit=args.memory_limit * 1024 * 1024)
+    print('Wrote {} groups'.format(num_groups))
+
+
+# .............................................................................
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Tests for the single pass occurrence grouper in occurrence_grouper.py
+"""
+import csv
+import glob
+import os
+
+import pytest
+
+from LmCompute.tools.multi.occurrence_grouper import (
+    group_records, INDEX_HEADER, iterate_sorted_partition, PartitionWriter,
+    read_group_index, read_group_rows)
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+GROUP_POSITION = 1
+GROUP_VALUES = ['Aa bb', 'Cc dd', 'Ee ff', 'Gg hh', 'Ii jj', 'Kk ll', 'Mm nn']
+NUM_RECORDS = 300
+
+
+# .............................................................................
+def _get_groups(records):
+    """Gets the records of each group in input order"""
+    groups = {}
+    for rec in records:
+        groups.setdefault(rec[GROUP_POSITION], []).append(rec)
+    return groups
+
+
+# .............................................................................
+def _read_csv(filename):
+    with open(filename, newline='') as in_file:
+        return list(csv.reader(in_file))
+
+
+# .............................................................................
+@pytest.fixture
+def input_files(occ_data):
+    """Writes the records to two CSV files with headers and a short record"""
+    records = occ_data.get_records(GROUP_VALUES, NUM_RECORDS, seed=5)
+    filenames = [
+        occ_data.write(
+            'occ_{}.csv'.format(i), recs + [['short']], delimiter=',')[0]
+        for i, recs in enumerate([records[:120], records[120:]])]
+    out_dir = os.path.join(occ_data.out_dir, 'out')
+    os.mkdir(out_dir)
+    return filenames, out_dir, records
+
+
+# .............................................................................
+def test_partition_writer(tmp_path):
+    """Evicted files are reopened for append and unused ones are created"""
+    filenames = [str(tmp_path / 'part_{}.csv'.format(i)) for i in range(5)]
+    with open(filenames[0], 'w') as out_file:
+        out_file.write('stale\n')
+    writer = PartitionWriter(filenames, max_open_files=2, buffer_size=10)
+    expected = [[] for _ in filenames]
+    for i in range(40):
+        idx = i % 4
+        row = [str(i), 'group {}'.format(idx)]
+        writer.writerow(idx, row)
+        expected[idx].append(row)
+        assert len(writer._files) <= 2
+    writer.close()
+
+    for filename, rows in zip(filenames, expected):
+        assert _read_csv(filename) == rows
+
+
+# .............................................................................
+@pytest.mark.parametrize('memory_limit', [10 ** 6, 200, 1])
+def test_iterate_sorted_partition(occ_data, memory_limit):
+    """Spilled runs merge to the same stable sort as an in-memory sort"""
+    records = occ_data.get_records(GROUP_VALUES, NUM_RECORDS, seed=5)
+    partition_filename = os.path.join(occ_data.out_dir, 'part.csv')
+    with open(partition_filename, 'w', newline='') as out_file:
+        csv.writer(out_file).writerows(records)
+
+    sorted_rows = list(iterate_sorted_partition(
+        partition_filename, GROUP_POSITION, memory_limit=memory_limit))
+    assert sorted_rows == sorted(
+        records, key=lambda rec: rec[GROUP_POSITION])
+    assert glob.glob('{}.run*'.format(partition_filename)) == []
+
+
+# .............................................................................
+@pytest.mark.parametrize('memory_limit', [10 ** 6, 300])
+def test_group_files(input_files, memory_limit):
+    """Each group is written to its own file, in input order"""
+    filenames, out_dir, records = input_files
+    groups = _get_groups(records)
+    num_groups = group_records(
+        filenames, out_dir, GROUP_POSITION, headers=True, num_partitions=3,
+        max_open_files=2, memory_limit=memory_limit)
+
+    assert num_groups == len(groups)
+    assert sorted(os.listdir(out_dir)) == sorted(
+        'taxon_{}.csv'.format(group) for group in groups)
+    for group, rows in groups.items():
+        assert _read_csv(
+            os.path.join(out_dir, 'taxon_{}.csv'.format(group))) == rows
+
+
+# .............................................................................
+@pytest.mark.parametrize('memory_limit', [10 ** 6, 300])
+def test_group_index(input_files, memory_limit):
+    """Groups are read from the sorted partitions with the index"""
+    filenames, out_dir, records = input_files
+    groups = _get_groups(records)
+    index_filename = os.path.join(out_dir, 'index.csv')
+    num_groups = group_records(
+        filenames, out_dir, GROUP_POSITION, headers=True, write_groups=False,
+        index_filename=index_filename, num_partitions=3, max_open_files=2,
+        memory_limit=memory_limit)
+
+    assert num_groups == len(groups)
+    assert _read_csv(index_filename)[0] == INDEX_HEADER
+    assert not glob.glob(os.path.join(out_dir, 'taxon_*_*.csv.sorted'))
+    group_index = read_group_index(index_filename)
+    assert sorted(group_index.keys()) == sorted(groups.keys())
+    for group, rows in groups.items():
+        assert group_index[group][3] == len(rows)
+        assert read_group_rows(group_index[group]) == rows
+
+    # Sorted partitions hold every record
+    partition_rows = []
+    for i in range(3):
+        partition_rows.extend(_read_csv(
+            os.path.join(out_dir, 'taxon_partition_{}.csv'.format(i))))
+    assert sorted(partition_rows) == sorted(records)
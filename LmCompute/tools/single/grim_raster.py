@@ -1,13 +1,103 @@
 """Intersect a shapegrid and a raster layer to create a GRIM column
+
+In batch mode, a JSON manifest lists many rasters to intersect with the same
+shapegrid.  The shapegrid and its cell index are read once, the rasters are
+processed concurrently, and each one produces the same GRIM column file as a
+single run.
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
+import sys
 
+from LmBackend.common.lmconstants import (
+    GrimEncodingMethod, RasterManifestKey)
+from LmCommon.common.lmconstants import ENCODING
 from LmCommon.common.ready_file import ready_filename
 from LmCommon.encoding.layer_encoder import LayerEncoder
 
 MIN_COVERAGE = 25
 
+# Encoding methods
+LARGEST_CLASS_METHOD = GrimEncodingMethod.LARGEST_CLASS
+MEAN_METHOD = GrimEncodingMethod.MEAN
+
+# Manifest entry keys, the manifest is a JSON list of objects with these keys.
+#    The method and identifier keys are optional.
+MANIFEST_RASTER_KEY = RasterManifestKey.RASTER
+MANIFEST_GRIM_COLUMN_KEY = RasterManifestKey.GRIM_COLUMN
+MANIFEST_METHOD_KEY = RasterManifestKey.METHOD
+MANIFEST_IDENT_KEY = RasterManifestKey.IDENT
+
+
+# .............................................................................
+def encode_grim_column(encoder, raster_filename, grim_column_filename,
+                       method=MEAN_METHOD, ident=None):
+    """Intersects a raster with the encoder shapegrid and writes a GRIM column
+
+    Args:
+        encoder (LayerEncoder): An encoder for the shapegrid.  A copy of it is
+            used for the raster so it can be shared between threads.
+        raster_filename (str): The file location of the raster to intersect.
+        grim_column_filename (str): The file location to write the column.
+        method (str): The encoding method, largest class or mean.
+        ident (str): An identifier for the column header.  The raster file
+            base name is used if this is None or 'none'.
+    """
+    if ident is None or ident.lower() == 'none':
+        ident = os.path.splitext(os.path.basename(raster_filename))[0]
+
+    raster_encoder = encoder.get_empty_copy()
+    if method == LARGEST_CLASS_METHOD:
+        raster_encoder.encode_largest_class(
+            raster_filename, ident, MIN_COVERAGE)
+    else:
+        raster_encoder.encode_mean_value(raster_filename, ident)
+
+    grim_col = raster_encoder.get_encoded_matrix()
+
+    ready_filename(grim_column_filename, overwrite=True)
+    grim_col.write(grim_column_filename)
+
+
+# .............................................................................
+def encode_manifest(shapegrid_filename, manifest_filename, method=MEAN_METHOD,
+                    max_workers=None):
+    """Intersects each raster in a manifest with a shapegrid
+
+    Args:
+        shapegrid_filename (str): The shapegrid to intersect the rasters with.
+        manifest_filename (str): A JSON file with a list of manifest entries.
+        method (str): The encoding method for entries without one.
+        max_workers (int): The number of rasters to process at once.
+
+    Returns:
+        int: The number of rasters that failed.
+    """
+    with open(manifest_filename, 'r', encoding=ENCODING) as in_file:
+        entries = json.load(in_file)
+
+    encoder = LayerEncoder(shapegrid_filename)
+
+    # ...............................
+    def _encode_entry(entry):
+        try:
+            encode_grim_column(
+                encoder, entry[MANIFEST_RASTER_KEY],
+                entry[MANIFEST_GRIM_COLUMN_KEY],
+                method=entry.get(MANIFEST_METHOD_KEY, method),
+                ident=entry.get(MANIFEST_IDENT_KEY))
+            return True
+        except Exception as err:
+            print('Failed to encode {}: {}'.format(
+                entry.get(MANIFEST_RASTER_KEY), str(err)))
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_encode_entry, entries))
+    return results.count(False)
+
 
 # .............................................................................
 def main():
@@ -21,37 +111,45 @@ def main():
         'shapegrid_filename', type=str,
         help="This is the shapegrid to intersect the layer with")
     parser.add_argument(
-        'raster_filename', type=str,
+        'raster_filename', type=str, nargs='?',
         help=('This is the file location of the raster file to use for '
               'intersection'))
     parser.add_argument(
-        'grim_column_filename', type=str,
+        'grim_column_filename', type=str, nargs='?',
         help='Location to write the GRIM column Matrix object')
 
     parser.add_argument('-m', '--method', dest='method',
-                        choices=['largest_class', 'mean'], default='mean',
+                        choices=[LARGEST_CLASS_METHOD, MEAN_METHOD],
+                        default=MEAN_METHOD,
                         help='Use this method for encoding the GRIM layer')
     parser.add_argument(
         '-i', '--ident', type=str, dest='ident',
         help='An identifer to be used as metadata for this column')
+    parser.add_argument(
+        '--manifest', type=str,
+        help=('A JSON manifest of rasters to intersect in batch mode, used '
+              'instead of the raster and GRIM column arguments'))
+    parser.add_argument(
+        '-w', '--max_workers', type=int,
+        help='The number of rasters to process at once in batch mode')
 
     args = parser.parse_args()
 
-    ident = os.path.splitext(os.path.basename(args.raster_filename))[0]
-    if args.ident is not None:
-        if args.ident.lower() != 'none':
-            ident = args.ident
-
-    encoder = LayerEncoder(args.shapegrid_filename)
-    if args.method == 'largest_class':
-        encoder.encode_largest_class(args.raster_filename, ident, MIN_COVERAGE)
+    if args.manifest is not None:
+        num_failed = encode_manifest(
+            args.shapegrid_filename, args.manifest, method=args.method,
+            max_workers=args.max_workers)
+        if num_failed > 0:
+            sys.exit(1)
     else:
-        encoder.encode_mean_value(args.raster_filename, ident)
-
-    grim_col = encoder.get_encoded_matrix()
-
-    ready_filename(args.grim_column_filename, overwrite=True)
-    grim_col.write(args.grim_column_filename)
+        if args.raster_filename is None or args.grim_column_filename is None:
+            parser.error(
+                'Raster and GRIM column arguments are required without a '
+                'manifest')
+        encoder = LayerEncoder(args.shapegrid_filename)
+        encode_grim_column(
+            encoder, args.raster_filename, args.grim_column_filename,
+            method=args.method, ident=args.ident)
 
 
 # .............................................................................
@@ -1,12 +1,130 @@
 """This script intersects a shapegrid and a raster layer to create a PAV
+
+In batch mode, a JSON manifest lists many rasters to intersect with the same
+shapegrid.  The shapegrid and its cell index are read once, the rasters are
+processed concurrently, and each one produces the same PAV and status files as
+a single run.
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
+import sys
 
+from LmBackend.common.lmconstants import RasterManifestKey
 from LmCommon.common.lmconstants import JobStatus, ENCODING
 from LmCommon.common.ready_file import ready_filename
 from LmCommon.encoding.layer_encoder import LayerEncoder
 
+# Manifest entry keys, the manifest is a JSON list of objects with these keys.
+#    The squid and status file keys are optional.
+MANIFEST_RASTER_KEY = RasterManifestKey.RASTER
+MANIFEST_PAV_KEY = RasterManifestKey.PAV
+MANIFEST_MIN_PRESENCE_KEY = RasterManifestKey.MIN_PRESENCE
+MANIFEST_MAX_PRESENCE_KEY = RasterManifestKey.MAX_PRESENCE
+MANIFEST_MIN_COVERAGE_KEY = RasterManifestKey.MIN_COVERAGE
+MANIFEST_SQUID_KEY = RasterManifestKey.SQUID
+MANIFEST_LAYER_STATUS_KEY = RasterManifestKey.LAYER_STATUS
+MANIFEST_STATUS_KEY = RasterManifestKey.STATUS
+
+
+# .............................................................................
+def _write_status(status_filename, status):
+    """Writes a status to a file if the file name is not None
+    """
+    if status_filename is not None:
+        ready_filename(status_filename, overwrite=True)
+        with open(status_filename, 'w', encoding=ENCODING) as out_file:
+            out_file.write('{}'.format(status))
+
+
+# .............................................................................
+def intersect_raster(encoder, raster_filename, pav_filename, min_presence,
+                     max_presence, min_coverage, squid=None,
+                     layer_status_filename=None, status_filename=None):
+    """Intersects a raster with the encoder shapegrid and writes a PAV
+
+    Args:
+        encoder (LayerEncoder): An encoder for the shapegrid.  A copy of it is
+            used for the raster so it can be shared between threads.
+        raster_filename (str): The file location of the raster to intersect.
+        pav_filename (str): The file location to write the PAV Matrix.
+        min_presence (float): The minimum value to consider present.
+        max_presence (float): The maximum value to consider present.
+        min_coverage (float): The proportion (or percent) of a cell that must
+            be present to determine the cell is present.
+        squid (str): A species identifier for the PAV column header.
+        layer_status_filename (str): An optional status file for the raster.
+        status_filename (str): An optional file to write the output status.
+    """
+    lyr_status = JobStatus.GENERAL
+    if layer_status_filename is not None:
+        with open(layer_status_filename, 'r', encoding=ENCODING) as in_file:
+            lyr_status = int(in_file.read().strip())
+
+    if lyr_status < JobStatus.GENERAL_ERROR:
+        if squid is None:
+            squid = os.path.basename(os.path.splitext(raster_filename)[0])
+
+        # Scale percent presence if necessary
+        if min_coverage > 1.0:
+            min_coverage = min_coverage / 100.0
+
+        raster_encoder = encoder.get_empty_copy()
+        raster_encoder.encode_presence_absence(
+            raster_filename, squid, min_presence, max_presence, min_coverage)
+        pav = raster_encoder.get_encoded_matrix()
+
+        if pav is not None:
+            ready_filename(pav_filename, overwrite=True)
+            pav.write(pav_filename)
+        _write_status(status_filename, JobStatus.COMPUTED)
+    else:
+        _write_status(status_filename, lyr_status)
+
+
+# .............................................................................
+def intersect_manifest(shapegrid_filename, manifest_filename,
+                       max_workers=None):
+    """Intersects each raster in a manifest with a shapegrid
+
+    Args:
+        shapegrid_filename (str): The shapegrid to intersect the rasters with.
+        manifest_filename (str): A JSON file with a list of manifest entries.
+        max_workers (int): The number of rasters to process at once.
+
+    Returns:
+        int: The number of rasters that failed.  Failed rasters get an error
+            status if they have a status file.
+    """
+    with open(manifest_filename, 'r', encoding=ENCODING) as in_file:
+        entries = json.load(in_file)
+
+    encoder = LayerEncoder(shapegrid_filename)
+
+    # ...............................
+    def _intersect_entry(entry):
+        try:
+            intersect_raster(
+                encoder, entry[MANIFEST_RASTER_KEY], entry[MANIFEST_PAV_KEY],
+                float(entry[MANIFEST_MIN_PRESENCE_KEY]),
+                float(entry[MANIFEST_MAX_PRESENCE_KEY]),
+                float(entry[MANIFEST_MIN_COVERAGE_KEY]),
+                squid=entry.get(MANIFEST_SQUID_KEY),
+                layer_status_filename=entry.get(MANIFEST_LAYER_STATUS_KEY),
+                status_filename=entry.get(MANIFEST_STATUS_KEY))
+            return True
+        except Exception as err:
+            print('Failed to intersect {}: {}'.format(
+                entry.get(MANIFEST_RASTER_KEY), str(err)))
+            _write_status(
+                entry.get(MANIFEST_STATUS_KEY), JobStatus.GENERAL_ERROR)
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_intersect_entry, entries))
+    return results.count(False)
+
 
 # .............................................................................
 def main():
@@ -20,20 +138,20 @@ def main():
         'shapegrid_filename', type=str,
         help='This is the shapegrid to intersect the layer with')
     parser.add_argument(
-        'raster_filename', type=str,
+        'raster_filename', type=str, nargs='?',
         help='The file location of the raster file to use for intersection')
     parser.add_argument(
-        'pav_filename', type=str,
+        'pav_filename', type=str, nargs='?',
         help='The file location to write the output PAV Matrix object')
 
     parser.add_argument(
-        'min_presence', type=float,
+        'min_presence', type=float, nargs='?',
         help='The minimum value to consider present')
     parser.add_argument(
-        'max_presence', type=float,
+        'max_presence', type=float, nargs='?',
         help='The maximum value to consider present')
     parser.add_argument(
-        'min_coverage', type=float,
+        'min_coverage', type=float, nargs='?',
         help=('The proportion of a cell that must be present to determine '
               'the cell is present (0.0 - 1.0]'))
 
@@ -46,42 +164,34 @@ def main():
         '--layer_status_file', type=str, help='Status file for input layer')
     parser.add_argument(
         '-s', '--status_file', type=str, help='Output status file')
+    parser.add_argument(
+        '--manifest', type=str,
+        help=('A JSON manifest of rasters to intersect in batch mode, used '
+              'instead of the raster, PAV, and presence arguments'))
+    parser.add_argument(
+        '-w', '--max_workers', type=int,
+        help='The number of rasters to process at once in batch mode')
 
     args = parser.parse_args()
 
-    lyr_status = JobStatus.GENERAL
-    if args.layer_status_file is not None:
-        with open(args.layer_status_file, 'r', encoding=ENCODING) as in_file:
-            lyr_status = int(in_file.read().strip())
-
-    if lyr_status < JobStatus.GENERAL_ERROR:
-        squid = os.path.basename(os.path.splitext(args.raster_filename)[0])
-        if args.squid is not None:
-            squid = args.squid
-
-        # Scale percent presence if necessary
-        min_coverage = args.min_coverage
-        if min_coverage > 1.0:
-            min_coverage = min_coverage / 100.0
-
-        encoder = LayerEncoder(args.shapegrid_filename)
-        encoder.encode_presence_absence(
-            args.raster_filename, squid, args.min_presence, args.max_presence,
-            min_coverage)
-        pav = encoder.get_encoded_matrix()
-
-        if pav is not None:
-            ready_filename(args.pav_filename, overwrite=True)
-            pav.write(args.pav_filename)
-        if args.status_file is not None:
-            ready_filename(args.status_file, overwrite=True)
-            with open(args.status_file, 'w', encoding=ENCODING) as out_file:
-                out_file.write('{}'.format(JobStatus.COMPUTED))
+    if args.manifest is not None:
+        num_failed = intersect_manifest(
+            args.shapegrid_filename, args.manifest,
+            max_workers=args.max_workers)
+        if num_failed > 0:
+            sys.exit(1)
     else:
-        if args.status_file is not None:
-            ready_filename(args.status_file, overwrite=True)
-            with open(args.status_file, 'w', encoding=ENCODING) as out_file:
-                out_file.write('{}'.format(lyr_status))
+        if None in (args.raster_filename, args.pav_filename,
+                    args.min_presence, args.max_presence, args.min_coverage):
+            parser.error(
+                'Raster, PAV, and presence arguments are required without a '
+                'manifest')
+        encoder = LayerEncoder(args.shapegrid_filename)
+        intersect_raster(
+            encoder, args.raster_filename, args.pav_filename,
+            args.min_presence, args.max_presence, args.min_coverage,
+            squid=args.squid, layer_status_filename=args.layer_status_file,
+            status_filename=args.status_file)
 
 
 # .............................................................................
@@ -73,6 +73,8 @@ class BoomCollate(LMObject):
         self.random_group_size = random_group_size
         self.do_parallel = False
         self.fdr = 0.05
+        # Random groups share this seed and use distinct first permutations
+        self.random_seed = gridset.get_id()
 
     # ................................
     def _create_filename(self, pam_id, *parts):
@@ -163,7 +165,16 @@ class BoomCollate(LMObject):
                 len(obs_rules), pam_id))
         pam_analysis_rules.extend(obs_rules)
 
-        # Randomized
+        # Randomized runs count exceedances of the observed values as they go
+        #    and write summaries, so they depend on the observed outputs
+        observed_filenames = {}
+        if obs_pam_stats_filenames is not None:
+            observed_filenames.update(zip(
+                ['diversity_stats_filename', 'species_stats_filename',
+                 'site_stats_filename'], obs_pam_stats_filenames))
+        if obs_mcpa_filenames is not None:
+            observed_filenames[
+                'mcpa_f_matrix_filename'] = obs_mcpa_filenames[1]
         rand_pam_stats_filenames = []
         rand_mcpa_stats_filenames = []
         for i, val in enumerate(
@@ -175,7 +186,8 @@ class BoomCollate(LMObject):
                  min(self.random_group_size, self.num_permutations - val),
                  grim_filename=grim_filename, biogeo_filename=biogeo_filename,
                  phylo_filename=phylo_filename, tree_filename=tree_filename,
-                 pam_success_filename=pam_success_filename)
+                 pam_success_filename=pam_success_filename,
+                 first_permutation=val, observed_filenames=observed_filenames)
             rand_pam_stats_filenames.append(pam_stats_filenames)
             rand_mcpa_stats_filenames.append(mcpa_filenames)
             pam_analysis_rules.extend(rand_rules)
@@ -223,7 +235,8 @@ class BoomCollate(LMObject):
     def _get_multispecies_run_rules_for_pam(
             self, pam_id, group_prefix, pam_filename, num_permutations,
             grim_filename=None, biogeo_filename=None, phylo_filename=None,
-            tree_filename=None, pam_success_filename=None):
+            tree_filename=None, pam_success_filename=None,
+            first_permutation=None, observed_filenames=None):
         """Get the rules for running a set of multi species analyses
 
         Return:
@@ -266,7 +279,11 @@ class BoomCollate(LMObject):
         run_rules.append(
             MultiSpeciesRunCommand(
                 pam_filename, num_permutations, self.do_pam_stats,
-                self.do_mcpa, parallel=self.do_parallel,
+                self.do_mcpa,
+                # Permutations run in a process pool, so permuted runs use
+                #    the batched MCPA engine instead of nested MCPA pools
+                parallel=self.do_parallel and num_permutations == 0,
+                batched=self.do_parallel and num_permutations > 0,
                 grim_filename=grim_filename, biogeo_filename=biogeo_filename,
                 phylo_filename=phylo_filename, tree_filename=tree_filename,
                 diversity_stats_filename=div_stats_filename,
@@ -276,7 +293,11 @@ class BoomCollate(LMObject):
                 # species_covariance_filename=None,
                 mcpa_output_filename=mcpa_filename,
                 mcpa_f_matrix_filename=mcpa_f_vals_filename,
-                pam_success_filename=pam_success_filename).get_makeflow_rule())
+                pam_success_filename=pam_success_filename,
+                random_seed=self.random_seed,
+                first_permutation=first_permutation,
+                summarize=bool(observed_filenames),
+                observed_filenames=observed_filenames).get_makeflow_rule())
         self.log.debug(
             'Adding {} run rules for pam {}'.format(len(run_rules), pam_id))
         return pam_stats_return, mcpa_return, run_rules
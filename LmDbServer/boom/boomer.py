@@ -9,7 +9,11 @@ Note:
         will run after all of the sdms are created.
 """
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
+import multiprocessing
 import os
 import sys
 import time
@@ -33,6 +37,36 @@ from LmServer.tools.cwalken import ChristopherWalken
 #    spuds into a single makeflow, along with multi-species commands to follow
 #    SDMs
 SPUD_LIMIT = 5000
+# Note: Parallel walkers keep this many species chunks in flight for each
+#    worker so that workers are not idle while the reader pulls species
+IN_FLIGHT_PER_WORKER = 2
+
+# Walker for configuring species chunks in a worker process
+_WORKER_STATE = {}
+
+
+# .............................................................................
+def _init_walker(config_fname):
+    """Creates a walker, with its own database connection, in a worker process
+
+    Args:
+        config_fname: The boom configuration file
+    """
+    log = ScriptLogger(
+        'boomer_worker.{}'.format(os.getpid()), level=logging.INFO)
+    scribe = BorgScribe(log)
+    if not scribe.open_connections():
+        raise LMError('Failed to open database')
+    walker = ChristopherWalken(config_fname, scribe=scribe)
+    walker.initialize_me(read_species=False)
+    _WORKER_STATE['walker'] = walker
+
+
+# .............................................................................
+def _configure_species_chunk(chunk):
+    """Configures the computations for a species chunk in a worker process
+    """
+    return _WORKER_STATE['walker'].configure_species_chunk(chunk)
 
 # .............................................................................
 class Boomer(LMObject):
@@ -51,6 +85,10 @@ class Boomer(LMObject):
             bushel. If the daemon is interrupted, it will write out the current
             MFChain, and pick up where it left off with a new MFChains for
             unprocessed species data.
+        - With more than one worker, species chunks are read in this process
+            and configured in the database by worker processes.  Results are
+            added to bushels in the order species were read, so bushels are
+            the same as with one worker.
 
     Todo:
         Next instance of boom.Walker will create new MFChains, but add data to
@@ -58,7 +96,7 @@ class Boomer(LMObject):
     """
 
     # .............................
-    def __init__(self, config_fname, success_fname, log=None):
+    def __init__(self, config_fname, success_fname, log=None, num_workers=1):
         self.name = self.__class__.__name__.lower()
         # Logfile
         if log is None:
@@ -71,6 +109,7 @@ class Boomer(LMObject):
 
         self.config_fname = config_fname
         self._success_fname = success_fname
+        self.num_workers = num_workers
 
         self.do_pam_stats = None
         self.do_mcpa = None
@@ -91,6 +130,12 @@ class Boomer(LMObject):
         # self.squid_names = None
         # Stop indicator
         self.keep_walken = False
+        # Species chunks being configured by worker processes, as
+        #    [next start, squid, chunk, future] lists in the order they were
+        #    read.  The future is None while the chunk waits for an earlier
+        #    species of the same taxon.
+        self._in_flight = deque()
+        self._parallel = False
 
         signal.signal(signal.SIGTERM, self._receive_signal)  # Stop signal
 
@@ -103,7 +148,12 @@ class Boomer(LMObject):
             stack: The stack at the time of signal
         """
         if sig_num in (signal.SIGTERM, signal.SIGKILL):
-            self.close()
+            if self._parallel:
+                # Stop reading species, process_all_species closes after
+                #    finishing species in flight
+                self.keep_walken = False
+            else:
+                self.close()
         else:
             message = 'Unknown signal: {}'.format(sig_num)
             self.log.error(message)
@@ -169,36 +219,46 @@ class Boomer(LMObject):
             workdir = self.potato_bushel.get_relative_directory()
             (squid, spud_rules, idx_success_filename
              ) = self.christopher.start_walken(workdir)
-            if idx_success_filename is not None:
-                self.pav_index_filenames.append(idx_success_filename)
-
-            # TODO: Track squids
-            if squid is not None:
-                self.spuds_in_bushel += 1
-                # self.squid_names.append(squid)
-
             self.keep_walken = not self.christopher.complete
-            # TODO: Master process for occurrence only? SDM only?
-            if spud_rules:
-                self.log.debug('Processing spud for potatoes')
-                self.potato_bushel.add_commands(spud_rules)
-                # TODO: Don't write triage file, but don't delete code
-                # if not self.do_pam_stats and len(
-                #         self.squid_names) >= SPUD_LIMIT:
-                if not self.do_pam_stats and self.spuds_in_bushel >= SPUD_LIMIT:
-                    self.rotate_potatoes()
-            self.log.info('-----------------')
+            self._add_spud(squid, spud_rules, idx_success_filename)
         except Exception as e:
             self.log.error('Exception {} on one species spud ...'.format(str(e)))
             raise e
 
+    # .............................
+    def _add_spud(self, squid, spud_rules, idx_success_filename):
+        """Add the rules for one species to the potato bushel."""
+        if idx_success_filename is not None:
+            self.pav_index_filenames.append(idx_success_filename)
+
+        # TODO: Track squids
+        if squid is not None:
+            self.spuds_in_bushel += 1
+            # self.squid_names.append(squid)
+
+        # TODO: Master process for occurrence only? SDM only?
+        if spud_rules:
+            self.log.debug('Processing spud for potatoes')
+            self.potato_bushel.add_commands(spud_rules)
+            # TODO: Don't write triage file, but don't delete code
+            # if not self.do_pam_stats and len(
+            #         self.squid_names) >= SPUD_LIMIT:
+            if not self.do_pam_stats and self.spuds_in_bushel >= SPUD_LIMIT:
+                self.rotate_potatoes()
+        self.log.info('-----------------')
+
+    # .............................
+    def _walken_complete(self):
+        """Return boolean indicating all species have been processed."""
+        return self.christopher.complete and not self._in_flight
+
     # .............................
     def _write_bushel(self):
         # Write all spud commands in existing bushel MFChain
         if self.potato_bushel:
             if self.potato_bushel.jobs:
                 # Only collate if do_pam_stats and finished with all SDMs
-                if self.do_pam_stats and self.christopher.complete:
+                if self.do_pam_stats and self._walken_complete():
                     # Add multispecies rules requested in boom config file
                     collate_rules = self._get_multispecies_rules()
 
@@ -226,7 +286,7 @@ class Boomer(LMObject):
 
         # Create new bushel IFF do_pam_stats is False, i.e. Rolling PAM,
         #   and there are more species to process
-        if not self.christopher.complete and not self.do_pam_stats:
+        if not self._walken_complete() and not self.do_pam_stats:
             self.potato_bushel = self._create_bushel_makeflow()
             self.log.info('Create new potato')
             self.spuds_in_bushel = 0
@@ -237,8 +297,13 @@ class Boomer(LMObject):
         """Close connections and stop."""
         self.keep_walken = False
         self.log.info('Closing boomer ...')
-        # Stop walken the archive and saveNextStart
-        self.christopher.stop_walken()
+        # Stop walken the archive and saveNextStart, restarting at the first
+        #    species that was read but not added to a bushel
+        resume_start = None
+        if self._in_flight:
+            resume_start = self._in_flight[0][0]
+            self._in_flight.clear()
+        self.christopher.stop_walken(line_num=resume_start)
         self.rotate_potatoes()
 
     # .............................
@@ -316,22 +381,131 @@ class Boomer(LMObject):
         except IOError as io_err:
             raise LMError('Failed to write success file', io_err)
 
+    # .............................
+    def _species_failed(self):
+        """Stop walken if too many species have failed."""
+        # if 10% of this bushel has failed, stop for debugging
+        if self.spuds_in_bushel > (SPUD_LIMIT / 20 ):
+            self.log.error('Failed to process 10% of bushel, examine data and code for error')
+            self.keep_walken = False
+        else:
+            self.log.error('Failed to process species, moving on')
+
+    # .............................
+    def _submit_species(self, executor, next_start, chunk, sci_name):
+        """Queue a species chunk and submit it to the workers.
+
+        A chunk with the same taxon as a species in flight is queued without
+        submitting it, so that workers do not race on its occurrence set,
+        projections and data files.  It is submitted by _submit_waiting when
+        the species before it is done.
+        """
+        entry = [next_start, sci_name.squid, chunk + (sci_name,), None]
+        if not any(other[1] == entry[1] for other in self._in_flight):
+            entry[3] = executor.submit(_configure_species_chunk, entry[2])
+        self._in_flight.append(entry)
+
+    # .............................
+    def _submit_waiting(self, executor, squid):
+        """Submit the queued chunk waiting for a taxon that is done."""
+        for entry in self._in_flight:
+            if entry[1] == squid:
+                if entry[3] is None:
+                    entry[3] = executor.submit(
+                        _configure_species_chunk, entry[2])
+                return
+
+    # .............................
+    def _process_species_in_parallel(self):
+        """Read species in this process and configure them in workers.
+
+        Taxa are found or inserted in this process, and chunks of the same
+        taxon are configured one at a time.
+
+        Returns:
+            int - The number of species added to bushels
+        """
+        count = 0
+        max_in_flight = self.num_workers * IN_FLIGHT_PER_WORKER
+        self._parallel = True
+        with ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_walker,
+                initargs=(self.config_fname,)) as executor:
+            while self.keep_walken or self._in_flight:
+                if self.keep_walken and len(self._in_flight) < max_in_flight:
+                    next_start = self.christopher.next_start
+                    chunk = self.christopher.pull_species()
+                    self.keep_walken = not self.christopher.complete
+                    # Empty chunks are only returned at the end of input
+                    if not chunk[0]:
+                        continue
+                    try:
+                        sci_name = (
+                            self.christopher.find_or_insert_species_taxon(
+                                chunk))
+                    except Exception as e:
+                        self.log.error(
+                            'Exception {} on one species spud ...'.format(
+                                str(e)))
+                        self._species_failed()
+                        continue
+                    if sci_name is None:
+                        # Nothing to compute, as in a serial walk
+                        count += 1
+                    else:
+                        self._submit_species(
+                            executor, next_start, chunk, sci_name)
+                    continue
+
+                # Build rules in this process, for the bushel they are added
+                #    to, in the order species were read
+                squid, future = self._in_flight[0][1], self._in_flight[0][3]
+                try:
+                    self._add_spud(*self.christopher.get_spud_rules(
+                        future.result(),
+                        self.potato_bushel.get_relative_directory()))
+                    count += 1
+                except BrokenProcessPool as e:
+                    # Restart at this species
+                    self.log.error(
+                        'Worker processes failed ({}), stopping'.format(e))
+                    self.keep_walken = False
+                    break
+                except Exception as e:
+                    self.log.error(
+                        'Exception {} on one species spud ...'.format(str(e)))
+                    was_walken = self.keep_walken
+                    self._species_failed()
+                    if was_walken and not self.keep_walken:
+                        # Too many failures, restart after this species, like
+                        #    a serial walk
+                        self._in_flight.popleft()
+                        break
+                self._in_flight.popleft()
+                self._submit_waiting(executor, squid)
+            # Species still in flight are read again on the next run
+            for entry in self._in_flight:
+                if entry[3] is not None:
+                    entry[3].cancel()
+        self._parallel = False
+        return count
+
     # .............................
     def process_all_species(self):
         """Read and process all species, while checking for stop signal."""
         print(('processAll with config_fname = {}'.format(self.config_fname)))
         count = 0
+        if (self.num_workers > 1 and
+                self.christopher.weapon_of_choice.supports_parallel):
+            count = self._process_species_in_parallel()
         while self.keep_walken:
             try:
                 self.process_one_species()
                 count += 1
             except:
-                # if 10% of this bushel has failed, stop for debugging
-                if self.spuds_in_bushel > (SPUD_LIMIT / 20 ):
-                    self.log.error('Failed to process 10% of bushel, examine data and code for error')
-                    self.keep_walken = False
-                else:
-                    self.log.error('Failed to process species, moving on')
+                self._species_failed()
         if not self.keep_walken:
             self.close()
         self.write_success_file(
@@ -359,6 +533,10 @@ def main():
     parser.add_argument(
         '--success_file', default=None,
         help=('Filename to be written on successful completion of script.'))
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help=('Number of processes configuring species in the database, '
+              'species are configured in this process if 1.'))
 
     args = parser.parse_args()
     config_fname = args.config_file
@@ -376,7 +554,8 @@ def main():
     scriptname = os.path.splitext(os.path.basename(__file__))[0]
     logname = '{}.{}'.format(scriptname, timestamp)
     logger = ScriptLogger(logname, level=logging.INFO)
-    boomer = Boomer(config_fname, success_fname, log=logger)
+    boomer = Boomer(
+        config_fname, success_fname, log=logger, num_workers=args.workers)
     boomer.initialize_me()
     boomer.process_all_species()
 
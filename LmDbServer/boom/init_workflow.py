@@ -13,7 +13,7 @@ import time
 from LmBackend.command.boom import BoomerCommand
 from LmBackend.command.common import (ConcatenateMatricesCommand, IdigbioQueryCommand)
 from LmBackend.command.server import (EncodeBioGeoHypothesesCommand, StockpileCommand)
-from LmBackend.command.single import GrimRasterCommand
+from LmBackend.command.single import GrimRasterBatchCommand
 from LmBackend.common.lmobj import LMError, LMObject
 from LmCommon.common.api_query import IdigbioAPI
 from LmCommon.common.config import Config
@@ -1258,6 +1258,12 @@ class BOOMFiller(LMObject):
                 '  Adding {} grim columns for scen_code {}'.format(
                     len(mtx_cols), code))
 
+            # Intersect every raster for this GRIM in one batch rule
+            manifest_filename = '{}_manifest{}'.format(
+                os.path.splitext(grim.get_dlocation())[0], LMFormat.JSON.ext)
+            intersect_cmd = GrimRasterBatchCommand(
+                shapegrid_filename, manifest_filename)
+
             col_filenames = []
             for mtx_col in mtx_cols:
                 mtx_col.post_to_solr = False
@@ -1274,14 +1280,17 @@ class BOOMFiller(LMObject):
                         mtx_col.INTERSECT_PARAM_MIN_PERCENT]
                 except KeyError:
                     min_percent = None
-                intersect_cmd = GrimRasterCommand(
-                    shapegrid_filename, mtx_col.layer.get_dlocation(),
-                    col_filename, minPercent=min_percent, ident=mtx_col.ident)
-                rules.append(intersect_cmd.get_makeflow_rule())
+                intersect_cmd.add_raster(
+                    mtx_col.layer.get_dlocation(), col_filename,
+                    minPercent=min_percent, ident=mtx_col.ident)
 
                 # Keep track of intersection filenames for matrix concatenation
                 col_filenames.append(col_filename)
 
+            if intersect_cmd.entries:
+                intersect_cmd.write_manifest()
+                rules.append(intersect_cmd.get_makeflow_rule())
+
             # Add concatenate command
             rules.extend(
                 self._get_matrix_assembly_and_stockpile_rules(
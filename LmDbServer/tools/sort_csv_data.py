@@ -1,70 +1,385 @@
 #!/bin/python
-"""Sort a csv file
+"""Sort a csv file of occurrence records on the group field
+
+The file is sorted with an external merge sort.  The input is divided into
+runs of about `run_size` bytes, each ending at a line end, and a pool of
+processes sorts each run on the group field and writes it to a run file.
+Sorted runs are merged with a heap, in several passes if there are more runs
+than `fan_in`, and the last pass writes the sorted CSV file.
+
+Note:
+    * Runs split the input at line ends, so records must not contain newlines
+        in quoted fields that span a run boundary.
+    * Records are not validated here, other than having a group value.  They
+        are validated when the sorted file is read by OccDataParser.
+    * Finished runs and merges are recorded in a progress file, so an
+        interrupted sort resumes with the remaining work when run again with
+        the same arguments.
 """
 import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor
 import csv
+import gzip
+import heapq
+import io
+import itertools
+import json
+from operator import itemgetter
 import os
+import pickle
 import sys
 
 from LmBackend.common.lmobj import LMError
 from LmCommon.common.lmconstants import LMFormat, ENCODING
-from LmCommon.common.occ_parse import OccDataParser
+from LmCommon.common.occ_parse import OccDataBlockParser, OccDataParser
 from LmServer.common.log import ScriptLogger
 
 OUT_DELIMITER = '\t'
 
+# Note: Runs are roughly this many bytes of input, workers hold several times
+#    this in memory while sorting
+DEFAULT_RUN_SIZE = 256 * 1024 * 1024
+# Note: The maximum number of runs merged at once, limits open files
+DEFAULT_FAN_IN = 64
+# Records are pickled to run files in batches of this size
+RUN_BATCH_SIZE = 10000
+RUN_EXT = '.pkl'
+COMPRESS_EXT = '.gz'
+COMPRESS_LEVEL = 1
+
+SORTED_PREFIX = 'smsort'
+MERGED_PREFIX = 'sorted'
+
 
 # .............................................................................
-def _get_op_filename(data_path, prefix, base, run=None):
+def _get_op_filename(data_path, prefix, base, run=None, ext=LMFormat.CSV.ext):
     base_name = '{}_{}'.format(prefix, base)
     if run is not None:
         base_name = '{}_{}'.format(base_name, run)
-    return os.path.join(data_path, '{}.csv'.format(base_name))
+    return os.path.join(data_path, '{}{}'.format(base_name, ext))
+
+
+# .............................................................................
+def _get_run_filename(data_path, base, level, idx, compress):
+    ext = RUN_EXT
+    if compress:
+        ext += COMPRESS_EXT
+    return _get_op_filename(
+        data_path, SORTED_PREFIX, base, run='{}_{}'.format(level, idx),
+        ext=ext)
+
+
+# .............................................................................
+def get_sort_key(value):
+    """Get the sort key for a group value
+
+    Integer values sort numerically and before other values, matching the
+    int or str group values of OccDataParser.
+    """
+    try:
+        return (0, int(value), '')
+    except ValueError:
+        return (1, 0, value)
+
+
+# .............................................................................
+def _get_run_ranges(data_fname, data_start, run_size):
+    """Get (start, end) byte offsets of runs, ending each at a line end
+    """
+    ranges = []
+    file_size = os.path.getsize(data_fname)
+    with open(data_fname, 'rb') as in_file:
+        start = data_start
+        while start < file_size:
+            end = start + run_size
+            if end < file_size:
+                in_file.seek(end - 1)
+                in_file.readline()
+                end = in_file.tell()
+            end = min(end, file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+# .............................................................................
+def _open_run(run_fname, mode, compress):
+    if compress:
+        return gzip.open(run_fname, mode, compresslevel=COMPRESS_LEVEL)
+    return open(run_fname, mode)
+
+
+# .............................................................................
+def _write_run(run_fname, items, compress):
+    """Write (key, record) items to a run file in pickled batches
+
+    Returns:
+        int - The number of records written
+    """
+    tmp_fname = run_fname + '.tmp'
+    count = 0
+    items = iter(items)
+    with _open_run(tmp_fname, 'wb', compress) as out_file:
+        batch = list(itertools.islice(items, RUN_BATCH_SIZE))
+        while batch:
+            pickle.dump(batch, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+            count += len(batch)
+            batch = list(itertools.islice(items, RUN_BATCH_SIZE))
+    os.replace(tmp_fname, run_fname)
+    return count
+
+
+# .............................................................................
+def _read_run(run_fname):
+    """Generator yielding the (key, record) items of a run file
+    """
+    compress = run_fname.endswith(COMPRESS_EXT)
+    with _open_run(run_fname, 'rb', compress) as in_file:
+        while True:
+            try:
+                batch = pickle.load(in_file)
+            except EOFError:
+                return
+            yield from batch
+
+
+# .............................................................................
+def _sort_run(data_fname, start, end, delimiter, group_by_idx, run_fname,
+              compress):
+    """Sort the records in a byte range of a CSV file into a run file
+
+    Note:
+        The key is computed once for each record and the sort is stable, so
+            records with the same key keep their input order.
+
+    Returns:
+        list - The number of records written and the number skipped
+    """
+    with open(data_fname, 'rb') as in_file:
+        in_file.seek(start)
+        text = in_file.read(end - start).decode(ENCODING)
+    items = []
+    skipped = 0
+    for rec in csv.reader(io.StringIO(text, newline=''), delimiter=delimiter):
+        if len(rec) > group_by_idx:
+            items.append((get_sort_key(rec[group_by_idx]), rec))
+        elif rec:
+            skipped += 1
+    items.sort(key=itemgetter(0))
+    return [_write_run(run_fname, items, compress), skipped]
+
+
+# .............................................................................
+def _merge_runs(run_fnames, out_fname, compress):
+    """Merge sorted run files into one sorted run file
+    """
+    return _write_run(
+        out_fname,
+        heapq.merge(*[_read_run(fn) for fn in run_fnames], key=itemgetter(0)),
+        compress)
+
+
+# .............................................................................
+def _merge_runs_to_csv(run_fnames, merge_fname, header):
+    """Merge sorted run files into the sorted CSV file
+    """
+    tmp_fname = merge_fname + '.tmp'
+    count = 0
+    with open(tmp_fname, 'w', encoding=ENCODING, newline='') as out_file:
+        csv_writer = csv.writer(out_file, delimiter=OUT_DELIMITER)
+        if header is not None:
+            csv_writer.writerow(header)
+        for _, rec in heapq.merge(
+                *[_read_run(fn) for fn in run_fnames], key=itemgetter(0)):
+            csv_writer.writerow(rec)
+            count += 1
+    os.replace(tmp_fname, merge_fname)
+    return count
+
+
+# .............................................................................
+def _read_progress(progress_fname, source):
+    """Read the progress file, starting over if the source has changed
+    """
+    progress = None
+    try:
+        with open(progress_fname, 'r', encoding=ENCODING) as in_file:
+            progress = json.load(in_file)
+    except (IOError, ValueError):
+        pass
+    if progress is None or progress.get('source') != source:
+        progress = {'source': source, 'done': {}}
+    return progress
 
 
 # .............................................................................
-def _get_smallest_key_and_position(sorted_files):
-    """Get the smallest group data key and index of file containing it
+def _write_progress(progress_fname, progress):
+    tmp_fname = progress_fname + '.tmp'
+    with open(tmp_fname, 'w', encoding=ENCODING) as out_file:
+        json.dump(progress, out_file)
+    os.replace(tmp_fname, progress_fname)
+
+
+# .............................................................................
+def _run_tasks(log, func, tasks, progress, progress_fname, max_workers=None):
+    """Run tasks that are not done, recording each as it finishes
+
+    Args:
+        func: The function to run for each task.
+        tasks: A list of (output filename, function arguments) tuples.
+        progress: The progress dictionary, updated as tasks finish.
+        progress_fname: The file the progress is written to.
+        max_workers: The number of processes to use.
     """
-    idx_of_smallest = 0
-    smallest = sorted_files[idx_of_smallest].group_val
-    for idx, sorted_file in enumerate(sorted_files):
-        if sorted_file.group_val is not None:
-            if smallest is None or sorted_file.group_val < smallest:
-                smallest = sorted_file.group_val
-                idx_of_smallest = idx
-    if smallest is None:
-        return None, None
+    done = progress['done']
+    todo = [(out_fname, args) for out_fname, args in tasks
+            if os.path.basename(out_fname) not in done]
+    if len(todo) < len(tasks):
+        log.debug('Skipping {} finished tasks'.format(len(tasks) - len(todo)))
+
+    def _record(out_fname, result):
+        done[os.path.basename(out_fname)] = result
+        _write_progress(progress_fname, progress)
+        log.debug('Wrote {}, {}'.format(out_fname, result))
+
+    if max_workers == 1 or len(todo) <= 1:
+        for out_fname, args in todo:
+            _record(out_fname, func(*args))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(func, *args): out_fname
+                       for out_fname, args in todo}
+            for future in as_completed(futures):
+                _record(futures[future], future.result())
 
-    return smallest, idx_of_smallest
+
+# .............................................................................
+def _remove_files(fnames):
+    for fname in fnames:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+# .............................................................................
+def sort_csv_file(log, data_fname, meta_fname, merge_fname, delimiter='\t',
+                  do_sort=True, do_merge=True, run_size=DEFAULT_RUN_SIZE,
+                  fan_in=DEFAULT_FAN_IN, compress=False, max_workers=None,
+                  keep_runs=False):
+    """Sort a CSV file of occurrence records on the group field
+
+    Args:
+        log: Logger to use
+        data_fname: Filename of the unsorted CSV data
+        meta_fname: Metadata filename for these data
+        merge_fname: Output filename for the sorted CSV data
+        delimiter: Field delimiter of the input data
+        do_sort: Create the sorted runs
+        do_merge: Merge the sorted runs into the output file
+        run_size: The approximate number of input bytes in each run
+        fan_in: The maximum number of runs to merge at once
+        compress: Compress run files with gzip
+        max_workers: The number of processes to use, defaults to the number
+            of CPUs
+        keep_runs: Keep run files after they are merged
+    """
+    occ_parser = OccDataParser(
+        log, data_fname, meta_fname, delimiter=delimiter)
+    occ_parser.initialize_me()
+    header = occ_parser.header
+    group_by_idx = occ_parser.group_by_idx
+    occ_parser.close()
+
+    data_start = 0
+    if header is not None:
+        with open(data_fname, 'rb') as in_file:
+            in_file.readline()
+            data_start = in_file.tell()
+
+    basepath, _ = os.path.splitext(data_fname)
+    data_path, basename = os.path.split(basepath)
+    progress_fname = _get_op_filename(
+        data_path, SORTED_PREFIX, basename, run='progress',
+        ext=LMFormat.JSON.ext)
+    stat = os.stat(data_fname)
+    progress = _read_progress(progress_fname, {
+        'data_fname': os.path.abspath(data_fname), 'size': stat.st_size,
+        'mtime': stat.st_mtime, 'run_size': run_size, 'fan_in': fan_in,
+        'compress': compress})
+
+    run_ranges = _get_run_ranges(data_fname, data_start, run_size)
+    run_fnames = [
+        _get_run_filename(data_path, basename, 0, i, compress)
+        for i in range(len(run_ranges))]
+
+    if do_sort:
+        log.info('Sort {} runs of {}'.format(len(run_fnames), data_fname))
+        _run_tasks(
+            log, _sort_run,
+            [(run_fname, (data_fname, start, end, delimiter, group_by_idx,
+                          run_fname, compress))
+             for run_fname, (start, end) in zip(run_fnames, run_ranges)],
+            progress, progress_fname, max_workers=max_workers)
+
+    if do_merge:
+        missing = [fn for fn in run_fnames
+                   if os.path.basename(fn) not in progress['done']]
+        if missing:
+            raise LMError(
+                '{} sorted runs of {} are missing, sort them first'.format(
+                    len(missing), data_fname))
+        level = 1
+        while len(run_fnames) > fan_in:
+            groups = [run_fnames[i:i + fan_in]
+                      for i in range(0, len(run_fnames), fan_in)]
+            out_fnames = [
+                _get_run_filename(data_path, basename, level, i, compress)
+                for i in range(len(groups))]
+            log.info('Merge {} runs into {}'.format(
+                len(run_fnames), len(out_fnames)))
+            _run_tasks(
+                log, _merge_runs,
+                [(out_fname, (group, out_fname, compress))
+                 for out_fname, group in zip(out_fnames, groups)],
+                progress, progress_fname, max_workers=max_workers)
+            if not keep_runs:
+                _remove_files(run_fnames)
+            run_fnames = out_fnames
+            level += 1
+
+        log.info('Merge {} runs into {}'.format(len(run_fnames), merge_fname))
+        _run_tasks(
+            log, _merge_runs_to_csv,
+            [(merge_fname, (run_fnames, merge_fname, header))],
+            progress, progress_fname, max_workers=1)
+        if not keep_runs:
+            _remove_files(run_fnames + [progress_fname])
 
 
 # .............................................................................
 def check_merged_file(log, merge_fname, meta_fname):
     """Check the status of a merged file."""
     chunk_count = rec_count = fail_sort_count = fail_chunk_count = 0
-    big_sorted_data = OccDataParser(
+    big_sorted_data = OccDataBlockParser(
         log, merge_fname, meta_fname, delimiter=OUT_DELIMITER,
-        pull_chunks=True)
+        pull_chunks=True, use_index=False)
     big_sorted_data.initialize_me()
-    prev_key = big_sorted_data.group_val
+    prev_key = None
 
-    chunk, chunk_group, _ = big_sorted_data.pull_current_chunk()
     try:
-        while not big_sorted_data.closed and len(chunk) > 0:
-            if big_sorted_data.group_val > prev_key:
+        while not big_sorted_data.closed:
+            chunk, chunk_group, _ = big_sorted_data.pull_current_chunk()
+            curr_key = get_sort_key(str(chunk_group))
+            if prev_key is None or curr_key > prev_key:
                 chunk_count += 1
                 rec_count += len(chunk)
-            elif big_sorted_data.group_val < prev_key:
-                log.debug('Failure to sort prev_key {},  currKey {}'.format(
-                    prev_key, big_sorted_data.group_val))
+            elif curr_key < prev_key:
+                log.debug('Failure to sort prev_key {},  curr_key {}'.format(
+                    prev_key, curr_key))
                 fail_sort_count += 1
             else:
-                log.debug('Current chunk key = prev key %d' % (prev_key))
+                log.debug('Current chunk key = prev key {}'.format(prev_key))
                 fail_chunk_count += 1
-
-        prev_key = chunk_group
-        chunk = big_sorted_data.pull_current_chunk()
+            prev_key = curr_key
 
     except Exception as e:
         log.error(str(e))
@@ -83,195 +398,47 @@ def check_merged_file(log, merge_fname, meta_fname):
     log.debug(msg)
 
 
-# .............................................................................
-def sort_recs(array, idx):
-    """Sort records."""
-    less = []
-    equals = []
-    greater = []
-
-    if len(array) > 1:
-        pivot = array[0][idx]
-        for rec in array:
-            if rec[idx] < pivot:
-                less.append(rec)
-            if rec[idx] == pivot:
-                equals.append(rec)
-            if rec[idx] > pivot:
-                greater.append(rec)
-        # Don't forget to return something!
-        return sort_recs(less, idx) + equals + sort_recs(greater, idx)
-
-    # At the end of the recursion - when only one element, return the array.
-    return array
-
-
-# .............................................................................
-def split_into_files(log, occ_parser, data_path, prefix, basename,
-                     max_file_size):
-    """Split occurrence data into files."""
-    idx = 0
-    while not occ_parser.closed:
-        chunk = occ_parser.get_size_chunk(max_file_size)
-        fname = _get_op_filename(data_path, prefix, basename, run=idx)
-        with open(fname, 'w', encoding=ENCODING) as out_file:
-            csv_writer = csv.writer(out_file, delimiter=OUT_DELIMITER)
-            # Skip header, rely on metadata with column indices
-            #       csvwriter.writerow(occ_parser.header)
-            for rec in chunk:
-                csv_writer.writerow(rec)
-        log.debug('Wrote {} records to {}'.format(len(chunk), fname))
-        idx += 1
-    return idx
-
-
-# .............................................................................
-def sort_files(log, group_by_idx, data_path, in_prefix, out_prefix, basename):
-    """Sort files."""
-    idx = 0
-
-    in_fname = _get_op_filename(data_path, in_prefix, basename, run=idx)
-    while os.path.exists(in_fname):
-        out_fname = _get_op_filename(data_path, out_prefix, basename, run=idx)
-        log.debug('Write from {} to {}'.format(in_fname, out_fname))
-        # Read rows
-        uns_rows = []
-        with open(in_fname, 'r', encoding=ENCODING) as in_file, open(out_fname, 'w', encoding=ENCODING) as out_file:
-            with csv.reader(in_file, delimiter=OUT_DELIMITER) as occ_reader:
-                with csv.writer(
-                        out_file, delimiter=OUT_DELIMITER) as occ_writer:
-                    while True:
-                        try:
-                            uns_rows.append(next(occ_reader))
-                        except StopIteration:
-                            break
-                        except Exception as err:
-                            print('Error file {}, line {}: {}'.format(
-                                in_fname, occ_reader.line_num, err))
-                            break
-
-                    # Sort records into new array, then write to file, no
-                    #    header
-                    srt_rows = sort_recs(uns_rows, group_by_idx)
-                    for rec in srt_rows:
-                        occ_writer.writerow(rec)
-
-        # Move to next file
-        idx += 1
-        in_fname = _get_op_filename(data_path, in_prefix, basename, run=idx)
-    return idx
-
-
-# .............................................................................
-def _pop_chunk_and_write(csv_writer, occ_parser):
-    # first get chunk
-    this_key = occ_parser.group_val
-    chunk, _, _ = occ_parser.pull_current_chunk()
-    for rec in chunk:
-        csv_writer.writerow(rec)
-    return this_key
-
-
-# .............................................................................
-def merge_sorted_files(log, merge_fname, data_path, input_prefix, basename,
-                       meta_fname, in_idx=0):
-    """Merge multile files of csv records.
-
-    Merge multiple files of csv records sorted on keyCol, with the same key col
-    values in one or more files, into a single file, sorted on key col, placing
-    records containing the same key col value together.
-
-    Args:
-        merge_fname: Output filename
-        data_path: Path for input files
-        input_prefix: Filename prefix for input sorted files
-        basename: original base filename
-        meta_fname: Metadata filename for these data
-    """
-    # Open all input split files
-    sorted_files = []
-    srt_fname = _get_op_filename(data_path, input_prefix, basename, run=in_idx)
-    curr_idx = in_idx
-    enough_already = False
-    while not enough_already and os.path.exists(srt_fname):
-        try:
-            occ_parser = OccDataParser(
-                log, srt_fname, meta_fname, delimiter=OUT_DELIMITER,
-                pull_chunks=True)
-            occ_parser.initialize_me()
-        except IOError as err:
-            log.warning(
-                ('Enough already, IOError! Final file {}. Using only '
-                 'indices {} - {}, err {}').format(
-                     srt_fname, in_idx, curr_idx, str(err)))
-            enough_already = True
-        except Exception as err:
-            log.warning(
-                'Enough already! Final file {}. {}'.format(
-                    srt_fname, 'Using only indices {} - {}, err {}'.format(
-                        in_idx, curr_idx, err)))
-            enough_already = True
-        else:
-            sorted_files.append(occ_parser)
-            curr_idx += 1
-            srt_fname = _get_op_filename(
-                data_path, input_prefix, basename, run=curr_idx)
-
-    try:
-        # Open output sorted file
-        with open(merge_fname, 'w', encoding=ENCODING) as out_file:
-            csv_writer = csv.writer(out_file, delimiter=OUT_DELIMITER)
-            # Skip header (no longer written to files)
-            # find file with record containing smallest key
-            _, pos = _get_smallest_key_and_position(sorted_files)
-            while pos is not None:
-                # Output records in this file with small_key
-                _pop_chunk_and_write(csv_writer, sorted_files[pos])
-
-                # Find smallest again
-                _, pos = _get_smallest_key_and_position(sorted_files)
-
-    except Exception as err:
-        raise LMError(err)
-    finally:
-        for open_file in sorted_files:
-            log.debug('Closing file {}'.format(open_file.data_fname))
-            open_file.close()
-
-
 # .............................................................................
 def main():
     """Main method of the script
     """
     parser = argparse.ArgumentParser(
         description=(
-            'Populate a Lifemapper archive with metadata for single- or '
-            'multi-species computations specific to the configured input data '
-            'or the data package named.'))
+            'Sort a CSV file of occurrence records on the group field of its '
+            'metadata, using an external merge sort.'))
     parser.add_argument(
         'dump_filename', help=('Filename for unsorted database dump.'))
     parser.add_argument(
         '--delimiter', default='\t', help=('Field delimiter for these data.'))
-    # TODO: Use options or choices parameter to limit inputs
     parser.add_argument(
         '--command', default='all',
         help=('Process to be executed:\n'
-              '    split: split large unsorted input into smaller files\n'
-              '    sort: sort smaller files individually\n'
-              '    merge: Merge smaller sorted files into large sorted file\n'
+              '    sort: sort runs of the input into run files\n'
+              '    merge: Merge sorted runs into large sorted file\n'
               '    check: Test large sorted file for errors\n'
-              '    all: perform all (split, sort, merge) functions'),
-        choices=('split', 'sort', 'merge', 'check', 'all'))
+              '    all: perform sort and merge functions'),
+        choices=('sort', 'merge', 'check', 'all'))
     parser.add_argument(
-        '--start_idx', default=0,
-        help=('For merging, start at this file number (limit on number of '
-              'open files, may require doing this in 2 or more steps'))
+        '--run_size', type=int, default=DEFAULT_RUN_SIZE // (1024 * 1024),
+        help=('Approximate size of each sorted run, in megabytes'))
+    parser.add_argument(
+        '--fan_in', type=int, default=DEFAULT_FAN_IN,
+        help=('Maximum number of runs to merge at once (limit on number of '
+              'open files)'))
+    parser.add_argument(
+        '--processes', type=int, default=None,
+        help=('Number of processes, defaults to the number of CPUs'))
+    parser.add_argument(
+        '--compress', action='store_true',
+        help=('Compress the run files'))
+    parser.add_argument(
+        '--keep_runs', action='store_true',
+        help=('Keep run files after they are merged'))
 
     args = parser.parse_args()
     in_delimiter = args.delimiter
     data_fname = args.dump_filename
     cmd = args.command
-    start_idx = args.start_idx
 
     # Only 2 options
     if in_delimiter == ',':
@@ -279,50 +446,24 @@ def main():
     else:
         in_delimiter = '\t'
 
-    unsorted_prefix = 'chunk'
-    sorted_prefix = 'smsort'
-    merged_prefix = 'sorted'
-
     basepath, _ = os.path.splitext(data_fname)
     pth, basename = os.path.split(basepath)
     log_name = 'sortCSVData_{}_{}'.format(basename, cmd)
     meta_fname = basepath + LMFormat.JSON.ext
     merge_fname = os.path.join(pth, '{}_{}{}'.format(
-        merged_prefix, basename, LMFormat.CSV.ext))
+        MERGED_PREFIX, basename, LMFormat.CSV.ext))
     if not os.path.exists(data_fname) or not os.path.exists(meta_fname):
         print(('Files {} and {} must exist'.format(data_fname, meta_fname)))
         sys.exit()
 
     log = ScriptLogger(log_name)
-    if cmd in ('split', 'sort', 'all'):
-        # Split into smaller unsorted files
-        occ_parser = OccDataParser(
-            log, data_fname, meta_fname, delimiter=in_delimiter,
-            pull_chunks=True)
-        occ_parser.initialize_me()
-        group_by_idx = occ_parser.group_by_idx
-        print('group_by_idx = ', group_by_idx)
-
-        if cmd in ('split', 'all'):
-            # Split into smaller unsorted files
-            print('Split huge data file into smaller files')
-            split_into_files(
-                log, occ_parser, pth, unsorted_prefix, basename, 500000)
-            occ_parser.close()
-
-        if cmd in ('sort', 'all'):
-            # Sort smaller files
-            print('Sort smaller files')
-            sort_files(
-                log, group_by_idx, pth, unsorted_prefix, sorted_prefix,
-                basename)
-
-    if cmd in ('merge', 'all'):
-        # Merge all data for production system into multiple subset files
-        print('Merge smaller sorted files into huge sorted file')
-        merge_sorted_files(
-            log, merge_fname, pth, sorted_prefix, basename, meta_fname,
-            in_idx=start_idx)
+    if cmd in ('sort', 'merge', 'all'):
+        sort_csv_file(
+            log, data_fname, meta_fname, merge_fname, delimiter=in_delimiter,
+            do_sort=cmd in ('sort', 'all'), do_merge=cmd in ('merge', 'all'),
+            run_size=args.run_size * 1024 * 1024, fan_in=args.fan_in,
+            compress=args.compress, max_workers=args.processes,
+            keep_runs=args.keep_runs)
 
     if cmd == 'check':
         # Check final output (only for single file now)
@@ -0,0 +1,116 @@
+"""Tests for the external merge sort in sort_csv_data.py
+"""
+import csv
+import glob
+import os
+
+import pytest
+
+from LmBackend.common.lmobj import LMError
+from LmCommon.common.log import TestLogger
+from LmDbServer.tools.sort_csv_data import (
+    get_sort_key, MERGED_PREFIX, RUN_EXT, SORTED_PREFIX, sort_csv_file)
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+GROUP_IDX = 1
+# Integer group values sort numerically, before string values
+GROUP_VALUES = ['3', '10', '2', '100', 'abc', 'Abd', '7']
+NUM_RECORDS = 200
+
+
+# .............................................................................
+@pytest.fixture
+def occ_files(occ_data):
+    """Writes an unsorted CSV and metadata file, with one short record
+
+    The returned rows start with the header.
+    """
+    records = occ_data.get_records(GROUP_VALUES, NUM_RECORDS, seed=11)
+    data_fname, meta_fname = occ_data.write(
+        'occ.csv', records[:50] + [['short']] + records[50:])
+    merge_fname = os.path.join(
+        occ_data.out_dir, '{}_occ.csv'.format(MERGED_PREFIX))
+    return data_fname, meta_fname, merge_fname, [occ_data.header] + records
+
+
+# .............................................................................
+def _read_csv(fname):
+    with open(fname, newline='') as in_file:
+        return list(csv.reader(in_file, delimiter='\t'))
+
+
+# .............................................................................
+def _get_run_fnames(data_fname):
+    """Gets run files, which may be compressed, and the progress file"""
+    return glob.glob(os.path.join(
+        os.path.dirname(data_fname), '{}_*'.format(SORTED_PREFIX)))
+
+
+# .............................................................................
+def _get_expected(rows):
+    """Records are sorted stably on the group value after the header"""
+    return rows[:1] + sorted(
+        rows[1:], key=lambda rec: get_sort_key(rec[GROUP_IDX]))
+
+
+# .............................................................................
+def test_get_sort_key():
+    """Integer group values sort numerically and before strings"""
+    assert sorted(GROUP_VALUES, key=get_sort_key) == [
+        '2', '3', '7', '10', '100', 'Abd', 'abc']
+
+
+# .............................................................................
+def test_sort_one_run(occ_files):
+    """A file smaller than a run is sorted in memory"""
+    data_fname, meta_fname, merge_fname, rows = occ_files
+    sort_csv_file(
+        TestLogger('test_sort_csv_data'), data_fname, meta_fname,
+        merge_fname, max_workers=1)
+    assert _read_csv(merge_fname) == _get_expected(rows)
+    assert _get_run_fnames(data_fname) == []
+
+
+# .............................................................................
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_sort_spilled_runs(occ_files, compress, max_workers):
+    """Many small runs merged over several passes give the same output"""
+    data_fname, meta_fname, merge_fname, rows = occ_files
+    # About 20 runs, merged three at a time over three passes
+    sort_csv_file(
+        TestLogger('test_sort_csv_data'), data_fname, meta_fname,
+        merge_fname, run_size=300, fan_in=3, compress=compress,
+        max_workers=max_workers)
+    assert _read_csv(merge_fname) == _get_expected(rows)
+    assert _get_run_fnames(data_fname) == []
+
+
+# .............................................................................
+def test_sort_then_merge(occ_files):
+    """Sorting and merging can run separately, and merging needs all runs"""
+    data_fname, meta_fname, merge_fname, rows = occ_files
+    log = TestLogger('test_sort_csv_data')
+    with pytest.raises(LMError):
+        sort_csv_file(
+            log, data_fname, meta_fname, merge_fname, do_sort=False,
+            run_size=300, fan_in=3, max_workers=1)
+
+    sort_csv_file(
+        log, data_fname, meta_fname, merge_fname, do_merge=False,
+        run_size=300, fan_in=3, max_workers=1)
+    run_fnames = [
+        fn for fn in _get_run_fnames(data_fname) if fn.endswith(RUN_EXT)]
+    assert len(run_fnames) > 3
+    assert not os.path.exists(merge_fname)
+
+    # Finished runs are not sorted again
+    mtimes = {fn: os.path.getmtime(fn) for fn in run_fnames}
+    sort_csv_file(
+        log, data_fname, meta_fname, merge_fname, run_size=300, fan_in=3,
+        max_workers=1, keep_runs=True)
+    assert _read_csv(merge_fname) == _get_expected(rows)
+    for run_fname, mtime in mtimes.items():
+        assert os.path.getmtime(run_fname) == mtime
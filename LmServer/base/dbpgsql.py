@@ -1,16 +1,270 @@
 """Library to interact with the Lifemapper PostgreSQL/PostGIS databases
 
+Note:
+    Stored functions are called with bound parameters rather than formatted
+        strings.  Functions that are not overloaded for the number of
+        arguments used are prepared on the server the first time they are
+        called on a connection and executed by name after that.
+
+Note:
+    Pooled connections are shared by all of the database objects in a process
+        that use the same database, user, host, and port.  Each database
+        object holds a connection from the pool between `open` and `close`,
+        so a single object should not be used by more than one thread.
+
 Todo:
     Consider using namedtuple objects for rows.  To me, it looks cleaner if
         nothing else
 """
+import queue
+import threading
+import time
+
 import psycopg2
+from psycopg2.extensions import connection, TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
 
 from LmBackend.common.lmobj import LMError
 from LmServer.base.atom import Atom
 from LmServer.base.lmobj import LMAbstractObject
 from LmServer.common.data_locator import EarlJr
-from LmServer.common.lmconstants import LM_SCHEMA
+from LmServer.common.lmconstants import (
+    DB_BATCH_SIZE, DB_POOL_CHECK_INTERVAL, DB_POOL_SIZE, DB_POOL_SLOW_WAIT,
+    DB_POOL_TIMEOUT, LM_SCHEMA)
+
+# Note: Lists the stored functions in a schema that have a single signature
+#    for their number of arguments, only these are prepared so that the
+#    server resolves them exactly as it would a direct call
+_UNIQUE_FUNCTIONS_QUERY = (
+    'SELECT p.proname, p.pronargs FROM pg_catalog.pg_proc p '
+    'JOIN pg_catalog.pg_namespace n ON n.oid = p.pronamespace '
+    'WHERE n.nspname = %s GROUP BY p.proname, p.pronargs '
+    'HAVING count(*) = 1')
+# Note: Gets the argument type names of a stored function, used to cast the
+#    columns of batched calls
+_ARG_TYPES_QUERY = (
+    'SELECT p.proargtypes::regtype[]::text[] FROM pg_catalog.pg_proc p '
+    'JOIN pg_catalog.pg_namespace n ON n.oid = p.pronamespace '
+    'WHERE n.nspname = %s AND p.proname = %s AND p.pronargs = %s')
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+# ............................................................................
+class LmConnection(connection):
+    """A psycopg2 connection that caches stored function information
+    """
+
+    # ................................
+    def __init__(self, *args, **kwargs):
+        connection.__init__(self, *args, **kwargs)
+        # {(schema, function name, number of arguments): statement name}
+        self.prepared = {}
+        # {schema: set of (function name, number of arguments)}
+        self.unique_functions = {}
+        # {(schema, function name, number of arguments): argument types}
+        self.arg_types = {}
+        self.last_used = time.time()
+
+
+# ............................................................................
+class DbConnectionPool:
+    """A thread-safe pool of connections to one database
+
+    Connections are checked for health when they are taken from the pool and
+    any open transaction is rolled back when they are returned.  The time
+    callers spend waiting for a connection is recorded so that an undersized
+    pool can be spotted from the logs or `get_stats`.
+    """
+
+    # ................................
+    def __init__(self, logger, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 **connect_params):
+        """Constructor
+
+        Args:
+            logger (LmLogger): A logger for warnings about the pool.
+            max_size (int): The maximum number of connections checked out of
+                the pool at once.
+            timeout (float): Seconds to wait for a connection before failing.
+            **connect_params: Keyword arguments for psycopg2.connect.
+        """
+        self.log = logger
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connect_params = connect_params
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.num_opened = 0
+        self.num_discarded = 0
+
+    # ................................
+    def _connect(self):
+        """Opens a new connection to the database
+        """
+        conn = psycopg2.connect(
+            connection_factory=LmConnection, **self.connect_params)
+        with self._stats_lock:
+            self.num_opened += 1
+        return conn
+
+    # ................................
+    def _discard(self, conn):
+        """Closes a connection that will not be returned to the pool
+        """
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._stats_lock:
+            self.num_discarded += 1
+
+    # ................................
+    @staticmethod
+    def _is_healthy(conn):
+        """Checks that an idle connection can still be used
+
+        Connections that have been idle longer than DB_POOL_CHECK_INTERVAL
+        seconds are checked with a trivial query.
+        """
+        if conn.closed or \
+                conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        if time.time() - conn.last_used > DB_POOL_CHECK_INTERVAL:
+            try:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    # ................................
+    def _record_wait(self, wait_time):
+        """Records the time spent waiting for a connection
+        """
+        with self._stats_lock:
+            self.checkouts += 1
+            self.total_wait += wait_time
+            self.max_wait = max(self.max_wait, wait_time)
+        if wait_time > DB_POOL_SLOW_WAIT:
+            self.log.warning(
+                'Waited {:.2f} seconds for a connection to {} ({})'.format(
+                    wait_time, self.connect_params.get('database'),
+                    self.get_stats()))
+
+    # ................................
+    def get_connection(self):
+        """Takes a healthy connection from the pool, opening one if needed
+
+        Returns:
+            LmConnection - A connection that must be returned with
+                `put_connection`.
+
+        Raises:
+            LMError: If no connection is available within the timeout.
+        """
+        start_time = time.time()
+        if not self._slots.acquire(timeout=self.timeout):
+            self._record_wait(time.time() - start_time)
+            raise LMError(
+                'Timed out after {} seconds waiting for a connection to '
+                '{}'.format(
+                    self.timeout, self.connect_params.get('database')))
+        self._record_wait(time.time() - start_time)
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._is_healthy(conn):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    # ................................
+    def put_connection(self, conn, discard=False):
+        """Returns a connection to the pool
+
+        Args:
+            conn (LmConnection): A connection from `get_connection`.
+            discard (bool): Close the connection instead of reusing it, for
+                connections that have failed.
+        """
+        try:
+            if discard or conn.closed:
+                self._discard(conn)
+            else:
+                try:
+                    conn.rollback()
+                    conn.last_used = time.time()
+                    self._idle.put(conn)
+                except psycopg2.Error:
+                    self._discard(conn)
+        finally:
+            self._slots.release()
+
+    # ................................
+    def close_idle(self):
+        """Closes the connections that are not checked out
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    # ................................
+    def get_stats(self):
+        """Returns a dictionary of pool usage and wait time statistics
+        """
+        with self._stats_lock:
+            avg_wait = 0.0
+            if self.checkouts > 0:
+                avg_wait = self.total_wait / self.checkouts
+            return {
+                'checkouts': self.checkouts,
+                'average_wait': avg_wait,
+                'max_wait': self.max_wait,
+                'idle': self._idle.qsize(),
+                'opened': self.num_opened,
+                'discarded': self.num_discarded
+            }
+
+
+# ............................................................................
+def get_connection_pool(logger, **connect_params):
+    """Gets the shared connection pool for a set of connection parameters
+
+    Args:
+        logger (LmLogger): A logger used if the pool is created.
+        **connect_params: Keyword arguments for psycopg2.connect.
+    """
+    pool_key = tuple(sorted(connect_params.items()))
+    with _POOLS_LOCK:
+        if pool_key not in _POOLS:
+            _POOLS[pool_key] = DbConnectionPool(logger, **connect_params)
+        return _POOLS[pool_key]
+
+
+# ............................................................................
+def close_connection_pools():
+    """Closes the idle connections in every shared pool
+    """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    for pool in pools:
+        pool.close_idle()
 
 
 # ............................................................................
@@ -20,7 +274,7 @@ class DbPostgresql(LMAbstractObject):
 
     # ................................
     def __init__(self, logger, db=None, user=None, password=None, host=None,
-                 port=None, schema=LM_SCHEMA):
+                 port=None, schema=LM_SCHEMA, pooled=False):
         """Constructor for the DbPostgresql class
 
         Args:
@@ -28,6 +282,8 @@ class DbPostgresql(LMAbstractObject):
             user: database user name
             password: password for this user and database
             host: full dns name of the database hosting server
+            pooled: if True, connections are checked out of a shared pool
+                when opened and returned to it when closed
         """
         self.map_conn_str = (
             'user={} password={} dbname={} host={} port={}'.format(
@@ -39,6 +295,7 @@ class DbPostgresql(LMAbstractObject):
         self.port = port
         self.db = db
         self.schema = schema
+        self.pooled = pooled
         self.last_commands = []
         self.pconn = None
         self.cursor = None
@@ -87,41 +344,12 @@ class DbPostgresql(LMAbstractObject):
         return col_arg_name.lstrip('@')
 
     # ................................
-    def _format_args(self, fn_args):
-        """Formats a list of arguments for passing within a function call
-
-        Args:
-            fn_args: Arguments to be formatted
+    def _get_pool(self):
+        """Returns the shared connection pool for this database and user
         """
-        return ','.join([self._format_val(val) for val in fn_args])
-
-    # ................................
-    def _format_val(self, val):
-        """Reformat the values into a string acceptable for a SQL command.
-
-        Note:
-            * Single (not double) quotes for strings
-            * Escape internal quotes
-            * No quotes for numbers
-            * Boolean handling - SQL standard - TRUE or FALSE
-
-        Args:
-            val: Value to be formatted
-        """
-        if isinstance(val, str):
-            val = val.replace('\'', "''").replace('\\', '\\\\')
-            db_val = "E'{}'".format(val)
-        elif isinstance(val, bool):
-            db_val = str(val).upper()
-        elif isinstance(val, (int, float)):
-            db_val = str(val)
-        elif val is None:
-            db_val = 'NULL'
-        else:
-            raise LMError(
-                'DbConn._formatVal: unsupported type {} for {}'.format(
-                    type(val), val), line_num=self.get_line_num())
-        return db_val
+        return get_connection_pool(
+            self.log, user=self.user, password=self.password, host=self.host,
+            port=self.port, database=self.db)
 
     # ................................
     def open(self):
@@ -132,27 +360,39 @@ class DbPostgresql(LMAbstractObject):
         """
         # if pconn is open, do nothing
         if self.pconn is not None and self.pconn.closed:
-            self.pconn = None
+            self.close(discard=True)
 
         if self.pconn is None:
-            self.pconn = psycopg2.connect(
-                user=self.user, password=self.password, host=self.host,
-                port=self.port, database=self.db)
+            if self.pooled:
+                self.pconn = self._get_pool().get_connection()
+            else:
+                self.pconn = psycopg2.connect(
+                    user=self.user, password=self.password, host=self.host,
+                    port=self.port, database=self.db,
+                    connection_factory=LmConnection)
 
         if self.pconn is None:
             raise LMError('Unable to open connection to {}'.format(self.db))
 
     # ................................
-    def close(self):
-        """Close database connection"""
+    def close(self, discard=False):
+        """Close database connection, or return it to the pool
+
+        Args:
+            discard: if True, a pooled connection is closed rather than
+                returned for reuse
+        """
         if self.pconn is not None:
-            self.pconn.close()
+            if self.pooled:
+                self._get_pool().put_connection(self.pconn, discard=discard)
+            else:
+                self.pconn.close()
         self.pconn = None
 
     # ................................
     def reopen(self):
         """Close database connection and reopen"""
-        self.close()
+        self.close(discard=True)
         self.open()
 
     # ................................
@@ -408,6 +648,51 @@ class DbPostgresql(LMAbstractObject):
                     return rows[0], idxs
         return None, None
 
+    # ................................
+    def execute_insert_and_select_batch_function(self, fn_name, fn_args_list):
+        """Execute a db function for each set of arguments in one transaction
+
+        Args:
+            fn_name: stored function name
+            fn_args_list: a list of argument sequences, one for each call
+
+        Returns:
+            List with the row returned by each call, in the order of
+                fn_args_list, or None for calls that returned a row of nulls,
+                and a dictionary of indexes for the column names
+
+        Raises:
+            LMError: on error returned from the database.
+        """
+        rows, idxs = self._execute_function_batch(fn_name, fn_args_list)
+        self.pconn.commit()
+        found_rows = []
+        for row in rows:
+            if row is not None and any(val is not None for val in row):
+                found_rows.append(row)
+            else:
+                found_rows.append(None)
+        return found_rows, idxs
+
+    # ................................
+    def execute_modify_batch_function(self, fn_name, fn_args_list):
+        """Execute a modify function for each set of arguments in one commit
+
+        Args:
+            fn_name: stored function name
+            fn_args_list: a list of argument sequences, one for each call
+
+        Returns:
+            list of bool - Indication of success for each call, in the order of
+                fn_args_list
+
+        Raises:
+            LMError: on error returned from the database.
+        """
+        rows, _ = self._execute_function_batch(fn_name, fn_args_list)
+        self.pconn.commit()
+        return [row is not None and row[0] == 0 for row in rows]
+
     # ................................
     def _execute_function(self, fn_name, fn_args):
         """Call a stored database function
@@ -423,11 +708,45 @@ class DbPostgresql(LMAbstractObject):
         Raises:
             LMError: on error returned from the database.
         """
-        cmd = 'select * from {}.{}({});'.format(
-            self.schema, fn_name, self._format_args(fn_args))
-        self.last_commands = [cmd]
+        return self._execute_with_retries(
+            self._call_function, fn_name, fn_args)
+
+    # ................................
+    def _execute_function_batch(self, fn_name, fn_args_list):
+        """Call a stored database function for each set of arguments
+
+        Args:
+            fn_name: stored function name
+            fn_args_list: a list of argument sequences, one for each call
+
+        Returns:
+            List with one row for each call, in the order of fn_args_list, and
+                dictionary of field names and column indexes.
+
+        Raises:
+            LMError: on error returned from the database.
+        """
+        return self._execute_with_retries(
+            self._call_function_batch, fn_name, fn_args_list)
+
+    # ................................
+    def _execute_with_retries(self, call_func, fn_name, fn_args):
+        """Call a function with the arguments, reopening and retrying on error
+
+        Args:
+            call_func: the function used to call the stored function
+            fn_name: stored function name
+            fn_args: the arguments passed on to call_func
+
+        Returns:
+            The rows and indexes returned by call_func
+
+        Raises:
+            LMError: if the call fails after RETRY_COUNT retries.
+        """
+        self.last_commands = [(fn_name, fn_args)]
         try:
-            rows, idxs = self._send_command(cmd)
+            rows, idxs = call_func(fn_name, fn_args)
         except:
             # Sometimes needs a reset, try up to 5 times
             tries = 0
@@ -437,7 +756,7 @@ class DbPostgresql(LMAbstractObject):
             while not success and tries < self.RETRY_COUNT:
                 tries += 1
                 try:
-                    rows, idxs = self._send_command(cmd)
+                    rows, idxs = call_func(fn_name, fn_args)
                     success = True
                 except:
                     self.log.warning(
@@ -446,16 +765,158 @@ class DbPostgresql(LMAbstractObject):
                     self.reopen()
             if not success:
                 raise LMError(
-                    'Failed to execute command {} after {} tries, pconn={}'.format(
-                        cmd, self.pconn, tries))
+                    'Failed to execute {}.{} after {} tries, pconn={}'.format(
+                        self.schema, fn_name, tries, self.pconn))
         return rows, idxs
 
     # ................................
-    def _send_command(self, *cmds):
-        """Send commands to the database and get response
+    def _call_function(self, fn_name, fn_args):
+        """Call a stored function once with bound arguments
+
+        Args:
+            fn_name: stored function name
+            fn_args: 0..n arguments to the stored function
+
+        Returns:
+            List of rows (row = tuple of values for a record) and dictionary of
+                field names and column indexes.
+
+        Raises:
+            LMError: on error returned from the database.
+        """
+        placeholders = ', '.join(['%s'] * len(fn_args))
+        stmt_name = self._get_prepared_statement(fn_name, len(fn_args))
+        if stmt_name is None:
+            cmd = 'select * from {}.{}({});'.format(
+                self.schema, fn_name, placeholders)
+        elif fn_args:
+            cmd = 'EXECUTE {} ({});'.format(stmt_name, placeholders)
+        else:
+            cmd = 'EXECUTE {};'.format(stmt_name)
+        return self._send_command(cmd, fn_args)
+
+    # ................................
+    def _call_function_batch(self, fn_name, fn_args_list):
+        """Call a stored function once for each set of arguments
+
+        The arguments are sent as a VALUES list that is joined laterally to
+        the function, so each page of calls is a single round trip.  Calls
+        run in order and later calls see the changes of earlier ones.
+
+        Args:
+            fn_name: stored function name
+            fn_args_list: a list of argument sequences, one for each call
+
+        Returns:
+            List with one row for each call, in the order of fn_args_list, and
+                dictionary of field names and column indexes.
+
+        Raises:
+            LMError: on error returned from the database.
+        """
+        if not fn_args_list:
+            return [], {}
+        num_args = len(fn_args_list[0])
+        arg_types = self._get_function_arg_types(fn_name, num_args)
+        if arg_types is None:
+            # Overloaded functions can not be cast, call them one at a time
+            rows = []
+            idxs = None
+            for fn_args in fn_args_list:
+                fn_rows, idxs = self._call_function(fn_name, fn_args)
+                rows.append(fn_rows[0] if fn_rows else None)
+            return rows, idxs
+
+        # VALUES columns only get their type from the values in them, so
+        #    cast each column to the function argument type
+        cmd = (
+            'SELECT f.* FROM (VALUES %s) AS v(lm_row, {}) '
+            'LEFT JOIN LATERAL {}.{}({}) AS f ON TRUE '
+            'ORDER BY v.lm_row;').format(
+                ', '.join('a{}'.format(i) for i in range(num_args)),
+                self.schema, fn_name, ', '.join(
+                    'v.a{}::{}'.format(i, arg_type)
+                    for i, arg_type in enumerate(arg_types)))
+        values = [
+            (row_num, ) + tuple(fn_args)
+            for row_num, fn_args in enumerate(fn_args_list)]
+        self.last_commands = [(cmd, fn_name, len(values))]
+
+        cursor = self.pconn.cursor()
+        try:
+            rows = execute_values(
+                cursor, cmd, values, page_size=DB_BATCH_SIZE, fetch=True)
+            idxs = self._get_col_positions_by_name(cursor)
+        except Exception as err:
+            raise LMError(
+                'Exception on batch command {}'.format(
+                    self.last_commands), err, do_trace=True)
+        cursor.close()
+        return rows, idxs
+
+    # ................................
+    def _get_function_arg_types(self, fn_name, num_args):
+        """Get the argument types of a stored function
+
+        Args:
+            fn_name: stored function name
+            num_args: the number of arguments the function is called with
+
+        Returns:
+            list of str - The type name of each argument, or None if the
+                function is overloaded for this number of arguments.
+        """
+        if not self.is_open:
+            raise LMError('Database connection is still None!')
+        arg_types = self.pconn.arg_types
+        fn_key = (self.schema, fn_name.lower(), num_args)
+        if fn_key not in arg_types:
+            rows, _ = self._send_command(_ARG_TYPES_QUERY, fn_key)
+            arg_types[fn_key] = rows[0][0] if len(rows) == 1 else None
+        return arg_types[fn_key]
+
+    # ................................
+    def _get_prepared_statement(self, fn_name, num_args):
+        """Get the name of the prepared statement for a stored function
+
+        The statement is prepared on the current connection the first time
+        the function is called with this number of arguments.
+
+        Args:
+            fn_name: stored function name
+            num_args: the number of arguments the function is called with
+
+        Returns:
+            str - The statement name, or None if the function is overloaded
+                for this number of arguments and is called directly.
+        """
+        if not self.is_open:
+            raise LMError('Database connection is still None!')
+        prepared = self.pconn.prepared
+        unique_functions = self.pconn.unique_functions
+        stmt_key = (self.schema, fn_name.lower(), num_args)
+        if stmt_key not in prepared:
+            if self.schema not in unique_functions:
+                rows, _ = self._send_command(
+                    _UNIQUE_FUNCTIONS_QUERY, (self.schema,))
+                unique_functions[self.schema] = set(rows)
+            stmt_name = None
+            if stmt_key[1:] in unique_functions[self.schema]:
+                stmt_name = 'lm_stmt_{}'.format(len(prepared))
+                self._send_command(
+                    'PREPARE {} AS select * from {}.{}({});'.format(
+                        stmt_name, self.schema, fn_name, ', '.join(
+                            '${}'.format(i + 1) for i in range(num_args))))
+            prepared[stmt_key] = stmt_name
+        return prepared[stmt_key]
+
+    # ................................
+    def _send_command(self, cmd, params=None):
+        """Send a command to the database and get response
 
         Args:
-            *cmds: 0..n commands to be executed.
+            cmd: the command to be executed, with %s placeholders for params
+            params: optional sequence of values bound to the placeholders
 
         Returns:
             List of rows (row = tuple of values for a record) and dictionary of
@@ -465,16 +926,17 @@ class DbPostgresql(LMAbstractObject):
             LMError: on error returned from the database.
         """
         idxs = None
-        self.last_commands = [cmds]
+        self.last_commands = [(cmd, params)]
 
         if self.is_open:
             cursor = self.pconn.cursor()
             try:
-                for cmd in cmds:
-                    cursor.execute(cmd)
+                cursor.execute(cmd, params)
 
                 idxs = self._get_col_positions_by_name(cursor)
-                rows = cursor.fetchall()
+                rows = []
+                if cursor.description:
+                    rows = cursor.fetchall()
 
             except LMError:
                 raise
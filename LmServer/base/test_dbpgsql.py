@@ -0,0 +1,303 @@
+"""Tests for the connection pool and stored function calls in dbpgsql.py
+"""
+import threading
+import time
+
+import pytest
+
+from LmBackend.common.lmobj import LMError
+from LmCommon.common.log import TestLogger
+from LmServer.base import dbpgsql
+from LmServer.base.dbpgsql import DbPostgresql
+from LmServer.common.lmconstants import DB_POOL_CHECK_INTERVAL, LM_SCHEMA
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+# (function name, number of arguments) of functions with one signature
+UNIQUE_FUNCTIONS = [('lm_getthing', 2), ('lm_countthings', 0)]
+THING_COLUMNS = ['thingid', 'name']
+
+
+# .............................................................................
+def _respond(cmd, params):
+    """Answers the commands sent for stored function calls"""
+    if cmd == dbpgsql._UNIQUE_FUNCTIONS_QUERY:
+        return ['proname', 'pronargs'], UNIQUE_FUNCTIONS
+    if cmd.startswith('PREPARE'):
+        return [], []
+    if cmd.startswith('EXECUTE lm_stmt_0 '):
+        return THING_COLUMNS, [tuple(params)]
+    if cmd.startswith('EXECUTE'):
+        return ['count'], [(3, )]
+    # Overloaded functions are called directly
+    return ['total'], [(sum(params), )]
+
+
+# .............................................................................
+def _get_db(fake_db_pool, **pool_kwargs):
+    """Gets an open pooled database object and its pool"""
+    pool = fake_db_pool(**pool_kwargs)
+    db = DbPostgresql(TestLogger('test_dbpgsql'), db='test', pooled=True)
+    db.open()
+    db.pconn.respond = _respond
+    return db, pool
+
+
+# .............................................................................
+def test_pool_checkout_and_return(fake_db_pool):
+    """Returned connections are rolled back and reused"""
+    pool = fake_db_pool(max_size=2)
+    conn_1 = pool.get_connection()
+    conn_2 = pool.get_connection()
+    assert conn_1 is not conn_2
+
+    conn_1.cursor().execute('SELECT 1')
+    pool.put_connection(conn_1)
+    assert conn_1.rollbacks == 1
+    assert pool.get_connection() is conn_1
+
+    pool.put_connection(conn_2, discard=True)
+    assert conn_2.closed
+    pool.put_connection(conn_1)
+    assert pool.get_connection() is conn_1
+    assert pool.get_connection() is not conn_2
+
+    stats = pool.get_stats()
+    assert stats['checkouts'] == 5
+    assert stats['opened'] == 3
+    assert stats['discarded'] == 1
+    assert stats['idle'] == 0
+    assert 0 <= stats['average_wait'] <= stats['max_wait']
+
+
+# .............................................................................
+def test_pool_health_check(fake_db_pool):
+    """Connections idle for a while are checked before they are reused"""
+    pool = fake_db_pool(max_size=1)
+    conn = pool.get_connection()
+    pool.put_connection(conn)
+
+    # Recently used connections are not checked
+    assert pool.get_connection() is conn
+    assert conn.commands == []
+    conn.last_used = time.time() - DB_POOL_CHECK_INTERVAL - 1
+    pool.put_connection(conn)
+    assert conn.commands == []
+
+    conn.last_used = time.time() - DB_POOL_CHECK_INTERVAL - 1
+    assert pool.get_connection() is conn
+    assert conn.commands == [('SELECT 1', None)]
+    pool.put_connection(conn)
+
+    # Failed and closed connections are replaced
+    conn.last_used = time.time() - DB_POOL_CHECK_INTERVAL - 1
+    conn.fail = True
+    new_conn = pool.get_connection()
+    assert new_conn is not conn
+    assert conn.closed
+    new_conn.close()
+    pool.put_connection(new_conn)
+    assert pool.get_connection() is not new_conn
+    assert pool.get_stats()['discarded'] == 2
+
+
+# .............................................................................
+def test_pool_timeout(fake_db_pool):
+    """Callers wait for a returned connection and time out without one"""
+    pool = fake_db_pool(max_size=1, timeout=0.2)
+    conn = pool.get_connection()
+    with pytest.raises(LMError):
+        pool.get_connection()
+    assert pool.get_stats()['max_wait'] >= 0.2
+
+    # A connection returned by another thread ends the wait
+    timer = threading.Timer(0.1, pool.put_connection, args=(conn, ))
+    timer.start()
+    assert pool.get_connection() is conn
+    timer.join()
+    stats = pool.get_stats()
+    assert stats['checkouts'] == 3
+    assert stats['opened'] == 1
+
+
+# .............................................................................
+def test_prepared_statements(fake_db_pool):
+    """Unique functions are prepared once and executed with bound values"""
+    db, _ = _get_db(fake_db_pool)
+    conn = db.pconn
+    name = "O'Brien; DROP TABLE thing"
+
+    row, idxs = db.execute_select_one_function('lm_getThing', 7, name)
+    assert row == (7, name)
+    assert idxs == {'thingid': 0, 'name': 1}
+    assert [cmd for cmd, _ in conn.commands] == [
+        dbpgsql._UNIQUE_FUNCTIONS_QUERY,
+        'PREPARE lm_stmt_0 AS select * from {}.lm_getThing($1, $2);'.format(
+            LM_SCHEMA),
+        'EXECUTE lm_stmt_0 (%s, %s);']
+    assert conn.commands[2][1] == (7, name)
+
+    # Later calls only execute the statement
+    conn.commands.clear()
+    row, _ = db.execute_select_one_function('lm_getThing', 8, 'other')
+    assert row == (8, 'other')
+    assert conn.commands == [('EXECUTE lm_stmt_0 (%s, %s);', (8, 'other'))]
+
+    conn.commands.clear()
+    assert db.execute_modify_return_value('lm_countThings') == 3
+    assert [cmd for cmd, _ in conn.commands] == [
+        'PREPARE lm_stmt_1 AS select * from {}.lm_countThings();'.format(
+            LM_SCHEMA),
+        'EXECUTE lm_stmt_1;']
+    assert conn.commits == 1
+
+    # Functions overloaded for the number of arguments are called directly
+    conn.commands.clear()
+    row, _ = db.execute_select_one_function('lm_getThing', 1, 2, 3)
+    assert row == (6, )
+    assert conn.commands == [
+        ('select * from {}.lm_getThing(%s, %s, %s);'.format(LM_SCHEMA),
+         (1, 2, 3))]
+    db.close()
+
+
+# .............................................................................
+def test_failed_call_reopens(fake_db_pool):
+    """A failed connection is discarded and statements prepared again"""
+    db, pool = _get_db(fake_db_pool)
+    db.execute_select_one_function('lm_getThing', 1, 'a')
+    failed_conn = db.pconn
+    failed_conn.fail = True
+
+    # Reopened connections do not have the responses of the failed one
+    def _open_responding():
+        DbPostgresql.open(db)
+        db.pconn.respond = _respond
+
+    db.open = _open_responding
+    row, _ = db.execute_select_one_function('lm_getThing', 2, 'b')
+    assert row == (2, 'b')
+    assert failed_conn.closed
+    assert db.pconn is not failed_conn
+    assert [cmd for cmd, _ in db.pconn.commands] == [
+        dbpgsql._UNIQUE_FUNCTIONS_QUERY,
+        'PREPARE lm_stmt_0 AS select * from {}.lm_getThing($1, $2);'.format(
+            LM_SCHEMA),
+        'EXECUTE lm_stmt_0 (%s, %s);']
+
+    db.close()
+    stats = pool.get_stats()
+    assert stats['discarded'] == 1
+    assert stats['idle'] == 1
+
+
+# .............................................................................
+def _respond_batch(cmd, params):
+    """Answers batched calls as the database would
+
+    lm_findOrInsertThing returns NULL for things without a name and
+    lm_updateThing returns 0 for success, or NULL when the thing is missing.
+    """
+    if cmd == dbpgsql._ARG_TYPES_QUERY:
+        if params[1] == 'lm_overloaded':
+            return ['proargtypes'], []
+        return ['proargtypes'], [(['integer', 'text'], )]
+    if cmd.startswith('SELECT f.* FROM (VALUES '):
+        if 'lm_updateThing' in cmd:
+            return ['success'], [
+                (None, ) if thing_id < 0 else (0, )
+                for _, thing_id, _ in params]
+        return THING_COLUMNS, [
+            (None, None) if name is None else (thing_id * 10, name)
+            for _, thing_id, name in params]
+    return _respond(cmd, params)
+
+
+# .............................................................................
+def _get_batch_sql(fn_name, values):
+    """Gets the batched call of a function with integer and text arguments"""
+    return (
+        'SELECT f.* FROM (VALUES {}) AS v(lm_row, a0, a1) '
+        'LEFT JOIN LATERAL {}.{}(v.a0::integer, v.a1::text) AS f ON TRUE '
+        'ORDER BY v.lm_row;').format(
+            ','.join('({})'.format(', '.join(repr(val) for val in row))
+                     for row in values),
+            LM_SCHEMA, fn_name)
+
+
+# .............................................................................
+def test_insert_and_select_batch(fake_db_pool):
+    """Batches are sent in pages of numbered, cast values in call order"""
+    db, _ = _get_db(fake_db_pool)
+    conn = db.pconn
+    conn.respond = _respond_batch
+    num_calls = 2 * dbpgsql.DB_BATCH_SIZE + 3
+    fn_args_list = [
+        (i, None if i % 7 == 3 else 'thing {}'.format(i))
+        for i in range(num_calls)]
+
+    rows, idxs = db.execute_insert_and_select_batch_function(
+        'lm_findOrInsertThing', fn_args_list)
+    assert idxs == {'thingid': 0, 'name': 1}
+    assert rows == [
+        None if name is None else (i * 10, name)
+        for i, name in fn_args_list]
+
+    assert conn.commands[0] == (
+        dbpgsql._ARG_TYPES_QUERY, (LM_SCHEMA, 'lm_findorinsertthing', 2))
+    pages = conn.commands[1:]
+    assert len(pages) == 3
+    values = [(i, ) + fn_args for i, fn_args in enumerate(fn_args_list)]
+    for page_num, (cmd, params) in enumerate(pages):
+        page_values = values[page_num * dbpgsql.DB_BATCH_SIZE:
+                             (page_num + 1) * dbpgsql.DB_BATCH_SIZE]
+        assert params == page_values
+        assert cmd == _get_batch_sql('lm_findOrInsertThing', page_values)
+    assert conn.commits == 1
+
+    # Argument types are looked up once for each connection
+    conn.commands.clear()
+    rows, _ = db.execute_insert_and_select_batch_function(
+        'lm_findOrInsertThing', [(5, 'five')])
+    assert rows == [(50, 'five')]
+    assert conn.commands == [(
+        _get_batch_sql('lm_findOrInsertThing', [(0, 5, 'five')]),
+        [(0, 5, 'five')])]
+
+    assert db.execute_insert_and_select_batch_function(
+        'lm_findOrInsertThing', []) == ([], {})
+    db.close()
+
+
+# .............................................................................
+def test_modify_batch(fake_db_pool):
+    """Each call of a batched update reports its own success"""
+    db, _ = _get_db(fake_db_pool)
+    conn = db.pconn
+    conn.respond = _respond_batch
+    fn_args_list = [(1, 'a'), (-2, 'missing'), (3, 'c')]
+
+    assert db.execute_modify_batch_function(
+        'lm_updateThing', fn_args_list) == [True, False, True]
+    assert conn.commands[-1][0] == _get_batch_sql(
+        'lm_updateThing', [(0, 1, 'a'), (1, -2, 'missing'), (2, 3, 'c')])
+    assert conn.commits == 1
+    db.close()
+
+
+# .............................................................................
+def test_overloaded_batch(fake_db_pool):
+    """Functions that can not be cast are called one at a time"""
+    db, _ = _get_db(fake_db_pool)
+    conn = db.pconn
+    conn.respond = _respond_batch
+
+    rows, idxs = db.execute_insert_and_select_batch_function(
+        'lm_overloaded', [(1, 2), (3, 4)])
+    assert rows == [(3, ), (7, )]
+    assert idxs == {'total': 0}
+    assert conn.commands[-2:] == [
+        ('select * from {}.lm_overloaded(%s, %s);'.format(LM_SCHEMA), (1, 2)),
+        ('select * from {}.lm_overloaded(%s, %s);'.format(LM_SCHEMA), (3, 4))]
+    db.close()
@@ -97,6 +97,16 @@ SALT = "4303e8f7129243fd42a57bcc18a19f5b"
 
 # database name
 DB_STORE = 'borg'
+# The maximum number of pooled connections for each database and user
+DB_POOL_SIZE = 10
+# Seconds to wait for a pooled connection before failing
+DB_POOL_TIMEOUT = 30
+# Seconds a pooled connection may sit idle before it is checked on checkout
+DB_POOL_CHECK_INTERVAL = 60
+# Pool waits longer than this many seconds are logged as warnings
+DB_POOL_SLOW_WAIT = 1.0
+# The number of stored function calls sent in each round trip of a batch
+DB_BATCH_SIZE = 500
 
 # Relative paths
 # For LmCompute command construction by LmServer (for Makeflow)
@@ -1105,6 +1115,12 @@ SOLR_POST_COMMAND = '/opt/solr/bin/post'
 SOLR_SERVER = 'http://localhost:8983/solr/'
 # TODO: Consider moving to localconstants
 NUM_DOCS_PER_POST = 100
+# The number of documents requested in each page of a streaming Solr query
+SOLR_PAGE_SIZE = 1000
+# Seconds to wait for a Solr response before failing
+SOLR_TIMEOUT = 300
+# The maximum number of batches of documents posted to Solr at once
+SOLR_POST_WORKERS = 4
 
 
 class SOLR_FIELDS:
@@ -1,17 +1,27 @@
 """This module wraps interactions with Solr
 """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import itertools
 import json
+import queue
 from urllib.error import URLError
+import urllib.parse
 import urllib.request
 
 from LmBackend.common.lmobj import LMError
 from LmCommon.common.lmconstants import ENCODING
 from LmCommon.common.time import LmTime
 from LmServer.common.lmconstants import (
-    SnippetFields, SOLR_ARCHIVE_COLLECTION, SOLR_FIELDS, SOLR_SERVER,
-    SOLR_SNIPPET_COLLECTION, SOLR_TAXONOMY_COLLECTION, SOLR_TAXONOMY_FIELDS)
+    NUM_DOCS_PER_POST, SnippetFields, SOLR_ARCHIVE_COLLECTION, SOLR_FIELDS,
+    SOLR_PAGE_SIZE, SOLR_POST_WORKERS, SOLR_SERVER, SOLR_SNIPPET_COLLECTION,
+    SOLR_TAXONOMY_COLLECTION, SOLR_TAXONOMY_FIELDS, SOLR_TIMEOUT)
 from LmServer.common.log import SolrLogger
 
+# Idle keep-alive connections to Solr, reused by every query
+_CONNECTION_POOL = queue.LifoQueue()
+
 
 # .............................................................................
 def build_solr_document(doc_pairs):
@@ -64,6 +74,59 @@ def post_solr_document(collection, doc_filename):
         collection, doc_filename, headers={'Content-Type': 'text/xml'})
 
 
+# .............................................................................
+def post_solr_documents(collection, doc_pairs, batch_size=NUM_DOCS_PER_POST,
+                        max_workers=SOLR_POST_WORKERS, out_file=None):
+    """Post many documents to a Solr index in batches with a single commit.
+
+    Args:
+        collection: The name of the Solr core (index) to add documents to
+        doc_pairs: An iterable of lists of (field name, value) pairs, one for
+            each document.  It is consumed as batches are posted, so
+            documents may be generated while earlier batches are in flight.
+        batch_size: The number of documents to include in each POST
+        max_workers: The maximum number of batches posted at once
+        out_file: An optional open file to write the posted documents to as a
+            single Solr update document
+
+    Returns:
+        The number of documents posted
+    """
+    path = '{}{}/update'.format(
+        urllib.parse.urlsplit(SOLR_SERVER).path, collection)
+    headers = {'Content-Type': 'text/xml'}
+    if out_file is not None:
+        out_file.write('<update>\n')
+
+    num_docs = 0
+    doc_iter = iter(doc_pairs)
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batch = list(itertools.islice(doc_iter, batch_size))
+        while batch:
+            post_bytes = build_solr_document(batch)
+            if out_file is not None:
+                out_file.write('{}\n'.format(post_bytes.decode(ENCODING)))
+            # Bound the number of batches held in memory
+            if len(in_flight) >= max_workers:
+                in_flight.popleft().result()
+            in_flight.append(executor.submit(
+                _send_request, 'POST', path, body=post_bytes,
+                headers=headers))
+            num_docs += len(batch)
+            batch = list(itertools.islice(doc_iter, batch_size))
+        for posted in in_flight:
+            posted.result()
+
+    if out_file is not None:
+        out_file.write('</update>\n')
+    if num_docs > 0:
+        _send_request(
+            'POST', '{}?commit=true'.format(path), body=b'<commit/>',
+            headers=headers)
+    return num_docs
+
+
 # .............................................................................
 def _post(collection, doc_filename, headers=None):
     """Post a document to a Solr index."""
@@ -80,17 +143,16 @@ def _post(collection, doc_filename, headers=None):
 
 
 # .............................................................................
-def _query(collection, q_params=None, fq_params=None,
-           other_params='wt=json&indent=true'):
-    """Perform a query on a Solr index.
+def _get_query_parts(q_params=None, fq_params=None):
+    """Get the query and filter parts of a Solr query string.
 
     Args:
-        collection: The Solr collection (index / core) to query
         q_params: Parameters to include in the query section of the Solr query
         fq_params: Parameters to include in the filter section of the query
-        other_params: Other parameters to pass to Solr
+
+    Returns:
+        A list of query string parts to be joined with '&'
     """
-    log = SolrLogger()
     query_parts = []
     if q_params:
         q_parts = []
@@ -124,6 +186,150 @@ def _query(collection, q_params=None, fq_params=None,
 
     if len(query_parts) == 0:
         query_parts.append('q=*:*')
+    return query_parts
+
+
+# .............................................................................
+def _get_connection():
+    """Get an idle keep-alive HTTP connection to Solr from the pool."""
+    try:
+        return _CONNECTION_POOL.get_nowait()
+    except queue.Empty:
+        url_parts = urllib.parse.urlsplit(SOLR_SERVER)
+        if url_parts.scheme == 'https':
+            return http.client.HTTPSConnection(
+                url_parts.netloc, timeout=SOLR_TIMEOUT)
+        return http.client.HTTPConnection(
+            url_parts.netloc, timeout=SOLR_TIMEOUT)
+
+
+# .............................................................................
+def _send_request(method, path, body=None, headers=None):
+    """Send a request to Solr over a pooled keep-alive connection.
+
+    Args:
+        method: The HTTP method of the request
+        path: The path and query string of the request
+        body: Optional bytes to send with the request
+        headers: Optional HTTP headers for the request
+
+    Returns:
+        The bytes of the response body
+
+    Note:
+        A pooled connection closed by Solr while idle is replaced and the
+            request is retried once.
+    """
+    for attempt in range(2):
+        conn = _get_connection()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            res = conn.getresponse()
+            data = res.read()
+        except (http.client.HTTPException, OSError) as err:
+            conn.close()
+            if attempt > 0:
+                SolrLogger().error(
+                    'Exception on request for {}: {}'.format(path, str(err)),
+                    err)
+                raise
+        else:
+            _CONNECTION_POOL.put(conn)
+            if res.status != 200:
+                raise LMError(
+                    'Solr request {} failed with status {}'.format(
+                        path, res.status))
+            return data
+    return None
+
+
+# .............................................................................
+def _get_json(collection, query_string):
+    """Perform a Solr query over a pooled keep-alive connection.
+
+    Args:
+        collection: The Solr collection (index / core) to query
+        query_string: The full query string for the select handler
+    """
+    return json.loads(_send_request('GET', '{}{}/select?{}'.format(
+        urllib.parse.urlsplit(SOLR_SERVER).path, collection, query_string)))
+
+
+# .............................................................................
+def _stream_query(collection, q_params=None, fq_params=None, fields=None,
+                  page_size=SOLR_PAGE_SIZE, limit=None):
+    """Perform a Solr query and generate the matching documents.
+
+    The query is paged with a cursor mark so that every match is returned and
+    only one page is held in memory.  The next page is fetched in a
+    background thread while the documents of the current page are consumed.
+
+    Args:
+        collection: The Solr collection (index / core) to query
+        q_params: Parameters to include in the query section of the Solr query
+        fq_params: Parameters to include in the filter section of the query
+        fields: An optional list of the document fields to return
+        page_size: The number of documents to request in each page
+        limit: An optional maximum number of documents to return, pages past
+            this limit are not requested
+
+    Yields:
+        Each matching Solr document as a dictionary
+    """
+    if limit is not None:
+        if limit <= 0:
+            return
+        page_size = min(page_size, limit)
+    query_parts = _get_query_parts(q_params=q_params, fq_params=fq_params)
+    # Cursors require a sort on the unique key
+    query_parts.extend([
+        'wt=json', 'rows={}'.format(page_size),
+        'sort={}+asc'.format(SOLR_FIELDS.ID)])
+    if fields:
+        query_parts.append('fl={}'.format(','.join(fields)))
+
+    # ...........................
+    def _fetch_page(cursor_mark):
+        return _get_json(collection, '&'.join(query_parts + [
+            'cursorMark={}'.format(
+                urllib.parse.quote(cursor_mark, safe=''))]))
+
+    num_docs = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        cursor_mark = '*'
+        next_page = executor.submit(_fetch_page, cursor_mark)
+        while next_page is not None:
+            r_dict = next_page.result()
+            docs = r_dict['response']['docs']
+            next_cursor_mark = r_dict.get('nextCursorMark', cursor_mark)
+            if limit is not None:
+                docs = docs[:limit - num_docs]
+            num_docs += len(docs)
+
+            # Solr returns the same cursor mark when there are no more pages
+            next_page = None
+            if len(docs) == page_size and next_cursor_mark != cursor_mark and (
+                    limit is None or num_docs < limit):
+                cursor_mark = next_cursor_mark
+                next_page = executor.submit(_fetch_page, cursor_mark)
+
+            for doc in docs:
+                yield doc
+
+
+# .............................................................................
+def _query(collection, q_params=None, fq_params=None,
+           other_params='wt=json&indent=true'):
+    """Perform a query on a Solr index.
+
+    Args:
+        collection: The Solr collection (index / core) to query
+        q_params: Parameters to include in the query section of the Solr query
+        fq_params: Parameters to include in the filter section of the query
+        other_params: Other parameters to pass to Solr
+    """
+    log = SolrLogger()
+    query_parts = _get_query_parts(q_params=q_params, fq_params=fq_params)
 
     if other_params is not None:
         query_parts.append(other_params)
@@ -299,14 +505,15 @@ def facet_archive_on_gridset(user_id=None):
 
 
 # .............................................................................
-def query_archive_index(algorithm_code=None, bbox=None, display_name=None,
-                        gridset_id=None, model_scenario_code=None,
-                        point_max=None, point_min=None,
-                        projection_scenario_code=None, squid=None,
-                        tax_kingdom=None, tax_phylum=None, tax_class=None,
-                        tax_order=None, tax_family=None, tax_genus=None,
-                        tax_species=None, user_id=None, pam_id=None):
-    """Query the PAV archive Solr index."""
+def _get_archive_query_params(algorithm_code=None, bbox=None,
+                              display_name=None, gridset_id=None,
+                              model_scenario_code=None, point_max=None,
+                              point_min=None, projection_scenario_code=None,
+                              squid=None, tax_kingdom=None, tax_phylum=None,
+                              tax_class=None, tax_order=None, tax_family=None,
+                              tax_genus=None, tax_species=None, user_id=None,
+                              pam_id=None):
+    """Get the query and filter parameters for a PAV archive query."""
     q_params = [
         (SOLR_FIELDS.ALGORITHM_CODE, algorithm_code),
         (SOLR_FIELDS.DISPLAY_NAME, display_name),
@@ -338,14 +545,66 @@ def query_archive_index(algorithm_code=None, bbox=None, display_name=None,
         fq_params.append(
             (SOLR_FIELDS.PRESENCE, '%5B{},{}%20{},{}%5D'.format(
                 miny, minx, maxy, maxx)))
+    return q_params, fq_params
+
+
+# .............................................................................
+def iter_archive_index(fields=None, page_size=SOLR_PAGE_SIZE, limit=None,
+                       **query_params):
+    """Generate the PAV archive Solr index documents matching a query.
 
+    Args:
+        fields: An optional list of the document fields to return, such as
+            only the identifiers and compressed PAVs
+        page_size: The number of documents to request from Solr at a time
+        limit: An optional maximum number of documents to return
+        **query_params: Query parameters, see query_archive_index
+
+    Yields:
+        Each matching Solr document as a dictionary
+    """
+    q_params, fq_params = _get_archive_query_params(**query_params)
     try:
-        r_dict = _query(
-            SOLR_ARCHIVE_COLLECTION, q_params=q_params, fq_params=fq_params)
+        for doc in _stream_query(
+                SOLR_ARCHIVE_COLLECTION, q_params=q_params,
+                fq_params=fq_params, fields=fields, page_size=page_size,
+                limit=limit):
+            yield doc
+    except LMError:
+        raise
     except Exception as err:
         raise LMError(err)
 
-    return r_dict['response']['docs']
+
+# .............................................................................
+def query_archive_index(algorithm_code=None, bbox=None, display_name=None,
+                        gridset_id=None, model_scenario_code=None,
+                        point_max=None, point_min=None,
+                        projection_scenario_code=None, squid=None,
+                        tax_kingdom=None, tax_phylum=None, tax_class=None,
+                        tax_order=None, tax_family=None, tax_genus=None,
+                        tax_species=None, user_id=None, pam_id=None,
+                        fields=None, limit=None):
+    """Query the PAV archive Solr index.
+
+    Args:
+        fields: An optional list of the document fields to return
+        limit: An optional maximum number of documents to return.  Every
+            matching document is returned if this is None.
+
+    Returns:
+        A list of the matching Solr documents, see iter_archive_index to
+        process documents without holding them all in memory
+    """
+    return list(iter_archive_index(
+        fields=fields, limit=limit, algorithm_code=algorithm_code, bbox=bbox,
+        display_name=display_name, gridset_id=gridset_id,
+        model_scenario_code=model_scenario_code, point_max=point_max,
+        point_min=point_min,
+        projection_scenario_code=projection_scenario_code, squid=squid,
+        tax_kingdom=tax_kingdom, tax_phylum=tax_phylum, tax_class=tax_class,
+        tax_order=tax_order, tax_family=tax_family, tax_genus=tax_genus,
+        tax_species=tax_species, user_id=user_id, pam_id=pam_id))
 
 
 # .............................................................................
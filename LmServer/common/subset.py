@@ -4,17 +4,24 @@ Todo:
     Clean up code and rewrite where necessary
 """
 
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import os
+import threading
 
 import numpy as np
 from osgeo import ogr
 
 from LmBackend.command.server import IndexPAVCommand, StockpileCommand
-from LmBackend.command.single import IntersectRasterCommand, GrimRasterCommand
+from LmBackend.command.single import (
+    GrimRasterBatchCommand, IntersectRasterBatchCommand)
+from LmBackend.common.lmobj import LMError
 from LmCommon.common.lmconstants import (
     JobStatus, LMFormat, MatrixType, ProcessType)
 from LmCommon.common.time import gmt
-from LmCommon.compression.binary_list import decompress
+from LmCommon.compression.binary_list import (
+    decompress, decompress_indices)
 from LmCommon.encoding.layer_encoder import LayerEncoder
 from LmServer.base.service_object import ServiceObject
 from LmServer.common.lmconstants import SOLR_FIELDS, SubsetMethod, Priority
@@ -28,6 +35,24 @@ from LmServer.legion.shapegrid import Shapegrid
 from LmServer.legion.tree import Tree
 from lmpy import Matrix
 
+# Note: The Solr fields used when subsetting, query only these to avoid
+#    transferring unused document fields
+SUBSET_SOLR_FIELDS = [
+    SOLR_FIELDS.ID, SOLR_FIELDS.ALGORITHM_CODE, SOLR_FIELDS.COMPRESSED_PAV,
+    SOLR_FIELDS.EPSG_CODE, SOLR_FIELDS.GRIDSET_ID, SOLR_FIELDS.PROJ_ID,
+    SOLR_FIELDS.PROJ_SCENARIO_ALT_PRED_CODE, SOLR_FIELDS.PROJ_SCENARIO_CODE,
+    SOLR_FIELDS.PROJ_SCENARIO_DATE_CODE, SOLR_FIELDS.PROJ_SCENARIO_GCM,
+    SOLR_FIELDS.PROJ_SCENARIO_ID, SOLR_FIELDS.SHAPEGRID_ID, SOLR_FIELDS.SQUID]
+
+# Note: The number of shapegrid site indexes to keep in memory, subsets of the
+#    same global PAM reuse the index of its shapegrid
+SITE_INDEX_CACHE_SIZE = 4
+_SITE_INDEXES = OrderedDict()
+_SITE_INDEX_LOCK = threading.Lock()
+
+# Note: The number of scenario / algorithm PAMs to assemble at once
+SUBSET_WORKERS = 4
+
 
 # .............................................................................
 def subset_global_pam(archive_name, matches, user_id, bbox=None,
@@ -36,7 +61,9 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
 
     Args:
         archive_name (str): The name of the new gridset.
-        matches: Solr hits to be used for subsetting
+        matches: An iterable of Solr hits to be used for subsetting, such as
+            the generator returned by iter_archive_index.  Only the fields in
+            SUBSET_SOLR_FIELDS are used.
         user_id (str): The user that will own the new gridset
 
     Todo:
@@ -51,7 +78,10 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
         log = scribe.log
 
     # Get metadata
-    match_1 = matches[0]
+    matches = iter(matches)
+    match_1 = next(matches, None)
+    if match_1 is None:
+        raise LMError('No Solr matches to subset')
     orig_shp = scribe.get_shapegrid(match_1[SOLR_FIELDS.SHAPEGRID_ID])
     orig_num_rows = orig_shp.feature_count
     epsg = match_1[SOLR_FIELDS.EPSG_CODE]
@@ -73,7 +103,8 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
         MatrixColumn.INTERSECT_PARAM_MIN_PERCENT: 25
     }
 
-    orig_row_headers = get_row_headers(orig_shp.get_dlocation())
+    site_index = get_site_index(orig_shp.get_dlocation())
+    keep_sites = None
 
     # If bounding box, resolution, or user is different, create a new shapegrid
     if bbox != orig_shp.bbox or cell_size != orig_shp.cell_size or \
@@ -105,25 +136,18 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
         # Else, if the bounding box is different, we need to spatially subset
         elif bbox != orig_shp.bbox:
             method = SubsetMethod.SPATIAL
+            keep_sites = site_index.get_sites_in_bbox(bbox)
             bbox_wkt = \
                 'POLYGON(({0} {1},{0} {3},{2} {3},{2} {1},{0} {1}))'.format(
                     *bbox)
-            orig_shp.cutout(bbox_wkt, dloc=my_shp.get_dlocation())
-
-            row_headers = get_row_headers(my_shp.get_dlocation())
-            orig_row_headers = get_row_headers(orig_shp.get_dlocation())
-
-            keep_sites = []
-            for i, hdr in enumerate(orig_row_headers):
-                if hdr in row_headers:
-                    keep_sites.append(i)
+            orig_shp.cutout(
+                bbox_wkt, dloc=my_shp.get_dlocation(),
+                keep_fids=set(site_index.fids[keep_sites].tolist()))
 
         # Else, we can just subset the PAM columns
         else:
             method = SubsetMethod.COLUMN
 
-            row_headers = get_row_headers(orig_shp.get_dlocation())
-
             # Copy original shapegrid to new location
             orig_shp.write_shapefile(my_shp.get_dlocation())
 
@@ -144,7 +168,7 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
 
     # Create a dictionary of matches by scenario and algorithm
     match_groups = {}
-    for match in matches:
+    for match in itertools.chain([match_1], matches):
         scn_id = match[SOLR_FIELDS.PROJ_SCENARIO_ID]
         alg_code = match[SOLR_FIELDS.ALGORITHM_CODE]
 
@@ -205,62 +229,56 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
     if method in [SubsetMethod.COLUMN, SubsetMethod.SPATIAL]:
         # PAMs
         # --------
-        for scn_id in list(match_groups.keys()):
-            for alg_code, mtx_matches in match_groups[scn_id].items():
-
-                scn_code = mtx_matches[0][SOLR_FIELDS.PROJ_SCENARIO_CODE]
-                date_code = alt_pred_code = gcm_code = None
-
-                if SOLR_FIELDS.PROJ_SCENARIO_DATE_CODE in mtx_matches[0]:
-                    date_code = mtx_matches[0][
-                        SOLR_FIELDS.PROJ_SCENARIO_DATE_CODE]
-                if SOLR_FIELDS.PROJ_SCENARIO_GCM in mtx_matches[0]:
-                    gcm_code = mtx_matches[0][SOLR_FIELDS.PROJ_SCENARIO_GCM]
-                if SOLR_FIELDS.PROJ_SCENARIO_ALT_PRED_CODE in mtx_matches[0]:
-                    alt_pred_code = mtx_matches[0][
-                        SOLR_FIELDS.PROJ_SCENARIO_ALT_PRED_CODE]
-
-                scn_meta = {
-                    ServiceObject.META_DESCRIPTION:
-                        'Subset of grid set {}, scn {}, algorithm {}'.format(
-                            orig_gs_id, scn_id, alg_code),
-                    ServiceObject.META_KEYWORDS: ['subset', scn_code, alg_code]
-                }
-
-                # Assemble full matrix
-                pam_data = np.zeros(
-                    (orig_num_rows, len(mtx_matches)), dtype=int)
-                squids = []
-
-                for i, match_i in enumerate(mtx_matches):
-                    pam_data[:, i] = decompress(
-                        match_i[SOLR_FIELDS.COMPRESSED_PAV])
-                    squids.append(match_i[SOLR_FIELDS.SQUID])
+        row_headers = site_index.row_headers
+        if keep_sites is not None:
+            # The cut out shapegrid numbers the kept cells from 0, in the
+            #     same (feature id) order as keep_sites
+            row_headers = [
+                (new_idx, row_headers[i][1], row_headers[i][2])
+                for new_idx, i in enumerate(keep_sites.tolist())]
+
+        groups = [
+            (scn_id, alg_code, mtx_matches)
+            for scn_id, alg_matches in match_groups.items()
+            for alg_code, mtx_matches in alg_matches.items()]
+        for (scn_id, alg_code, mtx_matches), pam_data, squids in \
+                _iter_group_pam_data(groups, orig_num_rows, keep_sites):
+
+            scn_code = mtx_matches[0][SOLR_FIELDS.PROJ_SCENARIO_CODE]
+            date_code = alt_pred_code = gcm_code = None
+
+            if SOLR_FIELDS.PROJ_SCENARIO_DATE_CODE in mtx_matches[0]:
+                date_code = mtx_matches[0][
+                    SOLR_FIELDS.PROJ_SCENARIO_DATE_CODE]
+            if SOLR_FIELDS.PROJ_SCENARIO_GCM in mtx_matches[0]:
+                gcm_code = mtx_matches[0][SOLR_FIELDS.PROJ_SCENARIO_GCM]
+            if SOLR_FIELDS.PROJ_SCENARIO_ALT_PRED_CODE in mtx_matches[0]:
+                alt_pred_code = mtx_matches[0][
+                    SOLR_FIELDS.PROJ_SCENARIO_ALT_PRED_CODE]
+
+            scn_meta = {
+                ServiceObject.META_DESCRIPTION:
+                    'Subset of grid set {}, scn {}, algorithm {}'.format(
+                        orig_gs_id, scn_id, alg_code),
+                ServiceObject.META_KEYWORDS: ['subset', scn_code, alg_code]
+            }
 
-                # Create object
-                # NOTE: We use original row headers even though we are going to
-                #    slice them immediately after construction.  We do this to
-                #    keep consistent with other matrix slicing
-                pam_mtx = LMMatrix(
-                    pam_data, matrix_type=MatrixType.PAM, gcm_code=gcm_code,
-                    alt_pred_code=alt_pred_code, date_code=date_code,
-                    metadata=scn_meta, user_id=user_id, gridset=updated_gs,
-                    status=JobStatus.GENERAL, status_mod_time=gmt().mjd,
-                    headers={'0': orig_row_headers, '1': squids})
-
-                # If we need to spatially subset, slice the matrix
-                if method == SubsetMethod.SPATIAL:
-                    tmp = pam_mtx.matrix.slice(keep_sites)
-                    pam_mtx.set_data(tmp, headers=tmp.headers)
-
-                # Insert it into db
-                updated_pam_mtx = scribe.find_or_insert_matrix(pam_mtx)
-                updated_pam_mtx.update_status(JobStatus.COMPLETE)
-                scribe.update_object(updated_pam_mtx)
-                log.debug(
-                    'Dlocation for updated pam: {}'.format(
-                        updated_pam_mtx.get_dlocation()))
-                pam_mtx.matrix.write(updated_pam_mtx.get_dlocation())
+            # Create object, the data only has the kept sites
+            pam_mtx = LMMatrix(
+                pam_data, matrix_type=MatrixType.PAM, gcm_code=gcm_code,
+                alt_pred_code=alt_pred_code, date_code=date_code,
+                metadata=scn_meta, user_id=user_id, gridset=updated_gs,
+                status=JobStatus.GENERAL, status_mod_time=gmt().mjd,
+                headers={'0': row_headers, '1': squids})
+
+            # Insert it into db
+            updated_pam_mtx = scribe.find_or_insert_matrix(pam_mtx)
+            updated_pam_mtx.update_status(JobStatus.COMPLETE)
+            scribe.update_object(updated_pam_mtx)
+            log.debug(
+                'Dlocation for updated pam: {}'.format(
+                    updated_pam_mtx.get_dlocation()))
+            pam_mtx.matrix.write(updated_pam_mtx.get_dlocation())
 
         # GRIMs
         # --------
@@ -290,7 +308,7 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
 
             # If we need to spatially subset, slice the matrix
             if method == SubsetMethod.SPATIAL:
-                grim_mtx = grim_mtx.slice(keep_sites)
+                grim_mtx = grim_mtx.slice(keep_sites.tolist())
 
             grim_mtx.write(inserted_grim.get_dlocation())
 
@@ -313,7 +331,7 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
 
             # If we need to spatially subset, slice the matrix
             if method == SubsetMethod.SPATIAL:
-                bg_mtx = bg_mtx.slice(keep_sites)
+                bg_mtx = bg_mtx.slice(keep_sites.tolist())
 
             bg_mtx.write(inserted_bg.get_dlocation())
 
@@ -377,6 +395,12 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
                     status=JobStatus.GENERAL, status_mod_time=gmt().mjd)
                 pam = scribe.find_or_insert_matrix(pam_mtx)
 
+                # Intersect every projection for this PAM in one batch rule
+                intersect_cmd = IntersectRasterBatchCommand(
+                    my_shp.get_dlocation(), '{}_manifest{}'.format(
+                        os.path.splitext(pam.get_dlocation())[0],
+                        LMFormat.JSON.ext))
+
                 # Insert matrix columns for each match
                 for i, mtx_match in enumerate(mtx_matches):
                     try:
@@ -421,10 +445,9 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
                         min_percent = mtx_col.intersect_params[
                             MatrixColumn.INTERSECT_PARAM_MIN_PERCENT]
 
-                        intersect_cmd = IntersectRasterCommand(
-                            my_shp.get_dlocation(), prj.get_dlocation(),
-                            pav_fname, min_presence, max_presence, min_percent,
-                            squid=prj.squid)
+                        intersect_cmd.add_raster(
+                            prj.get_dlocation(), pav_fname, min_presence,
+                            max_presence, min_percent, squid=prj.squid)
                         index_cmd = IndexPAVCommand(
                             pav_fname, mtx_col.get_id(), prj.get_id(),
                             pam.get_id(), pav_post_fname)
@@ -432,11 +455,14 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
                             ProcessType.INTERSECT_RASTER, mtx_col.get_id(),
                             pav_success_fname, [pav_fname])
                         # Add rules to list
-                        rules.append(intersect_cmd.get_makeflow_rule())
                         rules.append(index_cmd.get_makeflow_rule(local=True))
                         rules.append(
                             stockpile_cmd.get_makeflow_rule(local=True))
 
+                if intersect_cmd.entries:
+                    intersect_cmd.write_manifest()
+                    rules.append(intersect_cmd.get_makeflow_rule())
+
                 # Initialize PAM after matrix columns inserted
                 pam.update_status(JobStatus.INITIALIZE)
                 scribe.update_object(pam)
@@ -465,6 +491,12 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
             # Get corresponding grim layers (scenario)
             old_grim_cols = scribe.get_columns_for_matrix(grim.get_id())
 
+            # Intersect every layer for this GRIM in one batch rule
+            intersect_cmd = GrimRasterBatchCommand(
+                my_shp.get_dlocation(), '{}_manifest{}'.format(
+                    os.path.splitext(inserted_grim.get_dlocation())[0],
+                    LMFormat.JSON.ext))
+
             for old_col in old_grim_cols:
                 # TODO: Metadata
                 grim_lyr_meta = {}
@@ -486,17 +518,19 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
                     work_dir, 'grim_col_{}.success'.format(mtx_col.get_id()))
                 min_percent = mtx_col.intersect_params[
                     MatrixColumn.INTERSECT_PARAM_MIN_PERCENT]
-                intersect_cmd = GrimRasterCommand(
-                    my_shp.get_dlocation(), old_col.layer.get_dlocation(),
-                    grim_col_fname, minPercent=min_percent,
-                    ident=mtx_col.ident)
+                intersect_cmd.add_raster(
+                    old_col.layer.get_dlocation(), grim_col_fname,
+                    minPercent=min_percent, ident=mtx_col.ident)
                 stockpile_cmd = StockpileCommand(
                     ProcessType.INTERSECT_RASTER_GRIM, mtx_col.get_id(),
                     grim_col_success_fname, [grim_col_fname])
                 # Add rules to list
-                rules.append(intersect_cmd.get_makeflow_rule())
                 rules.append(stockpile_cmd.get_makeflow_rule(local=True))
 
+            if intersect_cmd.entries:
+                intersect_cmd.write_manifest()
+                rules.append(intersect_cmd.get_makeflow_rule())
+
             inserted_grim.update_status(JobStatus.INITIALIZE)
             scribe.update_object(inserted_grim)
 
@@ -579,25 +613,154 @@ def subset_global_pam(archive_name, matches, user_id, bbox=None,
     return updated_gs
 
 
+# ............................................................................
+class SiteIndex:
+    """Class providing index-based site selection for a shapegrid
+
+    The feature ids, centroids, and envelopes of every cell are read once
+    into arrays in row header (feature id) order, so sites are selected with
+    vectorized comparisons rather than by searching row header lists.
+    """
+
+    # ...........................
+    def __init__(self, shapefile_filename):
+        """Constructor
+
+        Args:
+            shapefile_filename (str): The file location of the shapegrid.
+        """
+        ogr.RegisterAll()
+        drv = ogr.GetDriverByName(LMFormat.SHAPE.driver)
+        dataset = drv.Open(shapefile_filename)
+        lyr = dataset.GetLayer(0)
+
+        num_sites = lyr.GetFeatureCount()
+        fids = np.zeros(num_sites, dtype=np.int64)
+        centroids = np.zeros((num_sites, 2))
+        envelopes = np.zeros((num_sites, 4))
+        for j in range(num_sites):
+            cur_feat = lyr.GetFeature(j)
+            geom = cur_feat.geometry()
+            fids[j] = cur_feat.GetFID()
+            centroids[j] = geom.Centroid().GetPoint_2D()
+            envelopes[j] = geom.GetEnvelope()
+
+        order = np.argsort(fids, kind='stable')
+        self.fids = fids[order]
+        self.centroids = centroids[order]
+        # Envelopes are (min x, max x, min y, max y)
+        self.envelopes = envelopes[order]
+
+    # ...........................
+    @property
+    def row_headers(self):
+        """Returns the (feature id, x, y) row headers of the shapegrid
+        """
+        return [
+            (fid, x_coord, y_coord) for fid, (x_coord, y_coord) in zip(
+                self.fids.tolist(), self.centroids.tolist())]
+
+    # ...........................
+    def get_sites_in_bbox(self, bbox):
+        """Gets the row indices of the cells intersecting a bounding box
+
+        Args:
+            bbox (tuple): The (min x, min y, max x, max y) bounding box.
+
+        Returns:
+            numpy array: The sorted row indices of the selected sites.
+        """
+        min_x, min_y, max_x, max_y = bbox
+        return np.flatnonzero(
+            (self.envelopes[:, 0] <= max_x) & (self.envelopes[:, 1] >= min_x)
+            & (self.envelopes[:, 2] <= max_y)
+            & (self.envelopes[:, 3] >= min_y))
+
+
+# ............................................................................
+def get_site_index(shapefile_filename):
+    """Gets a site index for a shapegrid, reading it only if it is not cached
+
+    Args:
+        shapefile_filename (str): The file location of the shapegrid.
+    """
+    file_stat = os.stat(shapefile_filename)
+    key = (os.path.abspath(shapefile_filename), file_stat.st_mtime,
+           file_stat.st_size)
+    with _SITE_INDEX_LOCK:
+        if key in _SITE_INDEXES:
+            _SITE_INDEXES.move_to_end(key)
+            return _SITE_INDEXES[key]
+
+    site_index = SiteIndex(shapefile_filename)
+    with _SITE_INDEX_LOCK:
+        _SITE_INDEXES[key] = site_index
+        while len(_SITE_INDEXES) > SITE_INDEX_CACHE_SIZE:
+            _SITE_INDEXES.popitem(last=False)
+    return site_index
+
+
 # ............................................................................
 def get_row_headers(shapefile_filename):
     """Get a (sorted by feature id) list of row headers for a shapefile
+    """
+    return get_site_index(shapefile_filename).row_headers
 
-    Todo:
-        Move this to LmCommon or LmBackend and use with LmCompute.  This is a
-            rough copy of what is now used for rasterIntersect
+
+# ............................................................................
+def _get_group_pam_data(mtx_matches, num_rows, keep_sites=None):
+    """Assemble the PAM data of a group of Solr matches
+
+    Args:
+        mtx_matches (list): Solr matches with compressed PAVs.
+        num_rows (int): The number of sites in the uncompressed PAVs.
+        keep_sites (numpy array): Optional row indices of the sites to keep,
+            only these values are decoded from each PAV.
+
+    Returns:
+        tuple: The PAM data array and the list of column squids.
     """
-    ogr.RegisterAll()
-    drv = ogr.GetDriverByName(LMFormat.SHAPE.driver)
-    dataset = drv.Open(shapefile_filename)
-    lyr = dataset.GetLayer(0)
+    if keep_sites is not None:
+        num_rows = keep_sites.size
+    # PAVs are binary, so one byte per cell is enough
+    pam_data = np.zeros((num_rows, len(mtx_matches)), dtype=np.int8)
+    squids = []
+    for i, match in enumerate(mtx_matches):
+        if keep_sites is None:
+            decompress(match[SOLR_FIELDS.COMPRESSED_PAV], out=pam_data[:, i])
+        else:
+            pam_data[:, i] = decompress_indices(
+                match[SOLR_FIELDS.COMPRESSED_PAV], keep_sites)
+        squids.append(match[SOLR_FIELDS.SQUID])
+    return pam_data, squids
 
-    row_headers = []
 
-    for j in range(lyr.GetFeatureCount()):
-        cur_feat = lyr.GetFeature(j)
-        site_idx = cur_feat.GetFID()
-        x_coord, y_coord = cur_feat.geometry().Centroid().GetPoint_2D()
-        row_headers.append((site_idx, x_coord, y_coord))
+# ............................................................................
+def _iter_group_pam_data(groups, num_rows, keep_sites=None,
+                         max_workers=SUBSET_WORKERS):
+    """Assemble the PAM data of each match group in parallel
+
+    At most max_workers groups are assembled ahead of the consumer, so memory
+    is bounded no matter how many groups there are.
 
-    return sorted(row_headers)
+    Args:
+        groups (list): (scenario id, algorithm code, matches) tuples.
+        num_rows (int): The number of sites in the uncompressed PAVs.
+        keep_sites (numpy array): Optional row indices of the sites to keep.
+        max_workers (int): The number of groups to assemble at once.
+
+    Yields:
+        tuple: Each group with its PAM data array and column squids, in order.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for group in groups:
+            pending.append((group, executor.submit(
+                _get_group_pam_data, group[2], num_rows,
+                keep_sites=keep_sites)))
+            if len(pending) > max_workers:
+                done_group, assembled = pending.popleft()
+                yield (done_group,) + assembled.result()
+        while pending:
+            done_group, assembled = pending.popleft()
+            yield (done_group,) + assembled.result()
@@ -0,0 +1,200 @@
+"""Tests for the pooled, cursor paged Solr queries in LmServer.common.solr
+
+Note:
+    * A small Solr stand-in is served with http.server from a thread, so no
+        Solr instance is needed to run these tests
+"""
+import http.server
+import json
+import queue
+import threading
+import urllib.parse
+
+import pytest
+
+from LmBackend.common.lmobj import LMError
+from LmServer.common import solr
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+COLLECTION = 'lmArchive'
+NUM_DOCS = 7
+
+
+# .............................................................................
+class _SolrHandler(http.server.BaseHTTPRequestHandler):
+    """Answers select requests with cursor paged documents"""
+    protocol_version = 'HTTP/1.1'
+
+    # .....................................
+    def setup(self):
+        """Count each new client connection"""
+        super().setup()
+        self.server.num_connections += 1
+
+    # .....................................
+    def do_GET(self):
+        """Return a page of documents starting at the cursor mark"""
+        url_parts = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url_parts.query)
+        self.server.requests.append((url_parts.path, params))
+
+        if self.server.error_status is not None:
+            self._respond(self.server.error_status, {'error': 'failed'})
+            return
+
+        cursor_mark = params['cursorMark'][0]
+        start = 0 if cursor_mark == '*' else int(cursor_mark)
+        rows = int(params['rows'][0])
+        docs = self.server.docs[start:start + rows]
+        next_cursor_mark = str(start + len(docs)) if docs else cursor_mark
+        self._respond(200, {
+            'response': {'numFound': len(self.server.docs), 'docs': docs},
+            'nextCursorMark': next_cursor_mark})
+
+        # Drop the connection without telling the client, like an idle
+        #    keep-alive connection timed out by Solr
+        if self.server.drop_connections:
+            self.close_connection = True
+
+    # .....................................
+    def _respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # .....................................
+    def log_message(self, *args):
+        """Keep the test output quiet"""
+
+
+# .............................................................................
+@pytest.fixture
+def solr_server(monkeypatch):
+    """Serve the Solr stand-in and point the solr module at it"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _SolrHandler)
+    server.daemon_threads = True
+    server.docs = [{'id': i} for i in range(NUM_DOCS)]
+    server.requests = []
+    server.num_connections = 0
+    server.error_status = None
+    server.drop_connections = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(
+        solr, 'SOLR_SERVER',
+        'http://127.0.0.1:{}/solr/'.format(server.server_address[1]))
+    monkeypatch.setattr(solr, '_CONNECTION_POOL', queue.LifoQueue())
+    yield server
+
+    while not solr._CONNECTION_POOL.empty():
+        solr._CONNECTION_POOL.get_nowait().close()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+# .............................................................................
+def _cursor_marks(server):
+    return [params['cursorMark'][0] for _, params in server.requests]
+
+
+# .............................................................................
+def test_stream_query_pages_until_short_page(solr_server):
+    """Paging stops after a page with fewer documents than requested"""
+    docs = list(solr._stream_query(COLLECTION, page_size=3))
+    assert docs == solr_server.docs
+    assert _cursor_marks(solr_server) == ['*', '3', '6']
+    path, params = solr_server.requests[0]
+    assert path == '/solr/{}/select'.format(COLLECTION)
+    assert params['rows'] == ['3']
+    assert params['sort'] == ['{} asc'.format(solr.SOLR_FIELDS.ID)]
+
+
+# .............................................................................
+def test_stream_query_stops_on_repeated_cursor_mark(solr_server):
+    """An empty last page returns the same cursor mark and ends paging"""
+    solr_server.docs = solr_server.docs[:6]
+    docs = list(solr._stream_query(COLLECTION, page_size=3))
+    assert docs == solr_server.docs
+    assert _cursor_marks(solr_server) == ['*', '3', '6']
+
+
+# .............................................................................
+def test_stream_query_limit(solr_server):
+    """Pages past the limit are not requested"""
+    docs = list(solr._stream_query(COLLECTION, page_size=3, limit=4))
+    assert docs == solr_server.docs[:4]
+    assert _cursor_marks(solr_server) == ['*', '3']
+
+    solr_server.requests = []
+    assert list(solr._stream_query(COLLECTION, limit=0)) == []
+    assert solr_server.requests == []
+
+    docs = list(solr._stream_query(COLLECTION, page_size=10, limit=2))
+    assert docs == solr_server.docs[:2]
+    assert solr_server.requests[0][1]['rows'] == ['2']
+
+
+# .............................................................................
+def test_stream_query_fields(solr_server):
+    """Requested fields are sent in the field list parameter"""
+    list(solr._stream_query(COLLECTION, fields=['id', 'squid']))
+    assert solr_server.requests[0][1]['fl'] == ['id,squid']
+
+
+# .............................................................................
+def test_keep_alive_connection_reused(solr_server):
+    """Consecutive queries share one pooled connection"""
+    list(solr._stream_query(COLLECTION, page_size=3))
+    for _ in range(3):
+        solr._get_json(COLLECTION, 'q=*:*&cursorMark=*&rows=1')
+    assert len(solr_server.requests) == 6
+    assert solr_server.num_connections == 1
+    assert solr._CONNECTION_POOL.qsize() == 1
+
+
+# .............................................................................
+def test_error_status_raises(solr_server):
+    """A non-200 response raises an LMError and keeps the connection"""
+    solr_server.error_status = 500
+    with pytest.raises(LMError):
+        solr._get_json(COLLECTION, 'q=*:*')
+    with pytest.raises(LMError):
+        list(solr._stream_query(COLLECTION))
+    assert len(solr_server.requests) == 2
+    assert solr_server.num_connections == 1
+
+
+# .............................................................................
+def test_retry_on_closed_connection(solr_server):
+    """A pooled connection closed by the server is replaced and retried"""
+    solr_server.drop_connections = True
+    for _ in range(3):
+        r_dict = solr._get_json(COLLECTION, 'q=*:*&cursorMark=*&rows=2')
+        assert r_dict['response']['docs'] == solr_server.docs[:2]
+    assert len(solr_server.requests) == 3
+    assert solr_server.num_connections == 3
+
+
+# .............................................................................
+def test_failed_retry_raises(solr_server, monkeypatch):
+    """A request that fails on a new connection too is not retried again"""
+    logged = []
+
+    class _Logger:
+        def error(self, msg, err):
+            logged.append(msg)
+
+    monkeypatch.setattr(solr, 'SolrLogger', _Logger)
+    solr_server.shutdown()
+    solr_server.server_close()
+    with pytest.raises(OSError):
+        solr._get_json(COLLECTION, 'q=*:*')
+    assert len(logged) == 1
+    assert solr._CONNECTION_POOL.empty()
@@ -24,12 +24,14 @@ from LmServer.legion.sdm_proj import SDMProjection
 class BorgScribe(LMObject):
     """Class for interacting with the Lifemapper database."""
     # ................................
-    def __init__(self, logger, db_user=DbUser.Pipeline):
+    def __init__(self, logger, db_user=DbUser.Pipeline, pooled=False):
         """Constructor
 
         Args:
             logger (LmLogger): A logger object for info and error reporting
             db_user (str): Database user for connection
+            pooled (bool): If True, open_connections checks a connection out
+                of the shared pool and close_connections returns it
         """
 #         LMObject.__init__(self)
         self.log = logger
@@ -40,7 +42,8 @@ class BorgScribe(LMObject):
             raise LMError('Unknown database user {}'.format(db_user))
 
         self._borg = Borg(
-            logger, db_host, CONNECTION_PORT, db_user, HL_NAME[db_user])
+            logger, db_host, CONNECTION_PORT, db_user, HL_NAME[db_user],
+            pooled=pooled)
 
     # ................................
     @property
@@ -683,6 +686,18 @@ class BorgScribe(LMObject):
         """
         return self._borg.find_or_insert_sdm_project(proj)
 
+    # ................................
+    def find_or_insert_sdm_projects(self, projs):
+        """Find or insert a list of SDM projections in one transaction.
+
+        Args:
+            projs: A list of SDMProjection objects.
+
+        Returns:
+            A list of new or existing projections in the same order as projs.
+        """
+        return self._borg.find_or_insert_sdm_projects(projs)
+
     # ................................
     def count_sdm_projects(self, user_id=None, squid=None, display_name=None,
                            after_time=None, before_time=None, epsg=None,
@@ -742,6 +757,19 @@ class BorgScribe(LMObject):
         """
         return self._borg.find_or_insert_matrix_column(mtx_col)
 
+    # ................................
+    def find_or_insert_matrix_columns(self, mtx_cols):
+        """Find or insert a list of matrix columns in one transaction.
+
+        Args:
+            mtx_cols: A list of MatrixColumn objects to get or insert.
+
+        Returns:
+            A list of new or existing matrix columns in the same order as
+                mtx_cols.
+        """
+        return self._borg.find_or_insert_matrix_columns(mtx_cols)
+
     # ................................
     def init_or_rollback_intersect(self, lyr, mtx, intersect_params, mod_time):
         """Initialize model, projections for inputs/algorithm.
@@ -911,6 +939,12 @@ class BorgScribe(LMObject):
         """
         return self._borg.update_object(obj)
 
+    # ................................
+    def update_objects(self, objs):
+        """Update a list of objects in the database, batched by type
+        """
+        return self._borg.update_objects(objs)
+
     # ................................
     def delete_object(self, obj):
         """Delete an object from the databse
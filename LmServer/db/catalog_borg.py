@@ -29,7 +29,8 @@ class Borg(DbPostgresql):
     """Class to control modifications to the Borg database.
     """
     # ................................
-    def __init__(self, logger, db_host, db_port, db_user, db_key):
+    def __init__(self, logger, db_host, db_port, db_user, db_key,
+                 pooled=False):
         """Constructor for Borg class
 
         Args:
@@ -38,10 +39,11 @@ class Borg(DbPostgresql):
             db_port (int): Port number for database connection
             db_user (str): Database user name for the connection
             db_key (str): Password for database user
+            pooled (bool): Should connections come from the shared pool
         """
         DbPostgresql.__init__(
             self, logger, db=DB_STORE, user=db_user, password=db_key,
-            host=db_host, port=db_port, schema=LM_SCHEMA_BORG)
+            host=db_host, port=db_port, schema=LM_SCHEMA_BORG, pooled=pooled)
 
     # ................................
     @staticmethod
@@ -1802,6 +1804,19 @@ class Borg(DbPostgresql):
             True/False for successful update.
         """
         success = False
+        try:
+            success = self.execute_modify_function(
+                'lm_updateOccurrenceSet',
+                *self._get_occurrence_set_update_args(occ))
+        except Exception as err:
+            raise LMError('Failed to update occurrence set', err)
+        return success
+
+    # ................................
+    @staticmethod
+    def _get_occurrence_set_update_args(occ):
+        """Get the lm_updateOccurrenceSet arguments for an OccurrenceLayer
+        """
         poly_wkt = points_wkt = None
         metadata = occ.dump_layer_metadata()
         try:
@@ -1812,16 +1827,11 @@ class Borg(DbPostgresql):
 #             points_wkt = occ.get_multipoint_wkt(LMFormat.SHAPE.driver)
 #         except Exception:
 #             pass
-        try:
-            success = self.execute_modify_function(
-                'lm_updateOccurrenceSet', occ.get_id(), occ.verify,
-                occ.display_name, occ.get_dlocation(), occ.get_raw_dlocation(),
-                occ.query_count, occ.get_csv_extent_string(), occ.epsg_code,
-                metadata, occ.status, occ.status_mod_time, poly_wkt,
-                points_wkt)
-        except Exception as err:
-            raise LMError('Failed to update occurrence set', err)
-        return success
+        return (
+            occ.get_id(), occ.verify, occ.display_name, occ.get_dlocation(),
+            occ.get_raw_dlocation(), occ.query_count,
+            occ.get_csv_extent_string(), occ.epsg_code, metadata, occ.status,
+            occ.status_mod_time, poly_wkt, points_wkt)
 
     # ................................
     def get_sdm_project(self, layer_id):
@@ -1843,19 +1853,26 @@ class Borg(DbPostgresql):
             proj: The SDMProjection object to update
         """
         success = False
-        lyr_meta = proj.dump_layer_metadata()
-        prj_meta = proj.dump_param_metadata()
         try:
             success = self.execute_modify_function(
-                'lm_updateSDMProjectLayer', proj.get_param_id(), proj.get_id(),
-                proj.verify, proj.get_dlocation(), lyr_meta, proj.val_units,
-                proj.nodata_val, proj.min_val, proj.max_val, proj.epsg_code,
-                proj.get_csv_extent_string(), proj.get_wkt(), proj.mod_time,
-                prj_meta, proj.status, proj.status_mod_time)
+                'lm_updateSDMProjectLayer',
+                *self._get_sdm_project_update_args(proj))
         except Exception as err:
             raise LMError('Failed to update SDM projection', err)
         return success
 
+    # ................................
+    @staticmethod
+    def _get_sdm_project_update_args(proj):
+        """Get the lm_updateSDMProjectLayer arguments for an SDMProjection
+        """
+        return (
+            proj.get_param_id(), proj.get_id(), proj.verify,
+            proj.get_dlocation(), proj.dump_layer_metadata(), proj.val_units,
+            proj.nodata_val, proj.min_val, proj.max_val, proj.epsg_code,
+            proj.get_csv_extent_string(), proj.get_wkt(), proj.mod_time,
+            proj.dump_param_metadata(), proj.status, proj.status_mod_time)
+
     # ................................
     def find_or_insert_occurrence_set(self, occ):
         """Find or insert an occurrence set
@@ -2090,23 +2107,50 @@ class Borg(DbPostgresql):
             Assumes that pre- or post-processing layer inputs have already been
                 inserted
         """
-        lyr_meta = proj.dump_layer_metadata()
-        prj_meta = proj.dump_param_metadata()
-        alg_params = proj.dump_algorithm_parameter_string()
         row, idxs = self.execute_insert_and_select_one_function(
-            'lm_findOrInsertSDMProjectLayer', proj.get_param_id(),
-            proj.get_id(), proj.get_user_id(), proj.squid, proj.verify,
-            proj.name, proj.get_dlocation(), lyr_meta, proj.data_format,
-            proj.gdal_type, proj.ogr_type, proj.val_units, proj.nodata_val,
-            proj.min_val, proj.max_val, proj.epsg_code, proj.map_units,
-            proj.resolution, proj.get_csv_extent_string(), proj.get_wkt(),
-            proj.mod_time, proj.get_occ_layer_id(), proj.algorithm_code,
-            alg_params, proj.get_model_scenario_id(),
-            proj.get_proj_scenario_id(), prj_meta, proj.process_type,
-            proj.status, proj.status_mod_time)
+            'lm_findOrInsertSDMProjectLayer',
+            *self._get_sdm_project_insert_args(proj))
         new_or_existing_proj = self._create_sdm_projection(row, idxs)
         return new_or_existing_proj
 
+    # ................................
+    def find_or_insert_sdm_projects(self, projs):
+        """Find or insert a list of SDM Projections in one transaction
+
+        Args:
+            projs: a list of SDMProjection objects
+
+        Returns:
+            List of new or existing SDMProjections, in the same order as
+                projs, with None for any that could not be found or inserted
+
+        Note:
+            Assumes that pre- or post-processing layer inputs have already been
+                inserted
+        """
+        rows, idxs = self.execute_insert_and_select_batch_function(
+            'lm_findOrInsertSDMProjectLayer',
+            [self._get_sdm_project_insert_args(proj) for proj in projs])
+        return [self._create_sdm_projection(row, idxs) for row in rows]
+
+    # ................................
+    @staticmethod
+    def _get_sdm_project_insert_args(proj):
+        """Get the lm_findOrInsertSDMProjectLayer arguments for a projection
+        """
+        return (
+            proj.get_param_id(), proj.get_id(), proj.get_user_id(), proj.squid,
+            proj.verify, proj.name, proj.get_dlocation(),
+            proj.dump_layer_metadata(), proj.data_format, proj.gdal_type,
+            proj.ogr_type, proj.val_units, proj.nodata_val, proj.min_val,
+            proj.max_val, proj.epsg_code, proj.map_units, proj.resolution,
+            proj.get_csv_extent_string(), proj.get_wkt(), proj.mod_time,
+            proj.get_occ_layer_id(), proj.algorithm_code,
+            proj.dump_algorithm_parameter_string(),
+            proj.get_model_scenario_id(), proj.get_proj_scenario_id(),
+            proj.dump_param_metadata(), proj.process_type, proj.status,
+            proj.status_mod_time)
+
     # ................................
     def count_sdm_projects(self, user_id, squid, display_name, after_time,
                            before_time, epsg, after_status, before_status,
@@ -2195,6 +2239,47 @@ class Borg(DbPostgresql):
         Returns:
             New or existing MatrixColumn object
         """
+        row, idxs = self.execute_insert_and_select_one_function(
+            'lm_findOrInsertMatrixColumn',
+            *self._get_matrix_column_insert_args(mtx_col))
+        new_or_existing_mtx_col = self._create_matrix_column(row, idxs)
+        # Put shapegrid into updated matrixColumn
+        new_or_existing_mtx_col.shapegrid = mtx_col.shapegrid
+        new_or_existing_mtx_col.process_type = mtx_col.process_type
+        return new_or_existing_mtx_col
+
+    # ................................
+    def find_or_insert_matrix_columns(self, mtx_cols):
+        """Find or insert a list of matrix columns in one transaction
+
+        Args:
+            mtx_cols: a list of MatrixColumn objects
+
+        Returns:
+            List of new or existing MatrixColumn objects, in the same order as
+                mtx_cols, with None for any that could not be found or inserted
+        """
+        rows, idxs = self.execute_insert_and_select_batch_function(
+            'lm_findOrInsertMatrixColumn',
+            [self._get_matrix_column_insert_args(mtx_col)
+             for mtx_col in mtx_cols])
+        new_or_existing_mtx_cols = []
+        for mtx_col, row in zip(mtx_cols, rows):
+            new_or_existing_mtx_col = self._create_matrix_column(row, idxs)
+            if new_or_existing_mtx_col is not None:
+                # Put shapegrid into updated matrixColumn
+                new_or_existing_mtx_col.shapegrid = mtx_col.shapegrid
+                new_or_existing_mtx_col.process_type = mtx_col.process_type
+            new_or_existing_mtx_cols.append(new_or_existing_mtx_col)
+        return new_or_existing_mtx_cols
+
+    # ................................
+    def _get_matrix_column_insert_args(self, mtx_col):
+        """Get the lm_findOrInsertMatrixColumn arguments for a MatrixColumn
+
+        Note:
+            Inserts the column layer if it does not have a layer id yet
+        """
         lyr_id = None
         if mtx_col.layer is not None:
             # Check for existing id before pulling from db
@@ -2203,18 +2288,12 @@ class Borg(DbPostgresql):
                 new_or_existing_lyr = self.find_or_insert_layer(mtx_col.layer)
                 lyr_id = new_or_existing_lyr.get_layer_id()
 
-        mc_meta = mtx_col.dump_param_metadata()
-        int_params = mtx_col.dump_intersect_params()
-        row, idxs = self.execute_insert_and_select_one_function(
-            'lm_findOrInsertMatrixColumn', mtx_col.get_param_user_id(),
-            mtx_col.get_param_id(), mtx_col.parent_id,
-            mtx_col.get_matrix_index(), lyr_id, mtx_col.squid, mtx_col.ident,
-            mc_meta, int_params, mtx_col.status, mtx_col.status_mod_time)
-        new_or_existing_mtx_col = self._create_matrix_column(row, idxs)
-        # Put shapegrid into updated matrixColumn
-        new_or_existing_mtx_col.shapegrid = mtx_col.shapegrid
-        new_or_existing_mtx_col.process_type = mtx_col.process_type
-        return new_or_existing_mtx_col
+        return (
+            mtx_col.get_param_user_id(), mtx_col.get_param_id(),
+            mtx_col.parent_id, mtx_col.get_matrix_index(), lyr_id,
+            mtx_col.squid, mtx_col.ident, mtx_col.dump_param_metadata(),
+            mtx_col.dump_intersect_params(), mtx_col.status,
+            mtx_col.status_mod_time)
 
     # ................................
     def update_matrix_column(self, mtxcol):
@@ -2226,12 +2305,19 @@ class Borg(DbPostgresql):
         Returns:
             Boolean success/failure
         """
-        meta = mtxcol.dump_param_metadata()
-        int_params = mtxcol.dump_intersect_params()
         return self.execute_modify_function(
-            'lm_updateMatrixColumn', mtxcol.get_id(),
-            mtxcol.get_matrix_index(), meta, int_params, mtxcol.status,
-            mtxcol.status_mod_time)
+            'lm_updateMatrixColumn',
+            *self._get_matrix_column_update_args(mtxcol))
+
+    # ................................
+    @staticmethod
+    def _get_matrix_column_update_args(mtxcol):
+        """Get the lm_updateMatrixColumn arguments for a MatrixColumn
+        """
+        return (
+            mtxcol.get_id(), mtxcol.get_matrix_index(),
+            mtxcol.dump_param_metadata(), mtxcol.dump_intersect_params(),
+            mtxcol.status, mtxcol.status_mod_time)
 
     # ................................
     def get_matrix_column(self, mtx_col, mtx_col_id):
@@ -2894,6 +2980,45 @@ class Borg(DbPostgresql):
             raise LMError('Unsupported update for object {}'.format(type(obj)))
         return success
 
+    # ................................
+    def update_objects(self, objs):
+        """Updates a list of objects in the database
+
+        Occurrence sets, SDM projections, and matrix columns are updated in
+        one transaction for each type, other objects are updated one at a
+        time with update_object.
+
+        Returns:
+            List of True/False for success of each update, in the same order
+                as objs
+        """
+        successes = [False] * len(objs)
+        # {function name: ([object positions], [function arguments])}
+        batches = {}
+        for i, obj in enumerate(objs):
+            if isinstance(obj, OccurrenceLayer):
+                fn_name = 'lm_updateOccurrenceSet'
+                fn_args = self._get_occurrence_set_update_args(obj)
+            elif isinstance(obj, SDMProjection):
+                fn_name = 'lm_updateSDMProjectLayer'
+                fn_args = self._get_sdm_project_update_args(obj)
+            elif isinstance(obj, MatrixColumn):
+                fn_name = 'lm_updateMatrixColumn'
+                fn_args = self._get_matrix_column_update_args(obj)
+            else:
+                successes[i] = self.update_object(obj)
+                continue
+            positions, fn_args_list = batches.setdefault(fn_name, ([], []))
+            positions.append(i)
+            fn_args_list.append(fn_args)
+
+        for fn_name, (positions, fn_args_list) in batches.items():
+            batch_successes = self.execute_modify_batch_function(
+                fn_name, fn_args_list)
+            for i, success in zip(positions, batch_successes):
+                successes[i] = success
+        return successes
+
     # ................................
     def delete_object(self, obj):
         """Deletes object from database
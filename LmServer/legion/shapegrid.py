@@ -175,9 +175,18 @@ class Shapegrid(_LayerParameters, Vector, ProcessObject):
                 'Resolution of cell_size is greater than x or y range')
 
     # .................................
-    def cutout(self, cutout_wkt, remove_orig=False, dloc=None):
+    def cutout(self, cutout_wkt, remove_orig=False, dloc=None,
+               keep_fids=None):
         """Create a new shapegrid from original using cutout.
 
+        Args:
+            cutout_wkt: WKT of the polygon to cut out
+            remove_orig: If True, replace the original shapegrid file
+            dloc: The file location of the new shapegrid
+            keep_fids: Optional feature ids of the cells to keep, used
+                instead of intersecting each cell with the cutout polygon so
+                the new shapegrid matches a precomputed site selection
+
         Todo:
             Check this, it may fail on newer versions of OGR -
                 old: CreateFeature vs new: SetFeature
@@ -221,7 +230,11 @@ class Shapegrid(_LayerParameters, Vector, ProcessObject):
         while orig_feature is not None:
             clone = orig_feature.Clone()
             clone_geom_ref = clone.GetGeometryRef()
-            if clone_geom_ref.Intersect(selected_poly):
+            if keep_fids is not None:
+                keep = orig_feature.GetFID() in keep_fids
+            else:
+                keep = clone_geom_ref.Intersect(selected_poly)
+            if keep:
                 # clone.SetField(site_idIdx,new_site_id)
                 new_layer.CreateFeature(clone)
                 new_site_id += 1
@@ -13,7 +13,7 @@ from LmCommon.common.ready_file import ready_filename
 from LmCommon.compression.binary_list import decompress
 from LmServer.common.lmconstants import SOLR_FIELDS
 from LmServer.common.log import ConsoleLogger
-from LmServer.common.solr import query_archive_index
+from LmServer.common.solr import iter_archive_index
 from LmServer.db.borg_scribe import BorgScribe
 
 
@@ -55,19 +55,9 @@ def assemble_pam(pam_id):
 
     pam = scribe.get_matrix(mtx_id=pam_id)
 
-    matches = query_archive_index(gridset_id=pam.gridset_id, user_id=pam.user)
     mtx_cols = scribe.list_matrix_columns(
         0, 10000, matrix_id=pam.get_id(), user_id=pam.user)
-    mtx_col_ids = [int(c.get_id()) for c in mtx_cols]
-
-    # ......................
-    def _match_in_column_ids(match):
-        """Filter function to determine if a matrix column is in the PAM
-        """
-        return int(match[SOLR_FIELDS.ID]) in mtx_col_ids
-
-    # Filter matches
-    filtered_matches = list(filter(_match_in_column_ids, matches))
+    mtx_col_ids = set(int(c.get_id()) for c in mtx_cols)
 
     # Create empty PAM
     shapegrid = pam.get_shapegrid()
@@ -75,13 +65,22 @@ def assemble_pam(pam_id):
 
     row_headers = _get_row_headers_from_shapegrid(shapegrid.get_dlocation())
 
-    pam_data = np.zeros((rows, len(filtered_matches)), dtype=np.int)
+    # PAVs are binary, so one byte per cell is enough.  Each PAM column has at
+    #    most one match so allocate for all of them and trim the rest
+    pam_data = np.zeros((rows, len(mtx_col_ids)), dtype=np.int8)
 
-    # Decompress
+    # Stream matches, decompressing those in the PAM as they arrive
     column_headers = []
-    for i, match in enumerate(filtered_matches):
-        column_headers.append(match[SOLR_FIELDS.SQUID])
-        pam_data[:, i] = decompress(match[SOLR_FIELDS.COMPRESSED_PAV])
+    for match in iter_archive_index(
+            fields=[SOLR_FIELDS.ID, SOLR_FIELDS.SQUID,
+                    SOLR_FIELDS.COMPRESSED_PAV],
+            gridset_id=pam.gridset_id, user_id=pam.user):
+        if int(match[SOLR_FIELDS.ID]) in mtx_col_ids:
+            decompress(
+                match[SOLR_FIELDS.COMPRESSED_PAV],
+                out=pam_data[:, len(column_headers)])
+            column_headers.append(match[SOLR_FIELDS.SQUID])
+    pam_data = pam_data[:, :len(column_headers)]
 
     pam.set_data(pam_data, headers={'0': row_headers, '1': column_headers})
 
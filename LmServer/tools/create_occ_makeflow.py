@@ -5,7 +5,8 @@ import argparse
 import os
 
 from LmBackend.command.multi import (
-    OccurrenceBucketeerCommand, OccurrenceSorterCommand)
+    OccurrenceBucketeerCommand, OccurrenceGrouperCommand,
+    OccurrenceSorterCommand)
 from LmBackend.command.server import TouchFileCommand
 from LmServer.legion.process_chain import MFChain
 
@@ -63,6 +64,34 @@ def get_rules_for_file(in_filename, group_position, width=1, depth=1,
     return rules
 
 
+# .............................................................................
+def get_grouper_rules(in_filenames, group_position, headers=False,
+                      out_dir='.'):
+    """Gets Makeflow rules for grouping CSV files in a single pass.
+
+    Args:
+        in_filenames: A list of CSV input file names
+        group_position: The field in the CSV file to use for grouping
+        headers: Do the input files have a header row
+        out_dir: The directory to write the sorted partition files and the
+            index of the groups in them
+
+    Note:
+        Only the sorted partitions and the index are written, like the
+            sorted buckets of 'get_rules_for_file'.  Writing a file for each
+            group as well would write the data a third time.
+    """
+    touch_fn = os.path.join(out_dir, 'touch.out')
+    touch_cmd = TouchFileCommand(touch_fn)
+    grouper_cmd = OccurrenceGrouperCommand(
+        group_position, in_filenames, out_dir, header_row=headers,
+        index_file_name=os.path.join(out_dir, 'group_index.csv'),
+        group_files=False)
+    grouper_cmd.inputs.append(touch_fn)
+    return [touch_cmd.get_makeflow_rule(local=True),
+            grouper_cmd.get_makeflow_rule()]
+
+
 # .............................................................................
 def main():
     """Main method for script
@@ -86,11 +115,24 @@ def main():
         'input_filename', type=str, nargs='+', help='Input CSV file')
     parser.add_argument(
         'out_dir', type=str, help='Directory to store output CSVs')
+    parser.add_argument(
+        '--single_pass', action='store_true',
+        help=('Group the input files in a single pass, writing sorted '
+              'partitions and an index of their groups, rather than sorted '
+              'buckets (width and depth are not used)'))
 
     args = parser.parse_args()
 
     mf_chain = MFChain(args.user_id)
 
+    if args.single_pass:
+        mf_chain.add_commands(
+            get_grouper_rules(
+                args.input_filename, args.group_position, headers=True,
+                out_dir=args.out_dir))
+        mf_chain.write(args.outfile_filename)
+        return
+
     # Recursively create rules
     for filename in args.input_filename:
         rules = get_rules_for_file(
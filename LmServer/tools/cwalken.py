@@ -85,8 +85,14 @@ class ChristopherWalken(LMObject):
         self.global_pams = {}
 
     # ....................................
-    def initialize_me(self):
-        """Set objects and parameters for workflow on this object."""
+    def initialize_me(self, read_species=True):
+        """Set objects and parameters for workflow on this object.
+
+        Args:
+            read_species: Initialize the species data reader.  Walkers that
+                only configure species chunks pulled by another walker, with
+                configure_species_chunk, do not read species data.
+        """
         self.more_data_to_process = False
 
         self.user_id = self._get_boom_or_default(BoomKeys.ARCHIVE_USER, default_value=PUBLIC_USER)
@@ -100,7 +106,8 @@ class ChristopherWalken(LMObject):
         earl = EarlJr()
         self.boom_path = earl.create_data_path(self.user_id, LMFileType.BOOM_CONFIG)
         # Species parser/puller
-        self.weapon_of_choice = self._get_occ_weapon_of_choice()
+        self.weapon_of_choice = self._get_occ_weapon_of_choice(
+            initialize=read_species)
         
         # SDM inputs
         self.min_points = self._get_boom_or_default(BoomKeys.POINT_COUNT_MIN)
@@ -219,7 +226,7 @@ class ChristopherWalken(LMObject):
         return var
 
     # ....................................
-    def _get_occ_weapon_of_choice(self):
+    def _get_occ_weapon_of_choice(self, initialize=True):
         # Get data_source and optional taxonomy source
         data_source = self._get_boom_or_default(BoomKeys.DATA_SOURCE)
         try:
@@ -260,7 +267,8 @@ class ChristopherWalken(LMObject):
                 occ_csv_fname, occ_meta_fname, occ_delimiter, logger=self.log,
                 use_gbif_taxonomy=use_gbif_taxon_ids, taxon_source_name=taxon_source_name)
 
-        weapon_of_choice.initialize_me()
+        if initialize:
+            weapon_of_choice.initialize_me()
 
         return weapon_of_choice
 
@@ -587,9 +595,62 @@ class ChristopherWalken(LMObject):
                 {scenarioCode: PAV filename for input into multi-species
                     MFChains (potatoInputs)}
         """
+        # WeaponOfChoice.get_one returns the next occurrenceset for species
+        # input data. If it is new, failed, or outdated, write the raw
+        # data and update the rawDlocation.
+        occ = self.weapon_of_choice.get_one()
+        if self.weapon_of_choice.finished_input:
+            self._write_done_walken_file()
+        return self.get_spud_rules(self._configure_species(occ), work_dir)
+
+    # ....................................
+    def pull_species(self):
+        """Pull the data chunk for the next species without processing it.
+
+        Returns:
+            A chunk to pass to configure_species_chunk, possibly in a walker
+                in another process
+        """
+        chunk = self.weapon_of_choice.pull_chunk()
+        if self.weapon_of_choice.finished_input:
+            self._write_done_walken_file()
+        return chunk
+
+    # ....................................
+    def find_or_insert_species_taxon(self, chunk):
+        """Get or insert the taxon of a pulled chunk.
+
+        Returns:
+            The ScientificName of the chunk, or None if it cannot be resolved
+        """
+        return self.weapon_of_choice.find_or_insert_sci_name(*chunk[:3])
+
+    # ....................................
+    def configure_species_chunk(self, chunk):
+        """Create database objects and sweep config for a pulled chunk.
+
+        Args:
+            chunk: A chunk from pull_species, optionally followed by its
+                ScientificName from find_or_insert_species_taxon
+
+        Returns:
+            A species configuration tuple for get_spud_rules
+        """
+        return self._configure_species(
+            self.weapon_of_choice.process_chunk(*chunk))
+
+    # ....................................
+    def _configure_species(self, occ):
+        """Find or insert computations for an occurrence set.
+
+        Returns:
+            Species squid, occurrence set id, the sweep config (None if there
+                is nothing to compute) and the sweep config filename
+        """
         squid = None
-        spud_rules = []
-        index_pavs_document_filename = None
+        occ_id = None
+        sweep_config = None
+        species_config_filename = None
         gs_id = 0
         curr_time = gmt().mjd
 
@@ -598,16 +659,11 @@ class ChristopherWalken(LMObject):
         except Exception:
             self.log.warning('Missing self.boom_gridset id!!')
 
-        # WeaponOfChoice.get_one returns the next occurrenceset for species
-        # input data. If it is new, failed, or outdated, write the raw
-        # data and update the rawDlocation.
-        occ = self.weapon_of_choice.get_one()
-        if self.weapon_of_choice.finished_input:
-            self._write_done_walken_file()
         if occ:
             squid = occ.squid
+            occ_id = occ.get_id()
 
-            occ_work_dir = 'occ_{}'.format(occ.get_id())
+            occ_work_dir = 'occ_{}'.format(occ_id)
             sweep_config = ParameterSweepConfiguration(work_dir=occ_work_dir)
 
             # If we have enough points to model
@@ -620,19 +676,12 @@ class ChristopherWalken(LMObject):
                     self._fill_sweep_config(sweep_config, None, occ, [], [])
             else:
                 for alg in self.algorithms:
-                    prjs = []
-                    mtx_cols = []
-                    for prj_scen in self.prj_scens:
-                        pamcode = '{}_{}'.format(prj_scen.code, alg.code)
-                        prj = self._find_or_insert_sdm_project(
-                            occ, alg, prj_scen, gmt().mjd)
-                        if prj is not None:
-                            prjs.append(prj)
-                            mtx = self.global_pams[pamcode]
-                            mtx_col = self._find_or_insert_intersect(
-                                prj, mtx, curr_time)
-                            if mtx_col is not None:
-                                mtx_cols.append(mtx_col)
+                    prjs = self._find_or_insert_sdm_projects(
+                        occ, alg, gmt().mjd)
+                    mtx_cols = self._find_or_insert_intersects(
+                        [(prj, self.global_pams['{}_{}'.format(
+                            prj.proj_scenario.code, alg.code)])
+                         for prj in prjs], curr_time)
                     do_sdm = self._do_compute_sdm(occ, prjs, mtx_cols)
                     self.log.info(
                         'Compute for Grid {} alg {}: {} projs, {}'
@@ -656,36 +705,58 @@ class ChristopherWalken(LMObject):
                 species_config_filename = os.path.join(
                     os.path.dirname(occ.get_dlocation()),
                     'species_config_{}{}'.format(
-                        occ.get_id(), LMFormat.JSON.ext))
+                        occ_id, LMFormat.JSON.ext))
                 sweep_config.save_config(species_config_filename)
+            else:
+                sweep_config = None
+        return squid, occ_id, sweep_config, species_config_filename
+
+    # ....................................
+    @staticmethod
+    def get_spud_rules(species_config, work_dir):
+        """Get the makeflow rules for a configured species.
 
-                # Add sweep rule
-                param_sweep_cmd = SpeciesParameterSweepCommand(
-                    species_config_filename, sweep_config.get_input_files(),
-                    sweep_config.get_output_files(work_dir), work_dir)
-                spud_rules.append(param_sweep_cmd.get_makeflow_rule())
-
-                # Add stockpile rule
-                stockpile_success_filename = os.path.join(
-                    work_dir, occ_work_dir, 'occ_{}stockpile.success'.format(
-                        occ.get_id()))
-                stockpile_cmd = MultiStockpileCommand(
-                    os.path.join(work_dir, sweep_config.stockpile_filename),
-                    stockpile_success_filename,
-                    pav_filename=os.path.join(
-                        work_dir, sweep_config.pavs_filename))
-                spud_rules.append(
-                    stockpile_cmd.get_makeflow_rule(local=True))
-
-                # Add multi-index rule if we added PAVs
-                if len(sweep_config.pavs) > 0:
-                    index_pavs_document_filename = os.path.join(
-                        work_dir, occ_work_dir, 'solr_pavs_post{}'.format(
-                            LMFormat.XML.ext))
-                    index_cmd = MultiIndexPAVCommand(
-                        os.path.join(work_dir, sweep_config.pavs_filename),
-                        index_pavs_document_filename)
-                    spud_rules.append(index_cmd.get_makeflow_rule(local=True))
+        Args:
+            species_config: A tuple returned by configure_species_chunk
+            work_dir: The relative work directory of the potato bushel that
+                will hold the rules
+
+        Returns:
+            Species squid, a list of spud rules and the PAV index document
+                filename
+        """
+        squid, occ_id, sweep_config, species_config_filename = species_config
+        spud_rules = []
+        index_pavs_document_filename = None
+        if sweep_config is not None:
+            occ_work_dir = 'occ_{}'.format(occ_id)
+            # Add sweep rule
+            param_sweep_cmd = SpeciesParameterSweepCommand(
+                species_config_filename, sweep_config.get_input_files(),
+                sweep_config.get_output_files(work_dir), work_dir)
+            spud_rules.append(param_sweep_cmd.get_makeflow_rule())
+
+            # Add stockpile rule
+            stockpile_success_filename = os.path.join(
+                work_dir, occ_work_dir, 'occ_{}stockpile.success'.format(
+                    occ_id))
+            stockpile_cmd = MultiStockpileCommand(
+                os.path.join(work_dir, sweep_config.stockpile_filename),
+                stockpile_success_filename,
+                pav_filename=os.path.join(
+                    work_dir, sweep_config.pavs_filename))
+            spud_rules.append(
+                stockpile_cmd.get_makeflow_rule(local=True))
+
+            # Add multi-index rule if we added PAVs
+            if len(sweep_config.pavs) > 0:
+                index_pavs_document_filename = os.path.join(
+                    work_dir, occ_work_dir, 'solr_pavs_post{}'.format(
+                        LMFormat.XML.ext))
+                index_cmd = MultiIndexPAVCommand(
+                    os.path.join(work_dir, sweep_config.pavs_filename),
+                    index_pavs_document_filename)
+                spud_rules.append(index_cmd.get_makeflow_rule(local=True))
 
             # TODO: Add metrics / snippets processing
         return squid, spud_rules, index_pavs_document_filename
@@ -771,9 +842,19 @@ class ChristopherWalken(LMObject):
         return sweep_config
 
     # ....................................
-    def stop_walken(self):
-        """Stop walking configured data."""
-        if not self.weapon_of_choice.complete:
+    def stop_walken(self, line_num=None):
+        """Stop walking configured data.
+
+        Args:
+            line_num: The starting position to save for the next run, if
+                species pulled before the current position were not processed
+        """
+        if line_num is not None:
+            self.log.info('Christopher, stop walken')
+            self.log.info('Saving next start {} ...'.format(line_num))
+            self.weapon_of_choice.save_next_start(line_num=line_num)
+            self.weapon_of_choice.close()
+        elif not self.weapon_of_choice.complete:
             self.log.info('Christopher, stop walken')
             self.log.info('Saving next start {} ...'.format(self.next_start))
             self.save_next_start()
@@ -782,33 +863,42 @@ class ChristopherWalken(LMObject):
             self.log.info('Christopher is done walken')
 
     # ....................................
-    def _find_or_insert_intersect(self, prj, mtx, curr_time):
-        """Initialize model, projections for inputs/algorithm."""
-        mtx_col = None
-        if prj is not None:
+    def _find_or_insert_intersects(self, prj_mtx_pairs, curr_time):
+        """Initialize intersections of projections with their matrices.
+
+        Args:
+            prj_mtx_pairs: A list of (SDMProjection, LMMatrix) tuples.
+            curr_time: The status modification time for new columns.
+
+        Returns:
+            A list of the MatrixColumns that were found or inserted.
+        """
+        shapegrid = self.boom_gridset.get_shapegrid()
+        tmp_cols = []
+        for prj, mtx in prj_mtx_pairs:
             # TODO: Save process_type into the DB??
             if LMFormat.is_gdal(driver=prj.data_format):
                 ptype = ProcessType.INTERSECT_RASTER
             else:
                 ptype = ProcessType.INTERSECT_VECTOR
 
-            tmp_col = MatrixColumn(
+            tmp_cols.append(MatrixColumn(
                 None, mtx.get_id(), self.user_id, layer=prj,
-                shapegrid=self.boom_gridset.get_shapegrid(),
-                intersect_params=self.intersect_params, squid=prj.squid,
-                ident=prj.ident, process_type=ptype, metadata={},
-                matrix_column_id=None, post_to_solr=True,
-                status=JobStatus.GENERAL, status_mod_time=curr_time)
-            mtx_col = self._scribe.find_or_insert_matrix_column(tmp_col)
-            if mtx_col is not None:
-                self.log.debug(
-                    'Found/inserted MatrixColumn {}'.format(mtx_col.get_id()))
-
-                # Reset process_type, shapegrid obj (not in db)
-                mtx_col.process_type = ptype
-                mtx_col.shapegrid = self.boom_gridset.get_shapegrid()
-
-        return mtx_col
+                shapegrid=shapegrid, intersect_params=self.intersect_params,
+                squid=prj.squid, ident=prj.ident, process_type=ptype,
+                metadata={}, matrix_column_id=None, post_to_solr=True,
+                status=JobStatus.GENERAL, status_mod_time=curr_time))
+
+        mtx_cols = []
+        if tmp_cols:
+            for mtx_col in self._scribe.find_or_insert_matrix_columns(
+                    tmp_cols):
+                if mtx_col is not None:
+                    self.log.debug(
+                        'Found/inserted MatrixColumn {}'.format(
+                            mtx_col.get_id()))
+                    mtx_cols.append(mtx_col)
+        return mtx_cols
 
     # ....................................
     def _do_reset(self, status, status_mod_time):
@@ -818,21 +908,33 @@ class ChristopherWalken(LMObject):
              status_mod_time < self.weapon_of_choice.expiration_date])
 
     # ....................................
-    def _find_or_insert_sdm_project(self, occ, alg, prj_scen, curr_time):
-        prj = None
+    def _find_or_insert_sdm_projects(self, occ, alg, curr_time):
+        """Initialize projections of an algorithm for each scenario.
+
+        Returns:
+            A list of the SDMProjections that were found or inserted.
+        """
+        prjs = []
         if occ is not None:
-            tmp_prj = SDMProjection(
-                occ, alg, self.mdl_scen, prj_scen, data_format=LMFormat.GTIFF.driver,
-                status=JobStatus.GENERAL, status_mod_time=curr_time)
-            prj = self._scribe.find_or_insert_sdm_project(tmp_prj)
-            if prj is not None:
-                self.log.debug(
-                    'Found/inserted SDMProject {}'.format(prj.get_id()))
-                # Fill in projection with input scenario layers, masks
-                prj._model_scenario = self.mdl_scen
-                prj._proj_scenario = prj_scen
-        return prj
-    
+            tmp_prjs = [
+                SDMProjection(
+                    occ, alg, self.mdl_scen, prj_scen,
+                    data_format=LMFormat.GTIFF.driver,
+                    status=JobStatus.GENERAL, status_mod_time=curr_time)
+                for prj_scen in self.prj_scens]
+            new_prjs = []
+            if tmp_prjs:
+                new_prjs = self._scribe.find_or_insert_sdm_projects(tmp_prjs)
+            for prj_scen, prj in zip(self.prj_scens, new_prjs):
+                if prj is not None:
+                    self.log.debug(
+                        'Found/inserted SDMProject {}'.format(prj.get_id()))
+                    # Fill in projection with input scenario layers, masks
+                    prj._model_scenario = self.mdl_scen
+                    prj._proj_scenario = prj_scen
+                    prjs.append(prj)
+        return prjs
+
     # ....................................
     def _delete_projs_and_intersections_for_occ(self, occ):
         """
@@ -4,10 +4,11 @@ import argparse
 import json
 
 import numpy as np
-from osgeo import gdal, ogr
+from osgeo import ogr
 
 from lmpy import Matrix
 from LmCommon.common.lmconstants import ENCODING
+from LmCommon.common.raster_blocks import RasterBlockReader
 
 
 # .............................................................................
@@ -71,29 +72,36 @@ def get_metrics(points_filename, layer_info, identifier,
 def get_metrics_for_layer(points, layer_filename, metric_functions):
     """Get layer values for each point and then generate metrics
     """
-    dataset = gdal.Open(layer_filename)
-    band = dataset.GetRasterBand(1)
-    data = np.array(band.ReadAsArray())
-    geo_transform = dataset.GetGeoTransform()
-    nodata_val = band.GetNoDataValue()
+    with RasterBlockReader(layer_filename) as reader:
+        geo_transform = reader.geo_transform
+        nodata_val = reader.nodata
+        num_rows, num_cols = reader.shape
+
+        pixels = []
+        for x_coord, y_coord in points:
+            # Floor so points just left of or above the layer are outside
+            pix_x = int(np.floor(
+                (x_coord - geo_transform[0]) / geo_transform[1]))
+            pix_y = int(np.floor(
+                (y_coord - geo_transform[3]) / geo_transform[5]))
+            if 0 <= pix_x < num_cols and 0 <= pix_y < num_rows:
+                pixels.append((pix_x, pix_y))
+            else:
+                print('Could not append value at ({}, {}): {}'.format(
+                    pix_x, pix_y, 'Point outside of layer'))
 
-    values = []
+        # Only read the blocks of the layer that contain points
+        point_values = reader.gather(
+            [pix_y * num_cols + pix_x for pix_x, pix_y in pixels])
 
-    for x_coord, y_coord in points:
-        pix_x = int((x_coord - geo_transform[0]) / geo_transform[1])
-        pix_y = int((y_coord - geo_transform[3]) / geo_transform[5])
-        try:
-            val = data[pix_y, pix_x]
-            if not is_close(val, nodata_val):
-                values.append(data[pix_y, pix_x])
-            else:
-                print(
-                    'Could not append value at ({}, {}): {}'.format(
-                        pix_x, pix_y, val))
-        except Exception as e:
+    values = []
+    for (pix_x, pix_y), val in zip(pixels, point_values):
+        if nodata_val is None or not is_close(val, nodata_val):
+            values.append(val)
+        else:
             print(
                 'Could not append value at ({}, {}): {}'.format(
-                    pix_x, pix_y, str(e)))
+                    pix_x, pix_y, val))
 
     arr = np.array(values)
 
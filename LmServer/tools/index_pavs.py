@@ -1,20 +1,54 @@
 """This script inserts PAVs into the Solr index
+
+Documents are built for many PAVs and posted in batches, with a single commit
+once every batch has been posted.  Shapegrid cell centroids are read once for
+each shapegrid rather than for each PAV.
 """
 import argparse
 import json
-import os
 
+import numpy as np
 from osgeo import ogr
 
 from LmBackend.common.lmconstants import RegistryKey
 from LmCommon.common.lmconstants import ENCODING
 from LmCommon.common.time import LmTime
 from LmCommon.compression.binary_list import decompress
-from LmServer.common.lmconstants import (SOLR_ARCHIVE_COLLECTION, SOLR_FIELDS)
+from LmServer.common.lmconstants import (
+    NUM_DOCS_PER_POST, SOLR_ARCHIVE_COLLECTION, SOLR_FIELDS,
+    SOLR_POST_WORKERS)
 from LmServer.common.log import ConsoleLogger
-from LmServer.common.solr import build_solr_document, post_solr_document
+from LmServer.common.solr import post_solr_documents
 from LmServer.db.borg_scribe import BorgScribe
 
+# Note: Solr presence point strings for the cells of each shapegrid, keyed by
+#    shapegrid id, so a shapegrid is read once no matter how many PAVs use it
+_SHAPEGRID_POINTS = {}
+
+
+# .............................................................................
+def get_shapegrid_presence_points(shapegrid):
+    """Gets the Solr presence point string of each shapegrid cell centroid
+
+    Args:
+        shapegrid : A Shapegrid object
+
+    Returns:
+        A numpy array of 'y,x' strings in shapegrid feature order
+    """
+    shapegrid_id = shapegrid.get_id()
+    if shapegrid_id not in _SHAPEGRID_POINTS:
+        shapegrid_dataset = ogr.Open(shapegrid.get_dlocation())
+        shapegrid_layer = shapegrid_dataset.GetLayer()
+        points = []
+        feat = shapegrid_layer.GetNextFeature()
+        while feat is not None:
+            cent = feat.GetGeometryRef().Centroid()
+            points.append('{},{}'.format(cent.GetY(), cent.GetX()))
+            feat = shapegrid_layer.GetNextFeature()
+        _SHAPEGRID_POINTS[shapegrid_id] = np.array(points, dtype=object)
+    return _SHAPEGRID_POINTS[shapegrid_id]
+
 
 # TODO: Different logger
 # .............................................................................
@@ -119,22 +153,13 @@ def get_post_pairs(pav, prj, occ, pam, sci_name, compressed_pav):
         (SOLR_FIELDS.COMPRESSED_PAV, compressed_pav)
     ]
 
-    # Process presence centroids
-    # See if we can get features from shapegrid
-    shapegrid_dataset = ogr.Open(shapegrid.get_dlocation())
-    shapegrid_layer = shapegrid_dataset.GetLayer()
+    # Add the centroid of each present cell
+    presence_points = get_shapegrid_presence_points(shapegrid)
     uncompressed_pav = decompress(compressed_pav)
-    i = 0
-    feat = shapegrid_layer.GetNextFeature()
-    while feat is not None:
-        if uncompressed_pav[i]:
-            geom = feat.GetGeometryRef()
-            cent = geom.Centroid()
-            fields.append(
-                (SOLR_FIELDS.PRESENCE, '{},{}'.format(
-                    cent.GetY(), cent.GetX())))
-        i += 1
-        feat = shapegrid_layer.GetNextFeature()
+    num_cells = min(presence_points.size, uncompressed_pav.size)
+    fields.extend(
+        (SOLR_FIELDS.PRESENCE, point) for point in presence_points[
+            :num_cells][uncompressed_pav[:num_cells] != 0])
     return fields
 
 
@@ -150,7 +175,13 @@ def main():
         'pavs_filename', type=str, help='A JSON file with PAV information')
     parser.add_argument(
         'post_index_filename', type=str,
-        help='A file location to be used for Solr POST')
+        help='A file location to write the posted Solr document')
+    parser.add_argument(
+        '-b', '--batch_size', type=int, default=NUM_DOCS_PER_POST,
+        help='The number of PAV documents to post at a time')
+    parser.add_argument(
+        '-w', '--max_workers', type=int, default=SOLR_POST_WORKERS,
+        help='The maximum number of batches to post at once')
 
     args = parser.parse_args()
 
@@ -159,37 +190,37 @@ def main():
 
     scribe = BorgScribe(ConsoleLogger())
     scribe.open_connections()
-    doc_pairs = []
-    for pav_info in pav_config:
-        compressed_pav = pav_info[RegistryKey.COMPRESSED_PAV_DATA]
-        pav_id = pav_info[RegistryKey.IDENTIFIER]
-        proj_id = pav_info[RegistryKey.PROJECTION_ID]
-
-        pav = scribe.get_matrix_column(mtx_col_id=pav_id)
-        prj = scribe.get_sdm_project(proj_id)
-        occ = prj.occ_layer
-        pam = scribe.get_matrix(mtx_id=pav.parent_id)
-        sci_name = scribe.get_taxon(squid=pav.squid)
-
-        val_pairs = get_post_pairs(
-            pav, prj, occ, pam, sci_name, compressed_pav)
-        if len(val_pairs) > 0:
-            doc_pairs.append(val_pairs)
-
-    # Get all the information for a POST
-    if len(doc_pairs) > 0:
-        solr_post_bytes = build_solr_document(doc_pairs)
-
-        # Write the (bytes) post document as an encoded string
-        solr_post_str =  solr_post_bytes.decode(encoding=ENCODING)
-        with open(args.post_index_filename, 'w', encoding=ENCODING) as out_f:
-            out_f.write(solr_post_str)
-
-        post_solr_document(SOLR_ARCHIVE_COLLECTION, args.post_index_filename)
-    else:
+    pams = {}
+
+    # ...............................
+    def _get_doc_pairs():
+        for pav_info in pav_config:
+            compressed_pav = pav_info[RegistryKey.COMPRESSED_PAV_DATA]
+            pav_id = pav_info[RegistryKey.IDENTIFIER]
+            proj_id = pav_info[RegistryKey.PROJECTION_ID]
+
+            pav = scribe.get_matrix_column(mtx_col_id=pav_id)
+            prj = scribe.get_sdm_project(proj_id)
+            occ = prj.occ_layer
+            # PAVs usually share a PAM, so only look each one up once
+            if pav.parent_id not in pams:
+                pams[pav.parent_id] = scribe.get_matrix(mtx_id=pav.parent_id)
+            pam = pams[pav.parent_id]
+            sci_name = scribe.get_taxon(squid=pav.squid)
+
+            val_pairs = get_post_pairs(
+                pav, prj, occ, pam, sci_name, compressed_pav)
+            if len(val_pairs) > 0:
+                yield val_pairs
+
+    # Build and post documents in batches, writing them to the post file
+    with open(args.post_index_filename, 'w', encoding=ENCODING) as out_f:
+        num_docs = post_solr_documents(
+            SOLR_ARCHIVE_COLLECTION, _get_doc_pairs(),
+            batch_size=args.batch_size, max_workers=args.max_workers,
+            out_file=out_f)
+    if num_docs == 0:
         print('No documents to post')
-        with open(args.post_index_filename, 'a', encoding=ENCODING):
-            os.utime(args.post_index_filename, None)
 
     scribe.close_connections()
 
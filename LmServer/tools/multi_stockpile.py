@@ -19,6 +19,20 @@ from LmServer.common.log import ConsoleLogger
 from LmServer.db.borg_scribe import BorgScribe
 
 
+# .............................................................................
+def _update_gathered_objects(scribe, objs, log):
+    """Updates the objects gathered before a failure
+
+    An error from the update is logged rather than raised, so that it does not
+    replace the original failure.
+    """
+    try:
+        scribe.update_objects(objs)
+    except Exception as err:
+        log.error('Failed to update {} gathered objects: {}'.format(
+            len(objs), err))
+
+
 # .............................................................................
 def stockpile_pavs(pav_list):
     """Stockpiles pavs from a list of dictionary entries
@@ -26,20 +40,31 @@ def stockpile_pavs(pav_list):
     log = ConsoleLogger()
     scribe = BorgScribe(log)
     scribe.open_connections()
-    for pav_dict in pav_list:
-        pav_id = int(pav_dict[RegistryKey.IDENTIFIER])
-        pav = scribe.get_matrix_column(mtx_col_id=pav_id)
-        if pav is None:
-            raise LMError('Failed to get PAV {}'.format(pav_id))
-        try:
-            pav_data = decompress(pav_dict[RegistryKey.COMPRESSED_PAV_DATA])
-            status = JobStatus.COMPLETE
-        except Exception:
-            status = JobStatus.IO_MATRIX_READ_ERROR
-
-        pav.update_status(status)
-        scribe.update_object(pav)
-    scribe.close_connections()
+    pavs = []
+    try:
+        for pav_dict in pav_list:
+            pav_id = int(pav_dict[RegistryKey.IDENTIFIER])
+            pav = scribe.get_matrix_column(mtx_col_id=pav_id)
+            if pav is None:
+                raise LMError('Failed to get PAV {}'.format(pav_id))
+            try:
+                pav_data = decompress(
+                    pav_dict[RegistryKey.COMPRESSED_PAV_DATA])
+                status = JobStatus.COMPLETE
+            except Exception:
+                status = JobStatus.IO_MATRIX_READ_ERROR
+
+            pav.update_status(status)
+            pavs.append(pav)
+    except Exception:
+        # Update the PAVs gathered before the failure, then raise it
+        _update_gathered_objects(scribe, pavs, log)
+        raise
+    else:
+        # Update the PAVs in one transaction
+        scribe.update_objects(pavs)
+    finally:
+        scribe.close_connections()
 
 
 # .............................................................................
@@ -49,56 +74,65 @@ def stockpile_objects(stockpile_list):
     scribe = BorgScribe(log)
     scribe.open_connections()
 
-    for stockpile_dict in stockpile_list:
-        obj_id = int(stockpile_dict[RegistryKey.IDENTIFIER])
-        test_file = stockpile_dict[RegistryKey.PRIMARY_OUTPUT]
-        process_type = int(stockpile_dict[RegistryKey.PROCESS_TYPE])
-        status = int(stockpile_dict[RegistryKey.STATUS])
-
-        # Get object
-        if ProcessType.is_occurrence(process_type):
-            obj = scribe.get_occurrence_set(occ_id=obj_id)
-            test_method = test_spatial
-        elif ProcessType.is_project(process_type):
-            obj = scribe.get_sdm_project(obj_id)
-            test_method = test_spatial
-        elif ProcessType.is_matrix(process_type):
-            obj = scribe.get_matrix(mtx_id=obj_id)
-            test_method = test_matrix
-        elif ProcessType.is_intersect(process_type):
-            obj = scribe.get_matrix_column(mtx_col_id=obj_id)
-            test_method = test_matrix
-        else:
-            raise LMError(
-                'Unsupported process type {} for object {}'.format(
-                    process_type, obj_id))
-        if obj is None:
-            raise LMError(
-                'Failed to get object {} for process {}'.format(
-                    obj_id, process_type))
-
-        log.debug('Test object: ptype {}, object id {}, status {}'.format(
-            process_type, obj_id, status))
-        if status < JobStatus.GENERAL_ERROR:
-            # Test outputs
-            status = test_method(test_file)
-            # Attempt to update verify
-            try:
-                obj.set_verify()
-            except AttributeError:
-                # If the object doesn't have the setVerify method, pass
-                pass
-
-            # TODO: Test secondary outputs
+    objs = []
+    try:
+        for stockpile_dict in stockpile_list:
+            obj_id = int(stockpile_dict[RegistryKey.IDENTIFIER])
+            test_file = stockpile_dict[RegistryKey.PRIMARY_OUTPUT]
+            process_type = int(stockpile_dict[RegistryKey.PROCESS_TYPE])
+            status = int(stockpile_dict[RegistryKey.STATUS])
+
+            # Get object
+            if ProcessType.is_occurrence(process_type):
+                obj = scribe.get_occurrence_set(occ_id=obj_id)
+                test_method = test_spatial
+            elif ProcessType.is_project(process_type):
+                obj = scribe.get_sdm_project(obj_id)
+                test_method = test_spatial
+            elif ProcessType.is_matrix(process_type):
+                obj = scribe.get_matrix(mtx_id=obj_id)
+                test_method = test_matrix
+            elif ProcessType.is_intersect(process_type):
+                obj = scribe.get_matrix_column(mtx_col_id=obj_id)
+                test_method = test_matrix
+            else:
+                raise LMError(
+                    'Unsupported process type {} for object {}'.format(
+                        process_type, obj_id))
+            if obj is None:
+                raise LMError(
+                    'Failed to get object {} for process {}'.format(
+                        obj_id, process_type))
 
-        # Update the object in the database
-        log.debug(
-            'Updating process type {}, object {}, with status {}'.format(
+            log.debug('Test object: ptype {}, object id {}, status {}'.format(
                 process_type, obj_id, status))
-        obj.update_status(status)
-        scribe.update_object(obj)
-
-    scribe.close_connections()
+            if status < JobStatus.GENERAL_ERROR:
+                # Test outputs
+                status = test_method(test_file)
+                # Attempt to update verify
+                try:
+                    obj.set_verify()
+                except AttributeError:
+                    # If the object doesn't have the setVerify method, pass
+                    pass
+
+                # TODO: Test secondary outputs
+
+            # Queue the object for the database update
+            log.debug(
+                'Updating process type {}, object {}, with status {}'.format(
+                    process_type, obj_id, status))
+            obj.update_status(status)
+            objs.append(obj)
+    except Exception:
+        # Update the objects gathered before the failure, then raise it
+        _update_gathered_objects(scribe, objs, log)
+        raise
+    else:
+        # Update the objects, batched by object type
+        scribe.update_objects(objs)
+    finally:
+        scribe.close_connections()
 
 
 # .............................................................................
@@ -13,7 +13,7 @@ import sys
 from LmBackend.common.lmobj import LMError, LMObject
 from LmCommon.common.api_query import GbifAPI
 from LmCommon.common.lmconstants import (JobStatus, LMFormat, ONE_HOUR, ProcessType, ENCODING)
-from LmCommon.common.occ_parse import OccDataParser
+from LmCommon.common.occ_parse import OccDataBlockParser
 from LmCommon.common.ready_file import ready_filename
 from LmCommon.common.time import gmt, LmTime
 from LmServer.base.taxon import ScientificName
@@ -29,6 +29,10 @@ TROUBLESHOOT_UPDATE_INTERVAL = ONE_HOUR
 class _SpeciesWeaponOfChoice(LMObject):
     """Base class for getting species data one species at a time
     """
+    # Subclasses that separate pull_chunk and process_chunk can process
+    #    species chunks in other processes
+    supports_parallel = False
+
     # ................................
     def __init__(self, scribe, user, archive_name, epsg, exp_date, input_fname,
                  meta_fname=None, taxon_source_name=None, logger=None):
@@ -164,13 +168,18 @@ class _SpeciesWeaponOfChoice(LMObject):
         return line
 
     # ................................
-    def save_next_start(self, fail=False):
+    def save_next_start(self, fail=False, line_num=None):
         """Save the starting position for the next run
+
+        Args:
+            fail: Save the start of the current species rather than the next
+            line_num: An explicit starting position to save
         """
-        if fail:
-            line_num = self.this_start
-        else:
-            line_num = self.next_start
+        if line_num is None:
+            if fail:
+                line_num = self.this_start
+            else:
+                line_num = self.next_start
         if line_num is not None:
             try:
                 with open(self.start_file, 'w', encoding=ENCODING) as out_f:
@@ -323,6 +332,25 @@ class _SpeciesWeaponOfChoice(LMObject):
     def _write_raw_data(self, occ, data=None, metadata=None):
         self._raise_subclass_error()
 
+    # ................................
+    def pull_chunk(self):
+        """Must be implemented in subclass if supports_parallel
+        """
+        self._raise_subclass_error()
+
+    # ................................
+    def find_or_insert_sci_name(self, data_chunk, taxon_key, taxon_name):
+        """Must be implemented in subclass if supports_parallel
+        """
+        self._raise_subclass_error()
+
+    # ................................
+    def process_chunk(self, data_chunk, taxon_key, taxon_name,
+                      column_meta=None, sci_name=None):
+        """Must be implemented in subclass if supports_parallel
+        """
+        self._raise_subclass_error()
+
     # ................................
     def close(self):
         """Must be implemented in subclass
@@ -382,6 +410,7 @@ class UserWoC(_SpeciesWeaponOfChoice):
             should name the field containing the GBIF TaxonID for the accepted
             Taxon of each record in the group.
     """
+    supports_parallel = True
 
     # ................................
     def __init__(
@@ -420,11 +449,12 @@ class UserWoC(_SpeciesWeaponOfChoice):
         """Creates objects for walking species and computation requests.
         """
         try:
-            self.occ_parser = OccDataParser(
+            self.occ_parser = OccDataBlockParser(
                 self.log, self._user_occ_csv, self._user_occ_meta,
                 delimiter=self._delimiter, pull_chunks=True)
         except Exception as e:
-            raise LMError('Failed to construct OccDataParser, {}'.format(e))
+            raise LMError(
+                'Failed to construct OccDataBlockParser, {}'.format(e))
 
         self._field_names = self.occ_parser.header
         self.occ_parser.initialize_me()
@@ -552,35 +582,85 @@ class UserWoC(_SpeciesWeaponOfChoice):
             - If taxon_name is missing, and use_gbif_taxonomy is False,
                 the OccurrenceLayer.displayname will use the GroupBy value
         """
+        occ = self.process_chunk(*self.pull_chunk())
+        if occ is not None:
+            self.log.info('WoC next start {}'.format(self.next_start))
+        return occ
+
+    # ................................
+    def pull_chunk(self):
+        """Pull the CSV records of the next species
+
+        Returns:
+            tuple: The records, GroupBy value, taxon name and column metadata
+                of the chunk, the arguments for process_chunk
+        """
+        data_chunk, taxon_key, taxon_name = (
+            self.occ_parser.pull_current_chunk())
+        return data_chunk, taxon_key, taxon_name, self.occ_parser.column_meta
+
+    # ................................
+    def find_or_insert_sci_name(self, data_chunk, taxon_key, taxon_name):
+        """Get or insert the ScientificName (squid) of a chunk of CSV records
+
+        Args:
+            data_chunk: A list of CSV records for one species
+            taxon_key: The GroupBy value of the records
+            taxon_name: The taxon name of the records
+
+        Returns:
+            ScientificName - The taxon of the records, or None if it cannot
+                be resolved
+        """
+        # TODO: enable generic replacement lookup
+        # if self._replacements and self._replace_col:
+        #     data_chunk = self._replace_lookup_keys(data_chunk)
+        if self.use_gbif_taxonomy:
+            # returns None if GBIF API does NOT return this or another key
+            #    as ACCEPTED, or if parsing error indicated by non-integer taxon_key
+            return self._get_insert_sci_name_for_gbif_species_key(
+                taxon_key, len(data_chunk))
+        if not taxon_name:
+            taxon_name = taxon_key
+        bbsci_name = ScientificName(taxon_name, user_id=self.user_id)
+        return self._scribe.find_or_insert_taxon(sci_name=bbsci_name)
+
+    # ................................
+    def process_chunk(self, data_chunk, taxon_key, taxon_name,
+                      column_meta=None, sci_name=None):
+        """Create an OccurrenceLayer from a chunk of CSV records
+
+        This uses the database but not the CSV parser, so a chunk from
+        pull_chunk may be processed by a UserWoC in another process that has
+        not been initialized.
+
+        Args:
+            data_chunk: A list of CSV records for one species
+            taxon_key: The GroupBy value of the records
+            taxon_name: The taxon name of the records
+            column_meta: The column metadata of the records, defaults to
+                that of this parser
+            sci_name: The ScientificName of the records, if it was already
+                found with find_or_insert_sci_name
+        """
         occ = None
-        (data_chunk, taxon_key, taxon_name) = self.occ_parser.pull_current_chunk()
+        if column_meta is None:
+            column_meta = self.occ_parser.column_meta
         if data_chunk:
-            # TODO: enable generic replacement lookup
-            # if self._replacements and self._replace_col:
-            #     data_chunk = self._replace_lookup_keys(data_chunk)
-            # Get or insert ScientificName (squid)
-            if self.use_gbif_taxonomy:
-                # returns None if GBIF API does NOT return this or another key
-                #    as ACCEPTED, or if parsing error indicated by non-integer taxon_key
-                sci_name = self._get_insert_sci_name_for_gbif_species_key(
-                    taxon_key, len(data_chunk))
-            else:
-                if not taxon_name:
-                    taxon_name = taxon_key
-                bbsci_name = ScientificName(taxon_name, user_id=self.user_id)
-                sci_name = self._scribe.find_or_insert_taxon(sci_name=bbsci_name)
+            if sci_name is None:
+                sci_name = self.find_or_insert_sci_name(
+                    data_chunk, taxon_key, taxon_name)
 
             if sci_name is not None:
                 occ = self._find_or_insert_occurrence_set(
                     sci_name, len(data_chunk), data=data_chunk,
-                    metadata=self.occ_parser.column_meta)
+                    metadata=column_meta)
                 if occ is not None:
                     self.log.info(
-                        'WoC processed occ set {}, {}; next start {}'.format(
+                        'WoC processed occ set {}, {}'.format(
                             occ.get_id(),
                             'name: {}, num records: {}'.format(
-                                sci_name.scientific_name, len(data_chunk)),
-                            self.next_start))
+                                sci_name.scientific_name, len(data_chunk))))
         return occ
 
     # ................................
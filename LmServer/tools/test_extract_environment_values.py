@@ -0,0 +1,56 @@
+"""Tests for the layer metrics of points in extract_environment_values.py
+"""
+import functools
+
+import numpy as np
+from osgeo import gdal
+import pytest
+
+from LmCommon.common.raster_blocks import (
+    DEFAULT_BLOCK_MEMORY, RasterBlockReader)
+from LmServer.tools import extract_environment_values
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+NODATA = -9999
+# Cells are 2 by 2 and the layer covers x from 10 to 20 and y from 42 to 50
+GEO_TRANSFORM = (10.0, 2.0, 0, 50.0, 0, -2.0)
+# Value 7, in row 1 and column 2, is nodata
+LAYER_DATA = np.where(
+    np.arange(20).reshape((4, 5)) == 7, NODATA,
+    np.arange(20).reshape((4, 5)))
+# Points in cells with values 0, 19, and 11
+INSIDE_POINTS = [(11.0, 49.0), (19.5, 42.5), (13.0, 45.0)]
+# Points in the nodata cell and less than a cell outside of each edge
+SKIPPED_POINTS = [
+    (15.0, 47.0), (9.0, 45.0), (12.0, 51.0), (21.0, 45.0), (12.0, 41.0)]
+
+
+# .............................................................................
+@pytest.fixture
+def layer_file(tmp_path):
+    """Writes the layer to a GeoTiff"""
+    filename = str(tmp_path / 'layer.tif')
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(filename, 5, 4, 1, gdal.GDT_Int32)
+    dataset.SetGeoTransform(GEO_TRANSFORM)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(LAYER_DATA)
+    dataset.FlushCache()
+    band = dataset = None
+    return filename
+
+
+# .............................................................................
+@pytest.mark.parametrize('memory_limit', [1, DEFAULT_BLOCK_MEMORY])
+def test_get_metrics_for_layer(layer_file, monkeypatch, memory_limit):
+    """Points outside of the layer and on nodata cells are skipped"""
+    monkeypatch.setattr(
+        extract_environment_values, 'RasterBlockReader',
+        functools.partial(RasterBlockReader, memory_limit=memory_limit))
+    metrics = extract_environment_values.get_metrics_for_layer(
+        SKIPPED_POINTS[:2] + INSIDE_POINTS + SKIPPED_POINTS[2:], layer_file,
+        [np.min, np.max, np.mean, len])
+    assert metrics == [0, 19, 10.0, 3]
@@ -1,18 +1,37 @@
 """Module functions for converting object to GeoJSON
+
+Note:
+    Matrix GeoJSON is built from cached shapegrid geometry JSON fragments and
+        attributes, and rows converted to Python values in one call, so no
+        feature is parsed and re-serialized.  A compact variant writes each
+        geometry once and matrix columns as arrays aligned with the features.
 """
+from collections import OrderedDict
 import json
+import os
+import threading
 
 import cherrypy
+import numpy as np
 import ogr
 
 from lmpy import Matrix
 
-from LmCommon.common.lmconstants import LMFormat, MatrixType
+from LmCommon.common.lmconstants import ENCODING, LMFormat, MatrixType
 from LmServer.base.layer import Vector
 from LmServer.legion.lm_matrix import LMMatrix
 from LmServer.legion.occ_layer import OccurrenceLayer
 from LmServer.legion.shapegrid import Shapegrid
 
+# Note: The number of shapegrids with cached geometry JSON, each fragment list
+#    is roughly the size of the shapefile
+GEOMETRY_CACHE_SIZE = 4
+_GEOMETRY_CACHE = OrderedDict()
+_GEOMETRY_CACHE_LOCK = threading.Lock()
+
+# Note: Streamed GeoJSON is sent in chunks of about this many characters
+GEO_JSON_CHUNK_SIZE = 1024 ** 2
+
 
 # .............................................................................
 def identity_func(value):
@@ -38,79 +57,206 @@ def right_hand_rule(coordinates):
 
 
 # .............................................................................
-def geo_jsonify_flo(flo, shp_file_name, matrix=None, mtx_join_attrib=None,
-                    ident=4, header_lookup_filename=None,
-                    transform=identity_func):
+def get_feature_geometries(shp_file_name):
+    """Gets the feature ids, geometry JSON and attributes of a shapefile
+
+    The features are read once and cached.
+
+    Args:
+        shp_file_name: The file location of the shapefile (shapegrid)
+
+    Returns:
+        A tuple of the list of feature ids, the list of GeoJSON geometry
+            strings, with coordinates in right hand rule order, and the list
+            of feature attribute dictionaries, for the features in layer
+            order
+    """
+    file_stat = os.stat(shp_file_name)
+    key = (os.path.abspath(shp_file_name), file_stat.st_mtime,
+           file_stat.st_size)
+    with _GEOMETRY_CACHE_LOCK:
+        if key in _GEOMETRY_CACHE:
+            _GEOMETRY_CACHE.move_to_end(key)
+            return _GEOMETRY_CACHE[key]
+
+    fids = []
+    geometries = []
+    attributes = []
+    drv = ogr.GetDriverByName(LMFormat.get_default_ogr().driver)
+    dataset = drv.Open(shp_file_name, 0)
+    lyr = dataset.GetLayer()
+    for feat in lyr:
+        geom_json = json.loads(feat.GetGeometryRef().ExportToJson())
+        right_hand_rule(geom_json['coordinates'])
+        fids.append(feat.GetFID())
+        geometries.append(json.dumps(geom_json))
+        attributes.append(feat.items())
+    dataset = None
+
+    with _GEOMETRY_CACHE_LOCK:
+        _GEOMETRY_CACHE[key] = (fids, geometries, attributes)
+        while len(_GEOMETRY_CACHE) > GEOMETRY_CACHE_SIZE:
+            _GEOMETRY_CACHE.popitem(last=False)
+    return fids, geometries, attributes
+
+
+# .............................................................................
+def _get_matrix_data(matrix):
+    """Gets the two dimensional matrix values to write as properties
+
+    Only the first depth layer of a three dimensional matrix is used, so each
+    property is a single value.  Boolean matrices are cast to integers
+    because booleans cannot be encoded correctly for JSON.
     """
-    @summary: A string generator for matrix GeoJSON
+    data = np.asarray(matrix)
+    if data.ndim == 3:
+        data = data[:, :, 0]
+    if data.dtype == bool:
+        data = data.astype(int)
+    return data
+
+
+# .............................................................................
+def _get_matrix_rows(matrix, mtx_join_attrib):
+    """Gets the matrix rows as Python values and a row lookup by join value
+    """
+    row_lookup = {
+        row_hdr[mtx_join_attrib]: i for i, row_hdr in enumerate(
+            matrix.get_row_headers())}
+    return _get_matrix_data(matrix).tolist(), row_lookup
+
+
+# .............................................................................
+def _iter_geo_json(shp_file_name, matrix=None, mtx_join_attrib=None, ident=4,
+                   header_lookup_filename=None, transform=identity_func,
+                   all_features=False):
+    """Generates the strings of matrix GeoJSON
+
+    If all_features is True, every feature is included with its shapefile
+    attributes as properties, and the matrix values are added to them for
+    features with a matrix row, as in geo_jsonify.  Otherwise only features
+    with a matrix row are included, with the matrix values as properties.
     """
     if isinstance(ident, int):
         ident = ' ' * ident
 
-    flo.write('{\n')
-    flo.write('{}"type" : "FeatureCollection",\n'.format(ident))
+    yield '{\n'
+    yield '{}"type" : "FeatureCollection",\n'.format(ident)
     if header_lookup_filename:
-        flo.write('{}"propertyLookupFilename" : "{}",\n'.format(
-            ident, header_lookup_filename))
-    flo.write('{}"features" : [\n'.format(ident))
-
-    row_lookup = {}
+        yield '{}"propertyLookupFilename" : "{}",\n'.format(
+            ident, header_lookup_filename)
+    yield '{}"features" : [\n'.format(ident)
 
     if matrix is not None:
-        col_headers = matrix.get_column_headers()
-        col_enum = [(j, str(k)) for j, k in enumerate(col_headers)]
-        row_headers = matrix.get_row_headers()
+        rows, row_lookup = _get_matrix_rows(matrix, mtx_join_attrib)
+        col_headers = [str(k) for k in matrix.get_column_headers()]
+        fids, geometries, attributes = get_feature_geometries(shp_file_name)
+
+        separator = ''
+        for fid, geometry, attrs in zip(fids, geometries, attributes):
+            if fid in row_lookup:
+                row = rows[row_lookup[fid]]
+                # Set data or individuals
+                if header_lookup_filename:
+                    properties = {'data': transform(row)}
+                elif transform is identity_func:
+                    properties = dict(zip(col_headers, row))
+                else:
+                    properties = {
+                        k: transform(val) for k, val in zip(col_headers, row)}
+                if all_features:
+                    properties = dict(attrs, **properties)
+            elif all_features:
+                properties = attrs
+            else:
+                continue
+            yield (
+                '{}{{"type": "Feature", "geometry": {}, "properties": {}, '
+                '"id": {}}}').format(
+                    separator, geometry, json.dumps(properties), fid)
+            separator = ',\n'
+        yield '\n'
 
-        for i, row_hdr in enumerate(row_headers):
-            row_lookup[row_hdr[mtx_join_attrib]] = i
+    yield '{}]\n'.format(ident)
+    yield '}'
 
-        # Define cast function, necessary if matrix if full of booleans
-        if matrix.dtype == bool:
-            cast_func = int
-        else:
-            cast_func = identity_func
 
-    # Build features list
-    drv = ogr.GetDriverByName(LMFormat.get_default_ogr().driver)
-    dataset = drv.Open(shp_file_name, 0)
-    lyr = dataset.GetLayer()
+# .............................................................................
+def _iter_compact_geo_json(shp_file_name, matrix, mtx_join_attrib=None):
+    """Generates the strings of compact matrix GeoJSON
 
-    # Get number of features
-    num_feats = lyr.GetFeatureCount()
-    count = 0
+    The features have geometry and no properties.  The matrix values are
+    written once per column, as arrays aligned with the features, under
+    "columnProperties" with the column headers in "columnHeaders".
+    """
+    rows, row_lookup = _get_matrix_rows(matrix, mtx_join_attrib)
+    col_headers = [str(k) for k in matrix.get_column_headers()]
+    fids, geometries, _ = get_feature_geometries(shp_file_name)
+    feat_idxs = [k for k, fid in enumerate(fids) if fid in row_lookup]
+
+    yield '{"type": "FeatureCollection", "features": [\n'
+    yield ',\n'.join(
+        '{{"type": "Feature", "geometry": {}, "properties": {{}}, '
+        '"id": {}}}'.format(geometries[k], fids[k]) for k in feat_idxs)
+    yield '\n], "columnHeaders": {}, "columnProperties": {{'.format(
+        json.dumps(col_headers))
+
+    row_idxs = [row_lookup[fids[k]] for k in feat_idxs]
+    data = _get_matrix_data(matrix)
+    columns = data[row_idxs].T.tolist() if row_idxs else [
+        [] for _ in col_headers]
+    yield ', '.join(
+        '{}: {}'.format(json.dumps(hdr), json.dumps(col_vals))
+        for hdr, col_vals in zip(col_headers, columns))
+    yield '}}'
 
-    for feat in lyr:
-        count += 1
-        # Get the GeoJSON for the feature
-        feat_json = json.loads(feat.ExportToJson())
-        right_hand_rule(feat_json['geometry']['coordinates'])
-        join_attrib = feat.GetFID()
-        # TODO: Remove this if updated library adds first id correctly
-        feat_json['id'] = feat.GetFID()
 
-        # Join matrix attributes
-        if join_attrib in row_lookup:
-            i = row_lookup[join_attrib]
-
-            # Set data or individuals
-            if header_lookup_filename:
-                feat_json['properties'] = {
-                    'data': transform(
-                        [cast_func(j.item()) for j in matrix[i]])
-                    }
-            else:
-                feat_json['properties'] = {
-                    k: transform(cast_func(matrix[i, j].item())
-                                 ) for j, k in col_enum}
-            # Need to conditionally write comma
-            if count >= num_feats:
-                flo.write('{}\n'.format(json.dumps(feat_json)))
-            else:
-                flo.write('{},\n'.format(json.dumps(feat_json)))
-    dataset = None
+# .............................................................................
+def geo_jsonify_flo(flo, shp_file_name, matrix=None, mtx_join_attrib=None,
+                    ident=4, header_lookup_filename=None,
+                    transform=identity_func, compact=False):
+    """Writes matrix GeoJSON to a file-like object as it is generated
+
+    Args:
+        flo: A text file-like object to write to
+        shp_file_name: The file location of the shapegrid
+        matrix: A matrix with a row for each joined feature
+        mtx_join_attrib: The row header position to join on feature ids
+        ident: The indentation (string or number of spaces) for the document
+        header_lookup_filename: If provided, properties are a 'data' list and
+            this file name is added for looking up the column headers
+        transform: A function applied to each properties 'data' list, or to
+            each value when there is no header lookup file
+        compact: If True, write the compact variant with matrix columns as
+            arrays, the header lookup, transform, and ident are not used
+    """
+    if compact:
+        strings = _iter_compact_geo_json(
+            shp_file_name, matrix, mtx_join_attrib=mtx_join_attrib)
+    else:
+        strings = _iter_geo_json(
+            shp_file_name, matrix=matrix, mtx_join_attrib=mtx_join_attrib,
+            ident=ident, header_lookup_filename=header_lookup_filename,
+            transform=transform)
+    for json_str in strings:
+        flo.write(json_str)
 
-    flo.write('{}]\n'.format(ident))
-    flo.write('}')
+
+# .............................................................................
+def _iter_chunks(strings):
+    """Joins generated strings into encoded chunks for streaming
+    """
+    chunk = []
+    chunk_len = 0
+    for json_str in strings:
+        chunk.append(json_str)
+        chunk_len += len(json_str)
+        if chunk_len >= GEO_JSON_CHUNK_SIZE:
+            yield ''.join(chunk).encode(ENCODING)
+            chunk = []
+            chunk_len = 0
+    if chunk:
+        yield ''.join(chunk).encode(ENCODING)
 
 
 # .............................................................................
@@ -122,25 +268,9 @@ def geo_jsonify(shp_file_name, matrix=None, mtx_join_attrib=None):
     # Build matrix lookup
     if matrix is not None:
         col_headers = matrix.get_column_headers()
-        row_headers = matrix.get_row_headers()
-
-        # Define a cast function, necessary if the matrix is full of booleans
-        #     because they cannot be encoded correctly for JSON
-        if matrix.dtype == bool:
-            cast_func = int
-        else:
-            cast_func = identity_func
-
-        for i, row_hdr in enumerate(row_headers):
-            join_att = row_hdr[mtx_join_attrib]
-            att_lookup[join_att] = {}
-
-            for j, col_hdr in enumerate(col_headers):
-                try:
-                    att_lookup[join_att][col_hdr] = cast_func(
-                        matrix[i, j].item())
-                except Exception:
-                    pass
+        rows, row_lookup = _get_matrix_rows(matrix, mtx_join_attrib)
+        for join_att, i in row_lookup.items():
+            att_lookup[join_att] = dict(zip(col_headers, rows[i]))
 
     # Build features list
     features = []
@@ -174,12 +304,51 @@ def geo_jsonify(shp_file_name, matrix=None, mtx_join_attrib=None):
 
 
 # .............................................................................
-def geo_json_object_formatter(obj):
+def geo_json_object_formatter(obj, compact=False, stream=False):
     """Looks at object and converts to JSON based on its type
+
+    Args:
+        obj: The object to format
+        compact: If True, format matrices as compact GeoJSON
+        stream: If True, return a generator of encoded chunks instead of a
+            string
+    """
+    if isinstance(obj, LMMatrix):
+        strings = _iter_matrix_object(obj, compact=compact)
+    else:
+        strings = [json.dumps(_format_object(obj), indent=4)]
+
+    if stream:
+        cherrypy.response.stream = True
+        return _iter_chunks(strings)
+    return ''.join(strings)
+
+
+# .............................................................................
+def _iter_matrix_object(obj, compact=False):
+    """Generates the GeoJSON strings for a matrix object
     """
-    response = _format_object(obj)
+    cherrypy.response.headers['Content-Type'
+                              ] = LMFormat.GEO_JSON.get_mime_type()
+    if obj.matrix_type in (
+            MatrixType.PAM, MatrixType.ROLLING_PAM, MatrixType.ANC_PAM,
+            MatrixType.SITES_COV_OBSERVED, MatrixType.SITES_COV_RANDOM,
+            MatrixType.SITES_OBSERVED, MatrixType.SITES_RANDOM):
+
+        shapegrid = obj.get_gridset().get_shapegrid()
+        mtx = Matrix.load(obj.get_dlocation())
+        cherrypy.response.headers[
+            'Content-Disposition'
+            ] = 'attachment; filename="mtx_{}.geojson"'.format(obj.get_id())
+        if compact:
+            return _iter_compact_geo_json(
+                shapegrid.get_dlocation(), mtx, mtx_join_attrib=0)
+        return _iter_geo_json(
+            shapegrid.get_dlocation(), matrix=mtx, mtx_join_attrib=0,
+            all_features=True)
 
-    return json.dumps(response, indent=4)
+    raise TypeError(
+        'Cannot format matrix type: {}'.format(obj.matrix_type))
 
 
 # .............................................................................
@@ -194,22 +363,4 @@ def _format_object(obj):
             ] = 'attachment; filename="{}.geojson"'.format(obj.name)
         return geo_jsonify(obj.get_dlocation())
 
-    if isinstance(obj, LMMatrix):
-        if obj.matrix_type in (
-                MatrixType.PAM, MatrixType.ROLLING_PAM, MatrixType.ANC_PAM,
-                MatrixType.SITES_COV_OBSERVED, MatrixType.SITES_COV_RANDOM,
-                MatrixType.SITES_OBSERVED, MatrixType.SITES_RANDOM):
-
-            shapegrid = obj.get_gridset().get_shapegrid()
-            mtx = Matrix.load(obj.get_dlocation())
-            cherrypy.response.headers[
-                'Content-Disposition'
-                ] = 'attachment; filename="mtx_{}.geojson"'.format(
-                    obj.get_id())
-            return geo_jsonify(
-                shapegrid.get_dlocation(), matrix=mtx, mtx_join_attrib=0)
-
-        raise TypeError(
-            'Cannot format matrix type: {}'.format(obj.matrix_type))
-
     raise TypeError('Cannot format object of type: {}'.format(type(obj)))
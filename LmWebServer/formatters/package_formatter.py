@@ -1,13 +1,23 @@
 """Module containing functions for creating output package files
 
+Note:
+    Packages are written as a zip stream.  Matrix CSVs and GeoJSON are
+        written into their zip entries as they are generated, and a package
+        can be streamed to the response while it is built.  The finished
+        package is kept and reused until the gridset is modified.
+
 Todo:
     Split up some functions into smaller chunks
 """
 from collections import defaultdict
 import csv
-from io import BytesIO, StringIO
+import functools
+import io
 import json
 import os
+import queue
+import tempfile
+import threading
 import zipfile
 
 import cherrypy
@@ -18,6 +28,7 @@ from lmpy import Matrix
 from LmCommon.common.lm_xml import tostring
 from LmCommon.common.lmconstants import (
     HTTPStatus, JobStatus, LMFormat, MatrixType, PamStatKeys, ENCODING)
+from LmCommon.common.time import from_timestamp
 from LmServer.common.data_locator import EarlJr
 from LmServer.common.lmconstants import MAP_TEMPLATE, LMFileType
 from LmServer.common.log import WebLogger
@@ -29,10 +40,68 @@ from LmWebServer.common.lmconstants import (
 from LmWebServer.formatters.eml_formatter import make_eml
 from LmWebServer.formatters.geo_json_formatter import geo_jsonify_flo
 from LmWebServer.formatters.template_filler import TemplateFiller
+from LmWebServer.services.cp_plugins.db import get_scribe, release_scribe
 
 # # ...........................................................................
 PACKAGE_VERSION = '1.0.2'
 
+# Note: Streamed package bytes are sent to the response in chunks of this size
+PACKAGE_CHUNK_SIZE = 1024 ** 2
+# Note: The number of chunks buffered ahead of a slow client
+PACKAGE_STREAM_QUEUE_SIZE = 8
+# Note: Placeholder for template values written directly into the zip entry
+_STREAM_MARKER = '\x00STREAMED_CONTENT\x00'
+
+
+# .............................................................................
+class _PackageStreamWriter:
+    """Unseekable file-like object for writing a package as it is streamed
+
+    Bytes written are copied to a cache file and queued in chunks for the
+    response generator.  If the client goes away the package is still
+    completed so it is cached for the next request.
+    """
+
+    # ..............................
+    def __init__(self, cache_flo):
+        self.cache_flo = cache_flo
+        self.chunks = queue.Queue(maxsize=PACKAGE_STREAM_QUEUE_SIZE)
+        self.client_connected = True
+        self._buffer = bytearray()
+
+    # ..............................
+    def write(self, data):
+        """Write bytes to the cache file and the response stream"""
+        self.cache_flo.write(data)
+        self._buffer.extend(data)
+        if len(self._buffer) >= PACKAGE_CHUNK_SIZE:
+            self._send(bytes(self._buffer))
+            self._buffer = bytearray()
+        return len(data)
+
+    # ..............................
+    def flush(self):
+        """Flush the cache file"""
+        self.cache_flo.flush()
+
+    # ..............................
+    def finish(self, err=None):
+        """Send any buffered bytes and then an end marker or an error"""
+        if self._buffer and err is None:
+            self._send(bytes(self._buffer))
+        self._buffer = bytearray()
+        self._send(err)
+
+    # ..............................
+    def _send(self, item):
+        """Queue an item for the response unless the client is gone"""
+        while self.client_connected:
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
 
 # .............................................................................
 def get_map_content_for_proj(prj, scribe):
@@ -250,6 +319,28 @@ def mung(data):
     return munged
 
 
+# .............................................................................
+def _write_text_entry(zip_f, arc_name, write_func=None, prefix='', suffix=''):
+    """Writes a text entry into a zip file as it is generated
+
+    Args:
+        zip_f (ZipFile): An open zip file object to add the entry to.
+        arc_name (str): The path of the entry in the zip file.
+        write_func (function): An optional function that writes the body of
+            the entry to the text file-like object it is given.
+        prefix (str): Text to write before the body.
+        suffix (str): Text to write after the body.
+    """
+    with zip_f.open(arc_name, mode='w', force_zip64=True) as entry_flo:
+        text_flo = io.TextIOWrapper(entry_flo, encoding=ENCODING, newline='')
+        text_flo.write(prefix)
+        if write_func is not None:
+            write_func(text_flo)
+        text_flo.write(suffix)
+        text_flo.flush()
+        text_flo.detach()
+
+
 # .............................................................................
 def _add_sdms_to_package(zip_f, projections, scribe):
     """Adds SDMs to output package and returns projection info.
@@ -307,8 +398,6 @@ def _add_sdms_to_package(zip_f, projections, scribe):
 
             # If we have a csv for this occurrence set, add it
             if os.path.exists(sys_occ_path):
-                # string io object
-                occ_string_io = BytesIO()
                 headers = list(occ.get_feature_attributes().items())
                 with open(sys_occ_path, encoding=ENCODING) as in_f:
                     # Get Delimiter
@@ -316,17 +405,12 @@ def _add_sdms_to_package(zip_f, projections, scribe):
                     in_f.seek(0)
                     delimiter = dialect.delimiter
 
-                    # Write header line
+                    # Write header line, then the rest of the lines
                     header_line = delimiter.join(
                         [i[1][0] for i in sorted(headers)])
-                    occ_string_io.write(
-                        '{}\n'.format(header_line).encode(ENCODING))
-                    # Write the rest of the lines
-                    for line in in_f:
-                        occ_string_io.write(line.encode(ENCODING))
-                occ_string_io.seek(0)
-                zip_f.writestr(arc_occ_path, occ_string_io.getvalue())
-                occ_string_io = None
+                    _write_text_entry(
+                        zip_f, arc_occ_path, prefix='{}\n'.format(header_line),
+                        write_func=lambda out_f: out_f.writelines(in_f))
             else:
                 # Write shapefile
                 for ext in LMFormat.SHAPE.get_extensions():
@@ -373,13 +457,45 @@ def _get_known_package_files():
 
 
 # .............................................................................
-def _package_gridset(gridset, include_csv=False, include_sdm=False):
+def _package_gridset(gridset, package_flo, include_csv=False,
+                     include_sdm=False):
     """Create a gridset package
+
+    The package may be written in a background thread, so it uses its own
+    pooled database connection rather than the request scribe.
+
+    Args:
+        gridset (Gridset): The gridset to package.
+        package_flo (file-like): A binary file-like object to write the zip
+            to, it does not need to be seekable.
+        include_csv (bool): Should matrix CSV files be included.
+        include_sdm (bool): Should SDM projections be included.
+    """
+    scribe = BorgScribe(WebLogger(), pooled=True)
+    scribe.open_connections()
+    try:
+        _write_gridset_package(
+            gridset, package_flo, scribe, include_csv=include_csv,
+            include_sdm=include_sdm)
+    finally:
+        scribe.close_connections()
+
+
+# .............................................................................
+def _write_gridset_package(gridset, package_flo, scribe, include_csv=False,
+                           include_sdm=False):
+    """Write the contents of a gridset package
+
+    Args:
+        gridset (Gridset): The gridset to package.
+        package_flo (file-like): A binary file-like object to write the zip
+            to, it does not need to be seekable.
+        scribe (BorgScribe): An open scribe for database queries.
+        include_csv (bool): Should matrix CSV files be included.
+        include_sdm (bool): Should SDM projections be included.
     """
     # Initialization
     # --------------
-    package_filename = gridset.get_package_location()
-    scribe = BorgScribe(WebLogger())
     user_id = gridset.get_user_id()
     occ_info = None
     prj_info = None
@@ -401,7 +517,7 @@ def _package_gridset(gridset, include_csv=False, include_sdm=False):
 
     # Open zip file
     with zipfile.ZipFile(
-            package_filename, mode='w', compression=zipfile.ZIP_DEFLATED,
+            package_flo, mode='w', compression=zipfile.ZIP_DEFLATED,
             allowZip64=True) as zip_f:
 
         # Add SDMs if we should
@@ -422,27 +538,29 @@ def _package_gridset(gridset, include_csv=False, include_sdm=False):
             # Only add if matrix is complete and observed scenario
             if mtx.status == JobStatus.COMPLETE and mtx.date_code == 'Curr':
                 # Handle each matrix type
+                # Each matrix is loaded once, for its role and for the CSV
+                mtx_obj = None
                 if mtx.matrix_type in [MatrixType.PAM, MatrixType.ROLLING_PAM]:
-                    pam = Matrix.load(mtx.get_dlocation())
+                    pam = mtx_obj = Matrix.load(mtx.get_dlocation())
                     csv_mtx_fn = os.path.join(
                         MATRIX_DIR, 'pam_{}.csv'.format(mtx.get_id()))
                 elif mtx.matrix_type == MatrixType.ANC_PAM:
-                    anc_pam = Matrix.load(mtx.get_dlocation())
+                    anc_pam = mtx_obj = Matrix.load(mtx.get_dlocation())
                     csv_mtx_fn = os.path.join(
                         MATRIX_DIR, 'anc_pam_{}.csv'.format(mtx.get_id()))
                 elif mtx.matrix_type == MatrixType.SITES_COV_OBSERVED:
-                    sites_cov_obs = Matrix.load(mtx.get_dlocation())
+                    sites_cov_obs = mtx_obj = Matrix.load(mtx.get_dlocation())
                     csv_mtx_fn = os.path.join(
                         MATRIX_DIR, 'sitesCovarianceObserved_{}.csv'.format(
                             mtx.get_id()))
                 elif mtx.matrix_type == MatrixType.SITES_OBSERVED:
-                    sites_obs = Matrix.load(mtx.get_dlocation())
+                    sites_obs = mtx_obj = Matrix.load(mtx.get_dlocation())
                     csv_mtx_fn = os.path.join(
                         MATRIX_DIR, 'sitesObserved_{}.csv'.format(
                             mtx.get_id()))
                     do_pam_stats = True
                 elif mtx.matrix_type == MatrixType.MCPA_OUTPUTS:
-                    mcpa_mtx = Matrix.load(mtx.get_dlocation())
+                    mcpa_mtx = mtx_obj = Matrix.load(mtx.get_dlocation())
                     csv_mtx_fn = os.path.join(
                         MATRIX_DIR, 'mcpa_{}.csv'.format(mtx.get_id()))
                     do_mcpa = True
@@ -454,13 +572,12 @@ def _package_gridset(gridset, include_csv=False, include_sdm=False):
 
                 # If we should write the CSV file, and the matrix exists, do it
                 if include_csv and os.path.exists(mtx.get_dlocation()):
-                    mtx_obj = Matrix.load(mtx.get_dlocation())
-                    csv_mtx_str = StringIO()
-                    mtx_obj.write_csv(csv_mtx_str)
-                    csv_mtx_str.seek(0)
-                    zip_f.writestr(csv_mtx_fn, csv_mtx_str.getvalue())
-                    csv_mtx_str = None
+                    if mtx_obj is None:
+                        mtx_obj = Matrix.load(mtx.get_dlocation())
+                    _write_text_entry(
+                        zip_f, csv_mtx_fn, write_func=mtx_obj.write_csv)
                     csvs_in_folder = True
+                mtx_obj = None
 
         # Add Generated Files
         # -------------------
@@ -498,6 +615,9 @@ def _package_gridset(gridset, include_csv=False, include_sdm=False):
             # Should we write this template?  Default to true and change if
             #    data will not support it.
             write_template = True
+            # Large values are written straight into the zip entry by this
+            #    function rather than filled in as a string
+            stream_func = None
             # TODO: See if there is a better way to determine what variables to
             #    send to template without just sending everything and wasting
             #    memory (would require all all file content to be generated at
@@ -553,15 +673,13 @@ def _package_gridset(gridset, include_csv=False, include_sdm=False):
                 if pam is not None:
                     header_lookup_fn = os.path.join(
                         DYN_PACKAGE_DIR, 'squidLookup.json')
-                    pam_str = StringIO()
-                    geo_jsonify_flo(
-                        pam_str, shapegrid.get_dlocation(), matrix=pam,
+                    temp_filler = TemplateFiller(pam_json=_STREAM_MARKER)
+                    stream_func = functools.partial(
+                        geo_jsonify_flo,
+                        shp_file_name=shapegrid.get_dlocation(), matrix=pam,
                         mtx_join_attrib=0, ident=0,
                         header_lookup_filename=header_lookup_fn,
                         transform=mung)
-                    pam_str.seek(0)
-                    temp_filler = TemplateFiller(pam_json=pam_str.getvalue())
-                    pam_str = None
                 else:
                     write_template = False
             elif r_path.endswith('squidLookup.json'):
@@ -585,59 +703,49 @@ def _package_gridset(gridset, include_csv=False, include_sdm=False):
                 if anc_pam is not None:
                     header_lookup_fn = os.path.join(
                         DYN_PACKAGE_DIR, 'nodeLookup.json')
-                    anc_pam_str = StringIO()
-                    geo_jsonify_flo(
-                        anc_pam_str, shapegrid.get_dlocation(), matrix=anc_pam,
-                        mtx_join_attrib=0, ident=0,
+                    temp_filler = TemplateFiller(anc_pam_json=_STREAM_MARKER)
+                    stream_func = functools.partial(
+                        geo_jsonify_flo,
+                        shp_file_name=shapegrid.get_dlocation(),
+                        matrix=anc_pam, mtx_join_attrib=0, ident=0,
                         header_lookup_filename=header_lookup_fn,
                         transform=mung)
-                    anc_pam_str.seek(0)
-                    temp_filler = TemplateFiller(
-                        anc_pam_json=anc_pam_str.getvalue())
-                    anc_pam_str = None
                 else:
                     write_template = False
             elif r_path.endswith('mcpaMatrix.js'):
                 if mcpa_mtx is not None:
-                    mtx_str = StringIO()
-                    mcpa_mtx.write_csv(mtx_str)
-                    mtx_str.seek(0)
-                    temp_filler = TemplateFiller(mcpa_csv=mtx_str.getvalue())
-                    mtx_str = None
+                    temp_filler = TemplateFiller(mcpa_csv=_STREAM_MARKER)
+                    stream_func = mcpa_mtx.write_csv
                 else:
                     write_template = False
             elif r_path.endswith('sitesCovarianceObserved.js'):
                 if sites_cov_obs is not None:
-                    mtx_str = StringIO()
                     mtx_2d = Matrix(
                         sites_cov_obs[:, :, 0],
                         headers={
                             '0': sites_cov_obs.getRowHeaders(),
                             '1': sites_cov_obs.getColumnHeaders()})
-                    geo_jsonify_flo(
-                        mtx_str, shapegrid.get_dlocation(), mtx_2d,
-                        mtx_join_attrib=0, ident=0)
-                    mtx_str.seek(0)
                     temp_filler = TemplateFiller(
-                        sites_cov_obs_json=mtx_str.getvalue())
-                    mtx_str = None
+                        sites_cov_obs_json=_STREAM_MARKER)
+                    stream_func = functools.partial(
+                        geo_jsonify_flo,
+                        shp_file_name=shapegrid.get_dlocation(),
+                        matrix=mtx_2d, mtx_join_attrib=0, ident=0)
                 else:
                     write_template = False
             elif r_path.endswith('sitesObserved.js'):
                 if sites_obs is not None:
-                    mtx_str = StringIO()
                     mtx_2d = Matrix(
                         sites_obs[:, :, 0],
                         headers={
                             '0': sites_obs.get_row_headers(),
                             '1': sites_obs.get_column_headers()})
-                    geo_jsonify_flo(
-                        mtx_str, shapegrid.get_dlocation(), mtx_2d,
-                        mtx_join_attrib=0, ident=0)
-                    mtx_str.seek(0)
                     temp_filler = TemplateFiller(
-                        sites_obs_json=mtx_str.getvalue())
-                    mtx_str = None
+                        sites_obs_json=_STREAM_MARKER)
+                    stream_func = functools.partial(
+                        geo_jsonify_flo,
+                        shp_file_name=shapegrid.get_dlocation(),
+                        matrix=mtx_2d, mtx_join_attrib=0, ident=0)
                 else:
                     write_template = False
 
@@ -645,8 +753,14 @@ def _package_gridset(gridset, include_csv=False, include_sdm=False):
             if write_template:
                 with open(template_fn) as in_file:
                     template_str = in_file.read()
-                zip_f.writestr(
-                    r_path, temp_filler.fill_templated_string(template_str))
+                filled_str = temp_filler.fill_templated_string(template_str)
+                if stream_func is None:
+                    zip_f.writestr(r_path, filled_str)
+                else:
+                    prefix, suffix = filled_str.split(_STREAM_MARKER, 1)
+                    _write_text_entry(
+                        zip_f, r_path, write_func=stream_func, prefix=prefix,
+                        suffix=suffix)
 
 
 # .............................................................................
@@ -675,10 +789,100 @@ def summarize_object_statuses(summary):
     return (waiting, running, complete, error, total)
 
 
+# .............................................................................
+def _is_package_current(gridset, package_filename):
+    """Determines if a cached package was built after the gridset changed
+    """
+    if not os.path.exists(package_filename):
+        return False
+    if gridset.mod_time is None:
+        return True
+    return from_timestamp(
+        os.path.getmtime(package_filename)).mjd >= gridset.mod_time
+
+
+# .............................................................................
+def _get_package_temp_file(package_filename):
+    """Opens a temporary file next to the package for writing it
+
+    Returns:
+        tuple: The open binary file and its file location.  The file is
+            renamed to the package location once it is complete so requests
+            never see a partial package.
+    """
+    package_dir = os.path.dirname(package_filename)
+    os.makedirs(package_dir, exist_ok=True)
+    fd, temp_filename = tempfile.mkstemp(
+        dir=package_dir, prefix=os.path.basename(package_filename),
+        suffix='.tmp')
+    return os.fdopen(fd, 'wb'), temp_filename
+
+
+# .............................................................................
+def _build_package_file(gridset, package_filename, include_csv=False,
+                        include_sdm=False):
+    """Builds a gridset package and caches it at the package location
+    """
+    temp_flo, temp_filename = _get_package_temp_file(package_filename)
+    try:
+        with temp_flo:
+            _package_gridset(
+                gridset, temp_flo, include_csv=include_csv,
+                include_sdm=include_sdm)
+        os.replace(temp_filename, package_filename)
+    except Exception:
+        os.remove(temp_filename)
+        raise
+
+
+# .............................................................................
+def _stream_package(gridset, package_filename, include_csv=False,
+                    include_sdm=False):
+    """Generates the bytes of a gridset package while it is being built
+
+    The package is built in a background thread and cached at the package
+    location when it is complete, even if the client disconnects first.
+    """
+    temp_flo, temp_filename = _get_package_temp_file(package_filename)
+    writer = _PackageStreamWriter(temp_flo)
+
+    # ...........................
+    def _build():
+        try:
+            with temp_flo:
+                _package_gridset(
+                    gridset, writer, include_csv=include_csv,
+                    include_sdm=include_sdm)
+            os.replace(temp_filename, package_filename)
+        except Exception as err:
+            os.remove(temp_filename)
+            writer.finish(err=err)
+        else:
+            writer.finish()
+
+    threading.Thread(target=_build, daemon=True).start()
+    try:
+        chunk = writer.chunks.get()
+        while chunk is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+            chunk = writer.chunks.get()
+    finally:
+        writer.client_connected = False
+
+
 # .............................................................................
 def gridset_package_formatter(gridset, include_csv=True, include_sdm=True,
                               stream=False):
     """Create a Gridset download package for the user to explore locally
+
+    Args:
+        gridset (Gridset): The gridset to package.
+        include_csv (bool): Should matrix CSV files be included.
+        include_sdm (bool): Should SDM projections be included.
+        stream (bool): If True, return a generator of the package bytes.  A
+            package that is not cached yet is streamed while it is built.
     """
     # Check that it is a gridset
     if not isinstance(gridset, Gridset):
@@ -688,12 +892,12 @@ def gridset_package_formatter(gridset, include_csv=True, include_sdm=True,
 
     package_filename = gridset.get_package_location()
 
-    # Check to see if the package does not exist
-    if not os.path.exists(package_filename):
+    # Check to see if the package does not exist or is out of date
+    build_package = not _is_package_current(gridset, package_filename)
+    if build_package:
 
         # Look for makeflows
-        scribe = BorgScribe(WebLogger())
-        scribe.open_connections()
+        scribe = get_scribe()
 
         # Check progress counts
         gridset_id = gridset.get_id()
@@ -713,7 +917,6 @@ def gridset_package_formatter(gridset, include_csv=True, include_sdm=True,
         # ) = summarize_object_statuses(occ_summary)
         # (waiting_mcs, running_mcs, complete_mcs, error_mcs, total_mcs
         # ) = summarize_object_statuses(mc_summary)
-        scribe.close_connections()
 
         cnt = waiting_mfs + running_mfs
 
@@ -725,16 +928,22 @@ def gridset_package_formatter(gridset, include_csv=True, include_sdm=True,
         #            MatrixType.PAM, MatrixType.ROLLING_PAM]]):
         # Assume we will never be able to create package if makeflow errors
         # if error_mfs > 0
-        if cnt == 0:
-            # Create the package
-            _package_gridset(
-                gridset, include_csv=include_csv, include_sdm=include_sdm)
-        else:
+        if cnt > 0:
             # Not ready, so just return HTTP ACCEPTED
             cherrypy.response.status = HTTPStatus.ACCEPTED
             return None
 
-    # Package exists, return it
+    # Packages are built with their own pooled connection and can take a long
+    #    time to send, so return the request connection to the pool first
+    release_scribe()
+
+    if build_package and not stream:
+        # Create the package, streamed packages are built below
+        _build_package_file(
+            gridset, package_filename, include_csv=include_csv,
+            include_sdm=include_sdm)
+
+    # Package exists or will be streamed, return it
     keep_chars = (' ', '.', '_')
     # Sanitize the gridset name for filename construction
     sanitized_gridset_name = ''.join(
@@ -748,9 +957,13 @@ def gridset_package_formatter(gridset, include_csv=True, include_sdm=True,
     cherrypy.response.headers['Content-Type'] = LMFormat.ZIP.get_mime_type()
 
     if stream:
-        cherrypy.lib.file_generator(open(package_filename, 'rb'))
-    else:
-        with open(package_filename, 'rb') as package_file:
-            cnt = package_file.read()
-        return cnt
-    return None
+        cherrypy.response.stream = True
+        if build_package:
+            return _stream_package(
+                gridset, package_filename, include_csv=include_csv,
+                include_sdm=include_sdm)
+        return cherrypy.lib.file_generator(open(package_filename, 'rb'))
+
+    with open(package_filename, 'rb') as package_file:
+        cnt = package_file.read()
+    return cnt
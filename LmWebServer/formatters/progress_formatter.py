@@ -5,8 +5,7 @@ import json
 import cherrypy
 
 from LmCommon.common.lmconstants import JobStatus, LMFormat
-from LmServer.common.log import WebLogger
-from LmServer.db.borg_scribe import BorgScribe
+from LmWebServer.services.cp_plugins.db import get_scribe
 
 
 # .............................................................................
@@ -42,8 +41,7 @@ def format_gridset(gridset_id, detail=False):
     Args:
         gridset_id (:obj:`int`): The gridset id to get progress for
     """
-    scribe = BorgScribe(WebLogger())
-    scribe.open_connections()
+    scribe = get_scribe()
 
     message = ''
     mf_summary = scribe.summarize_mf_chains_for_gridset(gridset_id)
@@ -146,7 +144,6 @@ def format_gridset(gridset_id, detail=False):
         progress_dict = {
             'progress': progress
         }
-    scribe.close_connections()
     return progress_dict
 
 
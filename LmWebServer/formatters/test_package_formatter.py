@@ -0,0 +1,97 @@
+"""Tests for building and streaming gridset packages in package_formatter.py
+"""
+import threading
+
+import cherrypy
+from cherrypy.lib.httputil import Host
+
+from LmWebServer.formatters import package_formatter
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+NUM_STREAMS = 3
+# Seconds to wait for streams, longer than the pool timeout
+STREAM_TIMEOUT = 10
+
+
+# .............................................................................
+class _Gridset:
+    """Gridset with just the attributes used to package it"""
+    name = 'Test gridset'
+    mod_time = None
+
+    # ................................
+    def __init__(self, gridset_id, package_filename):
+        self.gridset_id = gridset_id
+        self.package_filename = package_filename
+
+    # ................................
+    def get_id(self):
+        """Returns the gridset id"""
+        return self.gridset_id
+
+    # ................................
+    def get_package_location(self):
+        """Returns the package file location"""
+        return self.package_filename
+
+
+# .............................................................................
+def _start_request(monkeypatch):
+    """Starts a new CherryPy request in this thread"""
+    monkeypatch.setattr(
+        cherrypy.serving, 'request', cherrypy._cprequest.Request(
+            Host('127.0.0.1', 80), Host('127.0.0.1', 50000)))
+    monkeypatch.setattr(
+        cherrypy.serving, 'response', cherrypy._cprequest.Response())
+
+
+# .............................................................................
+def test_streams_fill_pool(fake_db_pool, monkeypatch, tmp_path):
+    """As many packages as pool connections can be streamed at once
+
+    Streams are read after their requests return, as the server sends them,
+    so the request connection must not be held while the package is built.
+    """
+    pool = fake_db_pool(max_size=NUM_STREAMS, timeout=2)
+    # Every package is built while the others hold their connections
+    barrier = threading.Barrier(NUM_STREAMS, timeout=STREAM_TIMEOUT)
+
+    def _write_package(gridset, package_flo, scribe, include_csv=False,
+                       include_sdm=False):
+        assert scribe.is_open
+        barrier.wait()
+        package_flo.write('gridset {}'.format(gridset.get_id()).encode())
+
+    monkeypatch.setattr(package_formatter, 'Gridset', _Gridset)
+    monkeypatch.setattr(
+        package_formatter, '_write_gridset_package', _write_package)
+
+    streams = []
+    for i in range(NUM_STREAMS):
+        _start_request(monkeypatch)
+        streams.append(package_formatter.gridset_package_formatter(
+            _Gridset(i, str(tmp_path / 'gridset_{}.zip'.format(i))),
+            stream=True))
+        assert cherrypy.response.stream
+
+    packages = [None] * NUM_STREAMS
+
+    def _read_stream(i):
+        packages[i] = b''.join(streams[i])
+
+    threads = [threading.Thread(target=_read_stream, args=(i, ))
+               for i in range(NUM_STREAMS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(STREAM_TIMEOUT)
+
+    assert packages == [
+        'gridset {}'.format(i).encode() for i in range(NUM_STREAMS)]
+    for i in range(NUM_STREAMS):
+        with open(str(tmp_path / 'gridset_{}.zip'.format(i)), 'rb') as in_f:
+            assert in_f.read() == packages[i]
+    stats = pool.get_stats()
+    assert stats['opened'] == stats['idle'] == NUM_STREAMS
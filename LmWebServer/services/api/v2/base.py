@@ -5,7 +5,7 @@ import cherrypy
 from LmCommon.common.lmconstants import DEFAULT_POST_USER
 from LmServer.common.localconstants import PUBLIC_USER
 from LmServer.common.log import WebLogger
-from LmServer.db.borg_scribe import BorgScribe
+from LmWebServer.services.cp_plugins.db import get_scribe
 
 
 # .............................................................................
@@ -21,17 +21,22 @@ class LmService:
     def __init__(self):
         """Constructor
 
-        The constructor is only responsible for getting a logger, user and a
-        scribe instance for the service.  We do that here in a simple base
-        class in case we decide that we need to use a different mechanism (such
-        as a CherryPy Tool)
+        The constructor is only responsible for getting a logger for the
+        service.  Service objects are shared by all request threads, so the
+        scribe is not created here, see the `scribe` property.
         """
-        log = WebLogger()
-        # self.scribe = cherrypy.thread_data.scribeRetriever.get_scribe()
-        self.scribe = BorgScribe(log)
-        self.scribe.open_connections()
         # self.log = cherrypy.session.log
-        self.log = log
+        self.log = WebLogger()
+
+    # ..........................
+    @property
+    def scribe(self):
+        """Returns a scribe for the current request
+
+        A pooled database connection is checked out the first time this is
+        used in a request and returned when the request ends.
+        """
+        return get_scribe()
 
     # ..........................
     @staticmethod
@@ -4,11 +4,34 @@ import cherrypy
 
 from LmServer.base.atom import Atom
 from LmServer.common.lmconstants import SOLR_FIELDS
-from LmServer.common.solr import facet_archive_on_gridset, query_archive_index
-from LmServer.common.subset import subset_global_pam
+from LmServer.common.solr import (
+    facet_archive_on_gridset, iter_archive_index, query_archive_index)
+from LmServer.common.subset import SUBSET_SOLR_FIELDS, subset_global_pam
 from LmWebServer.services.api.v2.base import LmService
 from LmWebServer.services.cp_tools.lm_format import lm_formatter
 
+# Note: The Solr fields returned by a Global PAM query.  Compressed PAVs are
+#    left out, they are large and are available from the PAV data URL
+QUERY_SOLR_FIELDS = [
+    SOLR_FIELDS.ID, SOLR_FIELDS.ALGORITHM_CODE, SOLR_FIELDS.DISPLAY_NAME,
+    SOLR_FIELDS.EPSG_CODE, SOLR_FIELDS.GRIDSET_ID, SOLR_FIELDS.GRIDSET_META_URL,
+    SOLR_FIELDS.MODEL_SCENARIO_CODE, SOLR_FIELDS.MODEL_SCENARIO_ID,
+    SOLR_FIELDS.MODEL_SCENARIO_URL, SOLR_FIELDS.OCCURRENCE_DATA_URL,
+    SOLR_FIELDS.OCCURRENCE_ID, SOLR_FIELDS.OCCURRENCE_META_URL,
+    SOLR_FIELDS.OCCURRENCE_MOD_TIME, SOLR_FIELDS.PAV_DATA_URL,
+    SOLR_FIELDS.PAV_META_URL, SOLR_FIELDS.POINT_COUNT, SOLR_FIELDS.PAM_ID,
+    SOLR_FIELDS.PROJ_DATA_URL, SOLR_FIELDS.PROJ_ID, SOLR_FIELDS.PROJ_META_URL,
+    SOLR_FIELDS.PROJ_MOD_TIME, SOLR_FIELDS.PROJ_SCENARIO_CODE,
+    SOLR_FIELDS.PROJ_SCENARIO_ID, SOLR_FIELDS.PROJ_SCENARIO_URL,
+    SOLR_FIELDS.SHAPEGRID_DATA_URL, SOLR_FIELDS.SHAPEGRID_ID,
+    SOLR_FIELDS.SHAPEGRID_META_URL, SOLR_FIELDS.SQUID, SOLR_FIELDS.TAXON_CLASS,
+    SOLR_FIELDS.TAXON_FAMILY, SOLR_FIELDS.TAXON_GENUS,
+    SOLR_FIELDS.TAXON_KINGDOM, SOLR_FIELDS.TAXON_ORDER,
+    SOLR_FIELDS.TAXON_PHYLUM, SOLR_FIELDS.TAXON_SPECIES, SOLR_FIELDS.USER_ID]
+
+# Note: The default maximum number of documents returned by a Global PAM query
+QUERY_LIMIT = 100
+
 
 # .............................................................................
 @cherrypy.expose
@@ -54,7 +77,7 @@ class GlobalPAMService(LmService):
             point_min=None, url_user=None, prj_scen_code=None, squid=None,
             taxon_kingdom=None, taxon_phylum=None, taxon_class=None,
             taxon_order=None, taxon_family=None, taxon_genus=None,
-            taxon_species=None, **params):
+            taxon_species=None, limit=QUERY_LIMIT, **params):
         """Queries the Global PAM and return entries matching the parameters
         """
         return self._make_solr_query(
@@ -66,7 +89,8 @@ class GlobalPAMService(LmService):
             tax_kingdom=taxon_kingdom, tax_phylum=taxon_phylum,
             tax_class=taxon_class, tax_order=taxon_order,
             tax_family=taxon_family, tax_genus=taxon_genus,
-            tax_species=taxon_species)
+            tax_species=taxon_species, fields=QUERY_SOLR_FIELDS,
+            limit=int(limit))
 
     # ................................
     @lm_formatter
@@ -87,7 +111,8 @@ class GlobalPAMService(LmService):
             tax_kingdom=taxon_kingdom, tax_phylum=taxon_phylum,
             tax_class=taxon_class, tax_order=taxon_order,
             tax_family=taxon_family, tax_genus=taxon_genus,
-            tax_species=taxon_species)
+            tax_species=taxon_species, fields=SUBSET_SOLR_FIELDS,
+            stream=True)
         # Make bbox tuple
         if bbox:
             bbox = tuple([float(i) for i in bbox.split(',')])
@@ -107,9 +132,19 @@ class GlobalPAMService(LmService):
                          projection_scenario_code=None, squid=None,
                          tax_kingdom=None, tax_phylum=None, tax_class=None,
                          tax_order=None, tax_family=None, tax_genus=None,
-                         tax_species=None):
-        return query_archive_index(
-            algorithm_code=algorithm_code, bbox=bbox,
+                         tax_species=None, fields=None, limit=None,
+                         stream=False):
+        """Queries the Global PAM Solr index
+
+        Args:
+            fields (list) : An optional list of the document fields to return
+            limit (int) : An optional maximum number of matches to return
+            stream (bool) : If True, return a generator of the matches rather
+                than a list
+        """
+        query_func = iter_archive_index if stream else query_archive_index
+        return query_func(
+            fields=fields, limit=limit, algorithm_code=algorithm_code, bbox=bbox,
             display_name=display_name, gridset_id=gridset_id,
             model_scenario_code=model_scenario_code, point_max=point_max,
             point_min=point_min, tax_class=tax_class,
@@ -126,7 +161,7 @@ class GlobalPAMService(LmService):
 
         Args:
             archive_name (str) : The name of this new grid set
-            matches (list) : Solr hits to be used for subsetting
+            matches (iterable) : Solr hits to be used for subsetting
         """
         return subset_global_pam(
             archive_name, matches, self.get_user_id(), bbox=bbox,
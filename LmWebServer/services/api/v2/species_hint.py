@@ -3,7 +3,7 @@ import cherrypy
 
 from LmCommon.common.lmconstants import HTTPStatus
 from LmServer.common.lmconstants import SOLR_FIELDS
-from LmServer.common.solr import query_archive_index
+from LmServer.common.solr import iter_archive_index
 from LmWebServer.services.api.v2.base import LmService
 from LmWebServer.services.cp_tools.lm_format import lm_formatter
 
@@ -33,13 +33,20 @@ class SpeciesHintService(LmService):
             genus = '{}*'.format(parts[0])
             species_search = None
 
-        matches = query_archive_index(
+        limit = int(limit)
+        if limit <= 0:
+            return []
+        matches = iter_archive_index(
             tax_genus=genus.title(), tax_species=species_search,
-            user_id=self.get_user_id(url_user=url_user))
+            user_id=self.get_user_id(url_user=url_user),
+            fields=[SOLR_FIELDS.ID, SOLR_FIELDS.OCCURRENCE_ID,
+                    SOLR_FIELDS.POINT_COUNT, SOLR_FIELDS.DISPLAY_NAME,
+                    SOLR_FIELDS.TAXON_GENUS, SOLR_FIELDS.TAXON_SPECIES])
 
-        occ_ids = []
+        occ_ids = set()
         ret = []
 
+        # Stop reading matches once there are enough occurrence sets
         for match in matches:
             occ_id = match[SOLR_FIELDS.OCCURRENCE_ID]
             point_count = match[SOLR_FIELDS.POINT_COUNT]
@@ -48,11 +55,14 @@ class SpeciesHintService(LmService):
                 match[SOLR_FIELDS.TAXON_GENUS],
                 match[SOLR_FIELDS.TAXON_SPECIES])
             if occ_id not in occ_ids:
-                occ_ids.append(occ_id)
+                occ_ids.add(occ_id)
                 ret.append({
                     'binomial': binomial,
                     'name': display_name,
                     'numPoints': point_count,
                     'occurrenceSet': occ_id
                 })
-        return ret[:limit]
+                if len(ret) >= limit:
+                    break
+        matches.close()
+        return ret
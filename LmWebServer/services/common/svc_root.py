@@ -7,6 +7,7 @@ from LmWebServer.services.api.v2.v2_root import ApiRootV2
 from LmWebServer.services.common.user_services import (
     UserLogin, UserLogout, UserSignUp)
 from LmWebServer.services.cp_dispatchers.lm_dispatch import LmDispatcher
+from LmWebServer.services.cp_plugins.db import subscribe_db
 from LmWebServer.services.cp_tools.basic_auth import get_user_name
 from LmWebServer.services.cp_tools.cors import CORS
 from LmWebServer.services.cp_tools.param_caster import cast_parameters
@@ -62,6 +63,9 @@ def start_cherrypy_application(environ):
         }
     }
 
+    # Close pooled database connections when the engine stops
+    subscribe_db(cherrypy.engine)
+
     cherrypy.config.update(CHERRYPY_CONFIG_FILE)
     cherrypy.tree.mount(
         LmServiceRoot(), script_name=environ['SCRIPT_NAME'], config=app_config)
@@ -1,63 +1,66 @@
-"""This module provides hooks for CherryPy threads to DB connections
+"""This module provides per-request database connections for CherryPy
 
-The db plugin module provides a hook for CherryPy threads so that each will
-have its own database connection.
+Services get a scribe for the current request with `get_scribe`.  The first
+call in a request checks a connection out of the shared pool and attaches a
+hook that returns it when the request ends, so requests that never touch the
+database do not hold a connection.
 
 Note:
-    * This may need to evolve to be a true 'CherryPy Plugin' but we will
-        classify it as a plugin because it is attached to a thread and that
-        can / will exist for multiple requests.  Whereas a CherryPy Tool only
-        exists for one request.
-    * psycopg2 is supposed to be thread safe, so this is not really necessary
-          and we could use a tool, but this will limit the overall number of
-          connections.
+    * The connection is returned in the 'on_end_request' hook, which runs
+        after a streamed response body has been written, so generators that
+        query the database while streaming keep a valid connection.
+        Services that stream long responses without the request scribe
+        should return the connection early with `release_scribe`.
+    * Pool wait times are recorded by the pool and slow waits are logged, see
+        LmServer.base.dbpgsql.DbConnectionPool.
 """
 import cherrypy
 
+from LmCommon.common.lmconstants import HTTPStatus
+from LmServer.base.dbpgsql import close_connection_pools
+from LmServer.common.lmconstants import DbUser
 from LmServer.common.log import WebLogger
 from LmServer.db.borg_scribe import BorgScribe
 
 
 # .............................................................................
-class _ScribeRetriever:
-    """Provide a single public method for getting a scribe connection.
+def get_scribe():
+    """Returns the scribe for the current request, opening it if needed
 
-    This class provides a single public method for getting a scribe connection.
-    The purpose of this class is to handle any errors that may occur with that
-    connection between requests and get a fresh connection if necessary
-   """
-
-    # ..........................
-    def __init__(self):
-        log = WebLogger()
-        self.scribe = BorgScribe(log)
-        self.scribe.open_connections()
-
-    # ..........................
-    def get_scribe(self):
-        """Returns a log and scribe for the request
-
-        Todo:
-            * Add checks to see if the scribe exists and has an open
-                connection, if it does not, refresh and send a new one
-        """
-        return self.scribe
+    Raises:
+        cherrypy.HTTPError: If a database connection cannot be checked out.
+    """
+    scribe = getattr(cherrypy.request, 'scribe', None)
+    if scribe is None:
+        scribe = BorgScribe(WebLogger(), db_user=DbUser.Pipeline, pooled=True)
+        cherrypy.request.scribe = scribe
+        cherrypy.request.hooks.attach('on_end_request', release_scribe)
+        if not scribe.open_connections():
+            raise cherrypy.HTTPError(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                'Database connection is not available')
+    return scribe
 
 
 # .............................................................................
-def connect_db(thread_index):
-    """Sets up a database connection and logger for a thread
+def release_scribe():
+    """Returns the request scribe connection to the pool
 
-    Args:
-        thread_index: A thread index provided by CherryPy
+    Note:
+        This is safe to call more than once in a request, a later call to
+            `get_scribe` checks out a new connection.
     """
-    cherrypy.thread_data.scribeRetriever = _ScribeRetriever()
+    scribe = getattr(cherrypy.request, 'scribe', None)
+    if scribe is not None:
+        cherrypy.request.scribe = None
+        scribe.close_connections()
 
 
 # .............................................................................
-def disconnect_db(thread_index):
-    """Attempt to close a database connection on thread close
-    """
-    scribe = cherrypy.thread_data.scribeRetriever.get_scribe()
+def subscribe_db(engine):
+    """Closes pooled database connections when the engine stops
 
-    scribe.closeConnections()
+    Args:
+        engine: The CherryPy engine (cherrypy.engine).
+    """
+    engine.subscribe('stop', close_connection_pools)
@@ -61,7 +61,9 @@ def lm_formatter(f):
             try:
                 if accept_hdr == LMFormat.GEO_JSON.get_mime_type():
                     return geo_json_object_formatter(
-                        handler_result).encode(ENCODING)
+                        handler_result,
+                        compact=str(kwargs.get('compact')).lower() == 'true',
+                        stream=True)
                 # If JSON or default
                 if accept_hdr in [LMFormat.JSON.get_mime_type(), '*/*']:
                     shoot_snippets(
@@ -103,8 +105,8 @@ def lm_formatter(f):
                     csvs = True
                     sdms = True
                     return gridset_package_formatter(
-                        handler_result, include_csv=csvs, include_sdm=sdms
-                        )
+                        handler_result, include_csv=csvs, include_sdm=sdms,
+                        stream=True)
                 if accept_hdr == LMFormat.PROGRESS.get_mime_type():
                     obj_type, obj_id, detail = handler_result
                     return progress_object_formatter(
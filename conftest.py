@@ -0,0 +1,240 @@
+"""Test configuration fixtures shared by the tests next to each module
+
+Note:
+    * pytest processes this module and creates test fixtures that can then be
+        used with the tests it discovers
+    * Server modules are imported in the fixtures that use them, so tests of
+        LmCommon and LmCompute do not need the server dependencies
+"""
+import csv
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+from LmCommon.common.log import TestLogger
+
+# .............................................................................
+# .                                 Constants                                 .
+# .............................................................................
+# Fields of the occurrence data written by the occ_data fixture, records are
+#    grouped on taxonKey
+OCC_HEADER = ['id', 'taxonKey', 'name', 'lon', 'lat', 'basis']
+OCC_METADATA = {
+    'id': {'name': 'id', 'type': 'integer', 'role': 'uniqueid'},
+    'taxonKey': {'name': 'taxonkey', 'type': 'integer', 'role': 'groupby'},
+    'name': {'name': 'name', 'type': 'string', 'role': 'taxaname'},
+    'lon': {'name': 'lon', 'type': 'real', 'role': 'longitude'},
+    'lat': {'name': 'lat', 'type': 'real', 'role': 'latitude'},
+    'basis': {
+        'name': 'basis', 'type': 'string',
+        'acceptedvals': ['observation', 'specimen']}
+}
+
+
+# .............................................................................
+class FakeDbCursor:
+    """Cursor of a FakeDbConnection
+
+    Commands are recorded on the connection and answered by its `respond`
+    function.  Rows passed to `mogrify` are collected for the next command,
+    as psycopg2.extras.execute_values does for each page of values.
+    """
+
+    # ................................
+    def __init__(self, conn):
+        self.connection = conn
+        self.description = None
+        self._rows = []
+        self._values = []
+
+    # ................................
+    def mogrify(self, template, args):
+        """Collect a row of values and return it formatted as SQL"""
+        self._values.append(tuple(args))
+        return '({})'.format(', '.join(repr(arg) for arg in args)).encode()
+
+    # ................................
+    def execute(self, cmd, params=None):
+        """Record a command and get its response"""
+        if isinstance(cmd, bytes):
+            cmd = cmd.decode()
+        if params is None and self._values:
+            params = self._values
+        self._values = []
+        self.connection.commands.append((cmd, params))
+        self.connection.in_transaction = True
+        if self.connection.fail:
+            import psycopg2
+            raise psycopg2.OperationalError('Fake connection failure')
+        columns, self._rows = self.connection.respond(cmd, params)
+        self.description = None
+        if columns:
+            self.description = [(col, ) for col in columns]
+
+    # ................................
+    def fetchall(self):
+        """Returns the rows of the last command"""
+        return list(self._rows)
+
+    # ................................
+    def close(self):
+        """Closes the cursor"""
+        self.connection.cursors_closed += 1
+
+
+# .............................................................................
+class FakeDbConnection:
+    """Stand-in for an LmConnection that records the commands it is sent
+
+    Attributes:
+        respond: A function of a command and its parameters that returns a
+            list of column names and a list of rows.  By default commands
+            return nothing.
+        fail: If True, commands raise psycopg2.OperationalError.
+    """
+    encoding = 'UTF8'
+
+    # ................................
+    def __init__(self):
+        self.prepared = {}
+        self.unique_functions = {}
+        self.arg_types = {}
+        self.last_used = time.time()
+        self.closed = 0
+        self.commands = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.cursors_closed = 0
+        self.in_transaction = False
+        self.fail = False
+        self.respond = lambda cmd, params: ([], [])
+
+    # ................................
+    def cursor(self):
+        """Returns a new cursor"""
+        return FakeDbCursor(self)
+
+    # ................................
+    def get_transaction_status(self):
+        """Returns the psycopg2 transaction status of the connection"""
+        from psycopg2.extensions import (
+            TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS)
+        if self.in_transaction:
+            return TRANSACTION_STATUS_INTRANS
+        return TRANSACTION_STATUS_IDLE
+
+    # ................................
+    def commit(self):
+        """Ends the transaction"""
+        self.commits += 1
+        self.in_transaction = False
+
+    # ................................
+    def rollback(self):
+        """Ends the transaction"""
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    # ................................
+    def close(self):
+        """Closes the connection"""
+        self.closed = 1
+
+
+# .............................................................................
+@pytest.fixture
+def fake_db_pool(monkeypatch):
+    """Gets a function that creates the connection pool for every database
+
+    Connections opened by LmServer.base.dbpgsql, pooled or not, are
+    FakeDbConnection objects.  The pool created by the returned function is
+    used by every pooled database object until the test ends.
+    """
+    import psycopg2
+    from LmServer.base import dbpgsql
+
+    monkeypatch.setattr(
+        psycopg2, 'connect', lambda *args, **kwargs: FakeDbConnection())
+
+    def _make_pool(max_size=2, timeout=1.0):
+        pool = dbpgsql.DbConnectionPool(
+            TestLogger('test_db_pool'), max_size=max_size, timeout=timeout,
+            database='test')
+        monkeypatch.setattr(
+            dbpgsql, 'get_connection_pool', lambda *args, **kwargs: pool)
+        return pool
+
+    return _make_pool
+
+
+# .............................................................................
+class OccDataWriter:
+    """Writes occurrence CSV and metadata files for tests
+
+    Attributes:
+        header: The field names of the occurrence records
+        metadata: The occurrence metadata of the header fields
+        out_dir: The directory to write files to
+    """
+    header = OCC_HEADER
+    metadata = OCC_METADATA
+
+    # ................................
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+
+    # ................................
+    @staticmethod
+    def get_records(group_vals, num_records, seed=0):
+        """Gets unsorted random records with repeated group values
+
+        Args:
+            group_vals: The taxonKey values to choose from
+            num_records: The number of records to get
+            seed: The random seed, so tests get the same records every run
+        """
+        rand_state = np.random.RandomState(seed)
+        return [
+            [str(i), str(group_val), 'taxon {}'.format(group_val),
+             '{:.3f}'.format(rand_state.uniform(-180, 180)),
+             '{:.3f}'.format(rand_state.uniform(-90, 90)),
+             str(rand_state.choice(['observation', 'specimen']))]
+            for i, group_val in enumerate(
+                rand_state.choice(group_vals, size=num_records))]
+
+    # ................................
+    def write(self, basename, records, delimiter='\t', header=True):
+        """Writes records to a CSV file and the metadata to a JSON file
+
+        Args:
+            basename: The CSV file name, the metadata file has the same name
+                with a .json extension
+            records: The rows to write after the header, these may be short
+                or empty to test bad records
+            delimiter: The field delimiter of the CSV file
+            header: Should the header be the first row of the CSV file
+
+        Returns:
+            tuple - The CSV and metadata file names
+        """
+        csv_fname = os.path.join(self.out_dir, basename)
+        meta_fname = '{}.json'.format(os.path.splitext(csv_fname)[0])
+        with open(csv_fname, 'w', newline='') as out_file:
+            writer = csv.writer(
+                out_file, delimiter=delimiter, lineterminator='\n')
+            if header:
+                writer.writerow(self.header)
+            writer.writerows(records)
+        with open(meta_fname, 'w') as out_file:
+            json.dump(self.metadata, out_file)
+        return csv_fname, meta_fname
+
+
+# .............................................................................
+@pytest.fixture
+def occ_data(tmp_path):
+    """Gets an OccDataWriter for the temporary directory of a test"""
+    return OccDataWriter(str(tmp_path))